@@ -0,0 +1,134 @@
+from __future__ import print_function
+
+"""
+Measure how long it takes to upload one large local file with convergent
+encryption to an in-process grid of ten storage servers, and how much of
+that is spent hashing the file to derive its encryption key.
+
+Run it with the file size in MiB (1024 by default; 10240 for a 10 GB file):
+
+python bench_convergent_upload.py [SIZE_MIB]
+
+The file is written to a temporary directory, which must have room for it
+and for the shares of one upload of it (about four times its size).
+
+It is hashed twice: reading it in 64 KiB blocks on the calling thread, as
+uploads used to, and the way FileName now does it, mapped into memory in a
+worker thread. It is then uploaded three times: once with the old hashing
+restored, once as it is now, and once with the known_keys the second
+upload returned, as a caller which can vouch that the file has not changed
+would, which skips hashing altogether. Each upload goes to a new grid, so
+that none of its shares are already on the servers, and the time to set
+that up is included.
+
+Expect the hashing itself to take about the same time either way, since it
+is bound by reading the file and by SHA-256, which cannot be split across
+threads. What the worker thread buys is a reactor which is free for other
+work meanwhile; only known_keys saves the first of the two reads of the file.
+If the file fits in the page cache, the second read is cheap anyway.
+"""
+
+import os, shutil, sys, tempfile, time
+
+from twisted.internet import defer, task, threads
+
+from allmydata.immutable import upload
+from allmydata.util.hashutil import convergence_hasher
+from allmydata.test.common import SameProcessStreamEndpointAssigner
+from allmydata.test.no_network import NoNetworkGrid
+
+MiB = 1024 * 1024
+
+
+def hash_blocks(hasher, f, size, progress):
+    # the way FileHandle hashed files before: 64 KiB reads, in-line
+    f.seek(0)
+    while True:
+        data = f.read(64 * 1024)
+        if not data:
+            break
+        hasher.update(data)
+    f.seek(0)
+
+
+def write_file(fn, size):
+    with open(fn, "wb") as f:
+        chunk = os.urandom(MiB)
+        for i in range(0, size, MiB):
+            f.write(chunk[:size - i])
+
+
+def timed(what, size, start):
+    elapsed = time.time() - start
+    print("%-28s %8.1fs %8.1f MB/s" % (what, elapsed, size / elapsed / 1e6))
+    sys.stdout.flush()
+
+
+@defer.inlineCallbacks
+def upload_to_new_grid(basedir, u):
+    # a new grid each time, so that none of the shares are already there
+    port_assigner = SameProcessStreamEndpointAssigner()
+    port_assigner.setUp()
+    grid = NoNetworkGrid(basedir, num_clients=1, num_servers=10,
+                         client_config_hooks={}, port_assigner=port_assigner)
+    grid.startService()
+    try:
+        grid._check_clients()
+        yield grid.clients[0].upload(u)
+    finally:
+        yield grid.stopService()
+        port_assigner.tearDown()
+        shutil.rmtree(basedir)
+
+
+@defer.inlineCallbacks
+def bench(reactor, size):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fn = os.path.join(tmpdir, "file")
+        write_file(fn, size)
+        grid = os.path.join(tmpdir, "grid")
+        convergence = b"secret"
+
+        with open(fn, "rb") as f:
+            start = time.time()
+            hash_blocks(convergence_hasher(3, 10, 128 * 1024, convergence),
+                        f, size, None)
+            timed("hash, 64 KiB reads", size, start)
+            start = time.time()
+            yield threads.deferToThread(
+                upload._hash_filehandle,
+                convergence_hasher(3, 10, 128 * 1024, convergence), f, size,
+                lambda bytes_read: None)
+            timed("hash, mapped, in a thread", size, start)
+
+        original = upload._hash_filehandle
+        upload._hash_filehandle = hash_blocks
+        try:
+            u = upload.FileName(fn, convergence)
+            u.THREADED_HASH_SIZE = size + 1
+            start = time.time()
+            yield upload_to_new_grid(grid, u)
+            timed("upload, before", size, start)
+        finally:
+            upload._hash_filehandle = original
+
+        u = upload.FileName(fn, convergence)
+        start = time.time()
+        yield upload_to_new_grid(grid, u)
+        timed("upload, after", size, start)
+
+        u = upload.FileName(fn, convergence, known_keys=u.get_known_keys())
+        start = time.time()
+        yield upload_to_new_grid(grid, u)
+        timed("upload, with known_keys", size, start)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def main():
+    size = int(sys.argv[1] if len(sys.argv) > 1 else 1024) * MiB
+    task.react(bench, [size])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+from __future__ import print_function
+
+"""
+Measure the throughput of uploading one large immutable file to an
+in-process grid of ten storage servers, for a range of encoder pipeline
+depths.
+
+Run it with the file size in MiB (64 by default), and the largest pipeline
+depth to try (the number of CPU cores by default):
+
+python bench_encode_pipeline.py [SIZE_MIB [MAX_DEPTH]]
+
+The file is uploaded with pipeline depths from 1 (one segment at a time,
+the default) up to the largest, doubling each time, each time with a fresh
+encryption key so that none of its shares are already on the servers. With
+a depth of more than one, the erasure coding and block hashing of the
+segments after the one being sent run in the reactor's thread pool, so the
+speedup is bounded by how much of the upload is spent in them rather than
+in encryption, hash trees, and the servers, all of which stay on the
+reactor thread. The servers write to local disk, so this includes the cost of
+storing the shares but not of a network.
+"""
+
+import multiprocessing, os, shutil, sys, tempfile, time
+
+from twisted.internet import defer, task
+
+from allmydata.immutable import upload
+from allmydata.test.common import SameProcessStreamEndpointAssigner
+from allmydata.test.no_network import NoNetworkGrid
+
+MiB = 1024 * 1024
+
+
+def depths(max_depth):
+    result = [1]
+    while result[-1] * 2 <= max_depth:
+        result.append(result[-1] * 2)
+    if result[-1] != max_depth:
+        result.append(max_depth)
+    return result
+
+
+@defer.inlineCallbacks
+def bench(reactor, size, max_depth):
+    tmpdir = tempfile.mkdtemp()
+    port_assigner = SameProcessStreamEndpointAssigner()
+    port_assigner.setUp()
+    grid = NoNetworkGrid(os.path.join(tmpdir, "grid"), num_clients=1,
+                         num_servers=10, client_config_hooks={},
+                         port_assigner=port_assigner)
+    grid.startService()
+    try:
+        grid._check_clients()
+        client = grid.clients[0]
+        uploader = client.getServiceNamed("uploader")
+        reactor.suggestThreadPoolSize(max_depth)
+        data = os.urandom(size)
+        for depth in depths(max_depth):
+            uploader._pipeline_depth = depth
+            start = time.time()
+            # no convergence secret, so each upload gets a new key
+            yield client.upload(upload.Data(data, None))
+            elapsed = time.time() - start
+            print("depth %2d  %8.1f MB/s" % (depth, size / elapsed / 1e6))
+            sys.stdout.flush()
+    finally:
+        yield grid.stopService()
+        port_assigner.tearDown()
+        shutil.rmtree(tmpdir)
+
+
+def main():
+    size = int(sys.argv[1] if len(sys.argv) > 1 else 64) * MiB
+    if len(sys.argv) > 2:
+        max_depth = int(sys.argv[2])
+    else:
+        max_depth = multiprocessing.cpu_count()
+    task.react(bench, [size, max_depth])
+
+if __name__ == "__main__":
+    main()
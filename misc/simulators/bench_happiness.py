@@ -0,0 +1,190 @@
+from __future__ import print_function
+
+"""
+Measure how long servers-of-happiness takes to compute for N=10, 30 and 100
+shares over 10 to 300 servers, with Hopcroft-Karp (allmydata.util.bipartite)
+and with the Edmonds-Karp max-flow it replaced.
+
+python bench_happiness.py [SEED]
+
+'happiness' is servers_of_happiness() on a layout where every share is on
+one server and one share in three is also on a second, as the uploader
+computes after each round of server selection and as the checker computes
+for every file. 'placement' is share_placement() with a third of the
+servers read-only and already holding a share, as PeerSelector computes
+once per round. 'lose one' is working out the happiness again after one of
+the servers fails during an upload: the encoder now tells the matching it
+already had rather than starting over. Times are in milliseconds.
+"""
+
+import random, sys, time
+from collections import deque
+
+from allmydata.immutable import happiness_upload
+from allmydata.util import happinessutil
+
+SHARES = [10, 30, 100]
+SERVERS = [10, 30, 100, 300]
+
+
+def residual_network(graph, flow):
+    # the edges which can still carry flow, in either direction
+    residual_graph = [[] for u in range(len(graph))]
+    for u in range(len(graph)):
+        for v in graph[u]:
+            if flow[u][v] == 1:
+                residual_graph[v].append(u)
+            else:
+                residual_graph[u].append(v)
+    return residual_graph
+
+
+def augmenting_path_for(residual_graph):
+    # a shortest path from the source (0) to the sink (the last vertex), as
+    # a list of edges, or None
+    sink = len(residual_graph) - 1
+    predecessor = {0: None}
+    queue = deque([0])
+    while queue:
+        u = queue.popleft()
+        for v in residual_graph[u]:
+            if v not in predecessor:
+                predecessor[v] = u
+                queue.append(v)
+    if sink not in predecessor:
+        return None
+    path = []
+    v = sink
+    while v != 0:
+        path.insert(0, (predecessor[v], v))
+        v = predecessor[v]
+    return path
+
+
+def edmonds_karp(graph):
+    # the maximum flow, found the way it used to be
+    dim = len(graph)
+    flow = [[0 for v in range(dim)] for u in range(dim)]
+    path = augmenting_path_for(residual_network(graph, flow))
+    while path:
+        for (u, v) in path:
+            flow[u][v] += 1
+            flow[v][u] -= 1
+        path = augmenting_path_for(residual_network(graph, flow))
+    return flow
+
+
+def old_servers_of_happiness(sharemap):
+    servermap = happinessutil.shares_by_server(sharemap)
+    peers = list(servermap)
+    shares = list(sharemap)
+    peer_to_index, _ = happiness_upload._reindex(peers, 1)
+    share_to_index, _ = happiness_upload._reindex(shares, len(peers) + 1)
+    graph = [[peer_to_index[peer] for peer in peers]]
+    for peer in peers:
+        graph.append([share_to_index[share] for share in servermap[peer]])
+    for share in shares:
+        graph.append([len(peers) + len(shares) + 1])
+    graph.append([])
+    return sum(edmonds_karp(graph)[0])
+
+
+def old_compute_maximum_graph(graph, shareIndices):
+    if graph == []:
+        return {}
+    flow = edmonds_karp(graph)
+    new_mappings = {}
+    for shareIndex in shareIndices:
+        peers = [peer for peer in graph[0] if flow[peer][shareIndex] == 1]
+        new_mappings[shareIndex] = peers[0] if peers else None
+    return new_mappings
+
+
+def make_sharemap(r, shares, servers):
+    serverids = ["server%d" % i for i in range(servers)]
+    sharemap = {}
+    for share in range(shares):
+        sharemap[share] = set([serverids[share % servers]])
+        if share % 3 == 0:
+            sharemap[share].add(r.choice(serverids))
+    return sharemap
+
+
+def make_placement(r, shares, servers):
+    peers = set("server%d" % i for i in range(servers))
+    readonly = set(r.sample(sorted(peers), servers // 3))
+    peers_to_shares = dict((peer, set([r.randrange(shares)]))
+                           for peer in readonly)
+    return (peers, readonly, set(range(shares)), peers_to_shares)
+
+
+def lose_one_new(sharemap, peer, shares):
+    matching = happinessutil.happiness_matching(sharemap)
+    start = time.time()
+    for share in shares:
+        matching.remove_edge(peer, share)
+    return len(matching), time.time() - start
+
+
+def lose_one_old(sharemap, peer, shares):
+    start = time.time()
+    for share in shares:
+        sharemap[share].discard(peer)
+        if not sharemap[share]:
+            del sharemap[share]
+        happiness = old_servers_of_happiness(sharemap)
+    return happiness, time.time() - start
+
+
+def timed(f, *args):
+    # repeat cheap calls until they have taken a measurable time
+    calls = 0
+    start = time.time()
+    while True:
+        result = f(*args)
+        calls += 1
+        elapsed = time.time() - start
+        if elapsed > 0.2:
+            return result, elapsed / calls * 1000
+
+
+def main():
+    seed = int(sys.argv[1] if len(sys.argv) > 1 else 0)
+    print("%6s %7s  %19s  %19s  %19s" % ("", "", "happiness",
+                                        "placement", "lose one"))
+    print("%6s %7s  %9s %9s  %9s %9s  %9s %9s"
+          % ("shares", "servers", "old", "new", "old", "new", "old", "new"))
+    for shares in SHARES:
+        for servers in SERVERS:
+            r = random.Random(seed)
+            sharemap = make_sharemap(r, shares, servers)
+            old, old_ms = timed(old_servers_of_happiness, sharemap)
+            new, new_ms = timed(happinessutil.servers_of_happiness, sharemap)
+            assert old == new, (old, new)
+            results = [old_ms, new_ms]
+
+            placement = make_placement(r, shares, servers)
+            compute_maximum_graph = happiness_upload._compute_maximum_graph
+            happiness_upload._compute_maximum_graph = old_compute_maximum_graph
+            try:
+                old, old_ms = timed(happiness_upload.share_placement, *placement)
+            finally:
+                happiness_upload._compute_maximum_graph = compute_maximum_graph
+            new, new_ms = timed(happiness_upload.share_placement, *placement)
+            assert (happiness_upload.calculate_happiness(old) ==
+                    happiness_upload.calculate_happiness(new))
+            results += [old_ms, new_ms]
+
+            peer = "server0"
+            lost = [share for share in sharemap if peer in sharemap[share]]
+            new, new_s = lose_one_new(sharemap, peer, lost)
+            old, old_s = lose_one_old(sharemap, peer, lost)
+            assert old == new, (old, new)
+            results += [old_s * 1000, new_s * 1000]
+
+            print("%6d %7d  %9.2f %9.2f  %9.2f %9.2f  %9.2f %9.2f"
+                  % tuple([shares, servers] + results))
+            sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+from __future__ import print_function
+
+"""
+Measure how long StorageFarmBroker.get_servers_for_psi() takes for grids of
+10, 100, 1000 and 5000 connected servers, compared with sorting them all as
+it used to.
+
+python bench_permuted_servers.py [CALLS]
+
+Each case is timed over CALLS calls (1000 by default), each with a
+different peer selection index. 'first 20' takes the 2N servers an upload
+with N=10 asks, and 'all' reads the whole permuted list, as mutable file
+operations do.
+"""
+
+import os, sys, time
+
+from allmydata.storage_client import StorageFarmBroker
+from allmydata.util import base32
+from allmydata.util.hashutil import permute_server_hash
+from allmydata.test.common import EMPTY_CLIENT_CONFIG
+
+SIZES = [10, 100, 1000, 5000]
+
+
+def make_broker(count):
+    broker = StorageFarmBroker(True, None, EMPTY_CLIENT_CONFIG)
+    for i in range(count):
+        ann = {"anonymous-storage-FURL": b"pb://abcde@nowhere/fake",
+               "permutation-seed-base32": base32.b2a(os.urandom(20))}
+        broker.test_add_rref(b"%d" % i, "rref", ann)
+    return broker
+
+
+def sort_all(broker, psi):
+    # get_servers_for_psi() as it was before the permuted ring
+    connected_servers = broker.get_connected_servers()
+    preferred_servers = frozenset(s for s in connected_servers
+                                  if s.get_longname() in broker.preferred_peers)
+    def _permuted(server):
+        seed = server.get_permutation_seed()
+        is_unpreferred = server not in preferred_servers
+        return (is_unpreferred, permute_server_hash(psi, seed))
+    return sorted(connected_servers, key=_permuted)
+
+
+def timed(f, psis):
+    start = time.time()
+    for psi in psis:
+        f(psi)
+    return (time.time() - start) / len(psis) * 1e6
+
+
+def main():
+    calls = int(sys.argv[1] if len(sys.argv) > 1 else 1000)
+    psis = [os.urandom(16) for i in range(calls)]
+    print("%7s  %22s  %22s" % ("", "first 20 (us/call)", "all (us/call)"))
+    print("%7s  %10s  %10s  %10s  %10s"
+          % ("servers", "sort", "ring", "sort", "ring"))
+    for size in SIZES:
+        broker = make_broker(size)
+        results = [
+            timed(lambda psi: sort_all(broker, psi)[:20], psis),
+            timed(lambda psi: broker.get_servers_for_psi(psi)[:20], psis),
+            timed(lambda psi: list(sort_all(broker, psi)), psis),
+            timed(lambda psi: list(broker.get_servers_for_psi(psi)), psis),
+        ]
+        print("%7d  %10.1f  %10.1f  %10.1f  %10.1f" % tuple([size] + results))
+        sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
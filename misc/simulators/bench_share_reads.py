@@ -0,0 +1,98 @@
+from __future__ import print_function
+
+"""
+Measure the cost of the small reads a downloader makes against an immutable
+share, with and without the storage server's file-descriptor cache.
+
+Run it with no arguments:
+
+python bench_share_reads.py
+
+For each mode it reports the wall-clock latency per BucketReader.remote_read
+call, how many files were opened per read, and (on Linux, where
+/proc/self/io is available) how many read-type system calls were made per
+read.
+"""
+
+import os, shutil, tempfile, time
+
+from allmydata.storage import immutable
+from allmydata.storage.server import StorageServer
+from allmydata.test.common_py3 import FakeCanary
+
+SHARE_SIZE = 1000000
+READ_SIZE = 4096
+READS = 20000
+
+
+def read_syscalls():
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("syscr:"):
+                    return int(line.split()[1])
+    except EnvironmentError:
+        pass
+    return None
+
+
+class CountingOpen(object):
+    def __init__(self, real_open):
+        self.opens = 0
+        self._open = real_open
+    def __call__(self, *args, **kwargs):
+        self.opens += 1
+        return self._open(*args, **kwargs)
+
+
+def bench(basedir, fd_cache_size):
+    ss = StorageServer(basedir, b"\x00" * 20, fd_cache_size=fd_cache_size)
+    already, writers = ss.remote_allocate_buckets(
+        b"si1", b"r" * 32, b"c" * 32, [0], SHARE_SIZE, FakeCanary())
+    writers[0].remote_write(0, os.urandom(SHARE_SIZE))
+    writers[0].remote_close()
+    reader = ss.remote_get_buckets(b"si1")[0]
+
+    # ShareFile opens files with the builtin open(), the descriptor cache
+    # with os.open()
+    module_open = vars(immutable).get("open")
+    counting_open = CountingOpen(os.open)
+    os.open = counting_open
+    immutable.open = CountingOpen(module_open or open)
+    try:
+        syscr = read_syscalls()
+        start = time.time()
+        offset = 0
+        for i in range(READS):
+            reader.remote_read(offset, READ_SIZE)
+            offset = (offset + 7 * READ_SIZE) % (SHARE_SIZE - READ_SIZE)
+        elapsed = time.time() - start
+        syscr_after = read_syscalls()
+        opens = counting_open.opens + immutable.open.opens
+    finally:
+        os.open = counting_open._open
+        if module_open is None:
+            del immutable.open
+        else:
+            immutable.open = module_open
+    ss.stopService()
+
+    print("fd_cache.size=%-4d %7.2fus/read  %.2f opens/read" %
+          (fd_cache_size, 1e6 * elapsed / READS, opens / float(READS)),
+          end="")
+    if syscr is not None:
+        print("  %.2f read syscalls/read" %
+              ((syscr_after - syscr) / float(READS)), end="")
+    print()
+
+
+def main():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for size in (0, 1000):
+            bench(os.path.join(tmpdir, "storage-%d" % size), size)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+from __future__ import print_function
+
+"""
+Measure the throughput of streaming one large immutable share through the
+storage server's read path, reading it from the file each time, through
+the file-descriptor cache, and through a memory mapping.
+
+Run it with the share size in MiB (2048 by default):
+
+python bench_share_streaming.py [SIZE_MIB]
+
+The share is written once, then each mode is run in a fresh process which
+reads the whole share with BucketReader.remote_read in downloader-sized
+blocks. For each mode it reports MB/s and the process's peak resident set
+size. The share will usually be in the page cache by the time it is read,
+so this measures the cost of the read path rather than of the disk. Pages
+of a mapped file count towards the resident set size while they are mapped,
+but they are shared with the page cache and can be dropped by the kernel at
+any time.
+"""
+
+import os, resource, shutil, subprocess, sys, tempfile, time
+
+from allmydata.storage.server import StorageServer
+from allmydata.test.common_py3 import FakeCanary
+
+MiB = 1024 * 1024
+READ_SIZE = 128 * 1024
+MODES = {"read": {},
+         "fd_cache": {"fd_cache_size": 10},
+         "mmap": {"mmap_cache_size": 10},
+         }
+
+
+def write_share(basedir, size):
+    ss = StorageServer(basedir, b"\x00" * 20)
+    already, writers = ss.remote_allocate_buckets(
+        b"si1", b"r" * 32, b"c" * 32, [0], size, FakeCanary())
+    block = os.urandom(MiB)
+    for offset in range(0, size, MiB):
+        writers[0].remote_write(offset, block[:size - offset])
+    writers[0].remote_close()
+
+
+def peak_rss_mb():
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return maxrss / float(MiB) # bytes
+    return maxrss / 1024.0 # kilobytes
+
+
+def bench(basedir, mode, size):
+    ss = StorageServer(basedir, b"\x00" * 20, **MODES[mode])
+    reader = ss.remote_get_buckets(b"si1")[0]
+    start = time.time()
+    for offset in range(0, size, READ_SIZE):
+        reader.remote_read(offset, READ_SIZE)
+    elapsed = time.time() - start
+    ss.stopService()
+    print("%-8s %8.1f MB/s  peak RSS %7.1f MiB" %
+          (mode, size / elapsed / 1e6, peak_rss_mb()))
+
+
+def main():
+    if len(sys.argv) == 4:
+        # a child process, running one mode
+        bench(sys.argv[1], sys.argv[2], int(sys.argv[3]))
+        return
+    size = int(sys.argv[1] if len(sys.argv) > 1 else 2048) * MiB
+    tmpdir = tempfile.mkdtemp()
+    try:
+        basedir = os.path.join(tmpdir, "storage")
+        write_share(basedir, size)
+        for mode in sorted(MODES):
+            sys.stdout.flush()
+            subprocess.check_call([sys.executable, __file__, basedir, mode,
+                                   str(size)])
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+from __future__ import print_function
+
+"""
+Measure how many small files per second can be uploaded to an in-process
+grid of ten storage servers, one at a time with Uploader.upload() and in a
+batch with Uploader.upload_many().
+
+Run it with the number of files (1000 by default), their size in bytes
+(1000 by default, which is too big to be a literal file), and the round
+trip time to add to every call to a server, in milliseconds (0 by default):
+
+python bench_upload_many.py [FILES [SIZE [RTT_MS]]]
+
+The in-process servers answer at once, so without an added round trip time
+this mostly measures the CPU cost of each upload. With one, it shows how
+much of uploading small files one by one is spent waiting for servers.
+"""
+
+import os, shutil, sys, tempfile, time
+
+from twisted.internet import defer, task
+
+from allmydata.immutable import upload
+from allmydata.test import no_network
+from allmydata.test.common import SameProcessStreamEndpointAssigner
+
+
+@defer.inlineCallbacks
+def bench(reactor, count, size, rtt):
+    if rtt:
+        no_network.fireEventually = lambda: task.deferLater(reactor, rtt,
+                                                            lambda: None)
+    tmpdir = tempfile.mkdtemp()
+    port_assigner = SameProcessStreamEndpointAssigner()
+    port_assigner.setUp()
+    grid = no_network.NoNetworkGrid(os.path.join(tmpdir, "grid"),
+                                    num_clients=1, num_servers=10,
+                                    client_config_hooks={},
+                                    port_assigner=port_assigner)
+    grid.startService()
+    try:
+        grid._check_clients()
+        uploader = grid.clients[0].getServiceNamed("uploader")
+
+        # no convergence secret, so each upload gets a new key
+        datas = [os.urandom(size) for i in range(count)]
+        start = time.time()
+        for data in datas:
+            yield uploader.upload(upload.Data(data, None))
+        elapsed = time.time() - start
+        print("upload()       %8.1f files/s" % (count / elapsed,))
+        sys.stdout.flush()
+
+        start = time.time()
+        results = yield uploader.upload_many([upload.Data(data, None)
+                                              for data in datas])
+        elapsed = time.time() - start
+        for (success, result) in results:
+            if not success:
+                result.raiseException()
+        print("upload_many()  %8.1f files/s" % (count / elapsed,))
+    finally:
+        yield grid.stopService()
+        port_assigner.tearDown()
+        shutil.rmtree(tmpdir)
+
+
+def main():
+    count = int(sys.argv[1] if len(sys.argv) > 1 else 1000)
+    size = int(sys.argv[2] if len(sys.argv) > 2 else 1000)
+    rtt = float(sys.argv[3] if len(sys.argv) > 3 else 0) / 1000
+    task.react(bench, [count, size, rtt])
+
+if __name__ == "__main__":
+    main()
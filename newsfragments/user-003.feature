@@ -0,0 +1 @@
+Storage servers now offer a ``readv`` method on immutable buckets, which reads several ranges of a share in one request, and downloaders use it when it is announced.
@@ -0,0 +1 @@
+Storage servers now offer an ``add_leases`` method which adds or renews leases on many storage indexes in one request, and deep-check with ``--add-lease`` uses it when it is announced.
@@ -0,0 +1 @@
+The storage server now keeps running counts of its buckets, shares and share bytes instead of counting them with a crawler, and reports them in the ``storage_server.share_counts.*`` statistics.
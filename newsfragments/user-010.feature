@@ -0,0 +1 @@
+The storage server now asks the operating system for free disk space at most once every few seconds, and reports the cached value in the ``storage_server.space.*`` statistics.
@@ -0,0 +1 @@
+Latencies are now kept in mergeable histograms, which the stats dictionary reports under a new ``histograms`` key, instead of in lists of recent samples.
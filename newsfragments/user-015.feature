@@ -0,0 +1 @@
+Storage servers now offer a ``hash_blocks`` method on immutable buckets, and verifiers use it instead of downloading every block when ``[client]verify.trust_server_hashes`` is set.
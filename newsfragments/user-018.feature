@@ -0,0 +1 @@
+The storage server now records corruption reports in a database, lists the reported shares on its status page, and quarantines immutable shares which fail a check, or which ``[storage]corruption.quarantine_threshold`` reports have been made against.
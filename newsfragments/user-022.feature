@@ -0,0 +1 @@
+Convergent uploads of files now hash the file in a thread, and can be given the keys of an earlier upload of the same file to avoid hashing it again.
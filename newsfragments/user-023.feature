@@ -0,0 +1 @@
+Uploaders can upload many small files with one round of share queries, with the new ``upload_many`` method, using the new ``get_share_numbers`` storage server method when it is announced.
@@ -26,6 +26,8 @@ import allmydata
 from allmydata.crypto import rsa, ed25519
 from allmydata.crypto.util import remove_prefix
 from allmydata.storage.server import StorageServer
+from allmydata.storage.durability import DURABILITY_POLICIES
+from allmydata.storage.scheduler import PRIORITY_CLASSES
 from allmydata import storage_client
 from allmydata.immutable.upload import Uploader
 from allmydata.immutable.offloaded import Helper
@@ -87,6 +89,8 @@ _client_config = configutil.ValidConfiguration(
             "shares.total",
             "stats_gatherer.furl",
             "storage.plugins",
+            "upload.pipeline_depth",
+            "verify.trust_server_hashes",
         ),
         "ftpd": (
             "accounts.file",
@@ -98,6 +102,10 @@ _client_config = configutil.ValidConfiguration(
             "debug_discard",
             "enabled",
             "anonymous",
+            "corruption.quarantine_threshold",
+            "disk_io.threads",
+            "durability",
+            "durability.group_interval",
             "expire.cutoff_date",
             "expire.enabled",
             "expire.immutable",
@@ -105,8 +113,23 @@ _client_config = configutil.ValidConfiguration(
             "expire.mode",
             "expire.mutable",
             "expire.override_lease_duration",
+            "fd_cache.size",
+            "lease_checker.threads",
+            "lease_db.enabled",
+            "mmap_cache.min_share_size",
+            "mmap_cache.size",
+            "packed_shares.enabled",
+            "packed_shares.max_size",
             "readonly",
             "reserved_space",
+            "scheduler.lease.bandwidth",
+            "scheduler.max_active_requests",
+            "scheduler.max_queued_requests_per_client",
+            "scheduler.max_queued_unidentified_requests",
+            "scheduler.read.bandwidth",
+            "scheduler.verify.bandwidth",
+            "scheduler.write.bandwidth",
+            "share_index.enabled",
             "storage_dir",
             "plugins",
         ),
@@ -843,6 +866,49 @@ class _Client(node.Node, pollmixin.PollMixin):
             sharetypes.append("mutable")
         expiration_sharetypes = tuple(sharetypes)
 
+        share_index = self.config.get_config("storage", "share_index.enabled",
+                                             False, boolean=True)
+        fd_cache_size = int(self.config.get_config("storage", "fd_cache.size",
+                                                   "0"))
+        mmap_cache_size = int(self.config.get_config("storage",
+                                                     "mmap_cache.size", "0"))
+        mmap_min_share_size = parse_abbreviated_size(
+            self.config.get_config("storage", "mmap_cache.min_share_size",
+                                   "1MiB"))
+        lease_db = self.config.get_config("storage", "lease_db.enabled",
+                                          False, boolean=True)
+        disk_io_threads = int(self.config.get_config("storage",
+                                                     "disk_io.threads", "0"))
+        corruption_quarantine_threshold = int(self.config.get_config(
+            "storage", "corruption.quarantine_threshold", "0"))
+        durability = self.config.get_config("storage", "durability", "none")
+        if durability not in DURABILITY_POLICIES:
+            raise ValueError("config error: [storage]durability= must be "
+                             "one of %s, not %r"
+                             % (", ".join(DURABILITY_POLICIES), durability))
+        durability_group_interval = float(self.config.get_config(
+            "storage", "durability.group_interval", "0.01"))
+        lease_checker_threads = int(self.config.get_config(
+            "storage", "lease_checker.threads", "0"))
+        packed_shares = self.config.get_config("storage",
+                                               "packed_shares.enabled",
+                                               False, boolean=True)
+        packed_share_max_size = parse_abbreviated_size(
+            self.config.get_config("storage", "packed_shares.max_size",
+                                   "64KiB"))
+        max_active_requests = int(self.config.get_config(
+            "storage", "scheduler.max_active_requests", "0"))
+        max_queued_requests_per_client = int(self.config.get_config(
+            "storage", "scheduler.max_queued_requests_per_client", "1000"))
+        max_queued_unidentified_requests = int(self.config.get_config(
+            "storage", "scheduler.max_queued_unidentified_requests", "10000"))
+        request_bandwidth = {}
+        for request_class in PRIORITY_CLASSES:
+            bandwidth = parse_abbreviated_size(self.config.get_config(
+                "storage", "scheduler.%s.bandwidth" % (request_class,), None))
+            if bandwidth:
+                request_bandwidth[request_class] = bandwidth
+
         ss = StorageServer(storedir, self.nodeid,
                            reserved_space=reserved,
                            discard_storage=discard,
@@ -852,7 +918,26 @@ class _Client(node.Node, pollmixin.PollMixin):
                            expiration_mode=mode,
                            expiration_override_lease_duration=o_l_d,
                            expiration_cutoff_date=cutoff_date,
-                           expiration_sharetypes=expiration_sharetypes)
+                           expiration_sharetypes=expiration_sharetypes,
+                           share_index_enabled=share_index,
+                           fd_cache_size=fd_cache_size,
+                           mmap_cache_size=mmap_cache_size,
+                           mmap_min_share_size=mmap_min_share_size,
+                           lease_db_enabled=lease_db,
+                           disk_io_threads=disk_io_threads,
+                           durability=durability,
+                           durability_group_interval=durability_group_interval,
+                           corruption_quarantine_threshold=
+                               corruption_quarantine_threshold,
+                           lease_checker_threads=lease_checker_threads,
+                           packed_shares_enabled=packed_shares,
+                           packed_share_max_size=packed_share_max_size,
+                           max_active_requests=max_active_requests,
+                           max_queued_requests_per_client=
+                               max_queued_requests_per_client,
+                           max_queued_unidentified_requests=
+                               max_queued_unidentified_requests,
+                           request_bandwidth=request_bandwidth)
         ss.setServiceParent(self)
         return ss
 
@@ -891,6 +976,9 @@ class _Client(node.Node, pollmixin.PollMixin):
 
         for ic in self.introducer_clients:
             ic.publish("storage", announcement, self._node_private_key)
+        self.log(format="storage announced %(elapsed).3fs after startup",
+                 elapsed=time.time() - self.started_timestamp,
+                 umid="b3k0Ug")
 
     def get_client_storage_plugin_web_resources(self):
         """
@@ -946,10 +1034,17 @@ class _Client(node.Node, pollmixin.PollMixin):
         self.history = History(self.stats_provider)
         self.terminator = Terminator()
         self.terminator.setServiceParent(self)
+        pipeline_depth = int(self.config.get_config("client",
+                                                    "upload.pipeline_depth",
+                                                    "1"))
+        if pipeline_depth < 1:
+            raise ValueError("config error: [client]upload.pipeline_depth= "
+                             "must be at least 1")
         uploader = Uploader(
             helper_furl,
             self.stats_provider,
             self.history,
+            pipeline_depth=pipeline_depth,
         )
         uploader.setServiceParent(self)
         self.init_blacklist()
@@ -1004,6 +1099,8 @@ class _Client(node.Node, pollmixin.PollMixin):
             self.mutable_file_default = MDMF_VERSION
         else:
             self.mutable_file_default = SDMF_VERSION
+        trust_server_hashes = self.config.get_config(
+            "client", "verify.trust_server_hashes", False, boolean=True)
         self.nodemaker = NodeMaker(self.storage_broker,
                                    self._secret_holder,
                                    self.get_history(),
@@ -1012,7 +1109,8 @@ class _Client(node.Node, pollmixin.PollMixin):
                                    self.get_encoding_parameters(),
                                    self.mutable_file_default,
                                    self._key_generator,
-                                   self.blacklist)
+                                   self.blacklist,
+                                   trust_server_hashes)
 
     def get_history(self):
         return self.history
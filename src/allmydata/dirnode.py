@@ -5,7 +5,7 @@ import time
 
 from zope.interface import implementer
 from twisted.internet import defer
-from foolscap.api import fireEventually
+from foolscap.api import fireEventually, DeadReferenceError
 import json
 
 from allmydata.crypto import aes
@@ -15,7 +15,8 @@ from allmydata.mutable.filenode import MutableFileNode
 from allmydata.unknown import UnknownNode, strip_prefix_for_ro
 from allmydata.interfaces import IFilesystemNode, IDirectoryNode, IFileNode, \
      ExistingChildError, NoSuchChildError, ICheckable, IDeepCheckable, \
-     MustBeDeepImmutableError, CapConstraintError, ChildOfWrongTypeError
+     MustBeDeepImmutableError, CapConstraintError, ChildOfWrongTypeError, \
+     MAX_BULK_LEASES
 from allmydata.check_results import DeepCheckResults, \
      DeepCheckAndRepairResults
 from allmydata.monitor import Monitor
@@ -875,28 +876,110 @@ class DeepChecker(object):
         else:
             self._results = DeepCheckResults(root_si)
         self._stats = DeepStats(root)
+        # When every server can take leases in bulk, we add them ourselves,
+        # MAX_BULK_LEASES storage indexes at a time, instead of letting the
+        # checker send one add_lease() per file per server.
+        self._pending_leases = None
+        if add_lease:
+            nodemaker = root._nodemaker
+            self._storage_broker = nodemaker.storage_broker
+            self._secret_holder = nodemaker.secret_holder
+            servers = self._storage_broker.get_connected_servers()
+            if servers and all(self._supports_bulk_add_lease(s)
+                               for s in servers):
+                self._pending_leases = []
+
+    def _supports_bulk_add_lease(self, server):
+        v = server.get_version()
+        if v is None:
+            return False
+        v1 = v.get(b"http://allmydata.org/tahoe/protocols/storage/v1", {})
+        return v1.get(b"supports-bulk-add-lease", False)
 
     def set_monitor(self, monitor):
         self.monitor = monitor
         monitor.set_status(self._results)
 
     def add_node(self, node, childpath):
+        add_lease = self._add_lease
+        flush = False
+        if self._pending_leases is not None:
+            add_lease = False
+            si = node.get_storage_index()
+            if si is not None:
+                self._pending_leases.append(si)
+                flush = len(self._pending_leases) >= MAX_BULK_LEASES
         if self._repair:
-            d = node.check_and_repair(self.monitor, self._verify, self._add_lease)
+            d = node.check_and_repair(self.monitor, self._verify, add_lease)
             d.addCallback(self._results.add_check_and_repair, childpath)
         else:
-            d = node.check(self.monitor, self._verify, self._add_lease)
+            d = node.check(self.monitor, self._verify, add_lease)
             d.addCallback(self._results.add_check, childpath)
         d.addCallback(lambda ignored: self._stats.add_node(node, childpath))
+        if flush:
+            d.addCallback(lambda ignored: self._flush_leases())
         return d
 
+    def _flush_leases(self):
+        storage_indexes = self._pending_leases
+        self._pending_leases = []
+        if not storage_indexes:
+            return defer.succeed(None)
+        crs = self._secret_holder.get_renewal_secret()
+        ccs = self._secret_holder.get_cancel_secret()
+        file_secrets = [(si,
+                         hashutil.file_renewal_secret_hash(crs, si),
+                         hashutil.file_cancel_secret_hash(ccs, si))
+                        for si in storage_indexes]
+        dl = []
+        for server in self._storage_broker.get_connected_servers():
+            lease_seed = server.get_lease_seed()
+            leases = [(si,
+                       hashutil.bucket_renewal_secret_hash(frs, lease_seed),
+                       hashutil.bucket_cancel_secret_hash(fcs, lease_seed))
+                      for (si, frs, fcs) in file_secrets]
+            storage_server = server.get_storage_server().with_priority("lease")
+            if self._supports_bulk_add_lease(server):
+                d = storage_server.add_leases(leases)
+                d.addCallback(self._check_bulk_leases, server, leases)
+            else:
+                # this server connected after we started
+                d = defer.DeferredList([storage_server.add_lease(*lease)
+                                        for lease in leases],
+                                       consumeErrors=True)
+            d.addErrback(self._add_leases_failed, server)
+            dl.append(d)
+        return defer.DeferredList(dl)
+
+    def _check_bulk_leases(self, results, server, leases):
+        failed = len([res for res in results if res is None])
+        if failed:
+            log.msg(format="add_leases to [%(name)s] failed for"
+                    " %(count)d of %(total)d storage indexes",
+                    name=server.get_name(), count=failed,
+                    total=len(leases), parent=self._lp,
+                    level=log.UNUSUAL, umid="Q2V0pg")
+
+    def _add_leases_failed(self, f, server):
+        if f.check(DeadReferenceError):
+            return
+        log.msg(format="error in add_leases to [%(name)s]",
+                name=server.get_name(), failure=f, parent=self._lp,
+                level=log.WEIRD, umid="o4y6uA")
+
     def enter_directory(self, parent, children):
         return self._stats.enter_directory(parent, children)
 
     def finish(self):
-        log.msg("deep-check done", parent=self._lp)
-        self._results.update_stats(self._stats.get_results())
-        return self._results
+        d = defer.succeed(None)
+        if self._pending_leases is not None:
+            d.addCallback(lambda ignored: self._flush_leases())
+        def _done(ignored):
+            log.msg("deep-check done", parent=self._lp)
+            self._results.update_stats(self._stats.get_results())
+            return self._results
+        d.addCallback(_done)
+        return d
 
 
 # use client.create_dirnode() to make one of these
@@ -101,3 +101,9 @@ class History(object):
         for s in self.all_helper_upload_statuses:
             yield s
 
+    def record_latency(self, name, seconds):
+        """Add the time taken by one operation to the histogram called
+        'name', for the stats gatherer."""
+        if self.stats_provider:
+            self.stats_provider.record(name, seconds)
+
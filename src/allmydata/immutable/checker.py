@@ -460,9 +460,20 @@ class Checker(log.PrefixingLogMixin):
     Before I send any new request to a server, I always ask the 'monitor'
     object that was passed into my constructor whether this task has been
     cancelled (by invoking its raise_if_cancelled() method).
+
+    If 'trust_server_hashes' is True, then for a server which announces
+    'supports-immutable-hash-blocks' I fetch and validate every hash in
+    each of its shares, but instead of downloading the blocks I ask the
+    server to hash them and compare the root of the tree it builds with the
+    share hash. This finds shares damaged by the disk or by a buggy server
+    at the cost of one small request, but unlike downloading the blocks it
+    trusts the server to hash the data it actually holds: a malicious
+    server could pass without storing the blocks at all. By default I
+    download every block from every server.
     """
+
     def __init__(self, verifycap, servers, verify, add_lease, secret_holder,
-                 monitor):
+                 monitor, trust_server_hashes=False):
         assert precondition(isinstance(verifycap, CHKFileVerifierURI), verifycap, type(verifycap))
 
         prefix = "%s" % base32.b2a(verifycap.get_storage_index()[:8])[:12]
@@ -474,6 +485,7 @@ class Checker(log.PrefixingLogMixin):
         self._servers = servers
         self._verify = verify # bool: verify what the servers claim, or not?
         self._add_lease = add_lease
+        self._trust_server_hashes = trust_server_hashes
 
         frs = file_renewal_secret_hash(secret_holder.get_renewal_secret(),
                                        self._verifycap.get_storage_index())
@@ -496,12 +508,14 @@ class Checker(log.PrefixingLogMixin):
         that we want to track and report whether or not each server
         responded.)"""
 
-        storage_server = s.get_storage_server()
+        # checking and verifying should not slow down the server's
+        # interactive clients, so hint that these requests can wait
+        storage_server = s.get_storage_server().with_priority("verify")
         lease_seed = s.get_lease_seed()
         if self._add_lease:
             renew_secret = self._get_renewal_secret(lease_seed)
             cancel_secret = self._get_cancel_secret(lease_seed)
-            d2 = storage_server.add_lease(
+            d2 = s.get_storage_server().with_priority("lease").add_lease(
                 storageindex,
                 renew_secret,
                 cancel_secret,
@@ -598,7 +612,8 @@ class Checker(log.PrefixingLogMixin):
             # identical (so the server couldn't, say, provide good responses
             # for one and not the other), but I think that full verification
             # is more important than defending against inconsistent server
-            # behavior. Besides, they can't pass the verifier without storing
+            # behavior. Besides, unless we were told to trust servers to hash
+            # their own blocks, they can't pass the verifier without storing
             # all the data, so there's not so much to be gained by behaving
             # inconsistently.
             d = vrbp.get_all_sharehashes()
@@ -621,6 +636,12 @@ class Checker(log.PrefixingLogMixin):
             return None
 
         def _get_blocks(vrbp):
+            if self._hashes_blocks(server):
+                return self._hash_blocks(server, sharenum, bucket, veup, vrbp,
+                                         _fetch_blocks)
+            return _fetch_blocks(vrbp)
+
+        def _fetch_blocks(vrbp):
             def _get_block(ign, blocknum):
                 db = vrbp.get_block(blocknum)
                 db.addCallback(_discard_result)
@@ -666,6 +687,44 @@ class Checker(log.PrefixingLogMixin):
 
         return d
 
+    def _hashes_blocks(self, server):
+        if not self._trust_server_hashes:
+            return False
+        v = server.get_version()
+        ver = v[b"http://allmydata.org/tahoe/protocols/storage/v1"]
+        return ver.get(b"supports-immutable-hash-blocks", False)
+
+    def _hash_blocks(self, server, sharenum, bucket, veup, vrbp,
+                     fetch_blocks):
+        """Ask the server to hash the blocks of this share itself, and check
+        the root it computes against the share hash tree, which vrbp has
+        already validated against the UEB. If the server fails to do so, I
+        fall back to fetch_blocks(vrbp)."""
+        d = bucket.callRemote("hash_blocks", veup.block_size, veup.share_size)
+        def _got_hashes(res):
+            (root, share_hashes) = res
+            share_hash = vrbp.share_hash_tree.get_leaf(sharenum)
+            try:
+                vrbp.share_hash_tree.set_hashes(dict(share_hashes))
+            except (IndexError, hashtree.BadHashError,
+                    hashtree.NotEnoughHashesError) as le:
+                raise BadOrMissingHash(le)
+            # the stored block hash tree must lead up to the share hash as
+            # well, since downloaders rely on it to find bad blocks
+            if root != share_hash or vrbp.block_hash_tree[0] != share_hash:
+                self.log("block hashes of shnum=%d on %s do not match its "
+                         "share hash" % (sharenum, server.get_name()))
+                raise BadOrMissingHash("root of block hash tree of share %d "
+                                       "does not match" % (sharenum,))
+        def _hash_failed(f):
+            f.trap(RemoteException)
+            self.log("hash_blocks failed on %s, downloading share %d instead"
+                     % (server.get_name(), sharenum),
+                     failure=f, level=log.UNUSUAL, umid="bX2kQw")
+            return fetch_blocks(vrbp)
+        d.addCallbacks(_got_hashes, _hash_failed)
+        return d
+
     def _verify_server_shares(self, s):
         """ Return a deferred which eventually fires with a tuple of
         (set(sharenum), server, set(corruptsharenum),
@@ -153,7 +153,8 @@ class DownloadNode(object):
         # so size is not negative (which indicates that offset >= EOF)
         size = max(0, min(size, self._verifycap.size-offset))
 
-        read_ev = self._download_status.add_read_event(offset, size, now())
+        started = now()
+        read_ev = self._download_status.add_read_event(offset, size, started)
         if IDownloadStatusHandlingConsumer.providedBy(consumer):
             consumer.set_download_status_read_event(read_ev)
             consumer.set_download_status(self._download_status)
@@ -185,7 +186,11 @@ class DownloadNode(object):
         # to assist the offset>0 process.
         d = s.start()
         def _done(res):
-            read_ev.finished(now())
+            finished = now()
+            read_ev.finished(finished)
+            if self._history:
+                self._history.record_latency("downloader.latencies.read",
+                                             finished - started)
             return res
         d.addBoth(_done)
         return d
@@ -7,7 +7,7 @@ from twisted.python.failure import Failure
 from foolscap.api import eventually
 from allmydata.util import base32, log, hashutil, mathutil
 from allmydata.util.spans import Spans, DataSpans
-from allmydata.interfaces import HASH_SIZE
+from allmydata.interfaces import HASH_SIZE, MAX_READV_SPANS
 from allmydata.hashtree import IncompleteHashTree, BadHashError, \
      NotEnoughHashesError
 
@@ -87,6 +87,9 @@ class Share(object):
         v = server.get_version()
         ver = v[b"http://allmydata.org/tahoe/protocols/storage/v1"]
         self._overrun_ok = ver[b"tolerates-immutable-read-overrun"]
+        # servers which support readv() let us fetch all the spans we want
+        # from this share in a single round trip
+        self._readv_ok = ver.get(b"supports-immutable-readv", False)
         # If _overrun_ok and we guess the offsets correctly, we can get
         # everything in one RTT. If _overrun_ok and we guess wrong, we might
         # need two RTT (but we could get lucky and do it in one). If overrun
@@ -734,6 +737,7 @@ class Share(object):
         # Reconsider the removal: maybe bring it back.
         ds = self._download_status
 
+        requests = []
         for (start, length) in ask:
             # TODO: quantize to reasonably-large blocks
             self._pending.add(start, length)
@@ -744,6 +748,14 @@ class Share(object):
                          level=log.NOISY, parent=self._lp, umid="sgVAyA")
             block_ev = ds.add_block_request(self._server, self._shnum,
                                             start, length, now())
+            requests.append((start, length, block_ev, lp))
+
+        if self._readv_ok and len(requests) > 1:
+            for i in range(0, len(requests), MAX_READV_SPANS):
+                self._send_readv(requests[i:i+MAX_READV_SPANS])
+            return
+
+        for (start, length, block_ev, lp) in requests:
             d = self._send_request(start, length)
             d.addCallback(self._got_data, start, length, block_ev, lp)
             d.addErrback(self._got_error, start, length, block_ev, lp)
@@ -753,6 +765,26 @@ class Share(object):
                                  failure=f, parent=self._lp,
                                  level=log.WEIRD, umid="qZu0wg"))
 
+    def _send_readv(self, requests):
+        vector = [(start, length) for (start, length, block_ev, lp) in requests]
+        d = self._rref.callRemote("readv", vector)
+        def _got_datav(datav):
+            if len(datav) != len(requests):
+                raise LayoutInvalid("readv returned %d spans, wanted %d"
+                                    % (len(datav), len(requests)))
+            for (data, (start, length, block_ev, lp)) in zip(datav, requests):
+                self._got_data(data, start, length, block_ev, lp)
+        def _got_readv_error(f):
+            for (start, length, block_ev, lp) in requests:
+                self._got_error(f, start, length, block_ev, lp)
+        d.addCallback(_got_datav)
+        d.addErrback(_got_readv_error)
+        d.addCallback(self._trigger_loop)
+        d.addErrback(lambda f:
+                     log.err(format="unhandled error during send_readv",
+                             failure=f, parent=self._lp,
+                             level=log.WEIRD, umid="hXh2Pw"))
+
     def _send_request(self, start, length):
         return self._rref.callRemote("read", start, length)
 
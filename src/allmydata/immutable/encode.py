@@ -2,7 +2,8 @@
 
 import time
 from zope.interface import implementer
-from twisted.internet import defer
+from twisted.internet import defer, threads
+from twisted.python.failure import Failure
 from foolscap.api import fireEventually
 from allmydata import uri
 from allmydata.storage.server import si_b2a
@@ -38,9 +39,12 @@ log(number of segments)).
 Each segment (A,B,C) is read into memory, encrypted, and encoded into
 blocks. The 'share' (say, share #1) that makes it out to a host is a
 collection of these blocks (block A1, B1, C1), plus some hash-tree
-information necessary to validate the data upon retrieval. Only one segment
-is handled at a time: all blocks for segment A are delivered before any
-work is begun on segment B.
+information necessary to validate the data upon retrieval. By default only
+one segment is handled at a time: all blocks for segment A are delivered
+before any work is begun on segment B. With a pipeline depth greater than
+one, the following segments are read and encoded (in threads) while the
+blocks of segment A are being delivered, but blocks are still delivered in
+order, and the shares are the same.
 
 As blocks are created, we retain the hash of each one. The list of block hashes
 for a single share (say, hash(A1), hash(B1), hash(C1)) is used to form the base
@@ -74,11 +78,32 @@ GiB=1024*MiB
 TiB=1024*GiB
 PiB=1024*TiB
 
+def _encode_and_hash(codec, chunks):
+    """Erasure-code one segment's chunks of ciphertext, and hash the
+    resulting blocks. This may run in a thread: zfec and hashlib release the
+    GIL while they work."""
+    results = []
+    # CRSEncoder.encode() has fired its Deferred by the time it returns
+    codec.encode(chunks).addBoth(results.append)
+    if isinstance(results[0], Failure):
+        results[0].raiseException()
+    (shares, shareids) = results[0]
+    return (shares, shareids, [hashutil.block_hash(block) for block in shares])
+
 @implementer(IEncoder)
 class Encoder(object):
-
-    def __init__(self, log_parent=None, upload_status=None, progress=None):
+    def __init__(self, log_parent=None, upload_status=None, progress=None,
+                 pipeline_depth=1):
         object.__init__(self)
+        # how many segments may be in memory at once: the one whose blocks
+        # are being sent, and those being read and encoded after it
+        assert pipeline_depth >= 1, pipeline_depth
+        self.pipeline_depth = pipeline_depth
+        # how many segments the shareholders which are keeping up may get
+        # ahead of the slowest one. The blocks of these segments are held in
+        # memory until the slowest shareholder has been sent them, so this
+        # is bounded by the same setting.
+        self.max_lead = pipeline_depth - 1
         self.uri_extension_data = {}
         self._codec = None
         self._status = None
@@ -208,6 +233,7 @@ class Encoder(object):
         for v in servermap.values():
             assert isinstance(v, set)
         self.servermap = servermap.copy()
+        self._happiness = happinessutil.happiness_matching(self.servermap)
 
     @log_call_deferred(action_type=u"immutable:encode:start")
     def start(self):
@@ -224,6 +250,13 @@ class Encoder(object):
         # to landlord[i]. This list contains a hash of each segment_share
         # that we sent to that landlord.
         self.share_root_hashes = [None] * self.num_shares
+        # shareid -> Deferred from the most recent send_block to it
+        self._block_sends = {}
+        # (Deferred, {shareid: when its block was sent}) for each segment
+        # some shareholder has not yet been sent all of
+        self._unfinished_segments = []
+        # shareid -> seconds spent waiting for it to catch up
+        self._stalls = {}
 
         self._times = {
             "cumulative_encoding": 0.0,
@@ -236,20 +269,7 @@ class Encoder(object):
         d = fireEventually()
 
         d.addCallback(lambda res: self.start_all_shareholders())
-
-        for i in range(self.num_segments-1):
-            # note to self: this form doesn't work, because lambda only
-            # captures the slot, not the value
-            #d.addCallback(lambda res: self.do_segment(i))
-            # use this form instead:
-            d.addCallback(lambda res, i=i: self._encode_segment(i))
-            d.addCallback(self._send_segment, i)
-            d.addCallback(self._turn_barrier)
-        last_segnum = self.num_segments - 1
-        d.addCallback(lambda res: self._encode_tail_segment(last_segnum))
-        d.addCallback(self._send_segment, last_segnum)
-        d.addCallback(self._turn_barrier)
-
+        d.addCallback(lambda res: self._encode_and_send_segments())
         d.addCallback(lambda res: self.finish_hashing())
 
         d.addCallback(lambda res:
@@ -304,8 +324,54 @@ class Encoder(object):
             dl.append(d)
         return self._gather_responses(dl)
 
+    def _encode_and_send_segments(self):
+        """Encode each segment and send its blocks to the shareholders, in
+        order. While one segment is being sent, up to pipeline_depth-1 of the
+        segments after it are read and encoded."""
+        encoding = {} # segnum -> Deferred from _encode_segment
+        # each segment is read once the segment before it has been read
+        self._reads = defer.succeed(None)
+        def _encode_ahead(segnum):
+            last = min(segnum + self.pipeline_depth, self.num_segments)
+            for i in range(segnum, last):
+                if i not in encoding:
+                    encoding[i] = self._encode_segment(i)
+            return encoding.pop(segnum)
+        d = defer.succeed(None)
+        for i in range(self.num_segments):
+            # note to self: this form doesn't work, because lambda only
+            # captures the slot, not the value
+            #d.addCallback(lambda res: self.do_segment(i))
+            # use this form instead:
+            d.addCallback(lambda res, i=i: _encode_ahead(i))
+            d.addCallback(self._send_segment, i)
+            d.addCallback(self._turn_barrier)
+        d.addCallback(lambda res: self._wait_for_segments(0))
+        def _failed(f):
+            # the segments read or encoded ahead will not be sent, and
+            # those still being sent will not be waited for
+            for encoded in encoding.values():
+                encoded.addErrback(lambda ign: None)
+            self._reads.addErrback(lambda ign: None)
+            for (sent, sent_at) in self._unfinished_segments:
+                sent.addErrback(lambda ign: None)
+            return f
+        d.addErrback(_failed)
+        return d
+
     def _encode_segment(self, segnum):
-        codec = self._codec
+        """Read, encode, and hash the blocks of one segment.
+
+        :return: A Deferred that fires with a tuple of the segment's blocks,
+            their share numbers, and their hashes.
+        """
+        if segnum == self.num_segments - 1:
+            # the tail segment may be short, and is padded by _gather_data
+            codec = self._tail_codec
+            allow_short = True
+        else:
+            codec = self._codec
+            allow_short = False
         start = time.time()
 
         # the ICodecEncoder API wants to receive a total of self.segment_size
@@ -333,49 +399,43 @@ class Encoder(object):
         # given time. We build up a segment's worth of cryptttext, then hand
         # it to the encoder. Assuming 3-of-10 encoding (3.3x expansion) and
         # 1MiB max_segment_size, we get a peak memory footprint of 4.3*1MiB =
-        # 4.3MiB. Lowering max_segment_size to, say, 100KiB would drop the
-        # footprint to 430KiB at the expense of more hash-tree overhead.
-
-        d = self._gather_data(self.required_shares, input_piece_size,
-                              crypttext_segment_hasher)
-        def _done_gathering(chunks):
-            for c in chunks:
-                assert len(c) == input_piece_size
-            self._crypttext_hashes.append(crypttext_segment_hasher.digest())
-            # during this call, we hit 5*segsize memory
-            return codec.encode(chunks)
-        d.addCallback(_done_gathering)
+        # 4.3MiB per segment in the pipeline. Lowering max_segment_size to,
+        # say, 100KiB would drop the footprint to 430KiB at the expense of
+        # more hash-tree overhead.
+
+        encoded = defer.Deferred()
+        def _read(res):
+            if isinstance(res, Failure):
+                # an earlier segment could not be read, so neither can this
+                encoded.errback(res)
+                return res
+            d = defer.maybeDeferred(self._gather_data, self.required_shares,
+                                    input_piece_size,
+                                    crypttext_segment_hasher,
+                                    allow_short=allow_short)
+            def _done_gathering(chunks):
+                for c in chunks:
+                    assert len(c) == input_piece_size
+                self._crypttext_hashes.append(
+                    crypttext_segment_hasher.digest())
+                # during this call, we hit 5*segsize memory
+                if self.pipeline_depth > 1:
+                    d2 = threads.deferToThread(_encode_and_hash, codec, chunks)
+                else:
+                    d2 = defer.maybeDeferred(_encode_and_hash, codec, chunks)
+                d2.chainDeferred(encoded)
+            def _failed(f):
+                encoded.errback(f)
+                return f
+            d.addCallbacks(_done_gathering, _failed)
+            return d
+        self._reads.addBoth(_read)
         def _done(res):
             elapsed = time.time() - start
             self._times["cumulative_encoding"] += elapsed
             return res
-        d.addCallback(_done)
-        return d
-
-    def _encode_tail_segment(self, segnum):
-
-        start = time.time()
-        codec = self._tail_codec
-        input_piece_size = codec.get_block_size()
-
-        crypttext_segment_hasher = hashutil.crypttext_segment_hasher()
-
-        d = self._gather_data(self.required_shares, input_piece_size,
-                              crypttext_segment_hasher, allow_short=True)
-        def _done_gathering(chunks):
-            for c in chunks:
-                # a short trailing chunk will have been padded by
-                # _gather_data
-                assert len(c) == input_piece_size
-            self._crypttext_hashes.append(crypttext_segment_hasher.digest())
-            return codec.encode(chunks)
-        d.addCallback(_done_gathering)
-        def _done(res):
-            elapsed = time.time() - start
-            self._times["cumulative_encoding"] += elapsed
-            return res
-        d.addCallback(_done)
-        return d
+        encoded.addCallback(_done)
+        return encoded
 
     def _gather_data(self, num_chunks, input_chunk_size,
                      crypttext_segment_hasher,
@@ -425,17 +485,21 @@ class Encoder(object):
         d.addCallback(_got)
         return d
 
-    def _send_segment(self, shares_and_shareids, segnum):
+    def _send_segment(self, encoded, segnum):
         # To generate the URI, we must generate the roothash, so we must
         # generate all shares, even if we aren't actually giving them to
         # anybody. This means that the set of shares we create will be equal
         # to or larger than the set of landlords. If we have any landlord who
         # *doesn't* have a share, that's an error.
-        (shares, shareids) = shares_and_shareids
+        (shares, shareids, block_hashes) = encoded
         _assert(set(self.landlords.keys()).issubset(set(shareids)),
                 shareids=shareids, landlords=self.landlords)
         start = time.time()
         dl = []
+        sent_at = {}
+        def _sent(res, shareid):
+            sent_at[shareid] = time.time()
+            return res
         self.set_status("Sending segment %d of %d" % (segnum+1,
                                                       self.num_segments))
         self.set_encode_and_push_progress(segnum)
@@ -444,9 +508,10 @@ class Encoder(object):
             block = shares[i]
             shareid = shareids[i]
             d = self.send_block(shareid, segnum, block, lognum)
+            d.addBoth(_sent, shareid)
             dl.append(d)
 
-            block_hash = hashutil.block_hash(block)
+            block_hash = block_hashes[i]
             #from allmydata.util import base32
             #log.msg("creating block (shareid=%d, blocknum=%d) "
             #        "len=%d %r .. %r: %s" %
@@ -471,25 +536,67 @@ class Encoder(object):
                       100 * (segnum+1) / self.num_segments,
                       ),
                      level=log.OPERATIONAL)
+            return res
+        dl.addCallback(_logit)
+
+        # move on to the next segment once every shareholder is no more than
+        # max_lead segments behind
+        self._unfinished_segments.append((dl, sent_at))
+        d = self._wait_for_segments(self.max_lead)
+        def _done(res):
             elapsed = time.time() - start
             self._times["cumulative_sending"] += elapsed
             return res
-        dl.addCallback(_logit)
-        return dl
+        d.addCallback(_done)
+        return d
+
+    def _wait_for_segments(self, allowed):
+        """Wait until no more than ``allowed`` segments have blocks which
+        some shareholder has not been sent. Time spent waiting is counted
+        against the shareholder which was sent its block last."""
+        if len(self._unfinished_segments) <= allowed:
+            return defer.succeed(None)
+        (d, sent_at) = self._unfinished_segments.pop(0)
+        stalled = not d.called
+        start = time.time()
+        def _sent(res):
+            if stalled and sent_at:
+                waited = time.time() - start
+                slowest = max(sent_at, key=lambda shareid: sent_at[shareid])
+                self._stalls[slowest] = self._stalls.get(slowest, 0.0) + waited
+            return self._wait_for_segments(allowed)
+        d.addCallback(_sent)
+        return d
 
     def send_block(self, shareid, segment_num, block, lognum):
         if shareid not in self.landlords:
             return defer.succeed(None)
-        sh = self.landlords[shareid]
-        lognum2 = self.log("put_block to %s" % self.landlords[shareid],
-                           parent=lognum, level=log.NOISY)
-        d = sh.put_block(segment_num, block)
-        def _done(res):
-            self.log("put_block done", parent=lognum2, level=log.NOISY)
-            return res
-        d.addCallback(_done)
-        d.addErrback(self._remove_shareholder, shareid,
-                     "segnum=%d" % segment_num)
+        # each shareholder is sent its blocks in order, one at a time: a
+        # block is sent once the shareholder has taken the one before it
+        d = defer.Deferred()
+        def _send(res):
+            if shareid not in self.landlords:
+                # removed while this block was waiting to be sent
+                d.callback(None)
+                return None
+            sh = self.landlords[shareid]
+            lognum2 = self.log("put_block to %s" % sh,
+                               parent=lognum, level=log.NOISY)
+            d2 = sh.put_block(segment_num, block)
+            def _done(res):
+                self.log("put_block done", parent=lognum2, level=log.NOISY)
+                return res
+            d2.addCallback(_done)
+            d2.addErrback(self._remove_shareholder, shareid,
+                          "segnum=%d" % segment_num)
+            d2.chainDeferred(d)
+            return None
+        previous = self._block_sends.get(shareid)
+        self._block_sends[shareid] = d
+        if previous is None:
+            _send(None)
+        else:
+            previous.addBoth(_send)
         return d
 
     def _remove_shareholder(self, why, shareid, where):
@@ -504,11 +611,12 @@ class Encoder(object):
             self.servermap[shareid].remove(peerid)
             if not self.servermap[shareid]:
                 del self.servermap[shareid]
+            self._happiness.remove_edge(peerid, shareid)
         else:
             # even more UNUSUAL
             self.log("they weren't in our list of landlords", parent=ln,
                      level=log.WEIRD, umid="TQGFRw")
-        happiness = happinessutil.servers_of_happiness(self.servermap)
+        happiness = len(self._happiness)
         if happiness < self.min_happiness:
             peerids = set(happinessutil.shares_by_server(self.servermap).keys())
             msg = happinessutil.failure_message(len(peerids),
@@ -694,6 +802,11 @@ class Encoder(object):
         # return a dictionary of encode+push timings
         return self._times
 
+    def get_stalls(self):
+        """Return a dict mapping share number to how many seconds the upload
+        waited for that share's shareholder to catch up with the others."""
+        return self._stalls
+
     def get_uri_extension_data(self):
         return self.uri_extension_data
     def get_uri_extension_hash(self):
@@ -23,13 +23,14 @@ from allmydata.immutable.downloader.status import DownloadStatus
 
 class CiphertextFileNode(object):
     def __init__(self, verifycap, storage_broker, secret_holder,
-                 terminator, history):
+                 terminator, history, trust_server_hashes=False):
         assert isinstance(verifycap, uri.CHKFileVerifierURI)
         self._verifycap = verifycap
         self._storage_broker = storage_broker
         self._secret_holder = secret_holder
         self._terminator = terminator
         self._history = history
+        self._trust_server_hashes = trust_server_hashes
         self._download_status = None
         self._node = None # created lazily, on read()
 
@@ -95,7 +96,8 @@ class CiphertextFileNode(object):
                     servers=self._storage_broker.get_connected_servers(),
                     verify=verify, add_lease=add_lease,
                     secret_holder=self._secret_holder,
-                    monitor=monitor)
+                    monitor=monitor,
+                    trust_server_hashes=self._trust_server_hashes)
         d = c.start()
         d.addCallback(self._maybe_repair, monitor)
         return d
@@ -179,7 +181,8 @@ class CiphertextFileNode(object):
 
         v = Checker(verifycap=verifycap, servers=servers,
                     verify=verify, add_lease=add_lease, secret_holder=sh,
-                    monitor=monitor)
+                    monitor=monitor,
+                    trust_server_hashes=self._trust_server_hashes)
         return v.start()
 
 @implementer(IConsumer, IDownloadStatusHandlingConsumer)
@@ -233,11 +236,12 @@ class ImmutableFileNode(object):
 
     # I wrap a CiphertextFileNode with a decryption key
     def __init__(self, filecap, storage_broker, secret_holder, terminator,
-                 history):
+                 history, trust_server_hashes=False):
         assert isinstance(filecap, uri.CHKFileURI)
         verifycap = filecap.get_verify_cap()
         self._cnode = CiphertextFileNode(verifycap, storage_broker,
-                                         secret_holder, terminator, history)
+                                         secret_holder, terminator, history,
+                                         trust_server_hashes)
         assert isinstance(filecap, uri.CHKFileURI)
         self.u = filecap
         self._readkey = filecap.key
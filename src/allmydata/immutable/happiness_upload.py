@@ -14,82 +14,10 @@ if PY2:
     # We omit dict, just in case newdict breaks things for external Python 2 code.
     from builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, list, object, range, str, max, min  # noqa: F401
 
+from collections import OrderedDict
 from queue import PriorityQueue
 
-
-def augmenting_path_for(graph):
-    """
-    I return an augmenting path, if there is one, from the source node
-    to the sink node in the flow network represented by my graph argument.
-    If there is no augmenting path, I return False. I assume that the
-    source node is at index 0 of graph, and the sink node is at the last
-    index. I also assume that graph is a flow network in adjacency list
-    form.
-    """
-    bfs_tree = bfs(graph, 0)
-    if bfs_tree[len(graph) - 1]:
-        n = len(graph) - 1
-        path = [] # [(u, v)], where u and v are vertices in the graph
-        while n != 0:
-            path.insert(0, (bfs_tree[n], n))
-            n = bfs_tree[n]
-        return path
-    return False
-
-def bfs(graph, s):
-    """
-    Perform a BFS on graph starting at s, where graph is a graph in
-    adjacency list form, and s is a node in graph. I return the
-    predecessor table that the BFS generates.
-    """
-    # This is an adaptation of the BFS described in "Introduction to
-    # Algorithms", Cormen et al, 2nd ed., p. 532.
-    # WHITE vertices are those that we haven't seen or explored yet.
-    WHITE = 0
-    # GRAY vertices are those we have seen, but haven't explored yet
-    GRAY  = 1
-    # BLACK vertices are those we have seen and explored
-    BLACK = 2
-    color        = [WHITE for i in range(len(graph))]
-    predecessor  = [None for i in range(len(graph))]
-    distance     = [-1 for i in range(len(graph))]
-    queue = [s] # vertices that we haven't explored yet.
-    color[s] = GRAY
-    distance[s] = 0
-    while queue:
-        n = queue.pop(0)
-        for v in graph[n]:
-            if color[v] == WHITE:
-                color[v] = GRAY
-                distance[v] = distance[n] + 1
-                predecessor[v] = n
-                queue.append(v)
-        color[n] = BLACK
-    return predecessor
-
-def residual_network(graph, f):
-    """
-    I return the residual network and residual capacity function of the
-    flow network represented by my graph and f arguments. graph is a
-    flow network in adjacency-list form, and f is a flow in graph.
-    """
-    new_graph = [[] for i in range(len(graph))]
-    cf = [[0 for s in range(len(graph))] for sh in range(len(graph))]
-    for i in range(len(graph)):
-        for v in graph[i]:
-            if f[i][v] == 1:
-                # We add an edge (v, i) with cf[v,i] = 1. This means
-                # that we can remove 1 unit of flow from the edge (i, v)
-                new_graph[v].append(i)
-                cf[v][i] = 1
-                cf[i][v] = -1
-            else:
-                # We add the edge (i, v), since we're not using it right
-                # now.
-                new_graph[i].append(v)
-                cf[i][v] = 1
-                cf[v][i] = -1
-    return (new_graph, cf)
+from allmydata.util.bipartite import BipartiteMatching
 
 
 def calculate_happiness(mappings):
@@ -136,44 +64,32 @@ def _calculate_mappings(peers, shares, servermap=None):
 
 def _compute_maximum_graph(graph, shareIndices):
     """
-    This is an implementation of the Ford-Fulkerson method for finding
-    a maximum flow in a flow network applied to a bipartite graph.
-    Specifically, it is the Edmonds-Karp algorithm, since it uses a
-    BFS to find the shortest augmenting path at each iteration, if one
-    exists.
-
-    The implementation here is an adapation of an algorithm described in
-    "Introduction to Algorithms", Cormen et al, 2nd ed., pp 658-662.
+    I find a maximum matching between the peers and the shares of the flow
+    network 'graph', as built by _flow_network or _servermap_flow_graph,
+    and return a dict mapping each of shareIndices to the index of the peer
+    it is matched with, or to None if it isn't matched.
+
+    The matching is found by Hopcroft-Karp (see allmydata.util.bipartite)
+    on the edges from peers to shares; the source and sink edges, which
+    Edmonds-Karp would push flow through, only say which vertices are peers
+    and which are shares. Its size is the value of a maximum flow through
+    graph.
     """
 
     if graph == []:
         return {}
 
-    dim = len(graph)
-    flow_function = [[0 for sh in range(dim)] for s in range(dim)]
-    residual_graph, residual_function = residual_network(graph, flow_function)
-
-    while augmenting_path_for(residual_graph):
-        path = augmenting_path_for(residual_graph)
-        # Delta is the largest amount that we can increase flow across
-        # all of the edges in path. Because of the way that the residual
-        # function is constructed, f[u][v] for a particular edge (u, v)
-        # is the amount of unused capacity on that edge. Taking the
-        # minimum of a list of those values for each edge in the
-        # augmenting path gives us our delta.
-        delta = min(residual_function[u][v] for (u, v) in path)
-        for (u, v) in path:
-            flow_function[u][v] += delta
-            flow_function[v][u] -= delta
-            residual_graph, residual_function = residual_network(graph,flow_function)
+    matching = BipartiteMatching(
+        OrderedDict((peerIndex, graph[peerIndex]) for peerIndex in graph[0])
+    )
+    share_to_peer = dict(
+        (shareIndex, peerIndex)
+        for (peerIndex, shareIndex) in matching.get_matching().items()
+    )
 
     new_mappings = {}
     for shareIndex in shareIndices:
-        peer = residual_graph[shareIndex]
-        if peer == [dim - 1]:
-            new_mappings.setdefault(shareIndex, None)
-        else:
-            new_mappings.setdefault(shareIndex, peer[0])
+        new_mappings.setdefault(shareIndex, share_to_peer.get(shareIndex))
 
     return new_mappings
 
@@ -311,8 +227,8 @@ def _flow_network(peerIndices, shareIndices):
     a node, and the corresponding list represents all of the nodes it is connected
     to.
 
-    This function is similar to allmydata.util.happinessutil.flow_network_for, but
-    we connect every peer with all shares instead of reflecting a supplied servermap.
+    This function is similar to _servermap_flow_graph, but we connect every
+    peer with all shares instead of reflecting a supplied servermap.
     """
     graph = []
     # The first entry in our flow network is the source.
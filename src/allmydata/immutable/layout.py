@@ -5,7 +5,7 @@ from allmydata.interfaces import IStorageBucketWriter, IStorageBucketReader, \
      FileTooLargeError, HASH_SIZE
 from allmydata.util import mathutil, observer, pipeline
 from allmydata.util.assertutil import precondition
-from allmydata.storage.server import si_b2a
+from allmydata.storage.common import si_b2a
 
 class LayoutInvalid(Exception):
     """ There is something wrong with these bytes so they can't be
@@ -76,6 +76,50 @@ limitations described in #346.
 
 FORCE_V2 = False # set briefly by unit tests to make small-sized V2 shares
 
+def parse_offsets(data):
+    """Parse the header at the start of a share, which must be at least 0x44
+    bytes long for a v2 share (0x24 for v1), and return (version, fieldsize,
+    fieldstruct, offsets), where offsets maps the name of each section of
+    the share to where it starts."""
+    precondition(len(data) >= 0x4)
+    (version,) = struct.unpack(">L", data[0:4])
+    if version != 1 and version != 2:
+        raise ShareVersionIncompatible(version)
+
+    if version == 1:
+        precondition(len(data) >= 0x24)
+        x = 0x0c
+        fieldsize = 0x4
+        fieldstruct = ">L"
+    else:
+        precondition(len(data) >= 0x44)
+        x = 0x14
+        fieldsize = 0x8
+        fieldstruct = ">Q"
+
+    offsets = {}
+    for field in ( 'data',
+                   'plaintext_hash_tree', # UNUSED
+                   'crypttext_hash_tree',
+                   'block_hashes',
+                   'share_hashes',
+                   'uri_extension',
+                   ):
+        offset = struct.unpack(fieldstruct, data[x:x+fieldsize])[0]
+        x += fieldsize
+        offsets[field] = offset
+    return (version, fieldsize, fieldstruct, offsets)
+
+def unpack_share_hashes(data):
+    """Return the (hashnum, hash) tuples packed in the share_hashes section
+    of a share."""
+    hashes = []
+    for i in range(0, len(data), 2+HASH_SIZE):
+        hashnum = struct.unpack(">H", data[i:i+2])[0]
+        hashvalue = data[i+2:i+2+HASH_SIZE]
+        hashes.append( (hashnum, hashvalue) )
+    return hashes
+
 def make_write_bucket_proxy(rref, server,
                             data_size, block_size, num_segments,
                             num_share_hashes, uri_extension_size_max):
@@ -99,6 +143,10 @@ class WriteBucketProxy(object):
     fieldsize = 4
     fieldstruct = ">L"
 
+    # the most data we will have in flight to one server, however long and
+    # fat the connection to it appears to be
+    MAX_PIPELINE_SIZE = 1024*1024
+
     def __init__(self, rref, server, data_size, block_size, num_segments,
                  num_share_hashes, uri_extension_size_max, pipeline_size=50000):
         self._rref = rref
@@ -120,8 +168,10 @@ class WriteBucketProxy(object):
         # k=3, max_segment_size=128KiB gives us a typical segment of 43691
         # bytes. Setting the default pipeline_size to 50KB lets us get two
         # segments onto the wire but not a third, which would keep the pipe
-        # filled.
-        self._pipeline = pipeline.Pipeline(pipeline_size)
+        # filled. The pipeline grows past that for servers which are far
+        # enough away that two segments do not fill it.
+        self._pipeline = pipeline.AdaptivePipeline(
+            pipeline_size, max(pipeline_size, self.MAX_PIPELINE_SIZE))
 
     def get_allocated_size(self):
         return (self._offsets['uri_extension'] + self.fieldsize +
@@ -337,37 +387,11 @@ class ReadBucketProxy(object):
         return self._read(0, 0x44)
 
     def _parse_offsets(self, data):
-        precondition(len(data) >= 0x4)
-        self._offsets = {}
-        (version,) = struct.unpack(">L", data[0:4])
-        if version != 1 and version != 2:
-            raise ShareVersionIncompatible(version)
-
-        if version == 1:
-            precondition(len(data) >= 0x24)
-            x = 0x0c
-            fieldsize = 0x4
-            fieldstruct = ">L"
-        else:
-            precondition(len(data) >= 0x44)
-            x = 0x14
-            fieldsize = 0x8
-            fieldstruct = ">Q"
-
+        (version, fieldsize, fieldstruct, offsets) = parse_offsets(data)
         self._version = version
         self._fieldsize = fieldsize
         self._fieldstruct = fieldstruct
-
-        for field in ( 'data',
-                       'plaintext_hash_tree', # UNUSED
-                       'crypttext_hash_tree',
-                       'block_hashes',
-                       'share_hashes',
-                       'uri_extension',
-                       ):
-            offset = struct.unpack(fieldstruct, data[x:x+fieldsize])[0]
-            x += fieldsize
-            self._offsets[field] = offset
+        self._offsets = offsets
         return self._offsets
 
     def _fetch_sharehashtree_and_ueb(self, offsets):
@@ -381,11 +405,7 @@ class ReadBucketProxy(object):
             raise LayoutInvalid("share hash tree truncated -- should have at least %d bytes -- not %d" % (sharehashtree_size, len(data)))
         if sharehashtree_size % (2+HASH_SIZE) != 0:
             raise LayoutInvalid("share hash tree malformed -- should have an even multiple of %d bytes -- not %d" % (2+HASH_SIZE, sharehashtree_size))
-        self._share_hashes = []
-        for i in range(0, sharehashtree_size, 2+HASH_SIZE):
-            hashnum = struct.unpack(">H", data[i:i+2])[0]
-            hashvalue = data[i+2:i+2+HASH_SIZE]
-            self._share_hashes.append( (hashnum, hashvalue) )
+        self._share_hashes = unpack_share_hashes(data[:sharehashtree_size])
 
         i = self._offsets['uri_extension']-self._offsets['share_hashes']
         if len(data) < i+self._fieldsize:
@@ -457,12 +477,7 @@ class ReadBucketProxy(object):
         def _unpack_share_hashes(data):
             if len(data) != size:
                 raise LayoutInvalid("share hash tree corrupted -- got a short read of the share data -- should have gotten %d, not %d bytes" % (size, len(data)))
-            hashes = []
-            for i in range(0, size, 2+HASH_SIZE):
-                hashnum = struct.unpack(">H", data[i:i+2])[0]
-                hashvalue = data[i+2:i+2+HASH_SIZE]
-                hashes.append( (hashnum, hashvalue) )
-            return hashes
+            return unpack_share_hashes(data)
         d.addCallback(_unpack_share_hashes)
         return d
 
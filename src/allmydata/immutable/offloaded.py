@@ -213,6 +213,11 @@ class CHKUploadHelper(Referenceable, upload.CHKUploader):
                        }
         for key,val in ur.get_timings().items():
             hur.timings[key] = val
+        # like the maps below, stalls_per_server is sent keyed by serverid
+        hur.timings["stalls_per_server"] = dict(
+            (server.get_serverid(), seconds)
+            for server, seconds
+            in ur.get_timings().get("stalls_per_server", {}).items())
         hur.uri_extension_hash = v.uri_extension_hash
         hur.ciphertext_fetched = self._fetcher.get_ciphertext_fetched()
         hur.preexisting_shares = ur.get_preexisting_shares()
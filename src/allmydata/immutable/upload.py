@@ -1,11 +1,12 @@
 from past.builtins import long, unicode
 
-import os, time, weakref, itertools
+import os, mmap, time, weakref, itertools
 from zope.interface import implementer
 from twisted.python import failure
-from twisted.internet import defer
+from twisted.internet import defer, reactor, threads
 from twisted.application import service
-from foolscap.api import Referenceable, Copyable, RemoteCopy, fireEventually
+from foolscap.api import Referenceable, Copyable, RemoteCopy, fireEventually, \
+     eventually
 
 from allmydata.crypto import aes
 from allmydata.util.hashutil import file_renewal_secret_hash, \
@@ -24,7 +25,8 @@ from allmydata.util.rrefutil import add_version_to_remote_reference
 from allmydata.interfaces import IUploadable, IUploader, IUploadResults, \
      IEncryptedUploadable, RIEncryptedUploadable, IUploadStatus, \
      NoServersError, InsufficientVersionError, UploadUnhappinessError, \
-     DEFAULT_MAX_SEGMENT_SIZE, IProgress, IPeerSelector
+     DEFAULT_MAX_SEGMENT_SIZE, IProgress, IPeerSelector, \
+     MAX_BULK_SHARE_QUERIES
 from allmydata.immutable import layout
 
 from io import BytesIO
@@ -315,6 +317,97 @@ def str_shareloc(shnum, bucketwriter):
     return "%s: %s" % (shnum, bucketwriter.get_servername(),)
 
 
+def _supports_bulk_share_query(server):
+    v = server.get_version()
+    if v is None:
+        return False
+    v1 = v.get(b"http://allmydata.org/tahoe/protocols/storage/v1", {})
+    return v1.get(b"supports-bulk-share-query", False)
+
+
+class ShareQueryBatcher(object):
+    """
+    I ask servers which shares they already hold for the storage indexes
+    of many uploads at once. Each server gets at most one
+    get_share_numbers() call at a time: the questions asked while one is
+    outstanding wait, and go together in the next one. Servers which do not
+    support it are asked with get_buckets(), one storage index at a time.
+    """
+
+    def __init__(self):
+        self._pending = {} # server -> [(storage_index, Deferred)]
+        self._busy = set() # servers with a call outstanding or about to go
+
+    def ask(self, server, storage_index):
+        """
+        Return a Deferred that fires with the set of share numbers that
+        ``server`` holds for ``storage_index``.
+        """
+        if not _supports_bulk_share_query(server):
+            d = server.get_storage_server().get_buckets(storage_index)
+            d.addCallback(set)
+            return d
+        d = defer.Deferred()
+        self._pending.setdefault(server, []).append((storage_index, d))
+        if server not in self._busy:
+            self._busy.add(server)
+            # let the questions asked in this turn go in the same call
+            eventually(self._send, server)
+        return d
+
+    def _send(self, server):
+        pending = self._pending.pop(server, [])
+        queries = pending[:MAX_BULK_SHARE_QUERIES]
+        if pending[MAX_BULK_SHARE_QUERIES:]:
+            self._pending[server] = pending[MAX_BULK_SHARE_QUERIES:]
+        if not queries:
+            self._busy.discard(server)
+            return
+        storage_server = server.get_storage_server()
+        d = storage_server.get_share_numbers([si for (si, qd) in queries])
+        def _answered(results):
+            for ((si, qd), shnums) in zip(queries, results):
+                qd.callback(set(shnums))
+        def _failed(f):
+            for (si, qd) in queries:
+                qd.errback(f)
+        d.addCallbacks(_answered, _failed)
+        d.addErrback(log.err, facility="tahoe.immutable.upload",
+                     umid="Rw3LdQ")
+        d.addCallback(lambda ign: self._send(server))
+
+
+class UploadBatch(object):
+    """
+    I keep track of the uploads started by one call to
+    Uploader.upload_many(), and hold the ShareQueryBatcher they share.
+    """
+
+    def __init__(self, count):
+        self.share_queries = ShareQueryBatcher()
+        self._count = count
+        self._finished = 0
+        self._started = time.time()
+        self._ended = None
+
+    def upload_finished(self):
+        self._finished += 1
+        if self._finished == self._count:
+            self._ended = time.time()
+
+    def get_count(self):
+        return self._count
+    def get_finished(self):
+        return self._finished
+    def get_files_per_second(self):
+        """Return how many of my uploads have finished per second so far,
+        or over the whole batch once it is done."""
+        elapsed = (self._ended or time.time()) - self._started
+        if not elapsed:
+            return 0.0
+        return self._finished / elapsed
+
+
 @implementer(IPeerSelector)
 class PeerSelector(object):
 
@@ -396,8 +489,11 @@ class _QueryStatistics(object):
 
 class Tahoe2ServerSelector(log.PrefixingLogMixin):
 
-    def __init__(self, upload_id, logparent=None, upload_status=None, reactor=None):
+    def __init__(self, upload_id, logparent=None, upload_status=None, reactor=None,
+                 share_queries=None):
         self.upload_id = upload_id
+        # a ShareQueryBatcher shared with other uploads, if any
+        self._share_queries = share_queries
         self._query_stats = _QueryStatistics()
         self.last_failure_msg = None
         self._status = IUploadStatus(upload_status)
@@ -410,6 +506,12 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
     def __repr__(self):
         return "<Tahoe2ServerSelector for upload %s>" % self.upload_id
 
+    def _ask_about_existing_shares(self, tracker):
+        if self._share_queries is None:
+            return tracker.ask_about_existing_shares()
+        return self._share_queries.ask(tracker.get_server(),
+                                       tracker.storage_index)
+
     def _create_trackers(self, candidate_servers, allocated_size,
                          file_renewal_secret, file_cancel_secret, create_server_tracker):
 
@@ -558,7 +660,8 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
 
         for tracker in readonly_trackers:
             assert isinstance(tracker, ServerTracker)
-            d = timeout_call(self._reactor, tracker.ask_about_existing_shares(), 15)
+            d = timeout_call(self._reactor,
+                             self._ask_about_existing_shares(tracker), 15)
             d.addBoth(self._handle_existing_response, tracker)
             ds.append(d)
             self.log("asking server %s for any existing shares" %
@@ -566,7 +669,8 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
 
         for tracker in write_trackers:
             assert isinstance(tracker, ServerTracker)
-            d = timeout_call(self._reactor, tracker.ask_about_existing_shares(), 15)
+            d = timeout_call(self._reactor,
+                             self._ask_about_existing_shares(tracker), 15)
 
             def timed_out(f, tracker):
                 # print("TIMEOUT {}: {}".format(tracker, f))
@@ -741,7 +845,9 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
             msg = ("last failure (from %s) was: %s" % (tracker, res))
             self.last_failure_msg = msg
         else:
-            for share in res.keys():
+            # a dict of buckets from get_buckets(), or a set of share
+            # numbers from a ShareQueryBatcher
+            for share in res:
                 self.peer_selector.add_peer_with_share(tracker.get_serverid(), share)
 
     def _get_progress_message(self):
@@ -1122,6 +1228,7 @@ class UploadStatus(object):
         self.results = None
         self.counter = next(self.statusid_counter)
         self.started = time.time()
+        self.batch = None
 
     def get_started(self):
         return self.started
@@ -1141,6 +1248,8 @@ class UploadStatus(object):
         return self.results
     def get_counter(self):
         return self.counter
+    def get_batch(self):
+        return self.batch
 
     def set_storage_index(self, si):
         self.storage_index = si
@@ -1157,10 +1266,13 @@ class UploadStatus(object):
         self.active = value
     def set_results(self, value):
         self.results = value
+    def set_batch(self, batch):
+        self.batch = batch
 
 class CHKUploader(object):
 
-    def __init__(self, storage_broker, secret_holder, progress=None, reactor=None):
+    def __init__(self, storage_broker, secret_holder, progress=None, reactor=None,
+                 pipeline_depth=1, share_queries=None):
         # server_selector needs storage_broker and secret_holder
         self._storage_broker = storage_broker
         self._secret_holder = secret_holder
@@ -1172,6 +1284,8 @@ class CHKUploader(object):
         self._upload_status.set_active(True)
         self._progress = progress
         self._reactor = reactor
+        self._pipeline_depth = pipeline_depth
+        self._share_queries = share_queries
 
         # locate_all_shareholders() will create the following attribute:
         # self._server_trackers = {} # k: shnum, v: instance of ServerTracker
@@ -1226,6 +1340,7 @@ class CHKUploader(object):
             self._log_number,
             self._upload_status,
             progress=self._progress,
+            pipeline_depth=self._pipeline_depth,
         )
         # this just returns itself
         yield self._encoder.set_encrypted_uploadable(eu)
@@ -1251,6 +1366,7 @@ class CHKUploader(object):
             self._log_number,
             self._upload_status,
             reactor=self._reactor,
+            share_queries=self._share_queries,
         )
 
         share_size = encoder.get_param("share_size")
@@ -1324,6 +1440,12 @@ class CHKUploader(object):
         timings["storage_index"] = self._storage_index_elapsed
         timings["peer_selection"] = self._server_selection_elapsed
         timings.update(e.get_times())
+        # {server: seconds the upload waited for it to catch up}
+        stalls = {}
+        for shnum, seconds in e.get_stalls().items():
+            server = self._server_trackers[shnum].get_server()
+            stalls[server] = stalls.get(server, 0.0) + seconds
+        timings["stalls_per_server"] = stalls
         ur = UploadResults(file_size=e.file_size,
                            ciphertext_fetched=0,
                            preexisting_shares=self._count_preexisting_shares,
@@ -1614,6 +1736,10 @@ class AssistedUploader(object):
         # if the file was already in the grid, hur.servermap is an empty dict
         for serverid, shnums in hur.servermap.items():
             servermap[gss(serverid)] = set(shnums)
+        if "stalls_per_server" in timings:
+            timings["stalls_per_server"] = dict(
+                (gss(serverid), seconds)
+                for serverid, seconds in timings["stalls_per_server"].items())
 
         ur = UploadResults(file_size=self._size,
                            # not if already found
@@ -1687,22 +1813,82 @@ class BaseUploadable(object):
         d.addCallback(_got_size)
         return d
 
+def _hash_filehandle(hasher, f, size, progress):
+    """
+    Feed the first ``size`` bytes of the file ``f`` to ``hasher``, calling
+    ``progress`` with the number of bytes hashed so far after each chunk.
+
+    If ``f`` is backed by a real file, it is mapped into memory rather than
+    read, which saves copying it through a read buffer, and the kernel is
+    told that it will be read sequentially so it can read ahead. Otherwise
+    it is read in large chunks. Either way hashlib releases the GIL while it
+    works, so this can usefully be run in a worker thread. I leave ``f``
+    positioned at its start.
+    """
+    CHUNKSIZE = 1024*1024
+    try:
+        m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    except (AttributeError, EnvironmentError, ValueError):
+        # not a real file (e.g. a BytesIO), or empty, or not mappable
+        m = None
+    if m is not None:
+        try:
+            if hasattr(m, "madvise"):
+                m.madvise(mmap.MADV_SEQUENTIAL)
+            for offset in range(0, size, CHUNKSIZE):
+                hasher.update(m[offset:offset+CHUNKSIZE])
+                progress(min(offset + CHUNKSIZE, size))
+        finally:
+            m.close()
+    else:
+        f.seek(0)
+        bytes_read = 0
+        while bytes_read < size:
+            data = f.read(min(CHUNKSIZE, size - bytes_read))
+            if not data:
+                break
+            hasher.update(data)
+            bytes_read += len(data)
+            progress(bytes_read)
+    f.seek(0)
+
 @implementer(IUploadable)
 class FileHandle(BaseUploadable):
+    # convergent files at least this large are hashed in a worker thread,
+    # so the reactor can get on with other work meanwhile
+    THREADED_HASH_SIZE = 1024*1024
 
-    def __init__(self, filehandle, convergence):
+    def __init__(self, filehandle, convergence, known_keys=None):
         """
         Upload the data from the filehandle.  If convergence is None then a
         random encryption key will be used, else the plaintext will be hashed,
         then the hash will be hashed together with the string in the
         "convergence" argument to form the encryption key.
+
+        Hashing a large file takes about as long as reading it. A caller
+        which has uploaded the same contents before, with the same
+        convergence string, and can vouch that they have not changed since
+        (e.g. by their size and timestamps), can skip that by passing the
+        keys that upload used as "known_keys", which is what
+        get_known_keys() returned then. The file is only hashed if none of
+        them was made with this upload's encoding parameters.
         """
         assert convergence is None or isinstance(convergence, bytes), (convergence, type(convergence))
         self._filehandle = filehandle
         self._key = None
         self.convergence = convergence
+        self._known_keys = dict(known_keys or {})
         self._size = None
 
+    def get_known_keys(self):
+        """
+        Return a dict mapping (k, n, segsize) to the convergent encryption
+        key for these contents with those encoding parameters, including the
+        one used by this upload once it has been computed, for the caller to
+        keep and pass as "known_keys" to a later upload of the same contents.
+        """
+        return dict(self._known_keys)
+
     def _get_encryption_key_convergent(self):
         if self._key is not None:
             return defer.succeed(self._key)
@@ -1710,32 +1896,38 @@ class FileHandle(BaseUploadable):
         d = self.get_size()
         # that sets self._size as a side-effect
         d.addCallback(lambda size: self.get_all_encoding_parameters())
+        def _hashed(key, k, n, segsize):
+            self._known_keys[(k, n, segsize)] = key
+            return key
         def _got(params):
             k, happy, n, segsize = params
-            f = self._filehandle
+            if (k, n, segsize) in self._known_keys:
+                return self._known_keys[(k, n, segsize)]
             enckey_hasher = convergence_hasher(k, n, segsize, self.convergence)
-            f.seek(0)
-            BLOCKSIZE = 64*1024
-            bytes_read = 0
-            while True:
-                data = f.read(BLOCKSIZE)
-                if not data:
-                    break
-                enckey_hasher.update(data)
-                # TODO: setting progress in a non-yielding loop is kind of
-                # pointless, but I'm anticipating (perhaps prematurely) the
-                # day when we use a slowjob or twisted's CooperatorService to
-                # make this yield time to other jobs.
-                bytes_read += len(data)
+            size = self._size
+            def _progress(bytes_read):
                 if self._status:
-                    self._status.set_progress(0, float(bytes_read)/self._size)
-            f.seek(0)
-            self._key = enckey_hasher.digest()
+                    self._status.set_progress(0, float(bytes_read)/size)
+            if size < self.THREADED_HASH_SIZE:
+                _hash_filehandle(enckey_hasher, self._filehandle, size,
+                                 _progress)
+                return _hashed(enckey_hasher.digest(), k, n, segsize)
+            def _progress_from_thread(bytes_read):
+                reactor.callFromThread(_progress, bytes_read)
+            d2 = threads.deferToThread(_hash_filehandle, enckey_hasher,
+                                       self._filehandle, size,
+                                       _progress_from_thread)
+            d2.addCallback(lambda ign: enckey_hasher.digest())
+            d2.addCallback(_hashed, k, n, segsize)
+            return d2
+        def _done(key):
+            self._key = key
             if self._status:
                 self._status.set_progress(0, 1.0)
             assert len(self._key) == 16
             return self._key
         d.addCallback(_got)
+        d.addCallback(_done)
         return d
 
     def _get_encryption_key_random(self):
@@ -1766,15 +1958,17 @@ class FileHandle(BaseUploadable):
         pass
 
 class FileName(FileHandle):
-    def __init__(self, filename, convergence):
+    def __init__(self, filename, convergence, known_keys=None):
         """
         Upload the data from the filename.  If convergence is None then a
         random encryption key will be used, else the plaintext will be hashed,
         then the hash will be hashed together with the string in the
-        "convergence" argument to form the encryption key.
+        "convergence" argument to form the encryption key. See FileHandle for
+        "known_keys".
         """
         assert convergence is None or isinstance(convergence, bytes), (convergence, type(convergence))
-        FileHandle.__init__(self, open(filename, "rb"), convergence=convergence)
+        FileHandle.__init__(self, open(filename, "rb"), convergence=convergence,
+                            known_keys=known_keys)
     def close(self):
         FileHandle.close(self)
         self._filehandle.close()
@@ -1797,14 +1991,19 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
     """
     name = "uploader"
     URI_LIT_SIZE_THRESHOLD = 55
+    # how many of the files given to upload_many() to upload at once
+    BATCH_CONCURRENCY = 16
 
-    def __init__(self, helper_furl=None, stats_provider=None, history=None, progress=None):
+    def __init__(self, helper_furl=None, stats_provider=None, history=None, progress=None,
+                 pipeline_depth=1):
         self._helper_furl = helper_furl
         self.stats_provider = stats_provider
         self._history = history
         self._helper = None
         self._all_uploads = weakref.WeakKeyDictionary() # for debugging
         self._progress = progress
+        # how many segments of each file to encode ahead of the one being sent
+        self._pipeline_depth = pipeline_depth
         log.PrefixingLogMixin.__init__(self, facility="tahoe.immutable.upload")
         service.MultiService.__init__(self)
 
@@ -1842,10 +2041,34 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
         """
         Returns a Deferred that will fire with the UploadResults instance.
         """
+        return self._upload(uploadable, progress, reactor, None)
+
+    def upload_many(self, uploadables, reactor=None):
+        """
+        Upload many files, BATCH_CONCURRENCY at a time, so that while some
+        are being sent others are looking for servers, and ask each server
+        about the storage indexes of many of them at once. Returns a
+        Deferred that fires with a list of (success, UploadResults or
+        Failure) tuples, one per uploadable.
+        """
+        batch = UploadBatch(len(uploadables))
+        semaphore = defer.DeferredSemaphore(self.BATCH_CONCURRENCY)
+        def _finished(res):
+            batch.upload_finished()
+            return res
+        ds = []
+        for uploadable in uploadables:
+            d = semaphore.run(self._upload, uploadable, None, reactor, batch)
+            d.addBoth(_finished)
+            ds.append(d)
+        return defer.DeferredList(ds, consumeErrors=True)
+
+    def _upload(self, uploadable, progress, reactor, batch):
         assert self.parent
         assert self.running
         assert progress is None or IProgress.providedBy(progress)
 
+        started = time.time()
         uploadable = IUploadable(uploadable)
         d = uploadable.get_size()
         def _got_size(size):
@@ -1874,9 +2097,14 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
                 else:
                     storage_broker = self.parent.get_storage_broker()
                     secret_holder = self.parent._secret_holder
-                    uploader = CHKUploader(storage_broker, secret_holder, progress=progress, reactor=reactor)
+                    share_queries = batch.share_queries if batch else None
+                    uploader = CHKUploader(storage_broker, secret_holder,
+                                           progress=progress, reactor=reactor,
+                                           pipeline_depth=self._pipeline_depth,
+                                           share_queries=share_queries)
                     d2.addCallback(lambda x: uploader.start(eu))
 
+                uploader.get_upload_status().set_batch(batch)
                 self._all_uploads[uploader] = None
                 if self._history:
                     self._history.add_upload(uploader.get_upload_status())
@@ -1891,6 +2119,12 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
                     d3.addCallback(put_readcap_into_results)
                     return d3
                 d2.addCallback(turn_verifycap_into_read_cap)
+                def _record_latency(uploadresults):
+                    if self.stats_provider:
+                        self.stats_provider.record("uploader.latencies.upload",
+                                                   time.time() - started)
+                    return uploadresults
+                d2.addCallback(_record_latency)
                 return d2
         d.addCallback(_got_size)
         def _done(res):
@@ -40,6 +40,9 @@ StorageIndex = StringConstraint(16)
 URI = StringConstraint(300) # kind of arbitrary
 
 MAX_BUCKETS = 256  # per peer -- zfec offers at most 256 shares per file
+MAX_READV_SPANS = 30 # per RIBucketReader.readv call
+MAX_BULK_LEASES = 500 # per RIStorageServer.add_leases call
+MAX_BULK_SHARE_QUERIES = 500 # per RIStorageServer.get_share_numbers call
 
 DEFAULT_MAX_SEGMENT_SIZE = 128*1024
 
@@ -76,6 +79,34 @@ class RIBucketReader(RemoteInterface):
     def read(offset=Offset, length=ReadSize):
         return ShareData
 
+    def readv(vector=ListOf(TupleOf(Offset, ReadSize),
+                            maxLength=MAX_READV_SPANS)):
+        """Read several ranges of the share in a single round trip. Each
+        (offset, length) element is handled exactly like a call to read(),
+        including the truncation of reads that extend beyond the end of the
+        share data, and I return a list with the data for each element in
+        order.
+
+        Only servers which announce 'supports-immutable-readv' in their
+        version dictionary provide this method.
+        """
+        return ListOf(ShareData, maxLength=MAX_READV_SPANS)
+
+    def hash_blocks(block_size=Offset, share_size=Offset):
+        """Hash every block of this share on the server, so that a verifier
+        need not download them. The share is cut into blocks of block_size
+        bytes, the last of which holds whatever remains of the share_size
+        bytes of block data. I return the root of the Merkle tree built
+        from the hashes of those blocks, and the share hash chain stored in
+        the share as a list of (hashnum, hash) tuples. I fail if share_size
+        is more than the share holds, or if it makes more blocks than the
+        share's block hash tree has leaves.
+
+        Only servers which announce 'supports-immutable-hash-blocks' in
+        their version dictionary provide this method.
+        """
+        return TupleOf(Hash, ListOf(TupleOf(int, Hash)))
+
     def advise_corrupt_share(reason=bytes):
         """Clients who discover hash failures in shares that they have
         downloaded from me will use this method to inform me about the
@@ -154,6 +185,25 @@ class RIStorageServer(RemoteInterface):
         """
         return Any() # returns None now, but future versions might change
 
+    def add_leases(leases=ListOf(TupleOf(StorageIndex,
+                                         LeaseRenewSecret,
+                                         LeaseCancelSecret),
+                                 maxLength=MAX_BULK_LEASES)):
+        """
+        Add (or renew) leases on many buckets in one call. Each
+        (storage_index, renew_secret, cancel_secret) element is handled like
+        a call to add_lease(). The elements are processed in storage index
+        order, so the leases in each prefix directory are updated together.
+
+        I return a list with one result per element, in the same order: the
+        number of shares that got the lease (zero if I hold no shares for
+        that storage index), or None if the lease could not be added.
+
+        Only servers which announce 'supports-bulk-add-lease' in their
+        version dictionary provide this method.
+        """
+        return ListOf(ChoiceOf(int, None), maxLength=MAX_BULK_LEASES)
+
     def renew_lease(storage_index=StorageIndex, renew_secret=LeaseRenewSecret):
         """
         Renew the lease on a given bucket, resetting the timer to 31 days.
@@ -171,6 +221,24 @@ class RIStorageServer(RemoteInterface):
     def get_buckets(storage_index=StorageIndex):
         return DictOf(int, RIBucketReader, maxKeys=MAX_BUCKETS)
 
+    def get_share_numbers(storage_indexes=ListOf(StorageIndex,
+                                                 maxLength=MAX_BULK_SHARE_QUERIES)):
+        """
+        Ask which immutable shares I hold for many storage indexes in one
+        call. This is what an uploader asks every candidate server about
+        each file, and unlike get_buckets() it does not make a bucket reader
+        for every share found.
+
+        I return a list with one element per storage index, in the same
+        order: the set of share numbers I would return from get_buckets()
+        for it (empty if I hold none).
+
+        Only servers which announce 'supports-bulk-share-query' in their
+        version dictionary provide this method.
+        """
+        return ListOf(SetOf(int, maxLength=MAX_BUCKETS),
+                      maxLength=MAX_BULK_SHARE_QUERIES)
+
 
 
     def slot_readv(storage_index=StorageIndex,
@@ -312,6 +380,24 @@ class RIStorageServer(RemoteInterface):
         store that on disk.
         """
 
+    def with_priority(priority=bytes, canary=Referenceable):
+        """
+        Return another RIStorageServer through which I will treat requests
+        (and reads and writes through the buckets it returns) as having the
+        given priority, when I am busy. 'priority' is one of 'read' (for
+        interactive downloads), 'write' (for uploads and mutable writes),
+        'verify' (for checking, verifying and repairing) or 'lease' (for
+        adding and renewing leases), most urgent first. Requests made
+        through the returned object are also queued separately from those
+        of other clients, which are told apart by the Tub that sent
+        'canary'. Without a hint, each request gets the priority which
+        suits its method. An unknown priority is treated as no hint.
+
+        Only servers which announce 'supports-priority-hints' in their
+        version dictionary provide this method.
+        """
+        return Referenceable
+
 
 class IStorageServer(Interface):
     """
@@ -343,6 +429,13 @@ class IStorageServer(Interface):
         :see: ``RIStorageServer.add_lease``
         """
 
+    def add_leases(
+            leases,
+    ):
+        """
+        :see: ``RIStorageServer.add_leases``
+        """
+
     def renew_lease(
             storage_index,
             renew_secret,
@@ -358,6 +451,13 @@ class IStorageServer(Interface):
         :see: ``RIStorageServer.get_buckets``
         """
 
+    def get_share_numbers(
+            storage_indexes,
+    ):
+        """
+        :see: ``RIStorageServer.get_share_numbers``
+        """
+
     def slot_readv(
             storage_index,
             shares,
@@ -387,6 +487,16 @@ class IStorageServer(Interface):
         :see: ``RIStorageServer.advise_corrupt_share``
         """
 
+    def with_priority(priority):
+        """
+        Return an ``IStorageServer`` for the same server which tags every
+        request with a priority hint: one of ``"read"``, ``"write"``,
+        ``"verify"`` or ``"lease"``. Servers which do not support priority
+        hints get the requests without one.
+
+        :see: ``RIStorageServer.with_priority``
+        """
+
 
 class IStorageBucketWriter(Interface):
     """
@@ -481,7 +591,8 @@ class IStorageBucketReader(Interface):
 class IStorageBroker(Interface):
     def get_servers_for_psi(peer_selection_index):
         """
-        @return: list of IServer instances
+        @return: sequence of the connected IServer instances, in permuted
+                 order. It can be iterated, indexed and sliced like a list.
         """
     def get_connected_servers():
         """
@@ -2242,6 +2353,14 @@ class IUploader(Interface):
         returns a Deferred that fires with an IUploadResults instance, from
         which the URI of the file can be obtained as results.uri ."""
 
+    def upload_many(uploadables):
+        """Upload many files, several at a time, sharing the queries that
+        server selection sends to each server between them. This is much
+        faster than uploading small files one by one. It returns a Deferred
+        that fires, once every upload has finished, with a list of
+        (success, result) tuples like a DeferredList's, one per uploadable
+        in the same order: (True, IUploadResults) or (False, Failure)."""
+
 
 class ICheckable(Interface):
     def check(monitor, verify=False, add_lease=False):
@@ -2776,6 +2895,12 @@ class IUploadStatus(Interface):
         number. This provides a handle to this particular upload, so a web
         page can generate a suitable hyperlink."""
 
+    def get_batch():
+        """Return the UploadBatch this upload belongs to, if it was started
+        by IUploader.upload_many(), else None. Its get_count(),
+        get_finished() and get_files_per_second() methods describe the
+        progress of the whole batch."""
+
 
 class IDownloadStatus(Interface):
     def get_started():
@@ -2940,11 +3065,14 @@ class RIStatsProvider(RemoteInterface):
 
     def get_stats():
         """
-        returns a dictionary containing 'counters' and 'stats', each a
-        dictionary with string counter/stat name keys, and numeric or None values.
+        returns a dictionary containing 'counters', 'stats' and
+        'histograms', each a dictionary with string counter/stat name keys,
+        and numeric or None values.
         counters are monotonically increasing measures of work done, and
         stats are instantaneous measures (potentially time averaged
-        internally)
+        internally). histograms hold the buckets of
+        allmydata.util.statistics.Histogram instances, flattened with
+        Histogram.to_stats(), so that they can be merged across nodes.
         """
         return DictOf(bytes, DictOf(bytes, ChoiceOf(float, int, long, None)))
 
@@ -1,4 +1,4 @@
-import random
+import random, time
 
 from zope.interface import implementer
 from twisted.internet import defer, reactor
@@ -24,6 +24,11 @@ from allmydata.mutable.checker import MutableChecker, MutableCheckAndRepairer
 from allmydata.mutable.repairer import Repairer
 
 
+def _record_latency(res, history, name, started):
+    history.record_latency(name, time.time() - started)
+    return res
+
+
 class BackoffAgent(object):
     # these parameters are copied from foolscap.reconnector, which gets them
     # from twisted.internet.protocol.ReconnectingClientFactory
@@ -632,11 +637,16 @@ class MutableFileNode(object):
 
 
     def _update_servermap(self, servermap, mode):
+        started = time.time()
         u = ServermapUpdater(self, self._storage_broker, Monitor(), servermap,
                              mode)
         if self._history:
             self._history.notify_mapupdate(u.get_status())
-        return u.update()
+        d = u.update()
+        if self._history:
+            d.addCallback(_record_latency, self._history,
+                          "mutable.latencies.mapupdate", started)
+        return d
 
 
     #def set_version(self, version):
@@ -683,11 +693,15 @@ class MutableFileNode(object):
         # Define IPublishInvoker with a set_downloader_hints method?
         # Then have the publisher call that method when it's done publishing?
         p = Publish(self, self._storage_broker, servermap)
+        started = time.time()
         if self._history:
             self._history.notify_publish(p.get_status(),
                                          new_contents.get_size())
         d = p.publish(new_contents)
         d.addCallback(self._did_upload, new_contents.get_size())
+        if self._history:
+            d.addCallback(_record_latency, self._history,
+                          "mutable.latencies.publish", started)
         return d
 
 
@@ -979,9 +993,13 @@ class MutableFileVersion(object):
         """
         r = Retrieve(self._node, self._storage_broker, self._servermap,
                      self._version, fetch_privkey)
+        started = time.time()
         if self._history:
             self._history.notify_retrieve(r.get_status())
         d = r.download(consumer, offset, size)
+        if self._history:
+            d.addCallback(_record_latency, self._history,
+                          "mutable.latencies.retrieve", started)
         return d
 
 
@@ -1007,11 +1025,15 @@ class MutableFileVersion(object):
     def _upload(self, new_contents):
         #assert self._pubkey, "update_servermap must be called before publish"
         p = Publish(self._node, self._storage_broker, self._servermap)
+        started = time.time()
         if self._history:
             self._history.notify_publish(p.get_status(),
                                          new_contents.get_size())
         d = p.publish(new_contents)
         d.addCallback(self._did_upload, new_contents.get_size())
+        if self._history:
+            d.addCallback(_record_latency, self._history,
+                          "mutable.latencies.publish", started)
         return d
 
 
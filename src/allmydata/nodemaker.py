@@ -19,7 +19,7 @@ class NodeMaker(object):
     def __init__(self, storage_broker, secret_holder, history,
                  uploader, terminator,
                  default_encoding_parameters, mutable_file_default,
-                 key_generator, blacklist=None):
+                 key_generator, blacklist=None, trust_server_hashes=False):
         self.storage_broker = storage_broker
         self.secret_holder = secret_holder
         self.history = history
@@ -29,6 +29,8 @@ class NodeMaker(object):
         self.mutable_file_default = mutable_file_default
         self.key_generator = key_generator
         self.blacklist = blacklist
+        # whether the verifier may ask servers to hash their own blocks
+        self.trust_server_hashes = trust_server_hashes
 
         self._node_cache = weakref.WeakValueDictionary() # uri -> node
 
@@ -36,10 +38,12 @@ class NodeMaker(object):
         return LiteralFileNode(cap)
     def _create_immutable(self, cap):
         return ImmutableFileNode(cap, self.storage_broker, self.secret_holder,
-                                 self.terminator, self.history)
+                                 self.terminator, self.history,
+                                 self.trust_server_hashes)
     def _create_immutable_verifier(self, cap):
         return CiphertextFileNode(cap, self.storage_broker, self.secret_holder,
-                                  self.terminator, self.history)
+                                  self.terminator, self.history,
+                                  self.trust_server_hashes)
     def _create_mutable(self, cap):
         n = MutableFileNode(self.storage_broker, self.secret_holder,
                             self.default_encoding_parameters,
@@ -941,6 +941,94 @@ def corrupt_share(options):
 
 
 
+class PackSharesOptions(BaseOptions):
+    def getSynopsis(self):
+        return "Usage: tahoe [global-options] debug pack-shares [options] NODEDIR"
+
+    optParameters = [
+        ["max-size", "m", "64KiB",
+         "Only pack shares of up to this size (as for [storage]packed_shares.max_size)."],
+        ]
+
+    description = """
+Move the small shares held by a storage server from their own files into its
+packed share store (see [storage]packed_shares.enabled in
+docs/configuration.rst), and remove the bucket directories this leaves
+empty. Immutable shares are packed if they hold no more than --max-size bytes
+of share data, and mutable shares if their whole container is no larger than
+that. Other shares, and files which do not look like shares, are left alone.
+
+The node must not be running while this command runs. Enable
+[storage]packed_shares.enabled afterwards, or the server will read the
+packed shares but keep new ones in files.
+
+ tahoe debug pack-shares ~/.tahoe
+"""
+
+    def parseArgs(self, nodedir):
+        from allmydata.util.encodingutil import argv_to_abspath
+        self['nodedir'] = argv_to_abspath(nodedir)
+
+def pack_shares(options):
+    from allmydata.storage.common import si_a2b
+    from allmydata.storage.packed import PackedShareStore
+    from allmydata.storage.shares import get_share_file
+    from allmydata.util.abbreviate import parse_abbreviated_size
+    from allmydata.util.encodingutil import listdir_unicode, quote_output
+
+    out = options.stdout
+    err = options.stderr
+    max_size = parse_abbreviated_size(options["max-size"])
+    storedir = os.path.join(options['nodedir'], "storage")
+    sharedir = os.path.join(storedir, "shares")
+    if not os.path.isdir(sharedir):
+        print("%s has no share directory" % quote_output(storedir), file=err)
+        return 1
+    store = PackedShareStore(os.path.join(storedir, "packed"))
+    packed = left = 0
+    for prefix in sorted(listdir_unicode(sharedir)):
+        prefixdir = os.path.join(sharedir, prefix)
+        if prefix == "incoming" or not os.path.isdir(prefixdir):
+            continue
+        for si_s in sorted(listdir_unicode(prefixdir)):
+            bucketdir = os.path.join(prefixdir, si_s)
+            try:
+                storage_index = si_a2b(si_s.encode("ascii"))
+                names = listdir_unicode(bucketdir)
+            except Exception:
+                print("Error processing %s" % quote_output(bucketdir), file=err)
+                failure.Failure().printTraceback(err)
+                continue
+            for name in names:
+                sharefile = os.path.join(bucketdir, name)
+                try:
+                    shnum = int(name)
+                    sf = get_share_file(sharefile)
+                    if sf.sharetype == "mutable":
+                        size = sf.get_container_size()
+                    else:
+                        size = sf.get_data_length()
+                except Exception:
+                    print("Skipping %s" % quote_output(sharefile), file=err)
+                    left += 1
+                    continue
+                if size > max_size:
+                    left += 1
+                    continue
+                with open(sharefile, "rb") as f:
+                    store.put_share(storage_index, shnum, f.read())
+                # until this file is removed, the packed copy is the one
+                # the server uses
+                os.remove(sharefile)
+                packed += 1
+            if not os.listdir(bucketdir):
+                os.rmdir(bucketdir)
+    store.close()
+    print("%d shares packed, %d left in their own files" % (packed, left),
+          file=out)
+    return 0
+
+
 class ReplOptions(BaseOptions):
     def getSynopsis(self):
         return "Usage: tahoe debug repl (OBSOLETE)"
@@ -1012,6 +1100,7 @@ class DebugCommand(BaseOptions):
         ["find-shares", None, FindSharesOptions, "Locate sharefiles in node dirs."],
         ["catalog-shares", None, CatalogSharesOptions, "Describe all shares in node dirs."],
         ["corrupt-share", None, CorruptShareOptions, "Corrupt a share by flipping a bit."],
+        ["pack-shares", None, PackSharesOptions, "Move small share files into the packed share store."],
         ["repl", None, ReplOptions, "OBSOLETE"],
         ["trial", None, TrialOptions, "OBSOLETE"],
         ["flogtool", None, FlogtoolOptions, "Utilities to access log files."],
@@ -1036,6 +1125,7 @@ subDispatch = {
     "find-shares": find_shares,
     "catalog-shares": catalog_shares,
     "corrupt-share": corrupt_share,
+    "pack-shares": pack_shares,
     "repl": repl,
     "trial": trial,
     "flogtool": flogtool,
@@ -15,6 +15,7 @@ from zope.interface import implementer
 from foolscap.api import eventually, DeadReferenceError, Referenceable, Tub
 
 from allmydata.util import log
+from allmydata.util.statistics import Histogram
 from allmydata.util.encodingutil import quote_local_unicode_path
 from allmydata.interfaces import RIStatsProvider, RIStatsGatherer, IStatsProducer
 
@@ -134,6 +135,7 @@ class StatsProvider(Referenceable, service.MultiService):
         self.gatherer_furl = gatherer_furl # might be None
 
         self.counters = {}
+        self.histograms = {}
         self.stats_producers = []
 
         # only run the LoadMonitor (which submits a timer every second) if
@@ -162,6 +164,18 @@ class StatsProvider(Referenceable, service.MultiService):
         val = self.counters.setdefault(name, 0)
         self.counters[name] = val + delta
 
+    def get_histogram(self, name):
+        """Return the Histogram called ``name``, creating it if necessary.
+        Its contents are reported under the 'histograms' key of
+        get_stats()."""
+        h = self.histograms.get(name)
+        if h is None:
+            h = self.histograms[name] = Histogram()
+        return h
+
+    def record(self, name, value):
+        self.get_histogram(name).record(value)
+
     def register_producer(self, stats_producer):
         self.stats_producers.append(IStatsProducer(stats_producer))
 
@@ -169,7 +183,11 @@ class StatsProvider(Referenceable, service.MultiService):
         stats = {}
         for sp in self.stats_producers:
             stats.update(sp.get_stats())
-        ret = { 'counters': self.counters, 'stats': stats }
+        histograms = {}
+        for (name, h) in self.histograms.items():
+            histograms.update(h.to_stats(name))
+        ret = { 'counters': self.counters, 'stats': stats,
+                'histograms': histograms }
         log.msg(format='get_stats() -> %(stats)s', stats=ret, level=log.NOISY)
         return ret
 
@@ -185,12 +203,34 @@ class StatsProvider(Referenceable, service.MultiService):
 
         stats = self.get_stats()
         return {b"counters": to_bytes(stats["counters"]),
-                b"stats": to_bytes(stats["stats"])}
+                b"stats": to_bytes(stats["stats"]),
+                b"histograms": to_bytes(stats["histograms"])}
 
     def _connected(self, gatherer, nickname):
         gatherer.callRemoteOnly('provide', self, nickname or '')
 
 
+def merge_histograms(all_stats):
+    """Combine the histograms in the get_stats() results of several stats
+    providers, returning a dict mapping each histogram name to a Histogram
+    of the values recorded by all of them."""
+    def text(s):
+        if isinstance(s, bytes):
+            return s.decode("utf-8")
+        return s
+    merged = {}
+    for stats in all_stats:
+        stats = dict((text(k), v) for (k, v) in stats.items())
+        flat = dict((text(k), v)
+                    for (k, v) in (stats.get("histograms") or {}).items())
+        names = [key[:-len(".count")] for key in flat
+                 if key.endswith(".count")]
+        for name in names:
+            h = Histogram.from_stats(flat, name)
+            merged.setdefault(name, Histogram()).merge(h)
+    return merged
+
+
 @implementer(RIStatsGatherer)
 class StatsGatherer(Referenceable, service.MultiService):
 
@@ -263,6 +303,7 @@ class JSONStatsGatherer(StdOutStatsGatherer):
         self.verbose = verbose
         StatsGatherer.__init__(self, basedir)
         self.jsonfile = os.path.join(basedir, "stats.json")
+        self.histogramsfile = os.path.join(basedir, "grid_histograms.json")
 
         if os.path.exists(self.jsonfile):
             try:
@@ -284,13 +325,25 @@ class JSONStatsGatherer(StdOutStatsGatherer):
         s['stats'] = stats
         self.dump_json()
 
+    def get_grid_histograms(self):
+        """Return a dict mapping histogram names to Histograms combining the
+        latest values reported by every node."""
+        return merge_histograms([s['stats'] for s
+                                 in self.gathered_stats.values()])
+
     def dump_json(self):
-        tmp = "%s.tmp" % (self.jsonfile,)
+        self._write_json(self.jsonfile, self.gathered_stats)
+        summaries = dict((name, h.summarize()) for (name, h)
+                         in self.get_grid_histograms().items())
+        self._write_json(self.histogramsfile, summaries)
+
+    def _write_json(self, filename, data):
+        tmp = "%s.tmp" % (filename,)
         with open(tmp, 'wb') as f:
-            json.dump(self.gathered_stats, f)
-        if os.path.exists(self.jsonfile):
-            os.unlink(self.jsonfile)
-        os.rename(tmp, self.jsonfile)
+            json.dump(data, f)
+        if os.path.exists(filename):
+            os.unlink(filename)
+        os.rename(tmp, filename)
 
 class StatsGathererService(service.MultiService):
     furl_file = "stats_gatherer.furl"
@@ -37,3 +37,17 @@ def storage_index_to_dir(storageindex):
         # On Python 3 we expect paths to be unicode.
         sia = sia.decode("ascii")
     return os.path.join(sia[:2], sia)
+
+
+class HeldOpen(object):
+    """Stands in for a newly opened container while a share file holds its
+    container open, leaving it open at the end of the ``with`` block."""
+
+    def __init__(self, f):
+        self._f = f
+
+    def __enter__(self):
+        return self._f
+
+    def __exit__(self, *exc_info):
+        return False
@@ -0,0 +1,211 @@
+"""
+A local SQLite registry of the shares reported to a storage server as
+corrupt, and of the shares it has quarantined.
+
+Ported to Python 3.
+"""
+
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import os
+
+from allmydata.storage.common import si_a2b, si_b2a
+from allmydata.util.dbutil import get_db
+
+SCHEMA_v1 = """
+CREATE TABLE version
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE reports
+(
+ storage_index VARCHAR(26) NOT NULL, -- base32
+ shnum INTEGER NOT NULL,
+ sharetype VARCHAR(9) NOT NULL,      -- 'mutable' or 'immutable'
+ reporter VARCHAR(6) NOT NULL,       -- 'client' or 'server'
+ reason TEXT NOT NULL,               -- the most recent reason given
+ count INTEGER NOT NULL,
+ last_reported INTEGER NOT NULL,     -- seconds since epoch
+ PRIMARY KEY (storage_index, shnum, reporter)
+);
+
+CREATE TABLE quarantine
+(
+ storage_index VARCHAR(26) NOT NULL, -- base32
+ shnum INTEGER NOT NULL,
+ sharetype VARCHAR(9) NOT NULL,
+ reason TEXT NOT NULL,
+ quarantined INTEGER NOT NULL,       -- seconds since epoch
+ PRIMARY KEY (storage_index, shnum)
+);
+"""
+
+# who made a report. Calls to the storage server do not identify the
+# client making them, so reports from all clients are counted together.
+REPORTERS = ("client", # a downloader, checker, or repairer
+             "server", # the server's own check of the share's hashes
+             )
+
+
+class CorruptionRegistry(object):
+    """
+    I hold one row per share and reporter for the shares reported as
+    corrupt, counting the reports and keeping the most recent reason, and
+    one row per quarantined share. The storage server does not serve
+    quarantined shares. I keep the numbers of the shares I know about in
+    memory as well, so that checking whether a share has been reported or
+    quarantined does not touch the database.
+
+    Most servers never see a corrupt share, so the database file is only
+    created when the first share is reported.
+    """
+
+    def __init__(self, dbfile):
+        self._dbfile = dbfile
+        self._db = None
+        # storage_index -> set of shnums
+        self._reported = {}
+        self._quarantined = {}
+        if os.path.exists(dbfile):
+            self._open()
+
+    def _open(self):
+        (self._sqlite, self._db) = get_db(self._dbfile,
+                                          create_version=(SCHEMA_v1, 1),
+                                          dbname="corruption",
+                                          journal_mode="WAL",
+                                          synchronous="NORMAL")
+        self._cursor = self._db.cursor()
+        for (table, shares) in [("reports", self._reported),
+                                ("quarantine", self._quarantined)]:
+            self._cursor.execute("SELECT storage_index, shnum FROM %s"
+                                 % (table,))
+            for (si_s, shnum) in self._cursor.fetchall():
+                storage_index = si_a2b(si_s.encode("ascii"))
+                shares.setdefault(storage_index, set()).add(shnum)
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+
+    def add_report(self, storage_index, shnum, sharetype, reporter, reason,
+                   now):
+        """Record a report that a share is corrupt.
+
+        :return: The number of reports ``reporter`` has made about the
+            share.
+        """
+        assert reporter in REPORTERS, reporter
+        if self._db is None:
+            self._open()
+        si_s = si_b2a(storage_index).decode("ascii")
+        c = self._cursor
+        c.execute("SELECT count FROM reports"
+                  " WHERE storage_index=? AND shnum=? AND reporter=?",
+                  (si_s, shnum, reporter))
+        row = c.fetchone()
+        count = (row[0] if row else 0) + 1
+        c.execute("INSERT OR REPLACE INTO reports VALUES (?,?,?,?,?,?,?)",
+                  (si_s, shnum, sharetype, reporter, reason, count,
+                   int(now)))
+        self._db.commit()
+        self._reported.setdefault(storage_index, set()).add(shnum)
+        return count
+
+    def quarantine(self, storage_index, shnum, sharetype, reason, now):
+        if self._db is None:
+            self._open()
+        si_s = si_b2a(storage_index).decode("ascii")
+        self._cursor.execute("INSERT OR REPLACE INTO quarantine"
+                             " VALUES (?,?,?,?,?)",
+                             (si_s, shnum, sharetype, reason, int(now)))
+        self._db.commit()
+        self._quarantined.setdefault(storage_index, set()).add(shnum)
+
+    def release(self, storage_index, shnum):
+        """Forget the reports about a share and take it out of quarantine,
+        because it has been replaced or deleted."""
+        if not self.is_registered(storage_index, shnum):
+            return
+        si_s = si_b2a(storage_index).decode("ascii")
+        for table in ("reports", "quarantine"):
+            self._cursor.execute("DELETE FROM %s"
+                                 " WHERE storage_index=? AND shnum=?"
+                                 % (table,), (si_s, shnum))
+        self._db.commit()
+        for shares in (self._reported, self._quarantined):
+            shnums = shares.get(storage_index)
+            if shnums is not None:
+                shnums.discard(shnum)
+                if not shnums:
+                    del shares[storage_index]
+
+    def is_registered(self, storage_index, shnum):
+        """Return whether a share has been reported or quarantined."""
+        return (shnum in self._reported.get(storage_index, ()) or
+                shnum in self._quarantined.get(storage_index, ()))
+
+    def get_reported(self, storage_index):
+        """Return the set of reported share numbers in a bucket."""
+        return frozenset(self._reported.get(storage_index, ()))
+
+    def get_quarantined(self, storage_index):
+        """Return the set of quarantined share numbers in a bucket."""
+        return frozenset(self._quarantined.get(storage_index, ()))
+
+    def get_shares(self):
+        """
+        :return: A list with a dict for each share that has been reported
+            or quarantined, most recently reported first. Each has the
+            share's ``storage_index`` (in base32), ``shnum``, and
+            ``sharetype``, ``reports``, which maps each reporter to a dict
+            of its report ``count``, its latest ``reason``, and when it was
+            ``last_reported``, and ``quarantined``, which is when the share
+            was quarantined or None.
+        """
+        if self._db is None:
+            return []
+        shares = {}
+        def _share(si_s, shnum, sharetype):
+            key = (si_s, shnum)
+            if key not in shares:
+                shares[key] = {"storage_index": si_s,
+                               "shnum": shnum,
+                               "sharetype": sharetype,
+                               "reports": {},
+                               "quarantined": None,
+                               }
+            return shares[key]
+        self._cursor.execute("SELECT storage_index, shnum, sharetype,"
+                             " reporter, reason, count, last_reported"
+                             " FROM reports")
+        for (si_s, shnum, sharetype, reporter, reason, count,
+             last_reported) in self._cursor.fetchall():
+            _share(si_s, shnum, sharetype)["reports"][reporter] = {
+                "count": count,
+                "reason": reason,
+                "last_reported": last_reported,
+            }
+        self._cursor.execute("SELECT storage_index, shnum, sharetype,"
+                             " quarantined FROM quarantine")
+        for (si_s, shnum, sharetype, quarantined) in self._cursor.fetchall():
+            _share(si_s, shnum, sharetype)["quarantined"] = quarantined
+        def _last_reported(share):
+            return max([r["last_reported"]
+                        for r in share["reports"].values()] +
+                       [share["quarantined"] or 0])
+        return sorted(shares.values(), key=_last_reported, reverse=True)
+
+    def get_stats(self):
+        return {"reported": sum(len(shnums)
+                                for shnums in self._reported.values()),
+                "quarantined": sum(len(shnums)
+                                   for shnums in self._quarantined.values())}
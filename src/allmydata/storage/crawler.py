@@ -15,19 +15,36 @@ if PY2:
     # so as not to create brittle pickles with random magic objects.
     from builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, range, str, max, min  # noqa: F401
 
-import os, time, struct
+import os, time, struct, threading
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
-from twisted.internet import reactor
+from twisted.internet import reactor, defer
+from twisted.internet.threads import deferToThreadPool
 from twisted.application import service
+from twisted.python import log as twlog
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
 from allmydata.storage.common import si_b2a
 from allmydata.util import fileutil
 
 class TimeSliceExceeded(Exception):
     pass
 
+def list_buckets(prefixdir):
+    """Return the names of the bucket directories in ``prefixdir``, or an
+    empty list if it cannot be read. Where os.scandir() is available, the
+    directory entries tell us which are directories without a stat() call
+    for each of them."""
+    try:
+        scandir = getattr(os, "scandir", None)
+        if scandir is None:
+            return os.listdir(prefixdir)
+        return [entry.name for entry in scandir(prefixdir) if entry.is_dir()]
+    except EnvironmentError:
+        return []
+
 class ShareCrawler(service.MultiService):
     """A ShareCrawler subclass is attached to a StorageServer, and
     periodically walks all of its shares, processing each one in some
@@ -63,6 +80,11 @@ class ShareCrawler(service.MultiService):
     will use crawler.get_state() to retrieve this dictionary; they can
     present the contents as they see fit.
 
+    If the server has a packed share store, the storage indexes of its
+    shares are crawled along with the bucket directories, so
+    process_bucket() may be called for a bucket which has no directory, or
+    whose directory does not hold all of its shares.
+
     Then create an instance, with a reference to a StorageServer and a
     filename where it can store persistent state. The statefile is used to
     keep track of how far around the ring the process has travelled, as well
@@ -76,6 +98,16 @@ class ShareCrawler(service.MultiService):
 
     The crawler instance must be started with startService() before it will
     do any work. To make it stop doing work, call stopService().
+
+    A subclass whose process_bucket() can run in a worker thread may set
+    'process_bucket_in_threads'. Then, if 'scan_threads' is set, the prefix
+    directories are listed, and process_bucket() is called for several
+    buckets at once, in a pool of that many threads, leaving the reactor
+    free meanwhile. The cpu_slice= and allowed_cpu_percentage= limits apply
+    to the time taken by this work just as they do to work done in the
+    reactor thread. Such a process_bucket() must not change self.state or
+    call into the storage server directly: it must use call_in_reactor() for
+    that. process_prefixdir() is not called in this case.
     """
 
     slow_start = 300 # don't start crawling for 5 minutes after startup
@@ -83,6 +115,10 @@ class ShareCrawler(service.MultiService):
     allowed_cpu_percentage = .10 # use up to 10% of the CPU, on average
     cpu_slice = 1.0 # use up to 1.0 seconds before yielding
     minimum_cycle_time = 300 # don't run a cycle faster than this
+    # the number of worker threads to use, if process_bucket_in_threads is
+    # set. This takes effect when the crawler is started.
+    scan_threads = 0
+    process_bucket_in_threads = False
 
     def __init__(self, server, statefile, allowed_cpu_percentage=None):
         service.MultiService.__init__(self)
@@ -105,7 +141,32 @@ class ShareCrawler(service.MultiService):
         self.last_prefix_elapsed_time = None
         self.last_cycle_started_time = None
         self.last_cycle_elapsed_time = None
-        self.load_state()
+        self._threadpool = None
+        self._thread_calls = threading.local()
+        # the state file can be large, so it is not read until the state is
+        # first needed, rather than while the node is starting up
+        self._state = None
+        self._last_complete_prefix_index = None
+
+    @property
+    def state(self):
+        if self._state is None:
+            self.load_state()
+        return self._state
+
+    @state.setter
+    def state(self, state):
+        self._state = state
+
+    @property
+    def last_complete_prefix_index(self):
+        if self._state is None:
+            self.load_state()
+        return self._last_complete_prefix_index
+
+    @last_complete_prefix_index.setter
+    def last_complete_prefix_index(self, i):
+        self._last_complete_prefix_index = i
 
     def minus_or_none(self, a, b):
         if a is None:
@@ -244,6 +305,9 @@ class ShareCrawler(service.MultiService):
         pass
 
     def save_state(self):
+        if self._state is None:
+            # never loaded, so never changed
+            return
         lcpi = self.last_complete_prefix_index
         if lcpi == -1:
             last_complete_prefix = None
@@ -262,12 +326,20 @@ class ShareCrawler(service.MultiService):
         self.current_sleep_time = self.slow_start
         self.next_wake_time = time.time() + self.slow_start
         self.timer = reactor.callLater(self.slow_start, self.start_slice)
+        if self.process_bucket_in_threads and self.scan_threads:
+            self._threadpool = ThreadPool(0, self.scan_threads,
+                                          name="tahoe-" + self.__class__.__name__)
+            self._threadpool.start()
         service.MultiService.startService(self)
 
     def stopService(self):
         if self.timer:
             self.timer.cancel()
             self.timer = None
+        if self._threadpool is not None:
+            # this waits for the buckets already being processed
+            self._threadpool.stop()
+            self._threadpool = None
         self.save_state()
         return service.MultiService.stopService(self)
 
@@ -277,11 +349,26 @@ class ShareCrawler(service.MultiService):
         self.sleeping_between_cycles = False
         self.current_sleep_time = None
         self.next_wake_time = None
+        if self._threadpool is not None:
+            d = self.crawl_in_threads(start_slice)
+            def _crawled(finished_cycle):
+                if finished_cycle is None:
+                    # we were stopped partway through: keep what the last
+                    # buckets did
+                    self.save_state()
+                    return
+                self._finish_slice(finished_cycle, start_slice)
+            d.addCallback(_crawled)
+            d.addErrback(twlog.err)
+            return
         try:
             self.start_current_prefix(start_slice)
             finished_cycle = True
         except TimeSliceExceeded:
             finished_cycle = False
+        self._finish_slice(finished_cycle, start_slice)
+
+    def _finish_slice(self, finished_cycle, start_slice):
         self.save_state()
         if not self.running:
             # someone might have used stopService() to shut us down
@@ -311,7 +398,9 @@ class ShareCrawler(service.MultiService):
         self.yielding(sleep_time)
         self.timer = reactor.callLater(sleep_time, self.start_slice)
 
-    def start_current_prefix(self, start_slice):
+    def _start_cycle(self):
+        """Start a new cycle, unless one is in progress, and return the
+        number of the current cycle."""
         state = self.state
         if state["current-cycle"] is None:
             self.last_cycle_started_time = time.time()
@@ -321,7 +410,29 @@ class ShareCrawler(service.MultiService):
             else:
                 state["current-cycle"] = state["last-cycle-finished"] + 1
             self.started_cycle(state["current-cycle"])
-        cycle = state["current-cycle"]
+        return state["current-cycle"]
+
+    def _sorted_buckets(self, prefix, buckets):
+        packed_store = self.server.packed_store
+        if packed_store is not None:
+            # buckets whose shares are all packed have no directory
+            buckets = list(set(buckets) |
+                           set(packed_store.get_bucket_names(prefix)))
+        return sorted(buckets)
+
+    def _prefix_finished(self, i, cycle, prefix):
+        self.last_complete_prefix_index = i
+
+        now = time.time()
+        if self.last_prefix_finished_time is not None:
+            elapsed = now - self.last_prefix_finished_time
+            self.last_prefix_elapsed_time = elapsed
+        self.last_prefix_finished_time = now
+
+        self.finished_prefix(cycle, prefix)
+
+    def start_current_prefix(self, start_slice):
+        cycle = self._start_cycle()
 
         for i in range(self.last_complete_prefix_index+1, len(self.prefixes)):
             # if we want to yield earlier, just raise TimeSliceExceeded()
@@ -330,27 +441,111 @@ class ShareCrawler(service.MultiService):
             if i == self.bucket_cache[0]:
                 buckets = self.bucket_cache[1]
             else:
-                try:
-                    buckets = os.listdir(prefixdir)
-                    buckets.sort()
-                except EnvironmentError:
-                    buckets = []
+                buckets = self._sorted_buckets(prefix,
+                                               list_buckets(prefixdir))
                 self.bucket_cache = (i, buckets)
             self.process_prefixdir(cycle, prefix, prefixdir,
                                    buckets, start_slice)
-            self.last_complete_prefix_index = i
+            self._prefix_finished(i, cycle, prefix)
+            if time.time() >= start_slice + self.cpu_slice:
+                raise TimeSliceExceeded()
+
+        self._cycle_finished(cycle)
 
-            now = time.time()
-            if self.last_prefix_finished_time is not None:
-                elapsed = now - self.last_prefix_finished_time
-                self.last_prefix_elapsed_time = elapsed
-            self.last_prefix_finished_time = now
+    @defer.inlineCallbacks
+    def crawl_in_threads(self, start_slice):
+        """Do what start_current_prefix() does, but with the prefix
+        directories listed and the buckets processed in my worker threads.
 
-            self.finished_prefix(cycle, prefix)
+        :return: A Deferred that fires with True if the cycle was finished,
+            False if the time slice ran out first, or None if I was stopped
+            first.
+        """
+        pool = self._threadpool
+        cycle = self._start_cycle()
+
+        for i in range(self.last_complete_prefix_index+1, len(self.prefixes)):
+            prefix = self.prefixes[i]
+            prefixdir = os.path.join(self.sharedir, prefix)
+            if i == self.bucket_cache[0]:
+                buckets = self.bucket_cache[1]
+            else:
+                names = yield deferToThreadPool(reactor, pool,
+                                                list_buckets, prefixdir)
+                buckets = self._sorted_buckets(prefix, names)
+                self.bucket_cache = (i, buckets)
+            finished = yield self._process_buckets_in_threads(
+                pool, cycle, prefix, prefixdir, buckets, start_slice)
+            if self._threadpool is not pool:
+                defer.returnValue(None)
+            if not finished:
+                defer.returnValue(False)
+            self._prefix_finished(i, cycle, prefix)
             if time.time() >= start_slice + self.cpu_slice:
-                raise TimeSliceExceeded()
+                defer.returnValue(False)
+
+        self._cycle_finished(cycle)
+        defer.returnValue(True)
+
+    @defer.inlineCallbacks
+    def _process_buckets_in_threads(self, pool, cycle, prefix, prefixdir,
+                                    buckets, start_slice):
+        last_complete = self.state["last-complete-bucket"]
+        if last_complete is not None:
+            buckets = [b for b in buckets if b > last_complete]
+        while buckets:
+            if self._threadpool is not pool:
+                # we were stopped
+                defer.returnValue(False)
+            batch = buckets[:self.scan_threads]
+            buckets = buckets[len(batch):]
+            ds = []
+            for bucket in batch:
+                d = deferToThreadPool(reactor, pool,
+                                      self._process_bucket_in_thread,
+                                      cycle, prefix, prefixdir, bucket)
+                d.addErrback(self._bucket_failed, bucket)
+                ds.append(d)
+            results = yield defer.gatherResults(ds)
+            for (bucket, calls) in zip(batch, results):
+                try:
+                    for (f, args, kwargs) in calls:
+                        f(*args, **kwargs)
+                except Exception:
+                    self._bucket_failed(Failure(), bucket)
+                self.state["last-complete-bucket"] = bucket
+            if time.time() >= start_slice + self.cpu_slice:
+                defer.returnValue(False)
+        defer.returnValue(True)
 
+    def _process_bucket_in_thread(self, cycle, prefix, prefixdir, bucket):
+        calls = self._thread_calls.calls = []
+        try:
+            self.process_bucket(cycle, prefix, prefixdir, bucket)
+        finally:
+            del self._thread_calls.calls
+        return calls
+
+    def _bucket_failed(self, f, bucket):
+        # one bad bucket must not stop the others in its batch, or the crawl
+        twlog.err(f, "%s error processing bucket %s"
+                  % (self.__class__.__name__, bucket))
+        return []
+
+    def call_in_reactor(self, f, *args, **kwargs):
+        """Call ``f(*args, **kwargs)`` in the reactor thread. When
+        process_bucket() is running in a worker thread, the call is put off
+        until the bucket is finished, and is made in order with the other
+        calls made for it; otherwise it is made right away.
+        """
+        calls = getattr(self._thread_calls, "calls", None)
+        if calls is None:
+            return f(*args, **kwargs)
+        calls.append((f, args, kwargs))
+
+    def _cycle_finished(self, cycle):
         # yay! we finished the whole cycle
+        state = self.state
         self.last_complete_prefix_index = -1
         self.last_prefix_finished_time = None # don't include the sleep
         now = time.time()
@@ -451,59 +646,3 @@ class ShareCrawler(service.MultiService):
         This method is for subclasses to override. No upcall is necessary.
         """
         pass
-
-
-class BucketCountingCrawler(ShareCrawler):
-    """I keep track of how many buckets are being managed by this server.
-    This is equivalent to the number of distributed files and directories for
-    which I am providing storage. The actual number of files+directories in
-    the full grid is probably higher (especially when there are more servers
-    than 'N', the number of generated shares), because some files+directories
-    will have shares on other servers instead of me. Also note that the
-    number of buckets will differ from the number of shares in small grids,
-    when more than one share is placed on a single server.
-    """
-
-    minimum_cycle_time = 60*60 # we don't need this more than once an hour
-
-    def __init__(self, server, statefile, num_sample_prefixes=1):
-        ShareCrawler.__init__(self, server, statefile)
-        self.num_sample_prefixes = num_sample_prefixes
-
-    def add_initial_state(self):
-        # ["bucket-counts"][cyclenum][prefix] = number
-        # ["last-complete-cycle"] = cyclenum # maintained by base class
-        # ["last-complete-bucket-count"] = number
-        # ["storage-index-samples"][prefix] = (cyclenum,
-        #                                      list of SI strings (base32))
-        self.state.setdefault("bucket-counts", {})
-        self.state.setdefault("last-complete-bucket-count", None)
-        self.state.setdefault("storage-index-samples", {})
-
-    def process_prefixdir(self, cycle, prefix, prefixdir, buckets, start_slice):
-        # we override process_prefixdir() because we don't want to look at
-        # the individual buckets. We'll save state after each one. On my
-        # laptop, a mostly-empty storage server can process about 70
-        # prefixdirs in a 1.0s slice.
-        if cycle not in self.state["bucket-counts"]:
-            self.state["bucket-counts"][cycle] = {}
-        self.state["bucket-counts"][cycle][prefix] = len(buckets)
-        if prefix in self.prefixes[:self.num_sample_prefixes]:
-            self.state["storage-index-samples"][prefix] = (cycle, buckets)
-
-    def finished_cycle(self, cycle):
-        last_counts = self.state["bucket-counts"].get(cycle, [])
-        if len(last_counts) == len(self.prefixes):
-            # great, we have a whole cycle.
-            num_buckets = sum(last_counts.values())
-            self.state["last-complete-bucket-count"] = num_buckets
-            # get rid of old counts
-            for old_cycle in list(self.state["bucket-counts"].keys()):
-                if old_cycle != cycle:
-                    del self.state["bucket-counts"][old_cycle]
-        # get rid of old samples too
-        for prefix in list(self.state["storage-index-samples"].keys()):
-            old_cycle,buckets = self.state["storage-index-samples"][prefix]
-            if old_cycle != cycle:
-                del self.state["storage-index-samples"][prefix]
-
@@ -0,0 +1,154 @@
+"""
+A thread pool for the storage server's blocking disk I/O.
+
+Ported to Python 3.
+"""
+
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import time
+
+from twisted.application import service
+from twisted.internet import defer
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+from allmydata.util.observer import OneShotObserverList
+from allmydata.util.statistics import Histogram
+
+
+class DiskIOPool(service.Service):
+    """
+    I run blocking disk operations in a bounded pool of worker threads, so
+    that one slow disk does not stall the reactor and every client connected
+    to it.
+
+    Operations are submitted with a key (a share's path, or a storage index)
+    and are started strictly in submission order with respect to other
+    operations on the same key: each one waits until every earlier
+    operation on any of its keys has finished. Operations with no key run
+    as soon as a thread is free.
+
+    Only the disk work itself belongs in the pool. Anything that touches the
+    storage server's in-memory state (counters, indexes, the lease database)
+    must stay in the reactor thread.
+    """
+
+    def __init__(self, num_threads, reactor=None):
+        service.Service.__init__(self)
+        assert num_threads > 0, num_threads
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._threadpool = ThreadPool(0, num_threads,
+                                      name="tahoe-storage-disk-io")
+        self._tails = {} # key -> OneShotObserverList for the last operation
+        self.pending = 0
+        self.max_pending = 0
+        self.completed = 0
+        self.wait_times = Histogram()
+
+    def startService(self):
+        service.Service.startService(self)
+        self._threadpool.start()
+
+    def stopService(self):
+        # this waits for operations already handed to the threads
+        self._threadpool.stop()
+        return service.Service.stopService(self)
+
+    def serialize(self, keys, f, *args, **kwargs):
+        """Call ``f(*args, **kwargs)`` in the reactor thread once every
+        operation previously submitted under any of ``keys`` has finished.
+        If ``f`` returns a Deferred, later operations on these keys wait for
+        it too.
+
+        :return: A Deferred that fires with the result of ``f``.
+        """
+        keys = set(keys)
+        waits = [self._tails[key].when_fired()
+                 for key in keys if key in self._tails]
+        done = OneShotObserverList()
+        for key in keys:
+            self._tails[key] = done
+        if waits:
+            d = defer.DeferredList(waits)
+            d.addCallback(lambda ign: f(*args, **kwargs))
+        else:
+            d = defer.maybeDeferred(f, *args, **kwargs)
+        def _finished(res):
+            for key in keys:
+                if self._tails.get(key) is done:
+                    del self._tails[key]
+            done.fire(None)
+            return res
+        d.addBoth(_finished)
+        return d
+
+    def is_busy(self, key):
+        """Return True if an operation submitted under ``key`` has not yet
+        finished."""
+        return key in self._tails
+
+    def defer_to_thread(self, f, *args, **kwargs):
+        """Call ``f(*args, **kwargs)`` in a worker thread, with no ordering
+        constraints.
+
+        :return: A Deferred that fires in the reactor thread with the result
+            of ``f``.
+        """
+        submitted = time.time()
+        self.pending += 1
+        self.max_pending = max(self.max_pending, self.pending)
+        def _timed():
+            started = time.time()
+            return (started, f(*args, **kwargs))
+        d = deferToThreadPool(self._reactor, self._threadpool, _timed)
+        def _done(res):
+            self.pending -= 1
+            self.completed += 1
+            return res
+        d.addBoth(_done)
+        def _record_wait(res):
+            (started, result) = res
+            self.wait_times.record(started - submitted)
+            return result
+        d.addCallback(_record_wait)
+        return d
+
+    def run(self, key, f, *args, **kwargs):
+        """Call ``f(*args, **kwargs)`` in a worker thread after every
+        earlier operation on ``key`` has finished. A ``key`` of None imposes
+        no ordering.
+
+        :return: A Deferred that fires in the reactor thread with the result
+            of ``f``.
+        """
+        if key is None:
+            return self.defer_to_thread(f, *args, **kwargs)
+        return self.serialize([key], self.defer_to_thread, f, *args, **kwargs)
+
+    def get_stats(self):
+        """
+        ``queue_depth`` counts the operations handed to the pool which have
+        not yet finished, and ``max_queue_depth`` its high-water mark. The
+        ``wait_time`` values describe how long operations have waited for a
+        free thread, in seconds.
+        """
+        stats = {"queue_depth": self.pending,
+                 "max_queue_depth": self.max_pending,
+                 "completed": self.completed,
+                 }
+        if self.wait_times.count:
+            stats["wait_time.mean"] = self.wait_times.get_mean()
+            stats["wait_time.99_0_percentile"] = \
+                self.wait_times.get_percentile(0.99)
+            stats["wait_time.max"] = self.wait_times.max
+        return stats
@@ -0,0 +1,162 @@
+"""
+How the storage server makes finished immutable shares durable.
+
+Ported to Python 3.
+"""
+
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import os, sys
+
+from twisted.application import service
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+# "none" leaves finished shares to the operating system to write out,
+# "fsync" syncs each one as it is closed, and "group" syncs the shares of
+# every upload which closes within a short interval together
+DURABILITY_POLICIES = ("none", "fsync", "group")
+
+
+def fsync_directory(dirname):
+    """Make a rename into or out of ``dirname`` durable, where the platform
+    allows it."""
+    if sys.platform == "win32":
+        # directories cannot be opened, and NTFS journals renames anyway
+        return
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class GroupCommitter(service.Service):
+    """
+    I sync the shares of concurrent uploads in batches.
+
+    A BucketWriter being closed hands itself to ``commit``. I wait up to
+    ``interval`` seconds for others to join it, then sync the data of every
+    share in the batch, move them all into place, and sync each of their
+    directories once, however many of the shares went into it. A share is
+    only reported as stored once this is done.
+
+    When ``disk_io`` is not None, the shares are synced at the same time,
+    one in each of its threads, so that the filesystem can write them out
+    together (most journalling filesystems combine concurrent syncs into
+    one journal commit), and the moves and directory syncs follow in one
+    more thread. Otherwise every share is synced in turn. Either way,
+    clients which close around the same time wait for the disk together,
+    rather than each waiting for the uploads ahead of it.
+    """
+
+    def __init__(self, interval, disk_io=None, reactor=None):
+        service.Service.__init__(self)
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self.interval = interval
+        self._disk_io = disk_io
+        self._pending = [] # (writer, Deferred)
+        self._timer = None
+        self.batches = 0
+        self.committed = 0
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        return self._commit_pending()
+
+    def commit(self, writer):
+        """Make ``writer``'s share durable along with any others closed
+        soon after it.
+
+        :return: A Deferred that fires with the size of the share once it
+            is in place.
+        """
+        d = defer.Deferred()
+        self._pending.append((writer, d))
+        if not self.running:
+            self._commit_pending()
+        elif self._timer is None or not self._timer.active():
+            self._timer = self._reactor.callLater(self.interval,
+                                                  self._commit_pending)
+        return d
+
+    def _commit_pending(self):
+        self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return defer.succeed(None)
+        writers = [writer for (writer, d) in batch]
+        if self._disk_io is not None:
+            d = defer.DeferredList([self._disk_io.run(None, self._sync, writer)
+                                    for writer in writers],
+                                   consumeErrors=True)
+            d.addCallback(lambda synced: self._disk_io.run(
+                None, self._move_into_place, writers,
+                [result for (success, result) in synced]))
+        else:
+            d = defer.maybeDeferred(self._commit, writers)
+        def _committed(results):
+            self.batches += 1
+            self.committed += len(batch)
+            for ((writer, writer_d), result) in zip(batch, results):
+                if isinstance(result, Failure):
+                    writer_d.errback(result)
+                else:
+                    writer_d.callback(result)
+        d.addCallback(_committed)
+        return d
+
+    def _commit(self, writers):
+        """Return, for each of ``writers``, the size of its share or a
+        Failure describing why it could not be stored."""
+        return self._move_into_place(writers,
+                                     [self._sync(writer) for writer in writers])
+
+    def _sync(self, writer):
+        """Finish and sync one share, returning a Failure if that fails."""
+        try:
+            writer._finish(sync=True)
+        except Exception:
+            return Failure()
+        return None
+
+    def _move_into_place(self, writers, results):
+        """Move the shares of ``writers`` whose results are still None into
+        place, and sync their directories. Return ``results`` with the size
+        of each share moved, or a Failure for each which was not."""
+        results = list(results)
+        dirnames = {} # directory -> indexes of the writers moved into it
+        for (i, writer) in enumerate(writers):
+            if results[i] is not None:
+                continue
+            try:
+                results[i] = writer._move_into_place()
+                for dirname in writer._synced_directories():
+                    dirnames.setdefault(dirname, []).append(i)
+            except Exception:
+                results[i] = Failure()
+        for dirname in sorted(dirnames):
+            try:
+                fsync_directory(dirname)
+            except Exception:
+                # the shares are in place, but may not survive a crash
+                f = Failure()
+                for i in dirnames[dirname]:
+                    results[i] = f
+        return results
+
+    def get_stats(self):
+        return {"batches": self.batches,
+                "committed": self.committed,
+                "pending": len(self._pending)}
@@ -11,8 +11,10 @@ if PY2:
 import time, os, pickle, struct
 from allmydata.storage.crawler import ShareCrawler
 from allmydata.storage.shares import get_share_file
+from allmydata.storage.packed import open_packed_share
 from allmydata.storage.common import UnknownMutableContainerVersionError, \
-     UnknownImmutableContainerVersionError
+     UnknownImmutableContainerVersionError, si_a2b, storage_index_to_dir
+from twisted.internet import defer
 from twisted.python import log as twlog
 
 class LeaseCheckingCrawler(ShareCrawler):
@@ -53,10 +55,17 @@ class LeaseCheckingCrawler(ShareCrawler):
 
     All cycle-to-date values remain valid until the start of the next cycle.
 
+    My process_bucket() may run in worker threads (see ShareCrawler): the
+    leases are read there, while the statistics, lease cancellations and
+    reports to the storage server are done in the reactor thread. A share
+    seen to have expired leases is expired through the server's
+    _serialize(), which reads its leases again and cancels only those still
+    expired, so a lease renewed in the meantime is kept.
     """
 
     slow_start = 360 # wait 6 minutes after startup
     minimum_cycle_time = 12*60*60 # not more than twice per day
+    process_bucket_in_threads = True
 
     def __init__(self, server, statefile, historyfile,
                  expiration_enabled, mode,
@@ -123,27 +132,58 @@ class LeaseCheckingCrawler(ShareCrawler):
 
     def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
         bucketdir = os.path.join(prefixdir, storage_index_b32)
-        s = self.stat(bucketdir)
+        storage_index = si_a2b(storage_index_b32.encode("ascii"))
+        packed_store = self.server.packed_store
+        packed_shnums = []
+        if packed_store is not None:
+            packed_shnums = packed_store.get_shnums(storage_index)
+        shares = [(shnum, os.path.join(bucketdir, "%d" % shnum), True)
+                  for shnum in packed_shnums]
+        s = None
+        if not packed_shnums or os.path.isdir(bucketdir):
+            s = self.stat(bucketdir)
+            for fn in os.listdir(bucketdir):
+                try:
+                    shnum = int(fn)
+                except ValueError:
+                    continue # non-numeric means not a sharefile
+                if shnum not in packed_shnums:
+                    shares.append((shnum, os.path.join(bucketdir, fn), False))
         would_keep_shares = []
         wks = None
 
-        for fn in os.listdir(bucketdir):
+        for (shnum, sharefile, packed) in shares:
             try:
-                shnum = int(fn)
-            except ValueError:
-                continue # non-numeric means not a sharefile
-            sharefile = os.path.join(bucketdir, fn)
-            try:
-                wks = self.process_share(sharefile)
+                if packed:
+                    sf = open_packed_share(packed_store, storage_index, shnum,
+                                           sharefile)
+                    wks = self.process_share(sharefile, sf)
+                else:
+                    wks = self.process_share(sharefile)
             except (UnknownMutableContainerVersionError,
                     UnknownImmutableContainerVersionError,
                     struct.error):
                 twlog.msg("lease-checker error processing %s" % sharefile)
                 twlog.err()
                 which = (storage_index_b32, shnum)
-                self.state["cycle-to-date"]["corrupt-shares"].append(which)
-                wks = (1, 1, 1, "unknown")
+                self.call_in_reactor(
+                    self.state["cycle-to-date"]["corrupt-shares"].append,
+                    which)
+                wks = (1, 1, 1, "unknown", False)
             would_keep_shares.append(wks)
+            if wks[4]:
+                # some of its leases have expired
+                self.call_in_reactor(self._expire_share_serialized,
+                                     storage_index, shnum)
+            elif self.server.lease_db is not None and wks[3] != "unknown":
+                # bring the lease database back in line with the share
+                if packed:
+                    sf = open_packed_share(packed_store, storage_index,
+                                           shnum, sharefile)
+                else:
+                    sf = get_share_file(sharefile)
+                self.call_in_reactor(self.server.share_leases_changed,
+                                     storage_index, shnum, sf)
 
         sharetype = None
         if wks:
@@ -158,7 +198,9 @@ class LeaseCheckingCrawler(ShareCrawler):
         try:
             bucket_diskbytes = s.st_blocks * 512
         except AttributeError:
-            bucket_diskbytes = 0 # no stat().st_blocks on windows
+            # no stat().st_blocks on windows, and no directory at all for a
+            # bucket whose shares are all packed
+            bucket_diskbytes = 0
         if sum([wks[0] for wks in would_keep_shares]) == 0:
             self.increment_bucketspace("original", bucket_diskbytes, sharetype)
         if sum([wks[1] for wks in would_keep_shares]) == 0:
@@ -166,22 +208,26 @@ class LeaseCheckingCrawler(ShareCrawler):
         if sum([wks[2] for wks in would_keep_shares]) == 0:
             self.increment_bucketspace("actual", bucket_diskbytes, sharetype)
 
-    def process_share(self, sharefilename):
+    def process_share(self, sharefilename, sf=None):
         # first, find out what kind of a share it is
-        sf = get_share_file(sharefilename)
+        if sf is None:
+            sf = get_share_file(sharefilename)
+            s = self.stat(sharefilename)
+        else:
+            # a packed share, which has no file of its own
+            s = sf.stat()
         sharetype = sf.sharetype
         now = time.time()
-        s = self.stat(sharefilename)
 
         num_leases = 0
         num_valid_leases_original = 0
         num_valid_leases_configured = 0
         expired_leases_configured = []
+        leases = list(sf.get_leases())
 
-        for li in sf.get_leases():
+        for li in leases:
             num_leases += 1
             original_expiration_time = li.get_expiration_time()
-            grant_renew_time = li.get_grant_renew_time_time()
             age = li.get_age()
             self.add_lease_age_to_histogram(age)
 
@@ -189,22 +235,7 @@ class LeaseCheckingCrawler(ShareCrawler):
             if original_expiration_time > now:
                 num_valid_leases_original += 1
 
-            #  expired-or-not according to our configured age limit
-            expired = False
-            if self.mode == "age":
-                age_limit = original_expiration_time
-                if self.override_lease_duration is not None:
-                    age_limit = self.override_lease_duration
-                if age > age_limit:
-                    expired = True
-            else:
-                assert self.mode == "cutoff-date"
-                if grant_renew_time < self.cutoff_date:
-                    expired = True
-            if sharetype not in self.sharetypes_to_expire:
-                expired = False
-
-            if expired:
+            if self.lease_is_expired(li, sharetype):
                 expired_leases_configured.append(li)
             else:
                 num_valid_leases_configured += 1
@@ -213,11 +244,11 @@ class LeaseCheckingCrawler(ShareCrawler):
         self.increment(so_far["leases-per-share-histogram"], num_leases, 1)
         self.increment_space("examined", s, sharetype)
 
-        would_keep_share = [1, 1, 1, sharetype]
+        would_keep_share = [1, 1, 1, sharetype, False]
 
-        if self.expiration_enabled:
-            for li in expired_leases_configured:
-                sf.cancel_lease(li.cancel_secret)
+        if self.expiration_enabled and expired_leases_configured:
+            # process_bucket() has them cancelled
+            would_keep_share[4] = True
 
         if num_valid_leases_original == 0:
             would_keep_share[0] = 0
@@ -232,6 +263,125 @@ class LeaseCheckingCrawler(ShareCrawler):
 
         return would_keep_share
 
+    def lease_is_expired(self, li, sharetype):
+        """Return True if the lease is expired according to our configured
+        age limit or cutoff date."""
+        if sharetype not in self.sharetypes_to_expire:
+            return False
+        if self.mode == "age":
+            age_limit = li.get_expiration_time()
+            if self.override_lease_duration is not None:
+                age_limit = self.override_lease_duration
+            return li.get_age() > age_limit
+        assert self.mode == "cutoff-date"
+        return li.get_grant_renew_time_time() < self.cutoff_date
+
+    def get_expiration_time_cutoff(self, now):
+        """Return the expiration time below which lease_is_expired() may
+        return True, for a lease-database query. Each lease is granted for
+        31 days, so its age and grant time both follow from its expiration
+        time."""
+        lease_duration = 31*24*60*60
+        if self.mode == "age":
+            if self.override_lease_duration is not None:
+                # now - (exp - duration) > override
+                return now + lease_duration - self.override_lease_duration
+            # now - (exp - duration) > exp
+            return (now + lease_duration) / 2
+        # exp - duration < cutoff_date
+        return self.cutoff_date + lease_duration
+
+    def expire_leases_from_db(self):
+        """Cancel the expired leases found by querying the server's lease
+        database, deleting shares which are left with no leases. Only the
+        share files which hold an expired lease are opened.
+
+        Each share is expired through the server's _serialize(), so that
+        when disk I/O is done in threads it waits for any write to the same
+        storage index which is already queued. I return a Deferred which
+        fires once every share has been dealt with, or None if nothing had
+        to wait.
+
+        I update the lease database, but not the cycle-to-date statistics:
+        those remain a record of what the crawler itself has seen.
+        """
+        if not self.expiration_enabled:
+            return None
+        lease_db = self.server.lease_db
+        cutoff = self.get_expiration_time_cutoff(time.time()) + 1
+        candidates = lease_db.get_shares_with_leases_expiring_before(
+            cutoff, self.sharetypes_to_expire)
+        ds = []
+        for (storage_index, shnum, sharetype) in candidates:
+            res = self.server._serialize([storage_index],
+                                         self._expire_share_from_db,
+                                         storage_index, shnum)
+            if isinstance(res, defer.Deferred):
+                ds.append(res)
+        if ds:
+            return defer.gatherResults(ds)
+        return None
+
+    def _expire_share_from_db(self, storage_index, shnum):
+        if not self._expire_share(storage_index, shnum):
+            # the lease database has a share which is not there
+            self.server.share_removed(storage_index, shnum)
+
+    def _expire_share_serialized(self, storage_index, shnum):
+        # The crawler saw expired leases on this share, perhaps in a worker
+        # thread and some time ago. Cancel them once nothing else is using
+        # the share: any of them renewed since then are kept.
+        d = defer.maybeDeferred(self.server._serialize, [storage_index],
+                                self._expire_share, storage_index, shnum)
+        d.addErrback(twlog.err, "lease-checker error expiring a share")
+
+    def _expire_share(self, storage_index, shnum):
+        """Cancel the leases on one share which are expired now, deleting
+        the share if none are left, and tell the storage server what
+        changed. This must be called through the server's _serialize(), and
+        reads the leases again rather than trusting an earlier look at
+        them.
+
+        :return: False if the share is not there, otherwise True.
+        """
+        packed_store = self.server.packed_store
+        def _packed():
+            return (packed_store is not None and
+                    packed_store.has_share(storage_index, shnum))
+        sharefile = os.path.join(self.sharedir,
+                                 storage_index_to_dir(storage_index),
+                                 "%d" % shnum)
+        packed = _packed()
+        if not packed and not os.path.exists(sharefile):
+            return False
+        try:
+            if packed:
+                sf = open_packed_share(packed_store, storage_index, shnum,
+                                       sharefile)
+            else:
+                sf = get_share_file(sharefile)
+            data_length = sf.get_data_length()
+            for li in list(sf.get_leases()):
+                if self.lease_is_expired(li, sf.sharetype):
+                    sf.cancel_lease(li.cancel_secret)
+        except (UnknownMutableContainerVersionError,
+                UnknownImmutableContainerVersionError,
+                struct.error):
+            twlog.msg("lease expiry error processing %s" % sharefile)
+            twlog.err()
+            return True
+        if packed:
+            still_there = _packed()
+        else:
+            still_there = os.path.exists(sharefile)
+        if still_there:
+            self.server.share_leases_changed(storage_index, shnum, sf)
+        else:
+            # the last lease was cancelled, which deleted the share
+            self.server.share_removed(storage_index, shnum, sf.sharetype,
+                                      data_length)
+        return True
+
     def increment_space(self, a, s, sharetype):
         sharebytes = s.st_size
         try:
@@ -261,6 +411,9 @@ class LeaseCheckingCrawler(ShareCrawler):
             self.increment(rec, a+"-buckets-"+sharetype, 1)
 
     def increment(self, d, k, delta=1):
+        self.call_in_reactor(self._increment, d, k, delta)
+
+    def _increment(self, d, k, delta):
         if k not in d:
             d[k] = 0
         d[k] += delta
@@ -0,0 +1,122 @@
+"""
+A bounded cache of open file descriptors for share files.
+
+Ported to Python 3.
+"""
+
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import os, threading
+from collections import OrderedDict
+
+_pread = getattr(os, "pread", None)
+
+
+class FileDescriptorCache(object):
+    """
+    I keep up to ``max_open`` share files open for reading, evicting the
+    least recently used one when a new file is needed. Reads are positional
+    (``os.pread`` where the platform has it), so no seek state is shared
+    between readers of the same file.
+
+    A cached descriptor keeps the underlying inode alive, so whoever deletes
+    or replaces a share file must call ``invalidate`` with its path, or later
+    reads will keep returning the old contents.
+
+    I may be used from several threads at once. A descriptor which is
+    evicted or invalidated while another thread is reading from it is
+    closed when that read finishes.
+    """
+
+    def __init__(self, max_open):
+        assert max_open > 0, max_open
+        self.max_open = max_open
+        self._fds = OrderedDict() # path -> fd, least recently used first
+        self._lock = threading.Lock()
+        self._readers = {} # fd -> number of reads in progress
+        self._retired = set() # fds to close when their last read finishes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _retire(self, fd):
+        # called with the lock held
+        if fd in self._readers:
+            self._retired.add(fd)
+        else:
+            os.close(fd)
+
+    def _checkout_fd(self, path):
+        with self._lock:
+            fd = self._fds.pop(path, None)
+            if fd is None:
+                self.misses += 1
+                fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+                while len(self._fds) >= self.max_open:
+                    (old_path, old_fd) = self._fds.popitem(last=False)
+                    self._retire(old_fd)
+                    self.evictions += 1
+            else:
+                self.hits += 1
+            self._fds[path] = fd
+            self._readers[fd] = self._readers.get(fd, 0) + 1
+            return fd
+
+    def _checkin_fd(self, fd):
+        with self._lock:
+            self._readers[fd] -= 1
+            if not self._readers[fd]:
+                del self._readers[fd]
+                if fd in self._retired:
+                    self._retired.remove(fd)
+                    os.close(fd)
+
+    def pread(self, path, length, offset):
+        """Read up to ``length`` bytes at ``offset`` from the file at
+        ``path``. Fewer bytes are returned only at the end of the file."""
+        fd = self._checkout_fd(path)
+        try:
+            chunks = []
+            while length > 0:
+                if _pread is not None:
+                    data = _pread(fd, length, offset)
+                else:
+                    # without pread, concurrent readers would fight over
+                    # the file position
+                    with self._lock:
+                        os.lseek(fd, offset, os.SEEK_SET)
+                        data = os.read(fd, length)
+                if not data:
+                    break
+                chunks.append(data)
+                offset += len(data)
+                length -= len(data)
+            return b"".join(chunks)
+        finally:
+            self._checkin_fd(fd)
+
+    def invalidate(self, path):
+        with self._lock:
+            fd = self._fds.pop(path, None)
+            if fd is not None:
+                self._retire(fd)
+
+    def close_all(self):
+        with self._lock:
+            while self._fds:
+                (path, fd) = self._fds.popitem()
+                self._retire(fd)
+
+    def get_stats(self):
+        return {"open": len(self._fds),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                }
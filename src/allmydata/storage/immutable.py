@@ -14,15 +14,19 @@ if PY2:
 import os, stat, struct, time
 
 from foolscap.api import Referenceable
+from twisted.internet import defer, threads
 
 from zope.interface import implementer
-from allmydata.interfaces import RIBucketWriter, RIBucketReader
-from allmydata.util import base32, fileutil, log
+from allmydata.interfaces import RIBucketWriter, RIBucketReader, HASH_SIZE
+from allmydata.hashtree import HashTree, roundup_pow2
+from allmydata.immutable.layout import parse_offsets, unpack_share_hashes
+from allmydata.util import base32, fileutil, log, mathutil
 from allmydata.util.assertutil import precondition
-from allmydata.util.hashutil import timing_safe_compare
+from allmydata.util.hashutil import block_hash, timing_safe_compare
 from allmydata.storage.lease import LeaseInfo
 from allmydata.storage.common import UnknownImmutableContainerVersionError, \
-     DataTooLargeError
+     DataTooLargeError, HeldOpen
+from allmydata.storage.durability import fsync_directory
 
 # each share file (in storage/shares/$SI/$SHNUM) contains lease information
 # and share data. The share data is accessed by RIBucketWriter.write and
@@ -52,12 +56,15 @@ from allmydata.storage.common import UnknownImmutableContainerVersionError, \
 class ShareFile(object):
     LEASE_SIZE = struct.calcsize(">L32s32sL")
     sharetype = "immutable"
+    _file = None
 
-    def __init__(self, filename, max_size=None, create=False):
-        """ If max_size is not None then I won't allow more than max_size to be written to me. If create=True and max_size must not be None. """
+    def __init__(self, filename, max_size=None, create=False, fd_cache=None,
+                 mmap_cache=None):
+        """ If max_size is not None then I won't allow more than max_size to be written to me. If create=True and max_size must not be None. If fd_cache is not None, reads go through that FileDescriptorCache instead of opening the file each time. If mmap_cache is not None and my share data is at least its min_size, reads are served from a mapping kept in that MappedFileCache instead. """
         precondition((max_size is not None) or (not create), max_size, create)
         self.home = filename
         self._max_size = max_size
+        self._fd_cache = fd_cache
         if create:
             # touch the file, so later callers will see that we're working on
             # it. Also construct the metadata.
@@ -77,8 +84,8 @@ class ShareFile(object):
             self._lease_offset = max_size + 0x0c
             self._num_leases = 0
         else:
-            with open(self.home, 'rb') as f:
-                filesize = os.path.getsize(self.home)
+            with self._open('rb') as f:
+                filesize = self.get_container_size()
                 (version, unused, num_leases) = struct.unpack(">LLL", f.read(0xc))
             if version != 1:
                 msg = "sharefile %s had version %d but we wanted 1" % \
@@ -87,8 +94,49 @@ class ShareFile(object):
             self._num_leases = num_leases
             self._lease_offset = filesize - (num_leases * self.LEASE_SIZE)
         self._data_offset = 0xc
+        self._mmap_cache = None
+        if (mmap_cache is not None and not create
+            and self.get_data_length() >= mmap_cache.min_size):
+            self._mmap_cache = mmap_cache
+
+    def _open(self, mode):
+        return open(self.home, mode)
+
+    def open(self):
+        """Open the container for writing and keep it open until ``close``
+        is called, so that a writer does not reopen it for every write."""
+        assert self._file is None
+        self._file = self._open('rb+')
+
+    def close(self):
+        """Close the container opened by ``open``, if it is open."""
+        f = self._file
+        self._file = None
+        if f is not None:
+            f.close()
+
+    def sync(self):
+        """Write everything written to the container opened by ``open``
+        through to the disk."""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _get_file(self, mode):
+        if self._file is not None:
+            return HeldOpen(self._file)
+        return self._open(mode)
+
+    def get_container_size(self):
+        return os.path.getsize(self.home)
+
+    def get_data_length(self):
+        return self._lease_offset - self._data_offset
 
     def unlink(self):
+        if self._fd_cache is not None:
+            self._fd_cache.invalidate(self.home)
+        if self._mmap_cache is not None:
+            self._mmap_cache.invalidate(self.home)
         os.unlink(self.home)
 
     def read_share_data(self, offset, length):
@@ -99,16 +147,115 @@ class ShareFile(object):
         actuallength = max(0, min(length, self._lease_offset-seekpos))
         if actuallength == 0:
             return b""
-        with open(self.home, 'rb') as f:
-            f.seek(seekpos)
-            return f.read(actuallength)
+        return self._read_container(seekpos, actuallength)
+
+    def read_share_data_view(self, offset, length):
+        """Like read_share_data, but return a memoryview. When my share is
+        memory-mapped, this is a view of the mapping itself, and no data is
+        copied until the caller uses it."""
+        precondition(offset >= 0)
+        seekpos = self._data_offset+offset
+        actuallength = max(0, min(length, self._lease_offset-seekpos))
+        if actuallength and self._mmap_cache is not None:
+            try:
+                # only the share data is mapped: the lease records after it
+                # may be truncated at any time
+                return self._mmap_cache.view(self.home, self._lease_offset,
+                                             seekpos, actuallength)
+            except (EnvironmentError, ValueError, OverflowError):
+                self._mapping_failed()
+        return memoryview(self.read_share_data(offset, length))
+
+    def hash_blocks(self, block_size, share_size):
+        """Hash the blocks of the share stored in me, as laid out by
+        allmydata.immutable.layout, and return the root of the tree of
+        their hashes and the share hashes stored with them, as for
+        RIBucketReader.hash_blocks. Blocks missing from a truncated share
+        are left out, so that its root does not match.
+
+        block_size and share_size come from the client, so I refuse to hash
+        more data than the share holds, or more blocks than its block hash
+        tree has leaves for."""
+        (version, fieldsize, fieldstruct, offsets) = parse_offsets(
+            self.read_share_data(0, 0x44))
+        max_share_size = offsets['plaintext_hash_tree'] - offsets['data']
+        # a complete binary tree with n leaves has 2n-1 nodes
+        max_blocks = ((offsets['share_hashes'] - offsets['block_hashes'])
+                      // HASH_SIZE + 1) // 2
+        if not (0 < share_size <= max_share_size and block_size > 0 and
+                mathutil.div_ceil(share_size, block_size) <= max_blocks):
+            raise ValueError("cannot hash %d bytes in blocks of %d bytes: the"
+                             " share holds %d bytes in at most %d blocks"
+                             % (share_size, block_size, max_share_size,
+                                max_blocks))
+        leaves = []
+        for blocknum in range(mathutil.div_ceil(share_size, block_size)):
+            offset = blocknum * block_size
+            length = min(block_size, share_size - offset)
+            data = self.read_share_data(offsets['data'] + offset, length)
+            leaves.append(block_hash(data))
+            if len(data) < length:
+                break
+        root = HashTree(leaves)[0]
+        start = offsets['share_hashes']
+        share_hashes = self.read_share_data(start,
+                                            offsets['uri_extension'] - start)
+        return (root, unpack_share_hashes(share_hashes))
+
+    def check_hashes(self, shnum):
+        """Check that the blocks of share number shnum, which is stored in
+        me, match the hashes stored with them, as far as I can without the
+        file's capability.
+
+        :return: None if they match, otherwise a description of what does
+            not match.
+        """
+        # allmydata.uri imports the storage server, which imports me
+        from allmydata.uri import unpack_extension
+        (version, fieldsize, fieldstruct, offsets) = parse_offsets(
+            self.read_share_data(0, 0x44))
+        start = offsets['uri_extension']
+        (length,) = struct.unpack(fieldstruct,
+                                  self.read_share_data(start, fieldsize))
+        ueb = unpack_extension(self.read_share_data(start + fieldsize,
+                                                    length))
+        block_size = mathutil.div_ceil(ueb['segment_size'],
+                                       ueb['needed_shares'])
+        share_size = offsets['plaintext_hash_tree'] - offsets['data']
+        (root, share_hashes) = self.hash_blocks(block_size, share_size)
+        if root != self.read_share_data(offsets['block_hashes'], HASH_SIZE):
+            return "the blocks do not match the block hash tree"
+        # the leaf of the share hash tree for this share is the root of
+        # its block hash tree
+        leaf = roundup_pow2(ueb['total_shares']) - 1 + shnum
+        if dict(share_hashes).get(leaf, root) != root:
+            return "the blocks do not match the share hash chain"
+        return None
+
+    def _mapping_failed(self):
+        log.msg(format="unable to map %(path)s, reading it instead",
+                path=self.home, level=log.UNUSUAL, umid="Qm1Ax4")
+        self._mmap_cache = None
+
+    def _read_container(self, offset, length):
+        if self._mmap_cache is not None and offset + length <= self._lease_offset:
+            try:
+                return self._mmap_cache.read(self.home, self._lease_offset,
+                                             offset, length)
+            except (EnvironmentError, ValueError, OverflowError):
+                self._mapping_failed()
+        if self._fd_cache is not None:
+            return self._fd_cache.pread(self.home, length, offset)
+        with self._open('rb') as f:
+            f.seek(offset)
+            return f.read(length)
 
     def write_share_data(self, offset, data):
         length = len(data)
         precondition(offset >= 0, offset)
         if self._max_size is not None and offset+length > self._max_size:
             raise DataTooLargeError(self._max_size, offset, length)
-        with open(self.home, 'rb+') as f:
+        with self._get_file('rb+') as f:
             real_offset = self._data_offset+offset
             f.seek(real_offset)
             assert f.tell() == real_offset
@@ -134,7 +281,7 @@ class ShareFile(object):
 
     def get_leases(self):
         """Yields a LeaseInfo instance for all leases."""
-        with open(self.home, 'rb') as f:
+        with self._open('rb') as f:
             (version, unused, num_leases) = struct.unpack(">LLL", f.read(0xc))
             f.seek(self._lease_offset)
             for i in range(num_leases):
@@ -143,7 +290,7 @@ class ShareFile(object):
                     yield LeaseInfo().from_immutable_data(data)
 
     def add_lease(self, lease_info):
-        with open(self.home, 'rb+') as f:
+        with self._open('rb+') as f:
             num_leases = self._read_num_leases(f)
             self._write_lease_record(f, num_leases, lease_info)
             self._write_num_leases(f, num_leases+1)
@@ -155,7 +302,7 @@ class ShareFile(object):
                 if new_expire_time > lease.expiration_time:
                     # yes
                     lease.expiration_time = new_expire_time
-                    with open(self.home, 'rb+') as f:
+                    with self._open('rb+') as f:
                         self._write_lease_record(f, i, lease)
                 return
         raise IndexError("unable to renew non-existent lease")
@@ -189,14 +336,14 @@ class ShareFile(object):
             # the same order as they were added, so that if we crash while
             # doing this, we won't lose any non-cancelled leases.
             leases = [l for l in leases if l] # remove the cancelled leases
-            with open(self.home, 'rb+') as f:
+            with self._open('rb+') as f:
                 for i, lease in enumerate(leases):
                     self._write_lease_record(f, i, lease)
                 self._write_num_leases(f, len(leases))
                 self._truncate_leases(f, len(leases))
         space_freed = self.LEASE_SIZE * num_leases_removed
         if not len(leases):
-            space_freed += os.stat(self.home)[stat.ST_SIZE]
+            space_freed += self.get_container_size()
             self.unlink()
         return space_freed
 
@@ -204,11 +351,32 @@ class ShareFile(object):
 @implementer(RIBucketWriter)
 class BucketWriter(Referenceable):
 
-    def __init__(self, ss, incominghome, finalhome, max_size, lease_info, canary):
+    def __init__(self, ss, incominghome, finalhome, max_size, lease_info,
+                 canary, disk_io=None, packed_store=None, storage_index=None,
+                 shnum=None, priority=None, client=None, durability="none",
+                 group_committer=None):
+        """If disk_io is not None, writing, closing, and aborting are done
+        in that DiskIOPool's threads, in the order they were requested. If
+        packed_store is not None, the finished share is put into that
+        PackedShareStore under storage_index and shnum, rather than moved
+        to finalhome. priority and client say how the storage server
+        schedules writes, as for the allocate_buckets call which made me.
+        durability is one of storage.durability.DURABILITY_POLICIES; for
+        "group", group_committer is the GroupCommitter which syncs the
+        share."""
+        assert durability != "group" or group_committer is not None
         self.ss = ss
         self.incominghome = incominghome
         self.finalhome = finalhome
         self._max_size = max_size # don't allow the client to write more than this
+        self._disk_io = disk_io
+        self._packed_store = packed_store
+        self._storage_index = storage_index
+        self._shnum = shnum
+        self._priority = priority
+        self._client = client
+        self._durability = durability
+        self._group_committer = group_committer
         self._canary = canary
         self._disconnect_marker = canary.notifyOnDisconnect(self._disconnected)
         self.closed = False
@@ -217,25 +385,133 @@ class BucketWriter(Referenceable):
         # also, add our lease to the file now, so that other ones can be
         # added by simultaneous uploaders
         self._sharefile.add_lease(lease_info)
+        self._sharefile.open()
+        # adjacent writes are collected here and written together
+        self._buffer = []
+        self._buffer_offset = 0
+        self._buffered = 0
 
     def allocated_size(self):
         return self._max_size
 
+    REQUEST_CLASSES = {"write": "write",
+                       "close": "write",
+                       }
+    REQUEST_COSTS = {"write": lambda offset, data: len(data)}
+
+    def doRemoteCall(self, methodname, args, kwargs):
+        return self.ss.schedule_remote_call(self, methodname, args, kwargs,
+                                            self._priority, self._client)
+
     def remote_write(self, offset, data):
         start = time.time()
         precondition(not self.closed)
         if self.throw_out_all_data:
             return
-        self._sharefile.write_share_data(offset, data)
+        if self._disk_io is not None:
+            d = self._disk_io.run(self.incominghome, self._write, offset, data)
+            d.addCallback(lambda ign: self._written(start))
+            return d
+        self._write(offset, data)
+        self._written(start)
+
+    # Clients send a share as a series of writes, mostly of single blocks,
+    # each following the last. Writes are buffered until this much data
+    # has been collected, so that the disk sees fewer, larger writes. The
+    # buffered data is only lost if the server stops before the share is
+    # closed, and the incomplete share would be thrown away then anyway.
+    WRITE_BUFFER_SIZE = 128*1024
+
+    def _write(self, offset, data):
+        precondition(offset >= 0, offset)
+        if offset + len(data) > self._max_size:
+            raise DataTooLargeError(self._max_size, offset, len(data))
+        if self._buffer and offset != self._buffer_offset + self._buffered:
+            self._flush()
+        if not self._buffer:
+            if len(data) >= self.WRITE_BUFFER_SIZE:
+                self._sharefile.write_share_data(offset, data)
+                return
+            self._buffer_offset = offset
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.WRITE_BUFFER_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if self._buffer:
+            data = b"".join(self._buffer)
+            self._buffer = []
+            self._buffered = 0
+            self._sharefile.write_share_data(self._buffer_offset, data)
+
+    def _finish(self, sync):
+        """Write out any buffered data, sync the share to disk if sync is
+        true, and close it."""
+        self._flush()
+        if sync:
+            self._sharefile.sync()
+        self._sharefile.close()
+
+    def _synced_directories(self):
+        """Return the directories whose entries must be synced to make a
+        share moved into place durable."""
+        if self._packed_store is not None:
+            # the packed store syncs its own segments
+            return []
+        return [os.path.dirname(self.finalhome)]
+
+    def _written(self, start):
         self.ss.add_latency("write", time.time() - start)
         self.ss.count("write")
 
     def remote_close(self):
         precondition(not self.closed)
         start = time.time()
-
-        fileutil.make_dirs(os.path.dirname(self.finalhome))
-        fileutil.rename(self.incominghome, self.finalhome)
+        # no more writes will be accepted, and a disconnect no longer
+        # aborts the upload
+        self.closed = True
+        self._canary.dontNotifyOnDisconnect(self._disconnect_marker)
+        if self._durability == "group":
+            # the flush waits for any writes still queued
+            d = self._run(self._flush)
+            d.addCallback(lambda ign: self._group_committer.commit(self))
+        elif self._disk_io is not None:
+            d = self._disk_io.run(self.incominghome, self._close_share)
+        else:
+            self._closed(self._close_share(), start)
+            return
+        d.addCallback(self._closed, start)
+        return d
+
+    def _run(self, f, *args):
+        if self._disk_io is not None:
+            return self._disk_io.run(self.incominghome, f, *args)
+        return defer.maybeDeferred(f, *args)
+
+    def _close_share(self):
+        sync = self._durability == "fsync"
+        self._finish(sync)
+        filelen = self._move_into_place()
+        if sync:
+            for dirname in self._synced_directories():
+                fsync_directory(dirname)
+        return filelen
+
+    def _move_into_place(self):
+        """Move the finished share from incoming/ to its final home, and
+        return its size."""
+        if self._packed_store is not None:
+            with open(self.incominghome, 'rb') as f:
+                container = f.read()
+            self._packed_store.put_share(self._storage_index, self._shnum,
+                                         container)
+            os.remove(self.incominghome)
+            filelen = len(container)
+        else:
+            fileutil.make_dirs(os.path.dirname(self.finalhome))
+            fileutil.rename(self.incominghome, self.finalhome)
+            filelen = os.stat(self.finalhome)[stat.ST_SIZE]
         try:
             # self.incominghome is like storage/shares/incoming/ab/abcde/4 .
             # We try to delete the parent (.../ab/abcde) to avoid leaving
@@ -260,11 +536,10 @@ class BucketWriter(Referenceable):
             # exceptions, those are normal consequences of the
             # above-mentioned conditions.
             pass
-        self._sharefile = None
-        self.closed = True
-        self._canary.dontNotifyOnDisconnect(self._disconnect_marker)
+        return filelen
 
-        filelen = os.stat(self.finalhome)[stat.ST_SIZE]
+    def _closed(self, filelen, start):
+        self._sharefile = None
         self.ss.bucket_writer_closed(self, filelen)
         self.ss.add_latency("close", time.time() - start)
         self.ss.count("close")
@@ -285,12 +560,14 @@ class BucketWriter(Referenceable):
         if self.closed:
             return
 
-        os.remove(self.incominghome)
-        # if we were the last share to be moved, remove the incoming/
-        # directory that was our parent
-        parentdir = os.path.split(self.incominghome)[0]
-        if not os.listdir(parentdir):
-            os.rmdir(parentdir)
+        if self._disk_io is not None:
+            # writes already queued must finish before the file goes away
+            d = self._disk_io.run(self.incominghome, self._remove_incoming,
+                                  self._sharefile)
+            d.addErrback(log.err, "storage: error removing aborted share",
+                         umid="ZzSFeg")
+        else:
+            self._remove_incoming(self._sharefile)
         self._sharefile = None
 
         # We are now considered closed for further writing. We must tell
@@ -299,15 +576,37 @@ class BucketWriter(Referenceable):
         self.closed = True
         self.ss.bucket_writer_closed(self, 0)
 
+    def _remove_incoming(self, sharefile):
+        sharefile.close()
+        os.remove(self.incominghome)
+        # if we were the last share to be moved, remove the incoming/
+        # directory that was our parent
+        parentdir = os.path.split(self.incominghome)[0]
+        if not os.listdir(parentdir):
+            os.rmdir(parentdir)
+
 
 @implementer(RIBucketReader)
 class BucketReader(Referenceable):
 
-    def __init__(self, ss, sharefname, storage_index=None, shnum=None):
+    def __init__(self, ss, sharefname, storage_index=None, shnum=None,
+                 fd_cache=None, disk_io=None, share_file=None,
+                 mmap_cache=None, priority=None, client=None):
+        """If disk_io is not None, reads are done in that DiskIOPool's
+        threads. If share_file is not None, it is read instead of the
+        share file at sharefname. priority and client say how the storage
+        server schedules reads, as for the get_buckets call which made
+        me."""
         self.ss = ss
-        self._share_file = ShareFile(sharefname)
+        if share_file is None:
+            share_file = ShareFile(sharefname, fd_cache=fd_cache,
+                                   mmap_cache=mmap_cache)
+        self._share_file = share_file
+        self._disk_io = disk_io
         self.storage_index = storage_index
         self.shnum = shnum
+        self._priority = priority
+        self._client = client
 
     def __repr__(self):
         return "<%s %s %s>" % (self.__class__.__name__,
@@ -316,12 +615,63 @@ class BucketReader(Referenceable):
                                ),
                                self.shnum)
 
+    REQUEST_CLASSES = {"read": "read",
+                       "readv": "read",
+                       "hash_blocks": "verify",
+                       }
+    REQUEST_COSTS = {"read": lambda offset, length: length,
+                     "readv": lambda vector: sum(length for (offset, length)
+                                                 in vector),
+                     "hash_blocks": lambda block_size, share_size: share_size,
+                     }
+
+    def doRemoteCall(self, methodname, args, kwargs):
+        return self.ss.schedule_remote_call(self, methodname, args, kwargs,
+                                            self._priority, self._client)
+
     def remote_read(self, offset, length):
         start = time.time()
+        if self._disk_io is not None:
+            d = self._disk_io.run(None, self._share_file.read_share_data,
+                                  offset, length)
+            d.addCallback(self._read_done, start)
+            return d
         data = self._share_file.read_share_data(offset, length)
+        return self._read_done(data, start)
+
+    def remote_readv(self, vector):
+        start = time.time()
+        if self._disk_io is not None:
+            d = self._disk_io.run(None, self._readv, vector)
+            d.addCallback(self._read_done, start)
+            return d
+        return self._read_done(self._readv(vector), start)
+
+    def _readv(self, vector):
+        return [self._share_file.read_share_data(offset, length)
+                for (offset, length) in vector]
+
+    def _read_done(self, result, start):
         self.ss.add_latency("read", time.time() - start)
         self.ss.count("read")
-        return data
+        return result
+
+    def remote_hash_blocks(self, block_size, share_size):
+        start = time.time()
+        # this reads the whole share, so never do it in the reactor thread
+        if self._disk_io is not None:
+            d = self._disk_io.run(None, self._share_file.hash_blocks,
+                                  block_size, share_size)
+        else:
+            d = threads.deferToThread(self._share_file.hash_blocks,
+                                      block_size, share_size)
+        d.addCallback(self._hash_blocks_done, start)
+        return d
+
+    def _hash_blocks_done(self, result, start):
+        self.ss.add_latency("hash-blocks", time.time() - start)
+        self.ss.count("hash-blocks")
+        return result
 
     def remote_advise_corrupt_share(self, reason):
         return self.ss.remote_advise_corrupt_share(b"immutable",
@@ -0,0 +1,130 @@
+"""
+A local SQLite index of the leases held on a storage server's shares.
+
+Ported to Python 3.
+"""
+
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+from allmydata.storage.common import si_a2b, si_b2a
+from allmydata.util import base32, hashutil
+from allmydata.util.dbutil import get_db
+
+SCHEMA_v1 = """
+CREATE TABLE version
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE leases
+(
+ storage_index VARCHAR(26) NOT NULL, -- base32
+ shnum INTEGER NOT NULL,
+ sharetype VARCHAR(9) NOT NULL,      -- 'mutable' or 'immutable'
+ renew_secret_hash VARCHAR(52) NOT NULL, -- base32, see renew_secret_hash()
+ owner_num INTEGER NOT NULL,
+ expiration_time INTEGER NOT NULL,   -- seconds since epoch
+ PRIMARY KEY (storage_index, shnum, renew_secret_hash)
+);
+
+CREATE INDEX leases_by_expiration_time ON leases (expiration_time);
+"""
+
+LEASE_DB_RENEW_SECRET_TAG = b"allmydata_lease_db_renew_secret_v1"
+
+
+def renew_secret_hash(renew_secret):
+    """The database never holds lease secrets, only this hash of them."""
+    return base32.b2a(hashutil.tagged_hash(LEASE_DB_RENEW_SECRET_TAG,
+                                           renew_secret)).decode("ascii")
+
+
+class LeaseDB(object):
+    """
+    I hold one row per lease per share: (storage index, shnum, sharetype,
+    renew secret hash, owner number, expiration time). The lease records in
+    the share files remain authoritative. I am a copy of them, kept current
+    by the storage server whenever it changes a lease or deletes a share,
+    so that expired leases can be found with one query on the expiration
+    time instead of by reading every share file.
+
+    Rows for shares that were changed behind the server's back are fixed up
+    by the lease-checking crawler as it visits each share.
+    """
+
+    def __init__(self, dbfile):
+        (self._sqlite, self._db) = get_db(dbfile,
+                                          create_version=(SCHEMA_v1, 1),
+                                          dbname="leasedb",
+                                          journal_mode="WAL",
+                                          synchronous="NORMAL")
+        self._cursor = self._db.cursor()
+
+    def close(self):
+        self._db.close()
+
+    def set_share_leases(self, storage_index, shnum, sharetype, leases):
+        """Replace the rows for one share with the given LeaseInfo
+        instances, which should be every lease currently on the share."""
+        si_s = si_b2a(storage_index).decode("ascii")
+        c = self._cursor
+        c.execute("DELETE FROM leases WHERE storage_index=? AND shnum=?",
+                  (si_s, shnum))
+        c.executemany("INSERT OR REPLACE INTO leases VALUES (?,?,?,?,?,?)",
+                      [(si_s, shnum, sharetype,
+                        renew_secret_hash(li.renew_secret),
+                        li.owner_num, int(li.get_expiration_time()))
+                       for li in leases])
+        self._db.commit()
+
+    def remove_share(self, storage_index, shnum):
+        si_s = si_b2a(storage_index).decode("ascii")
+        self._cursor.execute("DELETE FROM leases"
+                             " WHERE storage_index=? AND shnum=?",
+                             (si_s, shnum))
+        self._db.commit()
+
+    def get_share_leases(self, storage_index, shnum):
+        """
+        :return: A list of (renew_secret_hash, owner_num, expiration_time)
+            tuples, one for each lease on the share.
+        """
+        si_s = si_b2a(storage_index).decode("ascii")
+        self._cursor.execute("SELECT renew_secret_hash, owner_num,"
+                             " expiration_time FROM leases"
+                             " WHERE storage_index=? AND shnum=?"
+                             " ORDER BY renew_secret_hash",
+                             (si_s, shnum))
+        return [tuple(row) for row in self._cursor.fetchall()]
+
+    def get_shares_with_leases_expiring_before(self, expiration_time,
+                                               sharetypes):
+        """
+        :return: A sorted list of (storage_index, shnum, sharetype) tuples
+            for the shares of the given types which have at least one lease
+            with an expiration time earlier than ``expiration_time``.
+        """
+        sharetypes = list(sharetypes)
+        if not sharetypes:
+            return []
+        self._cursor.execute("SELECT DISTINCT storage_index, shnum, sharetype"
+                             " FROM leases WHERE expiration_time < ?"
+                             " AND sharetype IN (%s)"
+                             " ORDER BY storage_index, shnum"
+                             % ",".join("?" * len(sharetypes)),
+                             [int(expiration_time)] + sharetypes)
+        return [(si_a2b(si_s.encode("ascii")), shnum, sharetype)
+                for (si_s, shnum, sharetype) in self._cursor.fetchall()]
+
+    def get_stats(self):
+        self._cursor.execute("SELECT COUNT(*) FROM leases")
+        (leases,) = self._cursor.fetchone()
+        return {"leases": leases}
+
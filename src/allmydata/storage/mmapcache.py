@@ -0,0 +1,136 @@
+"""
+A bounded cache of memory-mapped immutable share files.
+
+Ported to Python 3.
+"""
+
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import os, mmap, threading
+from collections import OrderedDict
+
+
+class MappedFileCache(object):
+    """
+    I keep up to ``max_mapped`` share files memory-mapped, unmapping the
+    least recently used one when a new file is needed, so that reads of large
+    immutable shares are served straight from the page cache: no system call
+    per read, and no intermediate buffer between the kernel and the bytes
+    handed to the caller. ``view`` returns memoryview slices over the mapping
+    itself, for callers which can consume the data without copying it at
+    all.
+
+    Each mapping covers only the first ``size`` bytes of its file, which for
+    an immutable share is the end of the share data. Accessing a mapped page
+    beyond the end of a file raises SIGBUS, so a mapping must never extend
+    into a part of the file which might be truncated: lease records are
+    rewritten and truncated after the share data, but the share data itself
+    never shrinks.
+
+    Like a cached descriptor, a mapping keeps the underlying inode alive, so
+    whoever deletes or replaces a share file must call ``invalidate`` with
+    its path. A mapping which is still exported through a view when it is
+    evicted or invalidated is unmapped when the last view is released.
+
+    I may be used from several threads at once.
+    """
+
+    def __init__(self, max_mapped, min_size=1):
+        assert max_mapped > 0, max_mapped
+        assert min_size > 0, min_size
+        self.max_mapped = max_mapped
+        self.min_size = min_size
+        self._maps = OrderedDict() # path -> mmap, least recently used first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _retire(self, m):
+        # called with the lock held
+        try:
+            m.close()
+        except BufferError:
+            # a view is still using it
+            pass
+
+    def _get_map(self, path, size):
+        # called with the lock held
+        m = self._maps.pop(path, None)
+        if m is not None and len(m) != size:
+            self._retire(m)
+            m = None
+        if m is None:
+            self.misses += 1
+            fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+            try:
+                if os.fstat(fd).st_size < size:
+                    raise ValueError("%s is shorter than %d bytes"
+                                     % (path, size))
+                m = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+            finally:
+                # the mapping holds its own reference to the file
+                os.close(fd)
+            while len(self._maps) >= self.max_mapped:
+                (old_path, old_map) = self._maps.popitem(last=False)
+                self._retire(old_map)
+                self.evictions += 1
+        else:
+            self.hits += 1
+        self._maps[path] = m
+        return m
+
+    def view(self, path, size, offset, length):
+        """Return a memoryview of up to ``length`` bytes at ``offset`` within
+        the first ``size`` bytes of the file at ``path``, mapping the file if
+        it is not already mapped. The view must not be used after the file
+        has been invalidated.
+
+        :raise EnvironmentError: if the file cannot be opened or mapped.
+        :raise ValueError: if the file is shorter than ``size``.
+        """
+        end = min(offset + length, size)
+        with self._lock:
+            m = self._get_map(path, size)
+            if PY2:
+                # mmap objects do not support memoryview here
+                return memoryview(m[offset:end])
+            return memoryview(m)[offset:end]
+
+    def read(self, path, size, offset, length):
+        """Like ``view``, but return the data as bytes."""
+        v = self.view(path, size, offset, length)
+        try:
+            return v.tobytes()
+        finally:
+            if not PY2:
+                v.release()
+
+    def invalidate(self, path):
+        with self._lock:
+            m = self._maps.pop(path, None)
+            if m is not None:
+                self._retire(m)
+
+    def close_all(self):
+        with self._lock:
+            while self._maps:
+                (path, m) = self._maps.popitem()
+                self._retire(m)
+
+    def get_stats(self):
+        with self._lock:
+            mapped_bytes = sum(len(m) for m in self._maps.values())
+        return {"mapped": len(self._maps),
+                "mapped_bytes": mapped_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                }
@@ -11,7 +11,7 @@ from future.utils import PY2
 if PY2:
     from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
 
-import os, stat, struct
+import os, struct
 
 from allmydata.interfaces import BadWriteEnablerError
 from allmydata.util import idlib, log
@@ -19,7 +19,7 @@ from allmydata.util.assertutil import precondition
 from allmydata.util.hashutil import timing_safe_compare
 from allmydata.storage.lease import LeaseInfo
 from allmydata.storage.common import UnknownMutableContainerVersionError, \
-     DataTooLargeError
+     DataTooLargeError, HeldOpen
 from allmydata.mutable.layout import MAX_MUTABLE_SHARE_SIZE
 
 
@@ -66,12 +66,22 @@ class MutableShareFile(object):
     assert isinstance(MAGIC, bytes)
     MAX_SIZE = MAX_MUTABLE_SHARE_SIZE
     # TODO: decide upon a policy for max share size
+    # When a write runs past the end of the container, the container grows
+    # by at least this fraction of its size, so that a share written by a
+    # series of appends (as MDMF shares are) does not have its extra leases
+    # moved for every one of them.
+    CONTAINER_GROWTH = 0.5
+
+    # while the share is held open by open(), the open container and the
+    # fields of its header
+    _file = None
+    _header = None
 
     def __init__(self, filename, parent=None):
         self.home = filename
-        if os.path.exists(self.home):
+        if self._exists():
             # we don't cache anything, just check the magic
-            with open(self.home, 'rb') as f:
+            with self._open('rb') as f:
                 data = f.read(self.HEADER_SIZE)
             (magic,
              write_enabler_nodeid, write_enabler,
@@ -86,15 +96,69 @@ class MutableShareFile(object):
     def log(self, *args, **kwargs):
         return self.parent.log(*args, **kwargs)
 
+    def _open(self, mode):
+        return open(self.home, mode)
+
+    def open(self):
+        """Open the container and keep it open until ``close`` is called, so
+        that all the operations of one request use a single file handle.
+        Meanwhile, the header (including the location and number of the
+        extra leases) is read only once.
+        """
+        assert self._file is None
+        f = self._open('rb+')
+        try:
+            data = f.read(self.HEADER_SIZE)
+            (magic,
+             write_enabler_nodeid, write_enabler,
+             data_length, extra_lease_offset) = \
+             struct.unpack(">32s20s32sQQ", data)
+            assert magic == self.MAGIC
+            f.seek(extra_lease_offset)
+            (num_extra_leases,) = struct.unpack(">L", f.read(4))
+        except:
+            f.close()
+            raise
+        self._file = f
+        self._header = {
+            "write_enabler_nodeid": write_enabler_nodeid,
+            "write_enabler": write_enabler,
+            "data_length": data_length,
+            "extra_lease_offset": extra_lease_offset,
+            "num_extra_leases": num_extra_leases,
+        }
+
+    def close(self):
+        """Close the container opened by ``open``, if it is open."""
+        f = self._file
+        self._file = None
+        self._header = None
+        if f is not None:
+            f.close()
+
+    def _get_file(self, mode):
+        if self._file is not None:
+            return HeldOpen(self._file)
+        return self._open(mode)
+
+    def _exists(self):
+        return os.path.exists(self.home)
+
+    def get_container_size(self):
+        if self._file is not None:
+            self._file.seek(0, os.SEEK_END)
+            return self._file.tell()
+        return os.path.getsize(self.home)
+
     def create(self, my_nodeid, write_enabler):
-        assert not os.path.exists(self.home)
+        assert not self._exists()
         data_length = 0
         extra_lease_offset = (self.HEADER_SIZE
                               + 4 * self.LEASE_SIZE
                               + data_length)
         assert extra_lease_offset == self.DATA_OFFSET # true at creation
         num_extra_leases = 0
-        with open(self.home, 'wb') as f:
+        with self._open('wb') as f:
             header = struct.pack(
                 ">32s20s32sQQ",
                 self.MAGIC, my_nodeid, write_enabler,
@@ -107,9 +171,16 @@ class MutableShareFile(object):
             # extra leases go here, none at creation
 
     def unlink(self):
+        self.close()
         os.unlink(self.home)
 
+    def get_data_length(self):
+        with self._get_file('rb') as f:
+            return self._read_data_length(f)
+
     def _read_data_length(self, f):
+        if self._header is not None:
+            return self._header["data_length"]
         f.seek(self.DATA_LENGTH_OFFSET)
         (data_length,) = struct.unpack(">Q", f.read(8))
         return data_length
@@ -117,6 +188,8 @@ class MutableShareFile(object):
     def _write_data_length(self, f, data_length):
         f.seek(self.DATA_LENGTH_OFFSET)
         f.write(struct.pack(">Q", data_length))
+        if self._header is not None:
+            self._header["data_length"] = data_length
 
     def _read_share_data(self, f, offset, length):
         precondition(offset >= 0)
@@ -133,6 +206,8 @@ class MutableShareFile(object):
         return data
 
     def _read_extra_lease_offset(self, f):
+        if self._header is not None:
+            return self._header["extra_lease_offset"]
         f.seek(self.EXTRA_LEASE_OFFSET)
         (extra_lease_offset,) = struct.unpack(">Q", f.read(8))
         return extra_lease_offset
@@ -140,8 +215,12 @@ class MutableShareFile(object):
     def _write_extra_lease_offset(self, f, offset):
         f.seek(self.EXTRA_LEASE_OFFSET)
         f.write(struct.pack(">Q", offset))
+        if self._header is not None:
+            self._header["extra_lease_offset"] = offset
 
     def _read_num_extra_leases(self, f):
+        if self._header is not None:
+            return self._header["num_extra_leases"]
         offset = self._read_extra_lease_offset(f)
         f.seek(offset)
         (num_extra_leases,) = struct.unpack(">L", f.read(4))
@@ -151,6 +230,8 @@ class MutableShareFile(object):
         extra_lease_offset = self._read_extra_lease_offset(f)
         f.seek(extra_lease_offset)
         f.write(struct.pack(">L", num_leases))
+        if self._header is not None:
+            self._header["num_extra_leases"] = num_leases
 
     def _change_container_size(self, f, new_container_size):
         if new_container_size > self.MAX_SIZE:
@@ -177,6 +258,16 @@ class MutableShareFile(object):
         f.write(extra_lease_data)
         self._write_extra_lease_offset(f, new_extra_lease_offset)
 
+    def _grow_container_size(self, old_container_size, needed_size):
+        """Return the size to give a container of ``old_container_size``
+        which must hold ``needed_size`` bytes of data."""
+        if needed_size > self.MAX_SIZE:
+            # let _change_container_size complain
+            return needed_size
+        grown_size = old_container_size + int(old_container_size *
+                                              self.CONTAINER_GROWTH)
+        return max(needed_size, min(grown_size, self.MAX_SIZE))
+
     def _write_share_data(self, f, offset, data):
         length = len(data)
         precondition(offset >= 0)
@@ -194,7 +285,10 @@ class MutableShareFile(object):
                 # have to move the leases. With luck, they're expanding it
                 # more than the size of the extra lease block, which will
                 # minimize the corrupt-the-share window
-                self._change_container_size(f, offset+length)
+                self._change_container_size(
+                    f, self._grow_container_size(
+                        extra_lease_offset - self.DATA_OFFSET,
+                        offset+length))
                 extra_lease_offset = self._read_extra_lease_offset(f)
 
                 # an interrupt here is ok.. the container has been enlarged
@@ -275,7 +369,7 @@ class MutableShareFile(object):
 
     def get_leases(self):
         """Yields a LeaseInfo instance for all leases."""
-        with open(self.home, 'rb') as f:
+        with self._get_file('rb') as f:
             for i, lease in self._enumerate_leases(f):
                 yield lease
 
@@ -290,7 +384,7 @@ class MutableShareFile(object):
 
     def add_lease(self, lease_info):
         precondition(lease_info.owner_num != 0) # 0 means "no lease here"
-        with open(self.home, 'rb+') as f:
+        with self._get_file('rb+') as f:
             num_lease_slots = self._get_num_lease_slots(f)
             empty_slot = self._get_first_empty_lease_slot(f)
             if empty_slot is not None:
@@ -300,7 +394,7 @@ class MutableShareFile(object):
 
     def renew_lease(self, renew_secret, new_expire_time):
         accepting_nodeids = set()
-        with open(self.home, 'rb+') as f:
+        with self._get_file('rb+') as f:
             for (leasenum,lease) in self._enumerate_leases(f):
                 if timing_safe_compare(lease.renew_secret, renew_secret):
                     # yup. See if we need to update the owner time.
@@ -343,7 +437,7 @@ class MutableShareFile(object):
                                 cancel_secret=b"\x00"*32,
                                 expiration_time=0,
                                 nodeid=b"\x00"*20)
-        with open(self.home, 'rb+') as f:
+        with self._open('rb+') as f:
             for (leasenum,lease) in self._enumerate_leases(f):
                 accepting_nodeids.add(lease.nodeid)
                 if timing_safe_compare(lease.cancel_secret, cancel_secret):
@@ -355,7 +449,7 @@ class MutableShareFile(object):
                 freed_space = self._pack_leases(f)
                 f.close()
                 if not remaining:
-                    freed_space += os.stat(self.home)[stat.ST_SIZE]
+                    freed_space += self.get_container_size()
                     self.unlink()
                 return freed_space
 
@@ -371,6 +465,9 @@ class MutableShareFile(object):
         return 0
 
     def _read_write_enabler_and_nodeid(self, f):
+        if self._header is not None:
+            return (self._header["write_enabler"],
+                    self._header["write_enabler_nodeid"])
         f.seek(0)
         data = f.read(self.HEADER_SIZE)
         (magic,
@@ -382,7 +479,7 @@ class MutableShareFile(object):
 
     def readv(self, readv):
         datav = []
-        with open(self.home, 'rb') as f:
+        with self._get_file('rb') as f:
             for (offset, length) in readv:
                 datav.append(self._read_share_data(f, offset, length))
         return datav
@@ -394,7 +491,7 @@ class MutableShareFile(object):
 #        return data_length
 
     def check_write_enabler(self, write_enabler, si_s):
-        with open(self.home, 'rb+') as f:
+        with self._get_file('rb+') as f:
             (real_write_enabler, write_enabler_nodeid) = \
                                  self._read_write_enabler_and_nodeid(f)
         # avoid a timing attack
@@ -413,7 +510,7 @@ class MutableShareFile(object):
 
     def check_testv(self, testv):
         test_good = True
-        with open(self.home, 'rb+') as f:
+        with self._get_file('rb+') as f:
             for (offset, length, operator, specimen) in testv:
                 data = self._read_share_data(f, offset, length)
                 if not testv_compare(data, operator, specimen):
@@ -422,7 +519,7 @@ class MutableShareFile(object):
         return test_good
 
     def writev(self, datav, new_length):
-        with open(self.home, 'rb+') as f:
+        with self._get_file('rb+') as f:
             for (offset, data) in datav:
                 self._write_share_data(f, offset, data)
             if new_length is not None:
@@ -433,6 +530,7 @@ class MutableShareFile(object):
                     # share data has shrunk, then call
                     # self._change_container_size() here.
 
+
 def testv_compare(a, op, b):
     assert op in (b"lt", b"le", b"eq", b"ne", b"ge", b"gt")
     if op == b"lt":
@@ -0,0 +1,482 @@
+"""
+A log-structured store which packs many small shares into a few large
+segment files.
+
+Ported to Python 3.
+"""
+
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import os, re, io, struct, threading, zlib
+from collections import namedtuple
+
+from allmydata.storage.common import si_b2a
+from allmydata.storage.immutable import ShareFile
+from allmydata.storage.mutable import MutableShareFile
+from allmydata.storage.fdcache import FileDescriptorCache
+from allmydata.storage.shareindex import share_type_from_header
+from allmydata.util import fileutil, log
+
+# Each segment file is a sequence of records. A record is:
+#  0x00: magic, four bytes, b"TPS1"
+#  0x04: record kind, one byte: 1 for a share, 2 for a deletion
+#  0x05: storage index, 16 bytes
+#  0x15: share number, four bytes big-endian
+#  0x19: CRC-32 of the record data, four bytes big-endian
+#  0x1d: length of the record data, eight bytes big-endian = L
+#  0x25: record data, L bytes: for a share, its complete container (exactly
+#        what would be in its share file), and nothing for a deletion
+#
+# Records are only ever appended. A later record for the same (storage
+# index, share number) supersedes any earlier one, and segments are read in
+# numerical order, so the newest record of each share decides whether it
+# exists and what it holds.
+
+RECORD_MAGIC = b"TPS1"
+RECORD_HEADER = ">4sB16sLLQ"
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_HEADER)
+assert RECORD_HEADER_SIZE == 0x25, RECORD_HEADER_SIZE
+KIND_SHARE = 1
+KIND_DELETED = 2
+
+SEGMENT_RE = re.compile("^segment-([0-9]{8})$")
+
+PackedShareStat = namedtuple("PackedShareStat", ["st_size"])
+
+
+class _Segment(object):
+    def __init__(self, segnum):
+        self.segnum = segnum
+        self.size = 0 # bytes in the file, including garbage
+        self.live_bytes = 0 # bytes of records for shares which still exist
+        self.shares = set() # keys whose newest record is in this segment
+        self.deletions = set() # likewise, where that record is a deletion
+
+
+class PackedShareStore(object):
+    """
+    I hold share containers as records appended to large segment files,
+    with an in-memory index from (storage index, share number) to the
+    record's location, so that a server with millions of small shares does
+    not need millions of files and directories to hold them.
+
+    Changing a share appends a complete new copy of its container, and
+    deleting one appends a deletion record. The space taken by superseded
+    records is reclaimed by ``compact``, which copies the live records out
+    of mostly-garbage segments and then deletes those segments. Shares
+    which expire are deleted by the lease checker like any other, and their
+    space is reclaimed the same way.
+
+    The index is rebuilt by reading the record headers of every segment when
+    I am created. A torn record at the end of the newest segment, as left by
+    a crash in the middle of an append, is discarded.
+
+    I may be used from several threads at once.
+    """
+
+    SEGMENT_SIZE = 64*1024*1024
+    # compact a segment once at least this fraction of it is garbage
+    COMPACTION_THRESHOLD = 0.5
+
+    def __init__(self, directory, segment_size=None):
+        self.directory = directory
+        if segment_size is not None:
+            self.SEGMENT_SIZE = segment_size
+        fileutil.make_dirs(directory)
+        self._lock = threading.Lock()
+        self._index = {} # (storage index, shnum) -> (segnum, offset, length)
+        self._buckets = {} # storage index -> set of shnums
+        self._prefixes = {} # prefix -> set of storage indexes
+        self._segments = {} # segnum -> _Segment
+        self._fd_cache = FileDescriptorCache(16)
+        self._writer = None
+        self.compactions = 0
+        self.reclaimed_bytes = 0
+        self._load()
+
+    def _segment_path(self, segnum):
+        return os.path.join(self.directory, "segment-%08d" % segnum)
+
+    def _prefix(self, storage_index):
+        return si_b2a(storage_index)[:2].decode("ascii")
+
+    # loading
+
+    def _load(self):
+        segnums = []
+        for name in os.listdir(self.directory):
+            mo = SEGMENT_RE.match(name)
+            if mo:
+                segnums.append(int(mo.group(1)))
+        segnums.sort()
+        for segnum in segnums:
+            self._scan_segment(segnum, segnum == segnums[-1])
+        if segnums:
+            self._current = segnums[-1]
+        else:
+            self._current = 1
+            self._segments[1] = _Segment(1)
+        self._writer = open(self._segment_path(self._current), "ab")
+
+    def _scan_segment(self, segnum, newest):
+        """Add the records of one segment to the index. Only the newest
+        segment can have been interrupted by a crash, so only its record
+        data is checked, and anything after the last good record in it is
+        cut off."""
+        path = self._segment_path(segnum)
+        seg = self._segments[segnum] = _Segment(segnum)
+        filesize = os.path.getsize(path)
+        offset = 0
+        with open(path, "rb") as f:
+            while offset + RECORD_HEADER_SIZE <= filesize:
+                header = f.read(RECORD_HEADER_SIZE)
+                (magic, kind, storage_index, shnum, checksum,
+                 length) = struct.unpack(RECORD_HEADER, header)
+                end = offset + RECORD_HEADER_SIZE + length
+                if (magic != RECORD_MAGIC
+                    or kind not in (KIND_SHARE, KIND_DELETED)
+                    or end > filesize):
+                    break
+                if newest:
+                    data = f.read(length)
+                    if zlib.crc32(data) & 0xffffffff != checksum:
+                        break
+                else:
+                    f.seek(length, os.SEEK_CUR)
+                self._note_record(seg, offset, kind, storage_index, shnum,
+                                  length)
+                offset = end
+        seg.size = filesize
+        if offset < filesize:
+            if newest:
+                log.msg(format="discarding %(bytes)d bytes of incomplete "
+                        "records at the end of %(path)s",
+                        bytes=filesize - offset, path=path,
+                        level=log.UNUSUAL, umid="nNp0Pg")
+                with open(path, "rb+") as f:
+                    f.truncate(offset)
+                seg.size = offset
+            else:
+                # the rest of this segment is counted as garbage, so
+                # compaction will get rid of it
+                log.msg(format="unreadable records at offset %(offset)d "
+                        "of %(path)s", offset=offset, path=path,
+                        level=log.WEIRD, umid="r1Gm7A")
+
+    # index maintenance, called with the lock held
+
+    def _forget(self, key):
+        """Note that the newest record for ``key`` is being superseded."""
+        location = self._index.pop(key, None)
+        if location is not None:
+            (segnum, offset, length) = location
+            seg = self._segments[segnum]
+            seg.live_bytes -= RECORD_HEADER_SIZE + length
+            seg.shares.discard(key)
+            (storage_index, shnum) = key
+            shnums = self._buckets[storage_index]
+            shnums.discard(shnum)
+            if not shnums:
+                del self._buckets[storage_index]
+                prefix = self._prefix(storage_index)
+                self._prefixes[prefix].discard(storage_index)
+                if not self._prefixes[prefix]:
+                    del self._prefixes[prefix]
+        # there are only ever a few segments
+        for seg in self._segments.values():
+            seg.deletions.discard(key)
+
+    def _note_record(self, seg, offset, kind, storage_index, shnum, length):
+        key = (storage_index, shnum)
+        self._forget(key)
+        if kind == KIND_SHARE:
+            self._index[key] = (seg.segnum, offset, length)
+            seg.live_bytes += RECORD_HEADER_SIZE + length
+            seg.shares.add(key)
+            self._buckets.setdefault(storage_index, set()).add(shnum)
+            self._prefixes.setdefault(self._prefix(storage_index),
+                                      set()).add(storage_index)
+        else:
+            seg.deletions.add(key)
+
+    def _append(self, kind, storage_index, shnum, data):
+        assert len(storage_index) == 16, storage_index
+        seg = self._segments[self._current]
+        if seg.size >= self.SEGMENT_SIZE:
+            seg = self._start_new_segment()
+        header = struct.pack(RECORD_HEADER, RECORD_MAGIC, kind, storage_index,
+                             shnum, zlib.crc32(data) & 0xffffffff, len(data))
+        offset = seg.size
+        self._writer.write(header + data)
+        # readers use their own descriptors, so they must be able to see
+        # the record as soon as the index points at it
+        self._writer.flush()
+        seg.size += len(header) + len(data)
+        self._note_record(seg, offset, kind, storage_index, shnum, len(data))
+
+    def _start_new_segment(self):
+        # a finished segment is never written again, and only the newest
+        # segment is checked for torn records at startup, so it must be
+        # safely on disk before anything is written to its successor
+        self._writer.flush()
+        os.fsync(self._writer.fileno())
+        self._writer.close()
+        self._current += 1
+        seg = self._segments[self._current] = _Segment(self._current)
+        self._writer = open(self._segment_path(self._current), "ab")
+        return seg
+
+    # queries
+
+    def has_shares(self):
+        return bool(self._index)
+
+    def has_share(self, storage_index, shnum):
+        return (storage_index, shnum) in self._index
+
+    def get_shnums(self, storage_index):
+        """Return a sorted list of the share numbers I hold for
+        ``storage_index``."""
+        with self._lock:
+            return sorted(self._buckets.get(storage_index, ()))
+
+    def get_bucket_names(self, prefix):
+        """Return the base32-encoded storage indexes I hold shares for whose
+        names start with ``prefix``, like the names of the bucket
+        directories in a prefix directory."""
+        with self._lock:
+            storage_indexes = list(self._prefixes.get(prefix, ()))
+        return [si_b2a(si).decode("ascii") for si in storage_indexes]
+
+    def get_share_size(self, storage_index, shnum):
+        with self._lock:
+            return self._index[(storage_index, shnum)][2]
+
+    def get_share_type(self, storage_index, shnum):
+        """Return ``"immutable"``, ``"mutable"``, or ``None`` if the share
+        does not hold a share container."""
+        return share_type_from_header(
+            self.read_share(storage_index, shnum, 0, 32))
+
+    def read_share(self, storage_index, shnum, offset, length):
+        """Read up to ``length`` bytes at ``offset`` in a share's container.
+        Fewer bytes are returned only at the end of the container.
+
+        :raise KeyError: if I do not hold that share.
+        """
+        key = (storage_index, shnum)
+        while True:
+            with self._lock:
+                (segnum, record_offset, size) = self._index[key]
+            length = max(0, min(length, size - offset))
+            if not length:
+                return b""
+            try:
+                return self._fd_cache.pread(
+                    self._segment_path(segnum), length,
+                    record_offset + RECORD_HEADER_SIZE + offset)
+            except EnvironmentError:
+                # compaction may have moved the share and deleted its
+                # segment since we looked it up
+                with self._lock:
+                    if self._index.get(key, (None,))[0] == segnum:
+                        raise
+
+    def get_share(self, storage_index, shnum):
+        """Return the whole container of a share.
+
+        :raise KeyError: if I do not hold that share.
+        """
+        return self.read_share(storage_index, shnum, 0,
+                               self.get_share_size(storage_index, shnum))
+
+    # changes
+
+    def put_share(self, storage_index, shnum, data):
+        """Store ``data`` as the complete container of a share, replacing any
+        earlier version."""
+        with self._lock:
+            self._append(KIND_SHARE, storage_index, shnum, data)
+
+    def remove_share(self, storage_index, shnum):
+        with self._lock:
+            if (storage_index, shnum) in self._index:
+                self._append(KIND_DELETED, storage_index, shnum, b"")
+
+    def close(self):
+        with self._lock:
+            if self._writer is not None:
+                self._writer.flush()
+                os.fsync(self._writer.fileno())
+                self._writer.close()
+                self._writer = None
+        self._fd_cache.close_all()
+
+    def compact(self, threshold=None):
+        """Copy the live records out of every finished segment in which at
+        least ``threshold`` (by default ``COMPACTION_THRESHOLD``) of the
+        bytes are garbage, and delete those segments.
+
+        :return: The number of bytes reclaimed.
+        """
+        if threshold is None:
+            threshold = self.COMPACTION_THRESHOLD
+        reclaimed = 0
+        for segnum in sorted(self._segments):
+            with self._lock:
+                seg = self._segments.get(segnum)
+                if seg is None or segnum == self._current or not seg.size:
+                    continue
+                garbage = seg.size - seg.live_bytes
+                if garbage < threshold * seg.size:
+                    continue
+                reclaimed += self._compact_segment(seg)
+        return reclaimed
+
+    def _compact_segment(self, seg):
+        # called with the lock held
+        path = self._segment_path(seg.segnum)
+        before = sum(s.size for s in self._segments.values())
+        for key in sorted(seg.shares):
+            (segnum, offset, length) = self._index[key]
+            data = self._fd_cache.pread(path, length,
+                                        offset + RECORD_HEADER_SIZE)
+            self._append(KIND_SHARE, key[0], key[1], data)
+        # A deletion record must outlive every older record of its share,
+        # or the share would come back the next time the index is loaded.
+        # Only carry one forward if there is an older segment which might
+        # still hold such a record.
+        if min(self._segments) < seg.segnum:
+            for key in sorted(seg.deletions):
+                self._append(KIND_DELETED, key[0], key[1], b"")
+        del self._segments[seg.segnum]
+        self._writer.flush()
+        os.fsync(self._writer.fileno())
+        self._fd_cache.invalidate(path)
+        os.unlink(path)
+        reclaimed = before - sum(s.size for s in self._segments.values())
+        self.compactions += 1
+        self.reclaimed_bytes += reclaimed
+        return reclaimed
+
+    def get_stats(self):
+        with self._lock:
+            return {"segments": len(self._segments),
+                    "shares": len(self._index),
+                    "live_bytes": sum(s.live_bytes
+                                      for s in self._segments.values()),
+                    "total_bytes": sum(s.size
+                                       for s in self._segments.values()),
+                    "compactions": self.compactions,
+                    "reclaimed_bytes": self.reclaimed_bytes,
+                    }
+
+
+class _ContainerFile(io.BytesIO):
+    """A file-like copy of a packed share's container. If it was opened for
+    writing and has been changed, the new container is stored when it is
+    closed."""
+
+    def __init__(self, store, storage_index, shnum, mode):
+        data = b""
+        if "w" not in mode:
+            data = store.get_share(storage_index, shnum)
+        io.BytesIO.__init__(self, data)
+        self._store = store
+        self._key = (storage_index, shnum)
+        self._writable = "w" in mode or "+" in mode
+        self._dirty = "w" in mode
+
+    def write(self, data):
+        assert self._writable
+        self._dirty = True
+        return io.BytesIO.write(self, data)
+
+    def truncate(self, size=None):
+        assert self._writable
+        self._dirty = True
+        return io.BytesIO.truncate(self, size)
+
+    def close(self):
+        if self._dirty and not self.closed:
+            self._store.put_share(self._key[0], self._key[1],
+                                  self.getvalue())
+            self._dirty = False
+        io.BytesIO.close(self)
+
+
+class _PackedContainer(object):
+    """Mixed into the share file classes to keep their container in a
+    PackedShareStore rather than in a file of its own. ``home`` is still set
+    to the path that file would have, for the benefit of log messages and
+    callers which take the share number from it."""
+
+    def _set_store(self, store, storage_index, shnum):
+        self._store = store
+        self._storage_index = storage_index
+        self._shnum = shnum
+
+    def _open(self, mode):
+        return _ContainerFile(self._store, self._storage_index, self._shnum,
+                              mode)
+
+    def _exists(self):
+        return self._store.has_share(self._storage_index, self._shnum)
+
+    def get_container_size(self):
+        return self._store.get_share_size(self._storage_index, self._shnum)
+
+    def stat(self):
+        return PackedShareStat(self.get_container_size())
+
+    def unlink(self):
+        self._store.remove_share(self._storage_index, self._shnum)
+
+
+class PackedShareFile(_PackedContainer, ShareFile):
+    def __init__(self, store, storage_index, shnum, home):
+        self._set_store(store, storage_index, shnum)
+        ShareFile.__init__(self, home)
+
+    def _read_container(self, offset, length):
+        return self._store.read_share(self._storage_index, self._shnum,
+                                      offset, length)
+
+
+class PackedMutableShareFile(_PackedContainer, MutableShareFile):
+    # the whole container is stored again whenever it changes, so room to
+    # grow into would only waste space in the store
+    CONTAINER_GROWTH = 0
+
+    def __init__(self, store, storage_index, shnum, home, parent=None):
+        self._set_store(store, storage_index, shnum)
+        MutableShareFile.__init__(self, home, parent)
+
+    def get_container_size(self):
+        if self._file is not None:
+            # the store has not seen the changes yet
+            return MutableShareFile.get_container_size(self)
+        return _PackedContainer.get_container_size(self)
+
+
+def create_packed_mutable_share(store, storage_index, shnum, home, my_nodeid,
+                                write_enabler, parent):
+    ms = PackedMutableShareFile(store, storage_index, shnum, home, parent)
+    ms.create(my_nodeid, write_enabler)
+    return PackedMutableShareFile(store, storage_index, shnum, home, parent)
+
+
+def open_packed_share(store, storage_index, shnum, home, parent=None):
+    """Return a PackedMutableShareFile or PackedShareFile for a share in
+    ``store``, according to its container header."""
+    if store.get_share_type(storage_index, shnum) == "mutable":
+        return PackedMutableShareFile(store, storage_index, shnum, home,
+                                      parent)
+    return PackedShareFile(store, storage_index, shnum, home)
@@ -0,0 +1,226 @@
+"""
+Scheduling of the storage server's client requests by priority.
+
+Ported to Python 3.
+"""
+
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+from collections import OrderedDict, deque
+
+from twisted.application import service
+from twisted.internet import defer
+
+from allmydata.util.statistics import Histogram
+
+# the request classes, most urgent first
+PRIORITY_CLASSES = ("read", # interactive downloads
+                    "write", # uploads and mutable writes
+                    "verify", # checking, verifying and repairing
+                    "lease", # adding and renewing leases
+                    )
+
+
+class ServerBusyError(Exception):
+    """The storage server already has too many requests queued from this
+    client."""
+
+
+class RequestScheduler(service.Service):
+    """
+    I decide when each client request to the storage server is carried out,
+    so that interactive reads are not stuck behind a repairer's or a lease
+    crawler's requests.
+
+    Each request has a class (one of ``PRIORITY_CLASSES``) and a client,
+    which is any hashable object identifying where it came from. Requests
+    are queued per class and, within a class, per client. Whenever fewer
+    than ``max_active`` requests are in progress, I start the oldest request
+    of the next client (in turn) of the most urgent class with anything
+    queued. A request which has waited more than ``MAX_WAIT`` seconds goes
+    ahead of more urgent classes, so that no class is starved completely.
+    Requests from the same client in the same class are started in the
+    order they arrived.
+
+    ``bandwidth`` maps classes to a limit in bytes per second on the data
+    their requests read or write. A class which has used up its allowance
+    waits for it to build up again, for at most one second's worth.
+
+    A client with ``max_queued_per_client`` requests already waiting in a
+    class has further requests in that class refused with
+    ``ServerBusyError``. Requests whose client is None came from clients
+    which did not identify themselves, and share one queue, which has a
+    limit of its own, ``max_queued_unidentified``, since it is shared by
+    all of those clients together.
+    """
+
+    MAX_WAIT = 10
+
+    def __init__(self, max_active, max_queued_per_client=1000,
+                 bandwidth=None, max_queued_unidentified=10000, reactor=None):
+        service.Service.__init__(self)
+        assert max_active > 0, max_active
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self.max_active = max_active
+        self.max_queued_per_client = max_queued_per_client
+        self.max_queued_unidentified = max_queued_unidentified
+        self.bandwidth = dict(bandwidth or {})
+        for request_class in self.bandwidth:
+            assert request_class in PRIORITY_CLASSES, request_class
+        # class -> OrderedDict of client -> deque of waiting requests, with
+        # the client to be served next first
+        self._queues = dict((c, OrderedDict()) for c in PRIORITY_CLASSES)
+        self._allowance = {} # class -> (time, bytes it may still use)
+        self._active = 0
+        self._dispatching = False
+        self._timer = None
+        self.queued = dict((c, 0) for c in PRIORITY_CLASSES)
+        self.started = dict((c, 0) for c in PRIORITY_CLASSES)
+        self.rejected = dict((c, 0) for c in PRIORITY_CLASSES)
+        self.wait_times = dict((c, Histogram()) for c in PRIORITY_CLASSES)
+
+    def stopService(self):
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        return service.Service.stopService(self)
+
+    def submit(self, request_class, client, cost, f, *args, **kwargs):
+        """Call ``f(*args, **kwargs)`` when it is the turn of this request.
+        ``cost`` is the number of bytes it will read or write.
+
+        :return: A Deferred that fires with the result of ``f``, or fails
+            with ``ServerBusyError`` if the client has too many requests
+            waiting.
+        """
+        clients = self._queues[request_class]
+        limit = self.max_queued_per_client
+        if client is None:
+            limit = self.max_queued_unidentified
+        waiting = clients.get(client)
+        if waiting is None:
+            waiting = clients[client] = deque()
+        elif len(waiting) >= limit:
+            self.rejected[request_class] += 1
+            return defer.fail(ServerBusyError(
+                "too many %s requests queued" % (request_class,)))
+        d = defer.Deferred()
+        waiting.append((self._reactor.seconds(), cost, f, args, kwargs, d))
+        self.queued[request_class] += 1
+        self._dispatch()
+        return d
+
+    def _refill(self, request_class, now):
+        rate = self.bandwidth[request_class]
+        (then, allowance) = self._allowance.get(request_class, (now, rate))
+        allowance = min(rate, allowance + (now - then) * rate)
+        self._allowance[request_class] = (now, allowance)
+        return allowance
+
+    def _next_class(self, now):
+        """Return the class of the request to start next, or None if none
+        may start now."""
+        ready = []
+        retry_after = None
+        for request_class in PRIORITY_CLASSES:
+            clients = self._queues[request_class]
+            if not clients:
+                continue
+            if request_class in self.bandwidth:
+                allowance = self._refill(request_class, now)
+                if allowance <= 0:
+                    delay = -allowance / self.bandwidth[request_class]
+                    if retry_after is None or delay < retry_after:
+                        retry_after = delay
+                    continue
+            ready.append(request_class)
+        if retry_after is not None:
+            self._retry_after(retry_after)
+        if not ready:
+            return None
+        # the request at the head of each class is the next one it will
+        # start, so it is the one which would wait longest
+        def head_submitted(request_class):
+            waiting = next(iter(self._queues[request_class].values()))
+            return waiting[0][0]
+        oldest = min(ready, key=head_submitted)
+        if now - head_submitted(oldest) > self.MAX_WAIT:
+            return oldest
+        return ready[0]
+
+    def _retry_after(self, delay):
+        if self._timer is not None and self._timer.active():
+            return
+        if not self.running:
+            return
+        self._timer = self._reactor.callLater(delay, self._dispatch)
+
+    def _dispatch(self):
+        if self._dispatching:
+            # a request finished while another was being started; the loop
+            # below will see the free slot
+            return
+        self._dispatching = True
+        try:
+            while self._active < self.max_active:
+                now = self._reactor.seconds()
+                request_class = self._next_class(now)
+                if request_class is None:
+                    break
+                clients = self._queues[request_class]
+                (client, waiting) = clients.popitem(last=False)
+                request = waiting.popleft()
+                if waiting:
+                    # the other clients get their turn first
+                    clients[client] = waiting
+                self._start(request_class, request, now)
+        finally:
+            self._dispatching = False
+
+    def _start(self, request_class, request, now):
+        (submitted, cost, f, args, kwargs, d) = request
+        self.queued[request_class] -= 1
+        self.started[request_class] += 1
+        self.wait_times[request_class].record(now - submitted)
+        if request_class in self.bandwidth:
+            (then, allowance) = self._allowance[request_class]
+            self._allowance[request_class] = (then, allowance - cost)
+        self._active += 1
+        d2 = defer.maybeDeferred(f, *args, **kwargs)
+        def _finished(res):
+            self._active -= 1
+            self._dispatch()
+            return res
+        d2.addBoth(_finished)
+        d2.chainDeferred(d)
+
+    def get_stats(self):
+        """
+        ``active`` counts the requests in progress. For each class,
+        ``queued`` counts the requests waiting to start, ``started`` and
+        ``rejected`` the requests started and refused since the server
+        started, and the ``wait_time`` values describe how long they waited,
+        in seconds.
+        """
+        stats = {"active": self._active}
+        for request_class in PRIORITY_CLASSES:
+            prefix = request_class + "."
+            stats[prefix + "queued"] = self.queued[request_class]
+            stats[prefix + "clients"] = len(self._queues[request_class])
+            stats[prefix + "started"] = self.started[request_class]
+            stats[prefix + "rejected"] = self.rejected[request_class]
+            wait_times = self.wait_times[request_class]
+            if wait_times.count:
+                stats[prefix + "wait_time.mean"] = wait_times.get_mean()
+                stats[prefix + "wait_time.99_0_percentile"] = \
+                    wait_times.get_percentile(0.99)
+        return stats
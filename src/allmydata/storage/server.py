@@ -13,27 +13,45 @@ if PY2:
     from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, pow, round, super, dict, list, object, range, str, max, min  # noqa: F401
 
 
-import os, re, struct, time
+import os, re, tempfile, time
 import weakref
+from functools import partial
 import six
 
 from foolscap.api import Referenceable
 from twisted.application import service
+from twisted.application.internet import TimerService
+from twisted.internet import defer, threads
+from twisted.python.failure import Failure
 
 from zope.interface import implementer
 from allmydata.interfaces import RIStorageServer, IStatsProducer
 from allmydata.util import fileutil, idlib, log, time_format
+from allmydata.util.statistics import Histogram
 import allmydata # for __full_version__
 
-from allmydata.storage.common import si_b2a, si_a2b, storage_index_to_dir
+from allmydata.storage.common import si_b2a, si_a2b, storage_index_to_dir, \
+     UnknownImmutableContainerVersionError
 _pyflakes_hush = [si_b2a, si_a2b, storage_index_to_dir] # re-exported
 from allmydata.storage.lease import LeaseInfo
 from allmydata.storage.mutable import MutableShareFile, EmptyShare, \
      create_mutable_sharefile
 from allmydata.mutable.layout import MAX_MUTABLE_SHARE_SIZE
 from allmydata.storage.immutable import ShareFile, BucketWriter, BucketReader
-from allmydata.storage.crawler import BucketCountingCrawler
 from allmydata.storage.expirer import LeaseCheckingCrawler
+from allmydata.storage.shareindex import ShareIndex, ShareIndexCrawler
+from allmydata.storage.fdcache import FileDescriptorCache
+from allmydata.storage.mmapcache import MappedFileCache
+from allmydata.storage.space import SpaceAccounting
+from allmydata.storage.diskio import DiskIOPool
+from allmydata.storage.durability import DURABILITY_POLICIES, GroupCommitter
+from allmydata.storage.scheduler import RequestScheduler, PRIORITY_CLASSES
+from allmydata.storage.leasedb import LeaseDB
+from allmydata.storage.corruption import CorruptionRegistry
+from allmydata.storage.sharecounter import ShareCounter, ShareCountingCrawler
+from allmydata.storage.shareindex import get_share_type
+from allmydata.storage.packed import PackedShareStore, PackedShareFile, \
+     PackedMutableShareFile, create_packed_mutable_share
 
 # storage/
 # storage/shares/incoming
@@ -45,15 +63,34 @@ from allmydata.storage.expirer import LeaseCheckingCrawler
 # Where "$START" denotes the first 10 bits worth of $STORAGEINDEX (that's 2
 # base-32 chars).
 
+# storage/packed/segment-$NUM
+#   when packed shares are enabled, small shares are kept in these segment
+#   files (see allmydata.storage.packed) rather than in files of their own
+
 # $SHARENUM matches this regex:
 NUM_RE=re.compile("^[0-9]+$")
 
 
+def _readv_cost(storage_index, shares, readv):
+    return sum(length for (offset, length) in readv) * max(len(shares), 1)
+
+def _writev_cost(storage_index, secrets, tw_vectors, r_vector):
+    return sum(len(data)
+               for (testv, datav, new_length) in tw_vectors.values()
+               for (offset, data) in datav)
+
+
 
 @implementer(RIStorageServer, IStatsProducer)
 class StorageServer(service.MultiService, Referenceable):
     name = 'storage'
     LeaseCheckerClass = LeaseCheckingCrawler
+    ShareCountingCrawlerClass = ShareCountingCrawler
+    LEASE_DB_EXPIRY_INTERVAL = 60*60
+    PACKED_COMPACTION_INTERVAL = 60*60
+    # the least time between checks of the hashes in shares that clients
+    # have reported as corrupt
+    REPORTED_SHARE_CHECK_INTERVAL = 60
 
     def __init__(self, storedir, nodeid, reserved_space=0,
                  discard_storage=False, readonly_storage=False,
@@ -62,11 +99,31 @@ class StorageServer(service.MultiService, Referenceable):
                  expiration_mode="age",
                  expiration_override_lease_duration=None,
                  expiration_cutoff_date=None,
-                 expiration_sharetypes=("mutable", "immutable")):
+                 expiration_sharetypes=("mutable", "immutable"),
+                 share_index_enabled=False,
+                 fd_cache_size=0,
+                 mmap_cache_size=0,
+                 mmap_min_share_size=1024*1024,
+                 lease_db_enabled=False,
+                 disk_io_threads=0,
+                 lease_checker_threads=0,
+                 packed_shares_enabled=False,
+                 packed_share_max_size=64*1024,
+                 max_active_requests=0,
+                 max_queued_requests_per_client=1000,
+                 max_queued_unidentified_requests=10000,
+                 request_bandwidth=None,
+                 durability="none",
+                 durability_group_interval=0.01,
+                 corruption_quarantine_threshold=0):
         service.MultiService.__init__(self)
         assert isinstance(nodeid, bytes)
         assert len(nodeid) == 20
         assert isinstance(nodeid, bytes)
+        started = time.time()
+        # phase -> seconds it took, for the phases of startup whose work
+        # may grow with the number of shares
+        self.startup_timings = {}
         self.my_nodeid = nodeid
         self.storedir = storedir
         sharedir = os.path.join(storedir, "shares")
@@ -75,6 +132,13 @@ class StorageServer(service.MultiService, Referenceable):
         # we don't actually create the corruption-advisory dir until necessary
         self.corruption_advisory_dir = os.path.join(storedir,
                                                     "corruption-advisories")
+        self.corruption_registry = CorruptionRegistry(
+            os.path.join(storedir, "corruption.sqlite"))
+        self.corruption_quarantine_threshold = corruption_quarantine_threshold
+        # when the last check of a reported share started, and whether one
+        # is running
+        self._last_share_check = None
+        self._checking_share = False
         self.reserved_space = int(reserved_space)
         self.no_storage = discard_storage
         self.readonly_storage = readonly_storage
@@ -82,28 +146,74 @@ class StorageServer(service.MultiService, Referenceable):
         if self.stats_provider:
             self.stats_provider.register_producer(self)
         self.incomingdir = os.path.join(sharedir, 'incoming')
-        self._clean_incomplete()
+        self._discarddir = os.path.join(storedir, "incoming-discarded")
+        self._time_startup("clean-incoming", self._clean_incomplete)
         fileutil.make_dirs(self.incomingdir)
         self._active_writers = weakref.WeakKeyDictionary()
+        self._space = SpaceAccounting(self.sharedir, self.reserved_space)
+        self._fd_cache = None
+        if fd_cache_size:
+            self._fd_cache = FileDescriptorCache(fd_cache_size)
+        self._mmap_cache = None
+        if mmap_cache_size:
+            self._mmap_cache = MappedFileCache(mmap_cache_size,
+                                               mmap_min_share_size)
+        self._disk_io = None
+        if disk_io_threads:
+            self._disk_io = DiskIOPool(disk_io_threads)
+            self._disk_io.setServiceParent(self)
+        assert durability in DURABILITY_POLICIES, durability
+        self.durability = durability
+        self._group_committer = None
+        if durability == "group":
+            self._group_committer = GroupCommitter(durability_group_interval,
+                                                   self._disk_io)
+            self._group_committer.setServiceParent(self)
+        self._scheduler = None
+        if max_active_requests:
+            self._scheduler = RequestScheduler(
+                max_active_requests, max_queued_requests_per_client,
+                request_bandwidth, max_queued_unidentified_requests)
+            self._scheduler.setServiceParent(self)
+        self.packed_store = None
+        self._pack_new_shares = packed_shares_enabled
+        self._packed_share_max_size = packed_share_max_size
+        packeddir = os.path.join(storedir, "packed")
+        if packed_shares_enabled or os.path.isdir(packeddir):
+            # shares packed by an earlier run must stay readable even when
+            # no new shares are being packed
+            self._time_startup("packed-store", self.add_packed_store,
+                               packeddir)
         log.msg("StorageServer created", facility="tahoe.storage")
 
         if reserved_space:
-            if self.get_available_space() is None:
+            if fileutil.get_available_space(self.sharedir,
+                                            self.reserved_space) is None:
                 log.msg("warning: [storage]reserved_space= is set, but this platform does not support an API to get disk statistics (statvfs(2) or GetDiskFreeSpaceEx), so this reservation cannot be honored",
                         umin="0wZ27w", level=log.UNUSUAL)
 
-        self.latencies = {"allocate": [], # immutable
-                          "write": [],
-                          "close": [],
-                          "read": [],
-                          "get": [],
-                          "writev": [], # mutable
-                          "readv": [],
-                          "add-lease": [], # both
-                          "renew": [],
-                          "cancel": [],
-                          }
-        self.add_bucket_counter()
+        self.latencies = {}
+        for category in ["allocate", "write", "close", "read", "get", # immutable
+                         "get-share-numbers", "hash-blocks",
+                         "writev", "readv", # mutable
+                         "add-lease", "add-leases", "renew", "cancel", # both
+                         ]:
+            if self.stats_provider:
+                # so that the stats gatherer gets the whole histogram
+                h = self.stats_provider.get_histogram(
+                    "storage_server.latencies.%s" % (category,))
+            else:
+                h = Histogram()
+            self.latencies[category] = h
+        self._time_startup("share-counts", self.add_share_counter)
+        self._share_index = None
+        if share_index_enabled:
+            self.add_share_index()
+        self.lease_db = None
+        if lease_db_enabled:
+            self.lease_db = self._time_startup(
+                "lease-db", LeaseDB,
+                os.path.join(self.storedir, "leasedb.sqlite"))
 
         statefile = os.path.join(self.storedir, "lease_checker.state")
         historyfile = os.path.join(self.storedir, "lease_checker.history")
@@ -113,30 +223,152 @@ class StorageServer(service.MultiService, Referenceable):
                                    expiration_override_lease_duration,
                                    expiration_cutoff_date,
                                    expiration_sharetypes)
+        self.lease_checker.scan_threads = lease_checker_threads
         self.lease_checker.setServiceParent(self)
+        if self.lease_db is not None and expiration_enabled:
+            # with a lease database, expired leases are found by a query
+            # rather than by waiting for the crawler to reach their shares
+            self.lease_db_expirer = TimerService(
+                self.LEASE_DB_EXPIRY_INTERVAL,
+                self.lease_checker.expire_leases_from_db)
+            self.lease_db_expirer.setServiceParent(self)
+        self.startup_timings["total"] = time.time() - started
+        log.msg(format="StorageServer startup took %(timings)s",
+                timings=", ".join("%s %.3fs" % (phase, seconds)
+                                  for (phase, seconds)
+                                  in sorted(self.startup_timings.items())),
+                facility="tahoe.storage", umid="yD4nJw")
+
+    def _time_startup(self, phase, f, *args):
+        start = time.time()
+        result = f(*args)
+        self.startup_timings[phase] = time.time() - start
+        return result
 
     def __repr__(self):
         return "<StorageServer %s>" % (idlib.shortnodeid_b2a(self.my_nodeid),)
 
+    # the class of each remote method's requests when the client gives no
+    # priority hint. Methods not listed here are never queued.
+    REQUEST_CLASSES = {"allocate_buckets": "write",
+                       "get_buckets": "read",
+                       "get_share_numbers": "read",
+                       "slot_readv": "read",
+                       "slot_testv_and_readv_and_writev": "write",
+                       "add_lease": "lease",
+                       "add_leases": "lease",
+                       "renew_lease": "lease",
+                       }
+    # functions of each remote method's arguments which give the number of
+    # bytes the request will read or write
+    REQUEST_COSTS = {"slot_readv": _readv_cost,
+                     "slot_testv_and_readv_and_writev": _writev_cost,
+                     }
+
+    def doRemoteCall(self, methodname, args, kwargs):
+        return self.schedule_remote_call(self, methodname, args, kwargs)
+
+    def schedule_remote_call(self, obj, methodname, args, kwargs,
+                             priority=None, client=None):
+        """Call the remote method ``methodname`` of ``obj`` (this server, or
+        one of its bucket readers and writers) now or, when requests are
+        scheduled, in its turn. ``priority`` is the client's priority hint
+        and ``client`` identifies its queue.
+
+        This method is not for client use.
+        """
+        meth = getattr(obj, "remote_" + methodname)
+        request_class = obj.REQUEST_CLASSES.get(methodname)
+        if self._scheduler is None or request_class is None:
+            return meth(*args, **kwargs)
+        if priority in PRIORITY_CLASSES:
+            request_class = priority
+        cost = 0
+        cost_of = obj.REQUEST_COSTS.get(methodname)
+        if cost_of is not None:
+            cost = cost_of(*args, **kwargs)
+        return self._scheduler.submit(request_class, client, cost,
+                                      partial(meth, *args, **kwargs))
+
+    def remote_with_priority(self, priority, canary):
+        # the client's requests are queued by the Tub they came from, which
+        # foolscap has authenticated, and not by the object returned here,
+        # of which a client may ask for as many as it likes
+        return _PrioritizedStorageServer(self,
+                                         priority.decode("ascii", "replace"),
+                                         _remote_tubid(canary))
+
+    def stopService(self):
+        if self._fd_cache is not None:
+            self._fd_cache.close_all()
+        if self._mmap_cache is not None:
+            self._mmap_cache.close_all()
+        d = service.MultiService.stopService(self)
+        d.addCallback(lambda ign: self.share_counter.save(self._countsfile))
+        d.addCallback(lambda ign: self.corruption_registry.close())
+        if self.lease_db is not None:
+            d.addCallback(lambda ign: self.lease_db.close())
+        if self.packed_store is not None:
+            d.addCallback(lambda ign: self.packed_store.close())
+        return d
+
+    def startService(self):
+        service.MultiService.startService(self)
+        if os.path.exists(self._discarddir):
+            # remove the incomplete shares moved aside at startup
+            if self._disk_io is not None:
+                d = self._disk_io.run(None, fileutil.rm_dir, self._discarddir)
+            else:
+                d = threads.deferToThread(fileutil.rm_dir, self._discarddir)
+            d.addErrback(log.err, "storage: error removing incomplete shares",
+                         umid="Vw8kUQ")
+
     def have_shares(self):
         # quick test to decide if we need to commit to an implicit
         # permutation-seed or if we should use a new one
+        if self.packed_store is not None and self.packed_store.has_shares():
+            return True
         return bool(set(os.listdir(self.sharedir)) - set(["incoming"]))
 
-    def add_bucket_counter(self):
-        statefile = os.path.join(self.storedir, "bucket_counter.state")
-        self.bucket_counter = BucketCountingCrawler(self, statefile)
-        self.bucket_counter.setServiceParent(self)
+    def add_packed_store(self, packeddir):
+        self.packed_store = PackedShareStore(packeddir)
+        self.packed_compactor = TimerService(self.PACKED_COMPACTION_INTERVAL,
+                                             self._compact_packed_store)
+        self.packed_compactor.setServiceParent(self)
+
+    def _compact_packed_store(self):
+        if self._disk_io is not None:
+            d = self._disk_io.run(None, self.packed_store.compact)
+            d.addErrback(log.err, "storage: packed share compaction failed",
+                         umid="a2Xl1A")
+            return d
+        self.packed_store.compact()
+
+    def add_share_counter(self):
+        self._countsfile = os.path.join(self.storedir, "share_counts.json")
+        self.share_counter = ShareCounter()
+        self.share_counter_crawler = None
+        if not self.share_counter.load(self._countsfile):
+            # we crashed, or never counted: recount from disk
+            statefile = os.path.join(self.storedir, "share_counter.state")
+            klass = self.ShareCountingCrawlerClass
+            self.share_counter_crawler = klass(self, statefile,
+                                               self.share_counter)
+            self.share_counter_crawler.setServiceParent(self)
+
+    def add_share_index(self):
+        statefile = os.path.join(self.storedir, "share_index.state")
+        self._share_index = ShareIndex()
+        self.share_index_crawler = ShareIndexCrawler(self, statefile,
+                                                     self._share_index)
+        self.share_index_crawler.setServiceParent(self)
 
     def count(self, name, delta=1):
         if self.stats_provider:
             self.stats_provider.count("storage_server." + name, delta)
 
     def add_latency(self, category, latency):
-        a = self.latencies[category]
-        a.append(latency)
-        if len(a) > 1000:
-            self.latencies[category] = a[-1000:]
+        self.latencies[category].record(latency)
 
     def get_latencies(self):
         """Return a dict, indexed by category, that contains a dict of
@@ -148,19 +380,22 @@ class StorageServer(service.MultiService, Referenceable):
         samples for a given percentile to be interpreted unambiguously
         that percentile will be reported as None. If no samples have been
         collected for the given category, then that category name will
-        not be present in the return value. """
+        not be present in the return value.
+
+        The numbers cover every sample since the server started. The
+        percentiles are accurate to within a few percent (see
+        allmydata.util.statistics.Histogram). """
         # note that Amazon's Dynamo paper says they use 99.9% percentile.
         output = {}
         for category in self.latencies:
-            if not self.latencies[category]:
+            histogram = self.latencies[category]
+            if not histogram.count:
                 continue
             stats = {}
-            samples = self.latencies[category][:]
-            count = len(samples)
+            count = histogram.count
             stats["samplesize"] = count
-            samples.sort()
             if count > 1:
-                stats["mean"] = sum(samples) / count
+                stats["mean"] = histogram.get_mean()
             else:
                 stats["mean"] = None
 
@@ -171,7 +406,7 @@ class StorageServer(service.MultiService, Referenceable):
 
             for percentile, percentilestring, minnumtoobserve in orderstatlist:
                 if count >= minnumtoobserve:
-                    stats[percentilestring] = samples[int(percentile*count)]
+                    stats[percentilestring] = histogram.get_percentile(percentile)
                 else:
                     stats[percentilestring] = None
 
@@ -184,13 +419,26 @@ class StorageServer(service.MultiService, Referenceable):
         return log.msg(*args, **kwargs)
 
     def _clean_incomplete(self):
-        fileutil.rm_dir(self.incomingdir)
+        """Throw away the shares left incomplete by an earlier run. There
+        may be many of them, so they are only moved aside here, and
+        removed once I have started."""
+        if not os.path.exists(self.incomingdir):
+            return
+        fileutil.make_dirs(self._discarddir)
+        try:
+            os.rename(self.incomingdir,
+                      os.path.join(tempfile.mkdtemp(dir=self._discarddir),
+                                   "incoming"))
+        except EnvironmentError:
+            fileutil.rm_dir(self.incomingdir)
 
     def get_stats(self):
         # remember: RIStatsProvider requires that our return dict
         # contains numeric values.
         stats = { 'storage_server.allocated': self.allocated_size(), }
         stats['storage_server.reserved_space'] = self.reserved_space
+        for name, v in self._space.get_stats().items():
+            stats['storage_server.space.%s' % (name,)] = v
         for category,ld in self.get_latencies().items():
             for name,v in ld.items():
                 stats['storage_server.latencies.%s.%s' % (category, name)] = v
@@ -216,28 +464,86 @@ class StorageServer(service.MultiService, Referenceable):
             writeable = False
 
         stats['storage_server.accepting_immutable_shares'] = int(writeable)
-        s = self.bucket_counter.get_state()
-        bucket_count = s.get("last-complete-bucket-count")
-        if bucket_count:
+        bucket_count = self.share_counter.get_total_bucket_count()
+        if bucket_count is not None:
             stats['storage_server.total_bucket_count'] = bucket_count
+        for name, v in self.share_counter.get_stats().items():
+            stats['storage_server.share_counts.%s' % (name,)] = v
+        if self._share_index is not None:
+            for name, v in self._share_index.get_stats().items():
+                stats['storage_server.share_index.%s' % (name,)] = v
+        if self._fd_cache is not None:
+            for name, v in self._fd_cache.get_stats().items():
+                stats['storage_server.fd_cache.%s' % (name,)] = v
+        if self._mmap_cache is not None:
+            for name, v in self._mmap_cache.get_stats().items():
+                stats['storage_server.mmap_cache.%s' % (name,)] = v
+        if self.lease_db is not None:
+            for name, v in self.lease_db.get_stats().items():
+                stats['storage_server.lease_db.%s' % (name,)] = v
+        if self._disk_io is not None:
+            for name, v in self._disk_io.get_stats().items():
+                stats['storage_server.disk_io.%s' % (name,)] = v
+        for name, v in self.corruption_registry.get_stats().items():
+            stats['storage_server.corruption.%s' % (name,)] = v
+        if self._group_committer is not None:
+            for name, v in self._group_committer.get_stats().items():
+                stats['storage_server.group_commit.%s' % (name,)] = v
+        if self._scheduler is not None:
+            for name, v in self._scheduler.get_stats().items():
+                stats['storage_server.scheduler.%s' % (name,)] = v
+        if self.packed_store is not None:
+            for name, v in self.packed_store.get_stats().items():
+                stats['storage_server.packed.%s' % (name,)] = v
         return stats
 
     def get_available_space(self):
         """Returns available space for share storage in bytes, or None if no
-        API to get this information is available."""
+        API to get this information is available. The answer may be a few
+        seconds old."""
 
         if self.readonly_storage:
             return 0
-        return fileutil.get_available_space(self.sharedir, self.reserved_space)
+        return self._space.get_available_space()
+
+    def _available_space_is_cached(self):
+        return self.readonly_storage or self._space.is_fresh()
 
     def allocated_size(self):
-        space = 0
-        for bw in self._active_writers:
-            space += bw.allocated_size()
-        return space
+        return self._space.get_allocated_size()
+
+    def _serialize(self, storage_indexes, f, *args):
+        """Call f(*args) now or, when disk I/O is done in threads, once the
+        disk operations already queued for these storage indexes have
+        finished. Anything which reads or modifies the shares of a mutable
+        slot must go through here."""
+        if self._disk_io is None:
+            return f(*args)
+        return self._disk_io.serialize(storage_indexes, f, *args)
+
+    def _share_changes_pending(self, storage_index):
+        """Return True if an operation serialized on ``storage_index`` is
+        still queued or running, and so may have changed its shares on disk
+        without having told the share counter yet."""
+        return (self._disk_io is not None and
+                self._disk_io.is_busy(storage_index))
+
+    def _shnums_being_written(self, storage_index):
+        """Return the numbers of the immutable shares of ``storage_index``
+        whose writers are still open. The share counter is told about each
+        of them when its writer is closed."""
+        return set(shnum for (si, shnum)
+                   in list(self._active_writers.values())
+                   if si == storage_index)
 
     def remote_get_version(self):
-        remaining_space = self.get_available_space()
+        if self._disk_io is not None and not self._available_space_is_cached():
+            d = self._disk_io.run(None, self.get_available_space)
+            d.addCallback(self._get_version)
+            return d
+        return self._get_version(self.get_available_space())
+
+    def _get_version(self, remaining_space):
         if remaining_space is None:
             # We're on a platform that has no API to get disk stats.
             remaining_space = 2**64
@@ -252,6 +558,11 @@ class StorageServer(service.MultiService, Referenceable):
                       b"delete-mutable-shares-with-zero-length-writev": True,
                       b"fills-holes-with-zero-bytes": True,
                       b"prevents-read-past-end-of-share-data": True,
+                      b"supports-immutable-readv": True,
+                      b"supports-bulk-add-lease": True,
+                      b"supports-priority-hints": True,
+                      b"supports-immutable-hash-blocks": True,
+                      b"supports-bulk-share-query": True,
                       },
                     b"application-version": allmydata.__full_version__.encode("utf-8"),
                     }
@@ -260,12 +571,33 @@ class StorageServer(service.MultiService, Referenceable):
     def remote_allocate_buckets(self, storage_index,
                                 renew_secret, cancel_secret,
                                 sharenums, allocated_size,
-                                canary, owner_num=0):
+                                canary, owner_num=0, priority=None,
+                                client=None):
         # owner_num is not for clients to set, but rather it should be
         # curried into the PersonalStorageServer instance that is dedicated
-        # to a particular owner.
+        # to a particular owner. Likewise, priority and client come from
+        # the _PrioritizedStorageServer the request was made through, and
+        # are given to the BucketWriters.
         start = time.time()
         self.count("allocate")
+        if self._disk_io is not None and not self._available_space_is_cached():
+            d = self._disk_io.run(None, self.get_available_space)
+            d.addCallback(lambda remaining_space: self._serialize(
+                [storage_index], self._allocate_buckets, start,
+                storage_index, renew_secret, cancel_secret, sharenums,
+                allocated_size, canary, owner_num, priority, client,
+                remaining_space))
+            return d
+        return self._serialize([storage_index], self._allocate_buckets, start,
+                               storage_index, renew_secret, cancel_secret,
+                               sharenums, allocated_size, canary, owner_num,
+                               priority, client, self.get_available_space())
+
+    def _allocate_buckets(self, start, storage_index,
+                          renew_secret, cancel_secret,
+                          sharenums, allocated_size,
+                          canary, owner_num, priority, client,
+                          remaining_space):
         alreadygot = set()
         bucketwriters = {} # k: shnum, v: BucketWriter
         si_dir = storage_index_to_dir(storage_index)
@@ -284,7 +616,12 @@ class StorageServer(service.MultiService, Referenceable):
 
         max_space_per_bucket = allocated_size
 
-        remaining_space = self.get_available_space()
+        packed_store = None
+        if self._pack_new_shares and \
+               max_space_per_bucket <= self._packed_share_max_size:
+            # the finished share will go into the packed share store
+            packed_store = self.packed_store
+
         limited = remaining_space is not None
         if limited:
             # this is a bit conservative, since some of this allocated_size()
@@ -296,18 +633,28 @@ class StorageServer(service.MultiService, Referenceable):
         # fill alreadygot with all shares that we have, not just the ones
         # they asked about: this will save them a lot of work. Add or update
         # leases for all of them: if they want us to hold shares for this
-        # file, they'll want us to hold leases for this file.
+        # file, they'll want us to hold leases for this file. Quarantined
+        # shares get the lease too, as they do from add_lease, but are not
+        # offered to the uploader.
+        quarantined = self.corruption_registry.get_quarantined(storage_index)
         for (shnum, fn) in self._get_bucket_shares(storage_index):
-            alreadygot.add(shnum)
-            sf = ShareFile(fn)
+            if shnum not in quarantined:
+                alreadygot.add(shnum)
+            sf = self._open_share(storage_index, shnum, fn, "immutable")
             sf.add_or_renew_lease(lease_info)
+            self._update_lease_db(storage_index, shnum, sf)
 
         for shnum in sharenums:
             incominghome = os.path.join(self.incomingdir, si_dir, "%d" % shnum)
             finalhome = os.path.join(self.sharedir, si_dir, "%d" % shnum)
-            if os.path.exists(finalhome):
+            if shnum in alreadygot:
                 # great! we already have it. easy.
                 pass
+            elif shnum in quarantined:
+                # we have it, but it is corrupt. It cannot be replaced
+                # until it is deleted, so the uploader should put it
+                # somewhere else.
+                pass
             elif os.path.exists(incominghome):
                 # Note that we don't create BucketWriters for shnums that
                 # have a partial share (in incoming/), so if a second upload
@@ -317,37 +664,80 @@ class StorageServer(service.MultiService, Referenceable):
             elif (not limited) or (remaining_space >= max_space_per_bucket):
                 # ok! we need to create the new share file.
                 bw = BucketWriter(self, incominghome, finalhome,
-                                  max_space_per_bucket, lease_info, canary)
+                                  max_space_per_bucket, lease_info, canary,
+                                  disk_io=self._disk_io,
+                                  packed_store=packed_store,
+                                  storage_index=storage_index, shnum=shnum,
+                                  priority=priority, client=client,
+                                  durability=self.durability,
+                                  group_committer=self._group_committer)
                 if self.no_storage:
                     bw.throw_out_all_data = True
                 bucketwriters[shnum] = bw
-                self._active_writers[bw] = 1
+                self._active_writers[bw] = (storage_index, shnum)
+                self._space.allocate(bw, max_space_per_bucket)
                 if limited:
                     remaining_space -= max_space_per_bucket
             else:
                 # bummer! not enough space to accept this bucket
                 pass
 
-        if bucketwriters:
+        if bucketwriters and packed_store is None:
             fileutil.make_dirs(os.path.join(self.sharedir, si_dir))
 
         self.add_latency("allocate", time.time() - start)
         return alreadygot, bucketwriters
 
     def _iter_share_files(self, storage_index):
+        shares = self._get_indexed_shares(storage_index) or {}
         for shnum, filename in self._get_bucket_shares(storage_index):
-            with open(filename, 'rb') as f:
-                header = f.read(32)
-            if header[:32] == MutableShareFile.MAGIC:
-                sf = MutableShareFile(filename, self)
-                # note: if the share has been migrated, the renew_lease()
-                # call will throw an exception, with information to help the
-                # client update the lease.
-            elif header[:4] == struct.pack(">L", 1):
-                sf = ShareFile(filename)
+            if shnum in shares:
+                sharetype = shares[shnum][0]
             else:
+                sharetype = self._get_share_type(storage_index, shnum,
+                                                 filename)
+            if sharetype is None:
                 continue # non-sharefile
-            yield sf
+            # note: if a mutable share has been migrated, the renew_lease()
+            # call will throw an exception, with information to help the
+            # client update the lease.
+            yield self._open_share(storage_index, shnum, filename, sharetype)
+
+    def _is_packed(self, storage_index, shnum):
+        return (self.packed_store is not None and
+                self.packed_store.has_share(storage_index, shnum))
+
+    def _get_share_type(self, storage_index, shnum, filename):
+        if self._is_packed(storage_index, shnum):
+            return self.packed_store.get_share_type(storage_index, shnum)
+        return get_share_type(filename)
+
+    def _open_share(self, storage_index, shnum, filename, sharetype):
+        """Return a ShareFile (for an "immutable" ``sharetype``) or
+        MutableShareFile (for a "mutable" one) for one of my shares, whether
+        it is in the packed share store or in its own file at
+        ``filename``."""
+        if self._is_packed(storage_index, shnum):
+            if sharetype == "mutable":
+                return PackedMutableShareFile(self.packed_store,
+                                              storage_index, shnum, filename,
+                                              self)
+            return PackedShareFile(self.packed_store, storage_index, shnum,
+                                   filename)
+        if sharetype == "mutable":
+            return MutableShareFile(filename, self)
+        return ShareFile(filename)
+
+    def _add_lease(self, storage_index, lease_info):
+        """Add or renew a lease on every share of the given storage index,
+        and return the number of shares that were leased."""
+        count = 0
+        for sf in self._iter_share_files(storage_index):
+            sf.add_or_renew_lease(lease_info)
+            self._update_lease_db(storage_index,
+                                  int(os.path.basename(sf.home)), sf)
+            count += 1
+        return count
 
     def remote_add_lease(self, storage_index, renew_secret, cancel_secret,
                          owner_num=1):
@@ -357,54 +747,247 @@ class StorageServer(service.MultiService, Referenceable):
         lease_info = LeaseInfo(owner_num,
                                renew_secret, cancel_secret,
                                new_expire_time, self.my_nodeid)
-        for sf in self._iter_share_files(storage_index):
-            sf.add_or_renew_lease(lease_info)
-        self.add_latency("add-lease", time.time() - start)
-        return None
+        def _add():
+            self._add_lease(storage_index, lease_info)
+            self.add_latency("add-lease", time.time() - start)
+        return self._serialize([storage_index], _add)
+
+    def remote_add_leases(self, leases, owner_num=1):
+        start = time.time()
+        self.count("add-lease", len(leases))
+        new_expire_time = time.time() + 31*24*60*60
+        def _add():
+            results = [None] * len(leases)
+            # Sorting by storage index also sorts by prefix directory, so
+            # each prefix directory is visited in one run rather than once
+            # per item.
+            order = sorted(range(len(leases)), key=lambda i: leases[i][0])
+            for i in order:
+                (storage_index, renew_secret, cancel_secret) = leases[i]
+                lease_info = LeaseInfo(owner_num,
+                                       renew_secret, cancel_secret,
+                                       new_expire_time, self.my_nodeid)
+                try:
+                    results[i] = self._add_lease(storage_index, lease_info)
+                except Exception:
+                    log.msg(format="storage: add_leases failed for %(si)s",
+                            si=si_b2a(storage_index), failure=Failure(),
+                            level=log.WEIRD, umid="rB0Hxg")
+            self.add_latency("add-leases", time.time() - start)
+            return results
+        return self._serialize([si for (si, rs, cs) in leases], _add)
 
     def remote_renew_lease(self, storage_index, renew_secret):
         start = time.time()
         self.count("renew")
         new_expire_time = time.time() + 31*24*60*60
-        found_buckets = False
-        for sf in self._iter_share_files(storage_index):
-            found_buckets = True
-            sf.renew_lease(renew_secret, new_expire_time)
-        self.add_latency("renew", time.time() - start)
-        if not found_buckets:
-            raise IndexError("no such lease to renew")
+        def _renew():
+            found_buckets = False
+            for sf in self._iter_share_files(storage_index):
+                found_buckets = True
+                sf.renew_lease(renew_secret, new_expire_time)
+                self._update_lease_db(storage_index,
+                                      int(os.path.basename(sf.home)), sf)
+            self.add_latency("renew", time.time() - start)
+            if not found_buckets:
+                raise IndexError("no such lease to renew")
+        return self._serialize([storage_index], _renew)
 
     def bucket_writer_closed(self, bw, consumed_size):
         if self.stats_provider:
             self.stats_provider.count('storage_server.bytes_added', consumed_size)
-        del self._active_writers[bw]
+        (storage_index, shnum) = self._active_writers.pop(bw)
+        self._space.release(bw, consumed_size)
+        # an aborted bucket reports zero bytes consumed, a closed one always
+        # has at least a container header
+        if not consumed_size:
+            return
+        if self._share_index is not None:
+            self._share_index.add_share(storage_index, shnum, "immutable",
+                                        consumed_size)
+        sf = self._open_share(storage_index, shnum, bw.finalhome, "immutable")
+        data_length = sf.get_data_length()
+        self._count_share_added(storage_index, "immutable", data_length)
+        # don't keep serving an earlier share that lived at this path
+        self._invalidate_cached_share(bw.finalhome)
+        if self.lease_db is not None and not bw.throw_out_all_data:
+            self._update_lease_db(storage_index, shnum, sf)
+
+    def _share_written(self, storage_index, shnum, share, old_data_length):
+        """Return a callable which notes that a mutable share has been
+        written. ``old_data_length`` is the length of its data beforehand, or
+        None if the share is new.
+
+        I read the share, so call me right after the write and in the same
+        thread. Call the result in the reactor thread.
+        """
+        size = share.get_container_size()
+        data_length = share.get_data_length()
+        new_bucket = False
+        if old_data_length is None:
+            # the new share is already in place, so it is alone in a new
+            # bucket
+            new_bucket = len(list(self._list_bucket_shares(storage_index))) == 1
+        return partial(self._note_share_written, storage_index, shnum,
+                       share.sharetype, size, data_length, old_data_length,
+                       new_bucket)
+
+    def _note_share_written(self, storage_index, shnum, sharetype, size,
+                            data_length, old_data_length, new_bucket):
+        if self._share_index is not None:
+            self._share_index.add_share(storage_index, shnum, sharetype, size)
+        if self.corruption_registry.is_registered(storage_index, shnum):
+            # the reports were about the share's old contents
+            self.corruption_registry.release(storage_index, shnum)
+        if old_data_length is None:
+            self.share_counter.add_share(storage_index, sharetype,
+                                         data_length, new_bucket)
+        else:
+            self.share_counter.resize_share(storage_index, sharetype,
+                                            data_length - old_data_length)
+
+    def _count_share_added(self, storage_index, sharetype, data_length):
+        # the new share is already in place, so it is alone in a new bucket
+        new_bucket = len(list(self._get_bucket_shares(storage_index))) == 1
+        self.share_counter.add_share(storage_index, sharetype, data_length,
+                                     new_bucket)
+
+    def _update_lease_db(self, storage_index, shnum, sf):
+        if self.lease_db is not None:
+            self.lease_db.set_share_leases(storage_index, shnum, sf.sharetype,
+                                           sf.get_leases())
+
+    def share_leases_changed(self, storage_index, shnum, sf):
+        """Note that the leases on a share have been changed by something
+        other than a client request, such as lease expiration.
+
+        This method is not for client use.
+        """
+        self._update_lease_db(storage_index, shnum, sf)
+
+    def share_removed(self, storage_index, shnum, sharetype=None,
+                      data_length=None, bucket_empty=None):
+        """Note that a share file has been deleted, by lease expiration or a
+        zero-length mutable write. ``sharetype`` and ``data_length`` describe
+        the share that was deleted; if they are unknown, the share counts can
+        no longer be trusted and will be recomputed at the next startup.
+        ``bucket_empty`` says whether that was the last share of its storage
+        index, and is found from the disk if it is not given.
+
+        This method is not for client use.
+        """
+        if self._share_index is not None:
+            self._share_index.remove_share(storage_index, shnum)
+        if sharetype is None or data_length is None:
+            self.share_counter.mark_suspect()
+        else:
+            if bucket_empty is None:
+                bucket_empty = not list(self._get_bucket_shares(storage_index))
+            self.share_counter.remove_share(storage_index, sharetype,
+                                            data_length, bucket_empty)
+        if self.lease_db is not None:
+            self.lease_db.remove_share(storage_index, shnum)
+        if self.corruption_registry.is_registered(storage_index, shnum):
+            self.corruption_registry.release(storage_index, shnum)
+        self._invalidate_cached_share(
+            os.path.join(self.sharedir, storage_index_to_dir(storage_index),
+                         "%d" % shnum))
+
+    def _invalidate_cached_share(self, filename):
+        if self._fd_cache is not None:
+            self._fd_cache.invalidate(filename)
+        if self._mmap_cache is not None:
+            self._mmap_cache.invalidate(filename)
+
+    def _get_indexed_shares(self, storage_index):
+        """Return a dict mapping shnum to (sharetype, container_size) for
+        the shares held for this storage_index, or None if the share index
+        is disabled or cannot yet answer for it."""
+        if self._share_index is None:
+            return None
+        return self._share_index.get_shares(storage_index)
 
     def _get_bucket_shares(self, storage_index):
         """Return a list of (shnum, pathname) tuples for files that hold
         shares for this storage_index. In each tuple, 'shnum' will always be
-        the integer form of the last component of 'pathname'."""
+        the integer form of the last component of 'pathname'. Shares in the
+        packed share store are included, with the pathname they would have
+        if they were in files of their own."""
+        shares = self._get_indexed_shares(storage_index)
+        if shares is None:
+            for share in self._list_bucket_shares(storage_index):
+                yield share
+            return
+        storagedir = os.path.join(self.sharedir,
+                                  storage_index_to_dir(storage_index))
+        shnums = set(shares)
+        shnums.update(self._get_packed_shnums(storage_index))
+        for shnum in sorted(shnums):
+            yield (shnum, os.path.join(storagedir, "%d" % shnum))
+
+    def _list_bucket_shares(self, storage_index):
+        """Like _get_bucket_shares, but always list the bucket directory
+        rather than consult the share index."""
         storagedir = os.path.join(self.sharedir, storage_index_to_dir(storage_index))
+        packed = self._get_packed_shnums(storage_index)
+        for shnum in packed:
+            yield (shnum, os.path.join(storagedir, "%d" % shnum))
         try:
             for f in os.listdir(storagedir):
-                if NUM_RE.match(f):
+                if NUM_RE.match(f) and int(f) not in packed:
                     filename = os.path.join(storagedir, f)
                     yield (int(f), filename)
         except OSError:
             # Commonly caused by there being no buckets at all.
             pass
 
-    def remote_get_buckets(self, storage_index):
+    def _get_packed_shnums(self, storage_index):
+        if self.packed_store is None:
+            return []
+        return self.packed_store.get_shnums(storage_index)
+
+    def remote_get_buckets(self, storage_index, priority=None, client=None):
         start = time.time()
         self.count("get")
         si_s = si_b2a(storage_index)
         log.msg("storage: get_buckets %s" % si_s)
         bucketreaders = {} # k: sharenum, v: BucketReader
-        for shnum, filename in self._get_bucket_shares(storage_index):
+        for shnum, filename in self._get_served_shares(storage_index):
+            share_file = None
+            if self._is_packed(storage_index, shnum):
+                share_file = self._open_share(storage_index, shnum, filename,
+                                              "immutable")
             bucketreaders[shnum] = BucketReader(self, filename,
-                                                storage_index, shnum)
+                                                storage_index, shnum,
+                                                fd_cache=self._fd_cache,
+                                                disk_io=self._disk_io,
+                                                share_file=share_file,
+                                                mmap_cache=self._mmap_cache,
+                                                priority=priority,
+                                                client=client)
         self.add_latency("get", time.time() - start)
         return bucketreaders
 
+    def remote_get_share_numbers(self, storage_indexes):
+        start = time.time()
+        self.count("get", len(storage_indexes))
+        results = [None] * len(storage_indexes)
+        # visit each prefix directory in one run, as add_leases does
+        order = sorted(range(len(storage_indexes)),
+                       key=lambda i: storage_indexes[i])
+        for i in order:
+            results[i] = set(shnum for (shnum, filename)
+                             in self._get_served_shares(storage_indexes[i]))
+        self.add_latency("get-share-numbers", time.time() - start)
+        return results
+
+    def _get_served_shares(self, storage_index):
+        """Like _get_bucket_shares, but leave out quarantined shares."""
+        quarantined = self.corruption_registry.get_quarantined(storage_index)
+        for shnum, filename in self._get_bucket_shares(storage_index):
+            if shnum not in quarantined:
+                yield shnum, filename
+
     def get_leases(self, storage_index):
         """Provide an iterator that yields all of the leases attached to this
         bucket. Each lease is returned as a LeaseInfo instance.
@@ -417,7 +1000,7 @@ class StorageServer(service.MultiService, Referenceable):
         # from the first share
         try:
             shnum, filename = next(self._get_bucket_shares(storage_index))
-            sf = ShareFile(filename)
+            sf = self._open_share(storage_index, shnum, filename, "immutable")
             return sf.get_leases()
         except StopIteration:
             return iter([])
@@ -430,8 +1013,9 @@ class StorageServer(service.MultiService, Referenceable):
 
         :return: An iterable of the leases attached to this slot.
         """
-        for _, share_filename in self._get_bucket_shares(storage_index):
-            share = MutableShareFile(share_filename)
+        for shnum, share_filename in self._get_bucket_shares(storage_index):
+            share = self._open_share(storage_index, shnum, share_filename,
+                                     "mutable")
             return share.get_leases()
         return []
 
@@ -450,9 +1034,12 @@ class StorageServer(service.MultiService, Referenceable):
             any of the collected shares.
 
         :return dict[int, MutableShareFile]: The collected shares in a mapping
-            from integer share numbers to ``MutableShareFile`` instances.
+            from integer share numbers to ``MutableShareFile`` instances. They
+            are held open, and must be closed when the request is done with
+            them.
         """
         shares = {}
+        storage_index = si_a2b(si_s)
         if os.path.isdir(bucketdir):
             # shares exist if there is a file for them
             for sharenum_s in os.listdir(bucketdir):
@@ -461,11 +1048,26 @@ class StorageServer(service.MultiService, Referenceable):
                 except ValueError:
                     continue
                 filename = os.path.join(bucketdir, sharenum_s)
-                msf = MutableShareFile(filename, self)
-                msf.check_write_enabler(write_enabler, si_s)
-                shares[sharenum] = msf
+                shares[sharenum] = MutableShareFile(filename, self)
+        # or if they are in the packed share store
+        for sharenum in self._get_packed_shnums(storage_index):
+            filename = os.path.join(bucketdir, "%d" % sharenum)
+            shares[sharenum] = PackedMutableShareFile(self.packed_store,
+                                                      storage_index, sharenum,
+                                                      filename, self)
+        try:
+            for sharenum in sorted(shares):
+                shares[sharenum].open()
+                shares[sharenum].check_write_enabler(write_enabler, si_s)
+        except:
+            self._close_mutable_shares(shares)
+            raise
         return shares
 
+    def _close_mutable_shares(self, shares):
+        for share in shares.values():
+            share.close()
+
     def _evaluate_test_vectors(self, test_and_write_vectors, shares):
         """
         Execute test vectors against share data.
@@ -510,10 +1112,12 @@ class StorageServer(service.MultiService, Referenceable):
             read_data[sharenum] = share.readv(read_vector)
         return read_data
 
-    def _evaluate_write_vectors(self, bucketdir, secrets, test_and_write_vectors, shares):
+    def _evaluate_write_vectors(self, storage_index, bucketdir, secrets, test_and_write_vectors, shares, notes):
         """
         Execute write vectors against share data.
 
+        :param bytes storage_index: The storage index of the shares.
+
         :param bytes bucketdir: The parent directory holding the shares.  This
             is removed if the last share is removed from it.  If shares are
             created, they are created in it.
@@ -528,6 +1132,10 @@ class StorageServer(service.MultiService, Referenceable):
         :param dict[int, MutableShareFile]: The shares against which to
             execute the vectors.
 
+        :param list notes: Callables which update the server's in-memory
+            records of its shares are appended to this list, to be called
+            once the vectors have been applied.
+
         :return dict[int, MutableShareFile]: The shares which still exist
             after applying the vectors.
         """
@@ -537,9 +1145,22 @@ class StorageServer(service.MultiService, Referenceable):
             (testv, datav, new_length) = test_and_write_vectors[sharenum]
             if new_length == 0:
                 if sharenum in shares:
+                    old_data_length = shares[sharenum].get_data_length()
                     shares[sharenum].unlink()
+                    bucket_empty = not list(
+                        self._list_bucket_shares(storage_index))
+                    notes.append(partial(self.share_removed, storage_index,
+                                         sharenum, "mutable", old_data_length,
+                                         bucket_empty))
             else:
-                if sharenum not in shares:
+                old_data_length = None
+                if sharenum in shares:
+                    old_data_length = shares[sharenum].get_data_length()
+                elif self._pack_new_shares:
+                    shares[sharenum] = self._allocate_packed_slot_share(
+                        storage_index, bucketdir, secrets, sharenum)
+                    shares[sharenum].open()
+                else:
                     # allocate a new share
                     allocated_size = 2000 # arbitrary, really
                     share = self._allocate_slot_share(bucketdir, secrets,
@@ -547,8 +1168,17 @@ class StorageServer(service.MultiService, Referenceable):
                                                       allocated_size,
                                                       owner_num=0)
                     shares[sharenum] = share
+                    share.open()
                 shares[sharenum].writev(datav, new_length)
+                if (isinstance(shares[sharenum], PackedMutableShareFile) and
+                    shares[sharenum].get_container_size()
+                    > self._packed_share_max_size):
+                    shares[sharenum] = self._unpack_slot_share(
+                        storage_index, sharenum, shares[sharenum])
                 remaining_shares[sharenum] = shares[sharenum]
+                notes.append(self._share_written(storage_index, sharenum,
+                                                 shares[sharenum],
+                                                 old_data_length))
 
             if new_length == 0:
                 # delete bucket directories that exist but are empty.  They
@@ -597,51 +1227,91 @@ class StorageServer(service.MultiService, Referenceable):
             lease applied to them.
 
         See ``allmydata.interfaces.RIStorageServer`` for details about other
-        parameters and return value.
+        parameters and return value. When disk I/O is done in threads, the
+        return value is delivered through a Deferred.
         """
         start = time.time()
         self.count("writev")
         si_s = si_b2a(storage_index)
         log.msg("storage: slot_writev %s" % si_s)
+
+        def _done(res):
+            (testv_is_good, read_data, notes) = res
+            for note in notes:
+                note()
+            self.add_latency("writev", time.time() - start)
+            return (testv_is_good, read_data)
+        def _writev():
+            args = (storage_index, secrets, test_and_write_vectors,
+                    read_vector, renew_leases)
+            if self._disk_io is None:
+                return _done(self._slot_testv_and_readv_and_writev(*args))
+            d = self._disk_io.defer_to_thread(
+                self._slot_testv_and_readv_and_writev, *args)
+            d.addCallback(_done)
+            return d
+        return self._serialize([storage_index], _writev)
+
+    def _slot_testv_and_readv_and_writev(self, storage_index, secrets,
+                                         test_and_write_vectors, read_vector,
+                                         renew_leases):
+        """
+        Do the disk work of ``slot_testv_and_readv_and_writev``, which may
+        happen in a disk I/O thread.
+
+        :return: A tuple of the test vector result, the read data, and a list
+            of callables which bring the server's in-memory records up to
+            date. Those must be called in the reactor thread.
+        """
+        si_s = si_b2a(storage_index)
         si_dir = storage_index_to_dir(storage_index)
         (write_enabler, renew_secret, cancel_secret) = secrets
         bucketdir = os.path.join(self.sharedir, si_dir)
 
         # If collection succeeds we know the write_enabler is good for all
-        # existing shares.
+        # existing shares. Each share stays open, with its header cached,
+        # until we are done with it.
         shares = self._collect_mutable_shares_for_storage_index(
             bucketdir,
             write_enabler,
             si_s,
         )
-
-        # Now evaluate test vectors.
-        testv_is_good = self._evaluate_test_vectors(
-            test_and_write_vectors,
-            shares,
-        )
-
-        # now gather the read vectors, before we do any writes
-        read_data = self._evaluate_read_vectors(
-            read_vector,
-            shares,
-        )
-
-        if testv_is_good:
-            # now apply the write vectors
-            remaining_shares = self._evaluate_write_vectors(
-                bucketdir,
-                secrets,
+        try:
+            # Now evaluate test vectors.
+            testv_is_good = self._evaluate_test_vectors(
                 test_and_write_vectors,
                 shares,
             )
-            if renew_leases:
-                lease_info = self._make_lease_info(renew_secret, cancel_secret)
-                self._add_or_renew_leases(remaining_shares, lease_info)
+
+            # now gather the read vectors, before we do any writes
+            read_data = self._evaluate_read_vectors(
+                read_vector,
+                shares,
+            )
+
+            notes = []
+            if testv_is_good:
+                # now apply the write vectors
+                remaining_shares = self._evaluate_write_vectors(
+                    storage_index,
+                    bucketdir,
+                    secrets,
+                    test_and_write_vectors,
+                    shares,
+                    notes,
+                )
+                if renew_leases:
+                    lease_info = self._make_lease_info(renew_secret,
+                                                       cancel_secret)
+                    self._add_or_renew_leases(remaining_shares, lease_info)
+                    for (shnum, share) in remaining_shares.items():
+                        notes.append(partial(self._update_lease_db,
+                                             storage_index, shnum, share))
+        finally:
+            self._close_mutable_shares(shares)
 
         # all done
-        self.add_latency("writev", time.time() - start)
-        return (testv_is_good, read_data)
+        return (testv_is_good, read_data, notes)
 
     def remote_slot_testv_and_readv_and_writev(self, storage_index,
                                                secrets,
@@ -665,31 +1335,62 @@ class StorageServer(service.MultiService, Referenceable):
                                          self)
         return share
 
+    def _allocate_packed_slot_share(self, storage_index, bucketdir, secrets,
+                                    sharenum):
+        (write_enabler, renew_secret, cancel_secret) = secrets
+        filename = os.path.join(bucketdir, "%d" % sharenum)
+        return create_packed_mutable_share(self.packed_store, storage_index,
+                                           sharenum, filename,
+                                           self.my_nodeid, write_enabler,
+                                           self)
+
+    def _unpack_slot_share(self, storage_index, sharenum, share):
+        """Move a packed mutable share which has grown too large for the
+        packed share store into a file of its own."""
+        # store any changes made while it was held open
+        share.close()
+        fileutil.make_dirs(os.path.dirname(share.home))
+        fileutil.write_atomically(
+            share.home, self.packed_store.get_share(storage_index, sharenum))
+        # if we crash before this, the packed copy will still be used
+        self.packed_store.remove_share(storage_index, sharenum)
+        share = MutableShareFile(share.home, self)
+        share.open()
+        return share
+
     def remote_slot_readv(self, storage_index, shares, readv):
         start = time.time()
         self.count("readv")
         si_s = si_b2a(storage_index)
         lp = log.msg("storage: slot_readv %s %s" % (si_s, shares),
                      facility="tahoe.storage", level=log.OPERATIONAL)
-        si_dir = storage_index_to_dir(storage_index)
-        # shares exist if there is a file for them
-        bucketdir = os.path.join(self.sharedir, si_dir)
-        if not os.path.isdir(bucketdir):
+
+        def _done(datavs):
+            log.msg("returning shares %s" % (list(datavs.keys()),),
+                    facility="tahoe.storage", level=log.NOISY, parent=lp)
             self.add_latency("readv", time.time() - start)
-            return {}
+            return datavs
+        def _readv():
+            # shares exist if there is a file for them. This may consult the
+            # share index, so it stays out of the disk I/O threads.
+            filenames = [(sharenum, filename) for (sharenum, filename)
+                         in self._get_served_shares(storage_index)
+                         if sharenum in shares or not shares]
+            if self._disk_io is None:
+                return _done(self._read_slot_shares(storage_index, filenames,
+                                                    readv))
+            d = self._disk_io.defer_to_thread(self._read_slot_shares,
+                                              storage_index, filenames, readv)
+            d.addCallback(_done)
+            return d
+        return self._serialize([storage_index], _readv)
+
+    def _read_slot_shares(self, storage_index, filenames, readv):
         datavs = {}
-        for sharenum_s in os.listdir(bucketdir):
-            try:
-                sharenum = int(sharenum_s)
-            except ValueError:
-                continue
-            if sharenum in shares or not shares:
-                filename = os.path.join(bucketdir, sharenum_s)
-                msf = MutableShareFile(filename, self)
-                datavs[sharenum] = msf.readv(readv)
-        log.msg("returning shares %s" % (list(datavs.keys()),),
-                facility="tahoe.storage", level=log.NOISY, parent=lp)
-        self.add_latency("readv", time.time() - start)
+        for sharenum, filename in filenames:
+            msf = self._open_share(storage_index, sharenum, filename,
+                                   "mutable")
+            datavs[sharenum] = msf.readv(readv)
         return datavs
 
     def remote_advise_corrupt_share(self, share_type, storage_index, shnum,
@@ -716,4 +1417,119 @@ class StorageServer(service.MultiService, Referenceable):
                         "%(si)s-%(shnum)d: %(reason)s"),
                 share_type=share_type, si=si_s, shnum=shnum, reason=reason,
                 level=log.SCARY, umid="SGx2fA")
+        sharetype = share_type.decode("ascii", "replace")
+        count = self.corruption_registry.add_report(
+            storage_index, shnum, sharetype, "client",
+            reason.decode("utf-8", "replace"), time.time())
+        threshold = self.corruption_quarantine_threshold
+        if threshold and count >= threshold:
+            self.quarantine_share(storage_index, shnum, sharetype,
+                                  "reported corrupt %d times" % (count,))
+        elif (count == 1 and sharetype == "immutable" and
+              self.corruption_registry.get_reported(storage_index)
+              == frozenset([shnum]) and self._may_check_share()):
+            # the server can check the hashes in an immutable share itself.
+            # Checking reads the whole share, so it does so once per share,
+            # for the first share reported in each bucket, and no more
+            # than one share at a time and every
+            # REPORTED_SHARE_CHECK_INTERVAL seconds.
+            return self._check_reported_share(storage_index, shnum)
+        return None
+
+    def _may_check_share(self):
+        if self._checking_share:
+            return False
+        return (self._last_share_check is None or
+                time.time() - self._last_share_check >=
+                self.REPORTED_SHARE_CHECK_INTERVAL)
+
+    def _check_reported_share(self, storage_index, shnum):
+        for (i, filename) in self._get_served_shares(storage_index):
+            if i == shnum:
+                break
+        else:
+            return None
+        try:
+            sf = self._open_share(storage_index, shnum, filename, "immutable")
+        except UnknownImmutableContainerVersionError:
+            # not an immutable share at all
+            return None
+        def _check():
+            try:
+                return sf.check_hashes(shnum)
+            except EnvironmentError:
+                # the disk failed, not the share
+                raise
+            except Exception as e:
+                return "the share cannot be parsed: %r" % (e,)
+        # the share may be large, so never hash it in the reactor thread
+        self._checking_share = True
+        self._last_share_check = time.time()
+        if self._disk_io is not None:
+            d = self._disk_io.run(None, _check)
+        else:
+            d = threads.deferToThread(_check)
+        def _checked(problem):
+            self._checking_share = False
+            if problem is not None:
+                self.corruption_registry.add_report(storage_index, shnum,
+                                                    "immutable", "server",
+                                                    problem, time.time())
+                self.quarantine_share(storage_index, shnum, "immutable",
+                                      problem)
+        def _failed(f):
+            self._checking_share = False
+            return f
+        d.addCallbacks(_checked, _failed)
+        d.addErrback(log.err, "storage: error checking a reported share",
+                     umid="pM3uVw")
+        return d
+
+    def quarantine_share(self, storage_index, shnum, sharetype, reason):
+        """Stop serving a corrupt share. It is kept, and still counts
+        towards the space used, until it expires or is replaced.
+
+        This method is not for client use.
+        """
+        log.msg(format="quarantining (%(sharetype)s) %(si)s-%(shnum)d: "
+                "%(reason)s", sharetype=sharetype,
+                si=si_b2a(storage_index), shnum=shnum, reason=reason,
+                level=log.SCARY, umid="bd5Xqw")
+        self.corruption_registry.quarantine(storage_index, shnum, sharetype,
+                                            reason, time.time())
+        self._invalidate_cached_share(
+            os.path.join(self.sharedir, storage_index_to_dir(storage_index),
+                         "%d" % shnum))
+
+
+def _remote_tubid(ref):
+    """Return the ID of the Tub which sent the RemoteReference ``ref``, or
+    None if it did not come over a connection."""
+    get_tubid = getattr(ref, "getRemoteTubID", None)
+    if get_tubid is None:
         return None
+    return get_tubid()
+
+
+@implementer(RIStorageServer)
+class _PrioritizedStorageServer(Referenceable):
+    """
+    I am the RIStorageServer a client gets from ``with_priority``. Requests
+    made through me, or through the buckets I return, are scheduled in the
+    request class named by my priority hint (or in their usual class, if
+    the hint is not one the server knows), and in the queue of ``client``,
+    the ID of the client's Tub. Without one they share the queue of
+    requests which came without a hint.
+    """
+
+    def __init__(self, ss, priority, client):
+        self._ss = ss
+        self.priority = priority
+        self.client = client
+
+    def doRemoteCall(self, methodname, args, kwargs):
+        if methodname in ("allocate_buckets", "get_buckets"):
+            kwargs = dict(kwargs, priority=self.priority, client=self.client)
+        return self._ss.schedule_remote_call(self._ss, methodname, args,
+                                             kwargs, self.priority,
+                                             self.client)
@@ -0,0 +1,293 @@
+"""
+Running counts of the buckets, shares, and share data held by a storage
+server.
+
+Ported to Python 3.
+"""
+
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from future.utils import PY2
+if PY2:
+    # We omit anything that might end up in pickle, just in case.
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, range, str, max, min  # noqa: F401
+
+import os, json, struct
+import six
+
+from allmydata.storage.common import UnknownMutableContainerVersionError, \
+     UnknownImmutableContainerVersionError, si_a2b, si_b2a
+from allmydata.storage.crawler import ShareCrawler, TimeSliceExceeded
+from allmydata.storage.shares import get_share_file
+from allmydata.storage.packed import open_packed_share
+from allmydata.util import fileutil, log
+
+SHARETYPES = ("immutable", "mutable")
+
+
+def _empty_counts():
+    return dict((sharetype, {"buckets": 0, "shares": 0, "bytes": 0})
+                for sharetype in SHARETYPES)
+
+
+class ShareCounter(object):
+    """
+    I keep running counts of the buckets, shares, and bytes of share data
+    held by a storage server, for each share type. The storage server tells
+    me about every share it creates, resizes, or deletes, so my counts are
+    always current and never require a walk of the share directory. Share
+    data bytes do not include container headers or lease records, so adding
+    or cancelling a lease does not change them.
+
+    My counts are saved in a file when the server shuts down cleanly, and
+    the file is removed when they are loaded again, so a server that
+    crashes comes back with no saved counts. In that case (or if I was told
+    that my counts are suspect) a ``ShareCountingCrawler`` recounts from
+    disk. While that crawl runs, changes to buckets it has not yet reached
+    are ignored, since the crawler will see them when it gets there.
+    """
+
+    def __init__(self):
+        self._counts = _empty_counts()
+        self._counted_prefixes = set()
+        # the prefix the crawler is partway through, and the buckets it
+        # listed there but has not counted yet
+        self._current_prefix = None
+        self._uncounted_buckets = set()
+        self._complete = False
+        self._suspect = False
+
+    def _counting(self, storage_index):
+        if self._complete:
+            return True
+        bucket = si_b2a(storage_index).decode("ascii")
+        prefix = bucket[:2]
+        if prefix in self._counted_prefixes:
+            return True
+        # in the prefix being counted, a bucket which the crawler has
+        # already counted, or which appeared after it listed the prefix and
+        # so will not be visited, is counted here
+        return (prefix == self._current_prefix and
+                bucket not in self._uncounted_buckets)
+
+    def _adjust(self, sharetype, buckets, shares, nbytes):
+        counts = self._counts[sharetype]
+        counts["buckets"] += buckets
+        counts["shares"] += shares
+        counts["bytes"] += nbytes
+        if min(counts.values()) < 0:
+            self.mark_suspect()
+
+    def is_complete(self):
+        return self._complete
+
+    def mark_suspect(self):
+        """Note that a share changed in a way I could not account for. My
+        counts will not be saved, so they are recounted at the next
+        startup."""
+        if not self._suspect:
+            log.msg("share counts are suspect, will recount at next startup",
+                    level=log.UNUSUAL, umid="uJ3v4w")
+        self._suspect = True
+
+    def add_share(self, storage_index, sharetype, data_length, new_bucket):
+        if self._counting(storage_index):
+            self._adjust(sharetype, int(new_bucket), 1, data_length)
+
+    def resize_share(self, storage_index, sharetype, delta):
+        if self._counting(storage_index):
+            self._adjust(sharetype, 0, 0, delta)
+
+    def remove_share(self, storage_index, sharetype, data_length,
+                     bucket_empty):
+        if self._counting(storage_index):
+            self._adjust(sharetype, -int(bucket_empty), -1, -data_length)
+
+    def prefix_listed(self, prefix, buckets):
+        """Note that the crawler has listed ``buckets`` in ``prefix`` and
+        will count them one at a time."""
+        self._current_prefix = prefix
+        self._uncounted_buckets = set(buckets)
+
+    def bucket_counted(self, bucket, counts):
+        """Add the counts for one bucket of the prefix being counted, as
+        found on disk."""
+        for sharetype in SHARETYPES:
+            c = counts[sharetype]
+            self._adjust(sharetype, c["buckets"], c["shares"], c["bytes"])
+        self._uncounted_buckets.discard(bucket)
+
+    def prefix_counted(self, prefix):
+        """Note that every bucket in ``prefix`` has been counted."""
+        self._counted_prefixes.add(prefix)
+        if prefix == self._current_prefix:
+            self._current_prefix = None
+            self._uncounted_buckets = set()
+
+    def count_finished(self):
+        self._complete = True
+        self._counted_prefixes = set()
+        self._current_prefix = None
+        self._uncounted_buckets = set()
+
+    def get_counts(self):
+        """
+        :return: A dict mapping each share type to a dict of ``buckets``,
+            ``shares``, and ``bytes`` counts, or ``None`` if the counts are
+            still being computed.
+        """
+        if not self._complete:
+            return None
+        return dict((sharetype, dict(c))
+                    for (sharetype, c) in self._counts.items())
+
+    def get_total_bucket_count(self):
+        if not self._complete:
+            return None
+        return sum(c["buckets"] for c in self._counts.values())
+
+    def load(self, countsfile):
+        """Load counts saved by ``save`` and remove the file.
+
+        :return: True if usable counts were loaded, False if they must be
+            recomputed.
+        """
+        try:
+            with open(countsfile, "rb") as f:
+                saved = json.loads(f.read().decode("utf-8"))
+        except EnvironmentError:
+            return False
+        except ValueError:
+            log.msg("unparseable share counts in %s" % (countsfile,),
+                    level=log.UNUSUAL, umid="V2dbOA")
+            fileutil.remove_if_possible(countsfile)
+            return False
+        # Anything that happens between now and the next save() would be
+        # lost if we crashed, so the file must not outlive this process.
+        fileutil.remove_if_possible(countsfile)
+        try:
+            counts = _empty_counts()
+            for sharetype in SHARETYPES:
+                for name in counts[sharetype]:
+                    value = saved["counts"][sharetype][name]
+                    if (not isinstance(value, six.integer_types)
+                            or value < 0):
+                        return False
+                    counts[sharetype][name] = value
+        except (KeyError, TypeError):
+            return False
+        self._counts = counts
+        self.count_finished()
+        return True
+
+    def save(self, countsfile):
+        """Write my counts to ``countsfile``, unless they are incomplete or
+        suspect."""
+        if not self._complete or self._suspect:
+            return
+        data = json.dumps({"version": 1, "counts": self._counts})
+        fileutil.write_atomically(countsfile, data.encode("utf-8"))
+
+    def get_stats(self):
+        stats = {}
+        if self._complete:
+            for (sharetype, counts) in self._counts.items():
+                for (name, value) in counts.items():
+                    stats["%s.%s" % (sharetype, name)] = value
+        return stats
+
+
+class ShareCountingCrawler(ShareCrawler):
+    """
+    I make a single pass over the share directory to fill a
+    ``ShareCounter`` whose saved counts were missing or suspect, then remove
+    myself from my service parent.
+
+    Like other crawlers, I count one bucket at a time and yield when my time
+    slice runs out. Each bucket is counted within a single call, so every
+    change reported to the counter is either already on disk when I count
+    its bucket, or is applied to the counter after I have counted it. Two
+    kinds of change are reported some time after they reach the disk, and
+    would otherwise be counted twice: an immutable share is only reported
+    when its writer is closed, so I leave shares which are still being
+    written for the counter to add then, and changes made in disk I/O
+    threads are reported when the thread is done, so I wait for a bucket
+    until none are queued for it.
+    """
+
+    slow_start = 0
+    allowed_cpu_percentage = .50
+    minimum_cycle_time = 0
+
+    def __init__(self, server, statefile, share_counter):
+        self.share_counter = share_counter
+        self._listed_prefix = None
+        fileutil.remove_if_possible(statefile)
+        ShareCrawler.__init__(self, server, statefile)
+
+    def process_prefixdir(self, cycle, prefix, prefixdir, buckets, start_slice):
+        if prefix != self._listed_prefix:
+            # the buckets were listed in this same call
+            self.share_counter.prefix_listed(prefix, buckets)
+            self._listed_prefix = prefix
+        ShareCrawler.process_prefixdir(self, cycle, prefix, prefixdir,
+                                       buckets, start_slice)
+
+    def process_bucket(self, cycle, prefix, prefixdir, bucket):
+        storage_index = si_a2b(bucket.encode("ascii"))
+        if self.server._share_changes_pending(storage_index):
+            # come back to this bucket once the changes have been counted
+            raise TimeSliceExceeded()
+        being_written = self.server._shnums_being_written(storage_index)
+        counts = _empty_counts()
+        packed_store = self.server.packed_store
+        bucketdir = os.path.join(prefixdir, bucket)
+        packed_shnums = []
+        if packed_store is not None:
+            packed_shnums = packed_store.get_shnums(storage_index)
+        try:
+            names = os.listdir(bucketdir)
+        except EnvironmentError:
+            names = []
+        shares = [(shnum, True) for shnum in packed_shnums]
+        for name in names:
+            try:
+                shnum = int(name)
+            except ValueError:
+                continue # non-numeric means not a sharefile
+            if shnum not in packed_shnums:
+                shares.append((shnum, False))
+        buckettype = None
+        for (shnum, packed) in shares:
+            if shnum in being_written:
+                continue
+            filename = os.path.join(bucketdir, "%d" % shnum)
+            try:
+                if packed:
+                    sf = open_packed_share(packed_store, storage_index,
+                                           shnum, filename)
+                else:
+                    sf = get_share_file(filename)
+                sharetype = sf.sharetype
+                data_length = sf.get_data_length()
+            except (EnvironmentError,
+                    UnknownMutableContainerVersionError,
+                    UnknownImmutableContainerVersionError,
+                    struct.error):
+                continue # the lease checker reports corrupt shares
+            if buckettype is None:
+                buckettype = sharetype
+                counts[sharetype]["buckets"] += 1
+            counts[sharetype]["shares"] += 1
+            counts[sharetype]["bytes"] += data_length
+        self.share_counter.bucket_counted(bucket, counts)
+
+    def finished_prefix(self, cycle, prefix):
+        self.share_counter.prefix_counted(prefix)
+
+    def finished_cycle(self, cycle):
+        self.share_counter.count_finished()
+        self.disownServiceParent()
@@ -0,0 +1,163 @@
+"""
+An in-memory index of the shares held by a storage server.
+
+Ported to Python 3.
+"""
+
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from future.utils import PY2
+if PY2:
+    # We omit anything that might end up in pickle, just in case.
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, range, str, max, min  # noqa: F401
+
+import os, struct
+
+from allmydata.storage.common import si_a2b, si_b2a
+from allmydata.storage.crawler import ShareCrawler
+from allmydata.storage.mutable import MutableShareFile
+from allmydata.util import fileutil
+
+
+def get_share_type(filename):
+    """
+    Sniff the container header of a share file.
+
+    :return: ``"mutable"``, ``"immutable"``, or ``None`` if the file does not
+        look like a share container at all.
+    """
+    with open(filename, "rb") as f:
+        header = f.read(32)
+    return share_type_from_header(header)
+
+
+def share_type_from_header(header):
+    """
+    :return: ``"mutable"``, ``"immutable"``, or ``None``, according to the
+        first 32 bytes of a share container.
+    """
+    if header == MutableShareFile.MAGIC:
+        return "mutable"
+    if header[:4] == struct.pack(">L", 1):
+        return "immutable"
+    return None
+
+
+class ShareIndex(object):
+    """
+    I map storage indexes to the shares this server holds for them, so that
+    the storage server can answer "which shares do you have?" without
+    listing the bucket directory.
+
+    Each entry maps a share number to a ``(sharetype, container_size)``
+    tuple. I am populated incrementally by a ``ShareIndexCrawler`` at
+    startup, and kept current by the storage server as shares are created and
+    deleted. Until the crawler has scanned the prefix directory which holds a
+    given storage index I cannot answer for it, and ``get_shares`` returns
+    ``None`` so the caller can fall back to the disk.
+
+    I assume that the storage server is the only thing adding or removing
+    share files while it runs.
+    """
+
+    def __init__(self):
+        self._buckets = {} # storage index -> {shnum: (sharetype, size)}
+        self._scanned_prefixes = set()
+        self._complete = False
+        self.hits = 0
+        self.misses = 0
+
+    def _prefix(self, storage_index):
+        return si_b2a(storage_index)[:2].decode("ascii")
+
+    def is_complete(self):
+        return self._complete
+
+    def prefix_scanned(self, prefix):
+        self._scanned_prefixes.add(prefix)
+
+    def scan_finished(self):
+        self._complete = True
+        self._scanned_prefixes = set()
+
+    def get_shares(self, storage_index):
+        """
+        :return: A dict mapping share numbers to ``(sharetype,
+            container_size)`` tuples, or ``None`` if I cannot yet answer for
+            this storage index.
+        """
+        if not (self._complete or
+                self._prefix(storage_index) in self._scanned_prefixes):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self._buckets.get(storage_index, {})
+
+    def add_share(self, storage_index, shnum, sharetype, container_size):
+        self._buckets.setdefault(storage_index, {})[shnum] = (sharetype,
+                                                              container_size)
+
+    def remove_share(self, storage_index, shnum):
+        shares = self._buckets.get(storage_index)
+        if shares is None:
+            return
+        shares.pop(shnum, None)
+        if not shares:
+            del self._buckets[storage_index]
+
+    def get_stats(self):
+        return {"buckets": len(self._buckets),
+                "hits": self.hits,
+                "misses": self.misses,
+                "complete": int(self._complete),
+                }
+
+
+class ShareIndexCrawler(ShareCrawler):
+    """
+    I make a single pass over the share directory to populate a
+    ``ShareIndex``, then remove myself from my service parent. The index
+    lives only in memory, so every process starts a fresh scan: I discard
+    any state left behind by an earlier run.
+    """
+
+    slow_start = 0
+    allowed_cpu_percentage = .50
+    minimum_cycle_time = 0
+
+    def __init__(self, server, statefile, share_index):
+        self.share_index = share_index
+        fileutil.remove_if_possible(statefile)
+        ShareCrawler.__init__(self, server, statefile)
+
+    def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
+        storage_index = si_a2b(storage_index_b32.encode("ascii"))
+        bucketdir = os.path.join(prefixdir, storage_index_b32)
+        try:
+            names = os.listdir(bucketdir)
+        except EnvironmentError:
+            return
+        for name in names:
+            try:
+                shnum = int(name)
+            except ValueError:
+                continue # non-numeric means not a sharefile
+            filename = os.path.join(bucketdir, name)
+            try:
+                sharetype = get_share_type(filename)
+                size = os.path.getsize(filename)
+            except EnvironmentError:
+                continue
+            if sharetype is None:
+                continue
+            self.share_index.add_share(storage_index, shnum, sharetype, size)
+
+    def finished_prefix(self, cycle, prefix):
+        self.share_index.prefix_scanned(prefix)
+
+    def finished_cycle(self, cycle):
+        self.share_index.scan_finished()
+        self.disownServiceParent()
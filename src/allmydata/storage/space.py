@@ -0,0 +1,120 @@
+"""
+Tracking of the disk space available to the storage server.
+
+Ported to Python 3.
+"""
+
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import time, weakref
+
+from allmydata.util import fileutil
+
+
+class SpaceAccounting(object):
+    """
+    I answer the question "how much space may new shares take?" for
+    ``allocate_buckets`` without asking the operating system every time.
+
+    The free space reported by the filesystem (less the reserved space) is
+    remembered for ``ttl`` seconds. Space promised to uploads in progress is
+    kept as a running total, adjusted as each upload starts and finishes,
+    rather than summed over every active upload on each request. When an
+    upload finishes, the space its share now takes is subtracted from the
+    remembered free space, so that the estimate stays conservative until the
+    filesystem is asked again.
+
+    Uploads are identified by their BucketWriter. One which is dropped
+    without being closed or aborted gives its space back when it is garbage
+    collected.
+
+    ``get_available_space`` may be called from a disk I/O thread, everything
+    else only from the reactor thread.
+    """
+
+    TTL = 5
+
+    def __init__(self, whichdir, reserved_space, ttl=None):
+        self._whichdir = whichdir
+        self._reserved_space = reserved_space
+        if ttl is not None:
+            self.TTL = ttl
+        self._cached = None # (time, available space)
+        self._allocations = {} # weakref to BucketWriter -> allocated size
+        self._allocated = 0
+        self.disk_stats_calls = 0
+        self.cache_hits = 0
+
+    def is_fresh(self):
+        """Return True if ``get_available_space`` can answer without asking
+        the filesystem."""
+        cached = self._cached
+        return cached is not None and time.time() - cached[0] < self.TTL
+
+    def get_available_space(self):
+        """Return the space available for shares in bytes, not counting
+        space allocated to uploads in progress, or None if the platform has
+        no API to find out."""
+        cached = self._cached
+        if cached is not None and time.time() - cached[0] < self.TTL:
+            self.cache_hits += 1
+            return cached[1]
+        self.disk_stats_calls += 1
+        available = fileutil.get_available_space(self._whichdir,
+                                                 self._reserved_space)
+        self._cached = (time.time(), available)
+        return available
+
+    def invalidate(self):
+        """Forget the remembered free space, so the next request asks the
+        filesystem again."""
+        self._cached = None
+
+    def allocate(self, writer, size):
+        """Note that ``size`` bytes have been promised to ``writer``."""
+        self._allocations[weakref.ref(writer, self._writer_collected)] = size
+        self._allocated += size
+
+    def release(self, writer, consumed_size):
+        """Note that ``writer`` has finished with ``consumed_size`` bytes
+        left on disk (zero if it was aborted), and give back its
+        allocation."""
+        size = self._allocations.pop(weakref.ref(writer), None)
+        if size is not None:
+            self._allocated -= size
+        cached = self._cached
+        if consumed_size and cached is not None and cached[1] is not None:
+            self._cached = (cached[0], max(0, cached[1] - consumed_size))
+
+    def _writer_collected(self, ref):
+        size = self._allocations.pop(ref, None)
+        if size is not None:
+            self._allocated -= size
+
+    def get_allocated_size(self):
+        """Return the space promised to uploads in progress."""
+        return self._allocated
+
+    def get_stats(self):
+        """
+        ``available`` is the free space last reported by the filesystem (less
+        the reserved space and the shares written since), and ``age`` the
+        number of seconds since it was asked. ``disk_stats_calls`` counts
+        the times the filesystem was asked, and ``cache_hits`` the requests
+        answered without asking.
+        """
+        stats = {"disk_stats_calls": self.disk_stats_calls,
+                 "cache_hits": self.cache_hits,
+                 }
+        cached = self._cached
+        if cached is not None and cached[1] is not None:
+            stats["available"] = cached[1]
+            stats["age"] = time.time() - cached[0]
+        return stats
@@ -30,7 +30,7 @@ the foolscap-based server implemented in src/allmydata/storage/*.py .
 
 from past.builtins import unicode
 
-import re, time, hashlib
+import re, time, hashlib, heapq
 try:
     from ConfigParser import (
         NoSectionError,
@@ -44,6 +44,7 @@ from zope.interface import (
     implementer,
 )
 from twisted.internet import defer
+from twisted.python.failure import Failure
 from twisted.application import service
 from twisted.plugin import (
     getPlugins,
@@ -51,7 +52,7 @@ from twisted.plugin import (
 from eliot import (
     log_call,
 )
-from foolscap.api import eventually
+from foolscap.api import eventually, Referenceable
 from foolscap.reconnector import (
     ReconnectionInfo,
 )
@@ -137,6 +138,97 @@ class StorageClientConfig(object):
         )
 
 
+class PermutedServers(object):
+    """
+    I am the connected servers of a StorageFarmBroker, permuted for one peer
+    selection index: preferred servers first, then the others, each in
+    order of permute_server_hash(). I can be iterated, indexed and sliced
+    like a list, but I only sort as far as I am read, so taking the first
+    few servers of a large grid costs a heapify rather than a full sort.
+    """
+
+    def __init__(self, keyed):
+        # keyed is a list of (is_unpreferred, hash, tiebreak, server) tuples
+        heapq.heapify(keyed)
+        self._heap = keyed
+        self._sorted = []
+
+    def _sort_to(self, n):
+        while len(self._sorted) < n and self._heap:
+            self._sorted.append(heapq.heappop(self._heap)[3])
+
+    def __len__(self):
+        return len(self._sorted) + len(self._heap)
+
+    def __bool__(self):
+        return bool(self._sorted or self._heap)
+    __nonzero__ = __bool__
+
+    def __iter__(self):
+        i = 0
+        while True:
+            self._sort_to(i + 1)
+            if i >= len(self._sorted):
+                return
+            yield self._sorted[i]
+            i += 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            indexes = range(*index.indices(len(self)))
+            if indexes:
+                self._sort_to(max(indexes[0], indexes[-1]) + 1)
+            return [self._sorted[i] for i in indexes]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        self._sort_to(index + 1)
+        return self._sorted[index]
+
+    def __repr__(self):
+        return "<PermutedServers %r>" % (list(self),)
+
+
+class _ServerMap(dict):
+    """
+    I am the dict of StorageFarmBroker.servers, which calls ``changed``
+    before anything is added to or removed from it.
+    """
+
+    def __init__(self, changed):
+        dict.__init__(self)
+        self._changed = changed
+
+    def __setitem__(self, key, value):
+        self._changed()
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self._changed()
+        dict.__delitem__(self, key)
+
+    def clear(self):
+        self._changed()
+        dict.clear(self)
+
+    def pop(self, *args):
+        self._changed()
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self._changed()
+        return dict.popitem(self)
+
+    def setdefault(self, key, default=None):
+        self._changed()
+        return dict.setdefault(self, key, default)
+
+    def update(self, *args, **kwargs):
+        self._changed()
+        dict.update(self, *args, **kwargs)
+
+
 @implementer(IStorageBroker)
 class StorageFarmBroker(service.MultiService):
     """I live on the client, and know about storage servers. For each server
@@ -175,7 +267,10 @@ class StorageFarmBroker(service.MultiService):
         # storage servers that we've heard about. Each descriptor manages its
         # own Reconnector, and will give us a RemoteReference when we ask
         # them for it.
-        self.servers = {}
+        self.servers = _ServerMap(self._servers_changed)
+        # (is_unpreferred, permutation_seed, server) for each of them, made
+        # when first needed after they change
+        self._ring = None
         self._static_server_ids = set() # ignore announcements for these
         self.introducer_client = None
         self._threshold_listeners = [] # tuples of (threshold, Deferred)
@@ -346,17 +441,27 @@ class StorageFarmBroker(service.MultiService):
         for dsc in self.servers.values():
             dsc.try_to_connect()
 
+    def _servers_changed(self):
+        self._ring = None
+
+    def _get_ring(self):
+        if self._ring is None:
+            preferred_peers = self.preferred_peers
+            self._ring = [(s.get_longname() not in preferred_peers,
+                           s.get_permutation_seed(), s)
+                          for s in self.servers.values()]
+        return self._ring
+
     def get_servers_for_psi(self, peer_selection_index):
-        # return a list of server objects (IServers)
+        # return a PermutedServers of server objects (IServers)
         assert self.permute_peers == True
-        connected_servers = self.get_connected_servers()
-        preferred_servers = frozenset(s for s in connected_servers if s.get_longname() in self.preferred_peers)
-        def _permuted(server):
-            seed = server.get_permutation_seed()
-            is_unpreferred = server not in preferred_servers
-            return (is_unpreferred,
-                    permute_server_hash(peer_selection_index, seed))
-        return sorted(connected_servers, key=_permuted)
+        keyed = [(is_unpreferred,
+                  permute_server_hash(peer_selection_index, seed),
+                  i, server)
+                 for i, (is_unpreferred, seed, server)
+                 in enumerate(self._get_ring())
+                 if server.is_connected()]
+        return PermutedServers(keyed)
 
     def get_all_serverids(self):
         return frozenset(self.servers.keys())
@@ -845,19 +950,75 @@ class UnknownServerTypeError(Exception):
     pass
 
 
+def _supports_priority_hints(rref):
+    version = getattr(rref, "version", None) or {}
+    v1 = version.get(b"http://allmydata.org/tahoe/protocols/storage/v1", {})
+    return v1.get(b"supports-priority-hints", False)
+
+
 @implementer(IStorageServer)
 @attr.s
 class _StorageServer(object):
     """
     ``_StorageServer`` is a direct pass-through to an ``RIStorageServer`` via
     a ``RemoteReference``.
+
+    One made by ``with_priority`` sends its requests through the
+    ``RIStorageServer`` the server returns from its own ``with_priority``,
+    which it asks for again whenever the connection has been replaced.
+    The server tells clients apart by the Tub which sent ``_canary``.
     """
     _get_rref = attr.ib()
+    _priority = attr.ib(default=None)
+    _prioritized_rref = attr.ib(default=None, init=False, repr=False)
+    _prioritizing = attr.ib(default=None, init=False, repr=False)
+    _prioritized_servers = attr.ib(default=attr.Factory(dict), init=False,
+                                   repr=False)
+    _canary = attr.ib(default=attr.Factory(Referenceable), init=False,
+                      repr=False)
 
     @property
     def _rref(self):
         return self._get_rref()
 
+    def with_priority(self, priority):
+        if priority not in self._prioritized_servers:
+            self._prioritized_servers[priority] = _StorageServer(
+                get_rref=self._get_rref,
+                priority=priority,
+            )
+        return self._prioritized_servers[priority]
+
+    def _call(self, methname, *args):
+        rref = self._rref
+        if self._priority is None or not _supports_priority_hints(rref):
+            return rref.callRemote(methname, *args)
+        if self._prioritized_rref is not None \
+               and self._prioritized_rref[0] is rref:
+            return self._prioritized_rref[1].callRemote(methname, *args)
+        d = defer.Deferred()
+        d.addCallback(lambda prioritized:
+                      prioritized.callRemote(methname, *args))
+        if self._prioritizing is not None and self._prioritizing[0] is rref:
+            # calls made before the server answers all wait for the same
+            # with_priority request, and are sent in the order they were
+            # made once it does
+            self._prioritizing[1].append(d)
+            return d
+        waiting = [d]
+        self._prioritizing = (rref, waiting)
+        def _done(res):
+            if not isinstance(res, Failure):
+                self._prioritized_rref = (rref, res)
+            if self._prioritizing is not None \
+                   and self._prioritizing[1] is waiting:
+                self._prioritizing = None
+            for w in waiting:
+                w.callback(res)
+        rref.callRemote("with_priority", self._priority.encode("ascii"),
+                        self._canary).addBoth(_done)
+        return d
+
     def get_version(self):
         return self._rref.callRemote(
             "get_version",
@@ -872,7 +1033,7 @@ class _StorageServer(object):
             allocated_size,
             canary,
     ):
-        return self._rref.callRemote(
+        return self._call(
             "allocate_buckets",
             storage_index,
             renew_secret,
@@ -888,19 +1049,28 @@ class _StorageServer(object):
             renew_secret,
             cancel_secret,
     ):
-        return self._rref.callRemote(
+        return self._call(
             "add_lease",
             storage_index,
             renew_secret,
             cancel_secret,
         )
 
+    def add_leases(
+            self,
+            leases,
+    ):
+        return self._call(
+            "add_leases",
+            leases,
+        )
+
     def renew_lease(
             self,
             storage_index,
             renew_secret,
     ):
-        return self._rref.callRemote(
+        return self._call(
             "renew_lease",
             storage_index,
             renew_secret,
@@ -910,18 +1080,27 @@ class _StorageServer(object):
             self,
             storage_index,
     ):
-        return self._rref.callRemote(
+        return self._call(
             "get_buckets",
             storage_index,
         )
 
+    def get_share_numbers(
+            self,
+            storage_indexes,
+    ):
+        return self._call(
+            "get_share_numbers",
+            storage_indexes,
+        )
+
     def slot_readv(
             self,
             storage_index,
             shares,
             readv,
     ):
-        return self._rref.callRemote(
+        return self._call(
             "slot_readv",
             storage_index,
             shares,
@@ -935,7 +1114,7 @@ class _StorageServer(object):
             tw_vectors,
             r_vector,
     ):
-        return self._rref.callRemote(
+        return self._call(
             "slot_testv_and_readv_and_writev",
             storage_index,
             secrets,
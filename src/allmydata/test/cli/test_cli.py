@@ -360,6 +360,34 @@ class CLI(CLITestMixin, unittest.TestCase):
         self.failUnless("mqfblse6m5a6dh45isu2cg7oji" in err,
                         "didn't see 'mqfblse6m5a6dh45isu2cg7oji' in '%s'" % err)
 
+    def test_pack_shares(self):
+        from allmydata.storage.server import StorageServer
+        from allmydata.storage.packed import PackedShareStore
+        from allmydata.storage.common import storage_index_to_dir
+        from allmydata.test.common_py3 import FakeCanary
+        nodedir = "cli/test_pack_shares"
+        ss = StorageServer(os.path.join(nodedir, "storage"), "\x00" * 20)
+        for (si, size) in [("s" * 16, 10), ("l" * 16, 200)]:
+            already, writers = ss.remote_allocate_buckets(
+                si, "r" * 32, "c" * 32, [0], size, FakeCanary())
+            writers[0].remote_write(0, "x" * size)
+            writers[0].remote_close()
+
+        o = debug.PackSharesOptions()
+        o.stdout, o.stderr = StringIO(), StringIO()
+        o.parseOptions(["--max-size", "100", nodedir])
+        self.failUnlessReallyEqual(debug.pack_shares(o), 0)
+        self.failUnlessReallyEqual(o.stdout.getvalue(),
+                                   "1 shares packed, 1 left in their own files\n")
+        sharedir = os.path.join(nodedir, "storage", "shares")
+        self.failIf(os.path.exists(os.path.join(
+            sharedir, storage_index_to_dir("s" * 16))))
+        self.failUnless(os.path.exists(os.path.join(
+            sharedir, storage_index_to_dir("l" * 16), "0")))
+        store = PackedShareStore(os.path.join(nodedir, "storage", "packed"))
+        self.addCleanup(store.close)
+        self.failUnlessReallyEqual(store.get_shnums("s" * 16), [0])
+
     def test_alias(self):
         def s128(c): return base32.b2a(c*(128/8))
         def s256(c): return base32.b2a(c*(256/8))
@@ -39,10 +39,12 @@ from allmydata.util.assertutil import _assert
 
 from allmydata import uri as tahoe_uri
 from allmydata.client import _Client
-from allmydata.storage.server import StorageServer, storage_index_to_dir
+from allmydata.storage.server import StorageServer, storage_index_to_dir, \
+     si_a2b
 from allmydata.util import fileutil, idlib, hashutil
 from allmydata.util.hashutil import permute_server_hash
 from allmydata.util.fileutil import abspath_expanduser_unicode
+from allmydata.util.statistics import Histogram
 from allmydata.interfaces import IStorageBroker, IServer
 from allmydata.storage_client import (
     _StorageServer,
@@ -91,8 +93,7 @@ class LocalWrapper(object):
         def _really_call():
             def incr(d, k): d[k] = d.setdefault(k, 0) + 1
             incr(self.counter_by_methname, methname)
-            meth = getattr(self.original, "remote_" + methname)
-            return meth(*args, **kwargs)
+            return self.original.doRemoteCall(methname, args, kwargs)
 
         def _call():
             if self.broken:
@@ -128,6 +129,8 @@ class LocalWrapper(object):
             if methname == "get_buckets":
                 for shnum in res:
                     res[shnum] = LocalWrapper(res[shnum])
+            if methname == "with_priority":
+                res = _PrioritizedWrapper(res, self)
             return res
         d.addCallback(_return_membrane)
         if self.post_call_notifier:
@@ -141,6 +144,25 @@ class LocalWrapper(object):
     def dontNotifyOnDisconnect(self, marker):
         del self.disconnectors[marker]
 
+def _shared_with_server(name):
+    return property(lambda self: getattr(self._server_wrapper, name),
+                    lambda self, value: setattr(self._server_wrapper, name,
+                                                value))
+
+class _PrioritizedWrapper(LocalWrapper):
+    # what with_priority() returns breaks, hangs, and counts its calls along
+    # with the wrapper of the storage server itself, so that tests need not
+    # care which of them a client used
+    def __init__(self, original, server_wrapper):
+        self.original = original
+        self.disconnectors = {}
+        self._server_wrapper = server_wrapper
+
+    broken = _shared_with_server("broken")
+    hung_until = _shared_with_server("hung_until")
+    post_call_notifier = _shared_with_server("post_call_notifier")
+    counter_by_methname = _shared_with_server("counter_by_methname")
+
 def wrap_storage_server(original):
     # Much of the upload/download code uses rref.version (which normally
     # comes from rrefutil.add_version_to_remote_reference). To avoid using a
@@ -277,12 +299,19 @@ class _NoNetworkClient(_Client):
 class SimpleStats(object):
     def __init__(self):
         self.counters = {}
+        self.histograms = {}
         self.stats_producers = []
 
     def count(self, name, delta=1):
         val = self.counters.setdefault(name, 0)
         self.counters[name] = val + delta
 
+    def get_histogram(self, name):
+        return self.histograms.setdefault(name, Histogram())
+
+    def record(self, name, value):
+        self.get_histogram(name).record(value)
+
     def register_producer(self, stats_producer):
         self.stats_producers.append(stats_producer)
 
@@ -290,7 +319,11 @@ class SimpleStats(object):
         stats = {}
         for sp in self.stats_producers:
             stats.update(sp.get_stats())
-        ret = { 'counters': self.counters, 'stats': stats }
+        histograms = {}
+        for (name, h) in self.histograms.items():
+            histograms.update(h.to_stats(name))
+        ret = { 'counters': self.counters, 'stats': stats,
+                'histograms': histograms }
         return ret
 
 class NoNetworkGrid(service.MultiService):
@@ -549,6 +582,14 @@ class GridTestMixin(object):
         for sharefile, data in list(shares.items()):
             with open(sharefile, "wb") as f:
                 f.write(data)
+        # the servers need not avoid the restored shares any longer
+        for ss in self.g.servers_by_number.values():
+            for sharefile in shares:
+                if not sharefile.startswith(ss.sharedir + os.sep):
+                    continue
+                (bucketdir, shnum) = os.path.split(sharefile)
+                si = si_a2b(os.path.basename(bucketdir).encode("ascii"))
+                ss.corruption_registry.release(si, int(shnum))
 
     def delete_share(self, sharenum_and_serverid_and_sharefile):
         (shnum, serverid, sharefile) = sharenum_and_serverid_and_sharefile
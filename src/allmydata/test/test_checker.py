@@ -24,6 +24,7 @@ from allmydata.util import base32
 from allmydata.web import check_results as web_check_results
 from allmydata.storage_client import StorageFarmBroker, NativeStorageServer
 from allmydata.storage.server import storage_index_to_dir
+from allmydata.storage.immutable import BucketReader
 from allmydata.monitor import Monitor
 from allmydata.test.no_network import GridTestMixin
 from allmydata.immutable.upload import Data
@@ -31,6 +32,7 @@ from allmydata.mutable.publish import MutableData
 
 from .common import (
     EMPTY_CLIENT_CONFIG,
+    _corrupt_share_data,
 )
 
 from .web.common import (
@@ -852,3 +854,74 @@ class TooParallel(GridTestMixin, unittest.TestCase):
             return res
         d.addBoth(_clean_up)
         return d
+
+class HashBlocks(GridTestMixin, unittest.TestCase):
+    # if told to trust them, the verifier asks servers to hash their own
+    # blocks, rather than downloading them
+
+    @defer.inlineCallbacks
+    def _upload(self, trust_server_hashes=True):
+        self.set_up_grid(num_servers=4)
+        c0 = self.g.clients[0]
+        c0.nodemaker.trust_server_hashes = trust_server_hashes
+        c0.encoding_params = { "k": 2,
+                               "happy": 4,
+                               "n": 4,
+                               "max_segment_size": 50,
+                               }
+        ur = yield c0.upload(Data("data" * 100, convergence=""))
+        self.uri = ur.get_uri()
+        self.node = c0.create_node_from_uri(self.uri)
+        self.fetched = []
+        orig_get_block = ValidatedReadBucketProxy.get_block
+        def get_block(vrbp, blocknum):
+            self.fetched.append((vrbp.sharenum, blocknum))
+            return orig_get_block(vrbp, blocknum)
+        self.patch(ValidatedReadBucketProxy, "get_block", get_block)
+
+    @defer.inlineCallbacks
+    def test_healthy(self):
+        self.basedir = "checker/HashBlocks/healthy"
+        yield self._upload()
+        cr = yield self.node.check(Monitor(), verify=True)
+        self.failUnless(cr.is_healthy())
+        self.failUnlessEqual(cr.get_share_counter_good(), 4)
+        self.failUnlessEqual(self.fetched, [])
+
+    @defer.inlineCallbacks
+    def test_not_trusted(self):
+        # by default, every block is downloaded
+        self.basedir = "checker/HashBlocks/not_trusted"
+        yield self._upload(trust_server_hashes=False)
+        cr = yield self.node.check(Monitor(), verify=True)
+        self.failUnless(cr.is_healthy())
+        self.failUnlessEqual(set(shnum for (shnum, blocknum)
+                                 in self.fetched), set(range(4)))
+
+    @defer.inlineCallbacks
+    def test_corrupt_block(self):
+        self.basedir = "checker/HashBlocks/corrupt_block"
+        yield self._upload()
+        self.corrupt_shares_numbered(self.uri, [0], _corrupt_share_data)
+        cr = yield self.node.check(Monitor(), verify=True)
+        self.failIf(cr.is_healthy())
+        self.failUnlessEqual(cr.get_share_counter_good(), 3)
+        self.failUnlessEqual([shnum for (server, si, shnum)
+                              in cr.get_corrupt_shares()], [0])
+        self.failUnlessEqual(self.fetched, [])
+
+    @defer.inlineCallbacks
+    def test_download_on_failure(self):
+        self.basedir = "checker/HashBlocks/download_on_failure"
+        yield self._upload()
+        def broken_hash_blocks(*args, **kwargs):
+            raise IOError("intentional failure")
+        self.patch(BucketReader, "remote_hash_blocks", broken_hash_blocks)
+        self.corrupt_shares_numbered(self.uri, [0], _corrupt_share_data)
+        cr = yield self.node.check(Monitor(), verify=True)
+        self.failUnlessEqual(cr.get_share_counter_good(), 3)
+        self.failUnlessEqual([shnum for (server, si, shnum)
+                              in cr.get_corrupt_shares()], [0])
+        # every block of every share was downloaded instead
+        self.failUnlessEqual(set(shnum for (shnum, blocknum)
+                                 in self.fetched), set(range(4)))
@@ -18,6 +18,7 @@ if PY2:
 
 import time
 import os.path
+import threading
 from twisted.trial import unittest
 from twisted.application import service
 from twisted.internet import defer
@@ -107,6 +108,36 @@ class OneShotCrawler(ShareCrawler):
         self.finished_d.callback(None)
         self.disownServiceParent()
 
+class ThreadedCrawler(ShareCrawler):
+    cpu_slice = 500 # make sure it can complete in a single slice
+    slow_start = 0
+    process_bucket_in_threads = True
+    scan_threads = 3
+    def __init__(self, *args, **kwargs):
+        ShareCrawler.__init__(self, *args, **kwargs)
+        self.all_buckets = []
+        self.threads = set()
+        self.countdown = None
+        self.slices = 0
+        self.finished_d = defer.Deferred()
+    def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
+        self.threads.add(threading.current_thread())
+        if PY3:
+            storage_index_b32 = storage_index_b32.encode("ascii")
+        self.call_in_reactor(self.processed, storage_index_b32)
+    def processed(self, storage_index_b32):
+        self.all_buckets.append(storage_index_b32)
+        if self.countdown is not None:
+            self.countdown -= 1
+            if self.countdown == 0:
+                # force a timeout. We restore it in yielding()
+                self.cpu_slice = -1.0
+    def yielding(self, sleep_time):
+        self.slices += 1
+        self.cpu_slice = 500
+    def finished_cycle(self, cycle):
+        eventually(self.finished_d.callback, None)
+
 class Basic(unittest.TestCase, StallMixin, pollmixin.PollMixin):
     def setUp(self):
         self.s = service.MultiService()
@@ -162,6 +193,28 @@ class Basic(unittest.TestCase, StallMixin, pollmixin.PollMixin):
         c2.start_current_prefix(time.time())
         self.failUnlessEqual(sorted(sis), sorted(c2.all_buckets))
 
+    def test_lazy_state(self):
+        """A crawler does not read its state file until it needs it."""
+        self.basedir = "crawler/Basic/lazy_state"
+        fileutil.make_dirs(self.basedir)
+        serverid = b"\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        statefile = os.path.join(self.basedir, "statefile")
+        c = BucketEnumeratingCrawler(ss, statefile)
+        c.load_state()
+        c.state["last-cycle-finished"] = 3
+        c.save_state()
+
+        loaded = []
+        class LoadCountingCrawler(BucketEnumeratingCrawler):
+            def load_state(self):
+                loaded.append(True)
+                BucketEnumeratingCrawler.load_state(self)
+        c2 = LoadCountingCrawler(ss, statefile)
+        self.failUnlessEqual(loaded, [])
+        self.failUnlessEqual(c2.get_state()["last-cycle-finished"], 3)
+        self.failUnlessEqual(loaded, [True])
+
     def test_service(self):
         self.basedir = "crawler/Basic/service"
         fileutil.make_dirs(self.basedir)
@@ -292,6 +345,37 @@ class Basic(unittest.TestCase, StallMixin, pollmixin.PollMixin):
         self.failUnlessEqual(sorted(sis), sorted(c2.all_buckets))
         del c, c2
 
+    def test_threaded(self):
+        self.basedir = "crawler/Basic/threaded"
+        fileutil.make_dirs(self.basedir)
+        serverid = b"\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        ss.setServiceParent(self.s)
+
+        # put four buckets in each prefixdir
+        sis = []
+        for i in range(10):
+            for tail in range(4):
+                sis.append(self.write(i, ss, serverid, tail))
+
+        statefile = os.path.join(self.basedir, "statefile")
+        c = ThreadedCrawler(ss, statefile)
+        # run out of time partway through a prefix, after the second batch
+        c.countdown = 5
+        c.setServiceParent(self.s)
+
+        d = c.finished_d
+        def _check(ignored):
+            # every bucket was processed once, and the calls made for them
+            # were made in order
+            self.failUnlessEqual(c.all_buckets, sorted(sis))
+            # one slice which ran out of time, and one which finished
+            self.failUnlessEqual(c.slices, 2)
+            self.failIf(threading.current_thread() in c.threads)
+            self.failUnlessEqual(c.get_state()["last-cycle-finished"], 0)
+        d.addCallback(_check)
+        return d
+
     def test_paced_service(self):
         self.basedir = "crawler/Basic/paced_service"
         fileutil.make_dirs(self.basedir)
@@ -25,6 +25,7 @@ from allmydata.test.common import make_chk_file_uri, make_mutable_file_uri, \
 from allmydata.test.no_network import GridTestMixin
 from allmydata.unknown import UnknownNode, strip_prefix_for_ro
 from allmydata.nodemaker import NodeMaker
+from allmydata.storage.shares import get_share_file
 from base64 import b32decode
 import allmydata.test.common_util as testutil
 
@@ -1125,6 +1126,66 @@ class Dirnode(GridTestMixin, unittest.TestCase,
         d.addCallback(_check)
         return d
 
+    def _count_leases(self, node):
+        return [len(list(get_share_file(fn).get_leases()))
+                for (shnum, serverid, fn) in self.find_uri_shares(node.get_uri())]
+
+    def test_deepcheck_add_lease_bulk(self):
+        self.basedir = "dirnode/Dirnode/test_deepcheck_add_lease_bulk"
+        self.set_up_grid(num_clients=2, oneshare=True)
+        d = self._test_deepcheck_create()
+        def _deep_check_from_other_client(rootnode):
+            for ss in self.g.wrappers_by_id.values():
+                ss._clear_counters()
+            c1 = self.g.clients[1]
+            root1 = c1.create_node_from_uri(rootnode.get_uri())
+            return root1.start_deep_check(add_lease=True).when_done()
+        d.addCallback(_deep_check_from_other_client)
+        def _check(r):
+            self.failUnlessReallyEqual(r.get_counters()["count-objects-healthy"], 4)
+            # all four objects fit in a single add_leases() call per server
+            for ss in self.g.wrappers_by_id.values():
+                self.failUnlessReallyEqual(ss.counter_by_methname.get('add_leases'), 1)
+                self.failIf(ss.counter_by_methname.get('add_lease'))
+        d.addCallback(_check)
+        d.addCallback(lambda ign: self._subdir.get(u"file1"))
+        def _check_leases(file1):
+            # every share now holds a lease from each client
+            for node in [self._rootnode, self._subdir, file1]:
+                self.failUnlessEqual(set(self._count_leases(node)), set([2]))
+        d.addCallback(_check_leases)
+        # the first client's leases were made at upload time, and match the
+        # secrets it sends now, so they are renewed rather than added again
+        d.addCallback(lambda ign:
+                      self._rootnode.start_deep_check(add_lease=True).when_done())
+        d.addCallback(lambda ign: self._subdir.get(u"file1"))
+        d.addCallback(_check_leases)
+        return d
+
+    def test_deepcheck_add_lease_fallback(self):
+        self.basedir = "dirnode/Dirnode/test_deepcheck_add_lease_fallback"
+        self.set_up_grid(oneshare=True)
+        d = self._test_deepcheck_create()
+        def _old_server(rootnode):
+            # one server predates add_leases(), so every lease is added with
+            # add_lease() as the checkers go
+            server = list(self.g.clients[0].storage_broker.get_connected_servers())[0]
+            v1 = server.get_version()[b"http://allmydata.org/tahoe/protocols/storage/v1"]
+            del v1[b"supports-bulk-add-lease"]
+            for ss in self.g.wrappers_by_id.values():
+                ss._clear_counters()
+            return rootnode
+        d.addCallback(_old_server)
+        d.addCallback(lambda rootnode:
+                      rootnode.start_deep_check(add_lease=True).when_done())
+        def _check(r):
+            self.failUnlessReallyEqual(r.get_counters()["count-objects-healthy"], 4)
+            for ss in self.g.wrappers_by_id.values():
+                self.failIf(ss.counter_by_methname.get('add_leases'))
+                self.failUnless(ss.counter_by_methname.get('add_lease'))
+        d.addCallback(_check)
+        return d
+
     def test_deepcheck_mdmf(self):
         self.basedir = "dirnode/Dirnode/test_deepcheck_mdmf"
         self.set_up_grid(oneshare=True)
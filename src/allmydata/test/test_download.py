@@ -20,6 +20,7 @@ from twisted.trial import unittest
 from twisted.internet import defer, reactor
 from allmydata import uri
 from allmydata.storage.server import storage_index_to_dir
+from allmydata.storage.immutable import BucketReader
 from allmydata.util import base32, fileutil, spans, log, hashutil
 from allmydata.util.consumer import download_to_data, MemoryConsumer
 from allmydata.immutable import upload, layout
@@ -622,6 +623,67 @@ class DownloadTest(_Base, unittest.TestCase):
         d.addCallback(_got_data)
         return d
 
+    def _count_bucket_reads(self):
+        calls = {"read": 0, "readv": 0}
+        real_read = BucketReader.remote_read
+        real_readv = BucketReader.remote_readv
+        def remote_read(reader, offset, length):
+            calls["read"] += 1
+            return real_read(reader, offset, length)
+        def remote_readv(reader, vector):
+            calls["readv"] += 1
+            return real_readv(reader, vector)
+        self.patch(BucketReader, "remote_read", remote_read)
+        self.patch(BucketReader, "remote_readv", remote_readv)
+        return calls
+
+    def test_download_readv(self):
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        self.load_shares()
+        calls = self._count_bucket_reads()
+
+        # without overrun, once the offset table arrives the hashes and
+        # blocks of each share are wanted as several separate spans
+        for s in self.c0.storage_broker.get_connected_servers():
+            v = s.get_version()
+            v1 = v[b"http://allmydata.org/tahoe/protocols/storage/v1"]
+            v1[b"tolerates-immutable-read-overrun"] = False
+
+        n = self.c0.create_node_from_uri(immutable_uri)
+        d = download_to_data(n)
+        def _got_data(data):
+            self.failUnlessEqual(data, plaintext)
+            # spans which are wanted together are fetched with a single
+            # readv() call instead of one read() each
+            self.failUnless(calls["readv"] > 0, calls)
+        d.addCallback(_got_data)
+        return d
+
+    def test_download_no_readv(self):
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        self.load_shares()
+        calls = self._count_bucket_reads()
+
+        # servers which do not announce readv() support only get read() calls
+        for s in self.c0.storage_broker.get_connected_servers():
+            v = s.get_version()
+            v1 = v[b"http://allmydata.org/tahoe/protocols/storage/v1"]
+            v1[b"tolerates-immutable-read-overrun"] = False
+            del v1[b"supports-immutable-readv"]
+
+        n = self.c0.create_node_from_uri(immutable_uri)
+        d = download_to_data(n)
+        def _got_data(data):
+            self.failUnlessEqual(data, plaintext)
+            self.failUnlessEqual(calls["readv"], 0)
+            self.failUnless(calls["read"] > 0, calls)
+        d.addCallback(_got_data)
+        return d
+
     def test_download_segment(self):
         self.basedir = self.mktemp()
         self.set_up_grid()
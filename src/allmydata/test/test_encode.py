@@ -18,7 +18,7 @@ from twisted.python.failure import Failure
 from foolscap.api import fireEventually
 from allmydata import uri
 from allmydata.immutable import encode, upload, checker
-from allmydata.util import hashutil
+from allmydata.util import hashutil, pollmixin
 from allmydata.util.assertutil import _assert
 from allmydata.util.consumer import download_to_data
 from allmydata.interfaces import IStorageBucketWriter, IStorageBucketReader
@@ -271,7 +271,7 @@ class ValidatedExtendedURIProxy(unittest.TestCase):
                 dl.append(d)
         return defer.DeferredList(dl)
 
-class Encode(unittest.TestCase):
+class Encode(pollmixin.PollMixin, unittest.TestCase):
     def do_encode(self, max_segment_size, datalen, NUM_SHARES, NUM_SEGMENTS,
                   expected_block_hashes, expected_share_hashes):
         data = make_data(datalen)
@@ -359,6 +359,102 @@ class Encode(unittest.TestCase):
         # 5 segments: 25, 25, 25, 25, 1
         return self.do_encode(25, 101, 100, 5, 15, 8)
 
+    def encode_to_fakes(self, data, pipeline_depth, make_shareholder=None):
+        e = encode.Encoder(pipeline_depth=pipeline_depth)
+        u = upload.Data(data, convergence=b"some convergence string")
+        u.set_default_encoding_parameters({'max_segment_size': 25,
+                                           'k': 25, 'happy': 75, 'n': 100})
+        d = e.set_encrypted_uploadable(upload.EncryptAnUploadable(u))
+        shareholders = {}
+        def _ready(res):
+            servermap = {}
+            for shnum in range(100):
+                peer = (make_shareholder or FakeBucketReaderWriterProxy)()
+                peer.encoder = e
+                shareholders[shnum] = peer
+                servermap.setdefault(shnum, set()).add(peer.get_peerid())
+            e.set_shareholders(shareholders, servermap)
+            return e.start()
+        d.addCallback(_ready)
+        d.addCallback(lambda verifycap: (verifycap, shareholders))
+        return d
+
+    @defer.inlineCallbacks
+    def test_pipelined_shares_identical(self):
+        """Encoding segments ahead of the one being sent makes the same
+        shares as encoding them one at a time."""
+        data = make_data(124)
+        (verifycap1, serial) = yield self.encode_to_fakes(data, 1)
+        (verifycap3, pipelined) = yield self.encode_to_fakes(data, 3)
+        self.failUnlessEqual(verifycap1.to_string(), verifycap3.to_string())
+        for shnum in range(100):
+            self.failUnless(pipelined[shnum].closed)
+            for attr in ("blocks", "crypttext_hashes", "block_hashes",
+                         "share_hashes", "uri_extension"):
+                self.failUnlessEqual(getattr(serial[shnum], attr),
+                                     getattr(pipelined[shnum], attr))
+
+    def test_pipelined_abort(self):
+        """Aborting a pipelined upload fails it, even though segments after
+        the one being sent have already been read."""
+        class AbortingProxy(FakeBucketReaderWriterProxy):
+            def put_block(self, segmentnum, data):
+                if segmentnum == 1:
+                    self.encoder.abort()
+                return FakeBucketReaderWriterProxy.put_block(self, segmentnum,
+                                                             data)
+        d = self.encode_to_fakes(make_data(124), 2,
+                                 make_shareholder=AbortingProxy)
+        return self.assertFailure(d, encode.UploadAborted)
+
+    @defer.inlineCallbacks
+    def test_slow_shareholder(self):
+        """Shareholders which keep up are sent up to pipeline_depth-1
+        segments ahead of one which does not, and the time spent waiting for
+        the slow one is counted against it."""
+        class SlowProxy(FakeBucketReaderWriterProxy):
+            released = False
+            def put_block(self, segmentnum, data):
+                d = defer.Deferred()
+                sent = lambda ign: FakeBucketReaderWriterProxy.put_block(
+                    self, segmentnum, data)
+                d.addCallback(sent)
+                if self.released:
+                    d.callback(None)
+                else:
+                    self.waiting.append(d)
+                return d
+        shareholders = []
+        def make_shareholder():
+            if shareholders:
+                shareholder = FakeBucketReaderWriterProxy()
+            else:
+                shareholder = SlowProxy()
+                shareholder.waiting = []
+            shareholders.append(shareholder)
+            return shareholder
+        d = self.encode_to_fakes(make_data(124), 3,
+                                 make_shareholder=make_shareholder)
+        yield self.poll(lambda: len(shareholders) > 1
+                        and len(shareholders[1].blocks) == 3)
+        for i in range(20):
+            yield fireEventually()
+        (slow, fast) = shareholders[:2]
+        self.failUnlessEqual(sorted(fast.blocks), [0, 1, 2])
+        self.failUnlessEqual(slow.blocks, {})
+        # only the first block has been given to the slow shareholder
+        self.failUnlessEqual(len(slow.waiting), 1)
+
+        slow.released = True
+        slow.waiting.pop(0).callback(None)
+        (verifycap, shareholders) = yield d
+        (expected_verifycap, expected) = yield self.encode_to_fakes(
+            make_data(124), 1)
+        self.failUnlessEqual(verifycap.to_string(),
+                             expected_verifycap.to_string())
+        self.failUnlessEqual(slow.blocks, expected[0].blocks)
+        self.failUnlessEqual(list(shareholders[0].encoder.get_stalls()), [0])
+
 
 class Roundtrip(GridTestMixin, unittest.TestCase):
 
@@ -396,6 +492,17 @@ class Roundtrip(GridTestMixin, unittest.TestCase):
     def test_125(self): return self.do_test_size(125)
     def test_101(self): return self.do_test_size(101)
 
+    def test_pipelined(self):
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        self.c0.getServiceNamed("uploader")._pipeline_depth = 4
+        DATA = make_data(1001)
+        d = self.upload(DATA)
+        d.addCallback(lambda n: download_to_data(n))
+        d.addCallback(lambda newdata: self.failUnlessEqual(newdata, DATA))
+        return d
+
     def upload(self, data):
         u = upload.Data(data, None)
         u.max_segment_size = 25
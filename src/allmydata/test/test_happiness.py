@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 """
-Tests for allmydata.immutable.happiness_upload and
-allmydata.util.happinessutil.
+Tests for allmydata.immutable.happiness_upload,
+allmydata.util.happinessutil and allmydata.util.bipartite.
 
 Ported to Python 3.
 """
@@ -16,20 +16,100 @@ if PY2:
     # We omit dict, just in case newdict breaks things.
     from builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, list, object, range, str, max, min  # noqa: F401
 
+from collections import OrderedDict
+
 from twisted.trial import unittest
-from hypothesis import given
-from hypothesis.strategies import text, sets
+from hypothesis import given, settings
+from hypothesis.strategies import text, sets, dictionaries, integers, lists
 
 from allmydata.immutable import happiness_upload
+from allmydata.util.bipartite import BipartiteMatching
 from allmydata.util.happinessutil import servers_of_happiness, \
     shares_by_server, merge_servers
 from allmydata.test.common_py3 import ShouldFailMixin
 
 
+def _augmenting_path_for(graph):
+    """
+    I return an augmenting path, if there is one, from the source node
+    to the sink node in the flow network represented by my graph argument.
+    If there is no augmenting path, I return False. I assume that the
+    source node is at index 0 of graph, and the sink node is at the last
+    index. I also assume that graph is a flow network in adjacency list
+    form.
+    """
+    bfs_tree = _bfs(graph, 0)
+    if bfs_tree[len(graph) - 1]:
+        n = len(graph) - 1
+        path = [] # [(u, v)], where u and v are vertices in the graph
+        while n != 0:
+            path.insert(0, (bfs_tree[n], n))
+            n = bfs_tree[n]
+        return path
+    return False
+
+
+def _bfs(graph, s):
+    """
+    Perform a BFS on graph starting at s, where graph is a graph in
+    adjacency list form, and s is a node in graph. I return the
+    predecessor table that the BFS generates.
+    """
+    # This is an adaptation of the BFS described in "Introduction to
+    # Algorithms", Cormen et al, 2nd ed., p. 532.
+    # WHITE vertices are those that we haven't seen or explored yet.
+    WHITE = 0
+    # GRAY vertices are those we have seen, but haven't explored yet
+    GRAY  = 1
+    # BLACK vertices are those we have seen and explored
+    BLACK = 2
+    color        = [WHITE for i in range(len(graph))]
+    predecessor  = [None for i in range(len(graph))]
+    distance     = [-1 for i in range(len(graph))]
+    queue = [s] # vertices that we haven't explored yet.
+    color[s] = GRAY
+    distance[s] = 0
+    while queue:
+        n = queue.pop(0)
+        for v in graph[n]:
+            if color[v] == WHITE:
+                color[v] = GRAY
+                distance[v] = distance[n] + 1
+                predecessor[v] = n
+                queue.append(v)
+        color[n] = BLACK
+    return predecessor
+
+
+def _residual_network(graph, f):
+    """
+    I return the residual network and residual capacity function of the
+    flow network represented by my graph and f arguments. graph is a
+    flow network in adjacency-list form, and f is a flow in graph.
+    """
+    new_graph = [[] for i in range(len(graph))]
+    cf = [[0 for s in range(len(graph))] for sh in range(len(graph))]
+    for i in range(len(graph)):
+        for v in graph[i]:
+            if f[i][v] == 1:
+                # We add an edge (v, i) with cf[v,i] = 1. This means
+                # that we can remove 1 unit of flow from the edge (i, v)
+                new_graph[v].append(i)
+                cf[v][i] = 1
+                cf[i][v] = -1
+            else:
+                # We add the edge (i, v), since we're not using it right
+                # now.
+                new_graph[i].append(v)
+                cf[i][v] = 1
+                cf[v][i] = -1
+    return (new_graph, cf)
+
+
 class HappinessUploadUtils(unittest.TestCase):
     """
-    test-cases for happiness_upload utility functions augmenting_path_for and
-    residual_network.
+    test-cases for happiness_upload utility functions, and for the
+    Edmonds-Karp helpers that BipartiteMatching is checked against.
     """
 
     def test_residual_0(self):
@@ -42,7 +122,7 @@ class HappinessUploadUtils(unittest.TestCase):
         )
         flow = [[0 for _ in graph] for _ in graph]
 
-        residual, capacity = happiness_upload.residual_network(graph, flow)
+        residual, capacity = _residual_network(graph, flow)
 
         # XXX no idea if these are right; hand-verify
         self.assertEqual(residual, [[1], [2], [3], []])
@@ -292,6 +372,193 @@ class PlacementTests(unittest.TestCase):
         assert happiness == min(len(peers), len(shares))
 
 
+def _flow_graph(servermap):
+    """
+    I build the flow network for servermap, a dict of peer -> set(share),
+    that Edmonds-Karp needs: a source, then the peers, then the shares, then
+    a sink.
+    """
+    peers = sorted(servermap)
+    shares = sorted(set(share for peer in peers for share in servermap[peer]))
+    peer_to_index, _ = happiness_upload._reindex(peers, 1)
+    share_to_index, _ = happiness_upload._reindex(shares, len(peers) + 1)
+    sink = len(peers) + len(shares) + 1
+    graph = [[peer_to_index[peer] for peer in peers]]
+    for peer in peers:
+        graph.append([share_to_index[share] for share in sorted(servermap[peer])])
+    for share in shares:
+        graph.append([sink])
+    graph.append([])
+    return graph
+
+
+def _edmonds_karp(graph):
+    """
+    I return the value of a maximum flow through the flow network graph,
+    found with Edmonds-Karp the way happiness used to be computed, so that
+    BipartiteMatching can be checked against it.
+    """
+    dim = len(graph)
+    flow = [[0 for v in range(dim)] for u in range(dim)]
+    residual_graph, _ = _residual_network(graph, flow)
+    path = _augmenting_path_for(residual_graph)
+    while path:
+        for (u, v) in path:
+            flow[u][v] += 1
+            flow[v][u] -= 1
+        residual_graph, _ = _residual_network(graph, flow)
+        path = _augmenting_path_for(residual_graph)
+    return sum(flow[0])
+
+
+servermaps = dictionaries(
+    keys=integers(min_value=0, max_value=15),
+    values=sets(integers(min_value=0, max_value=12), max_size=6),
+    max_size=12,
+)
+
+
+class BipartiteMatchingTests(unittest.TestCase):
+    """
+    Tests for allmydata.util.bipartite.BipartiteMatching.
+    """
+
+    def assertIsMatching(self, matching, servermap):
+        pairs = matching.get_matching()
+        self.assertEqual(len(matching), len(pairs))
+        self.assertEqual(len(set(pairs.values())), len(pairs))
+        for peer, share in pairs.items():
+            self.assertIn(share, servermap[peer])
+
+    def test_empty(self):
+        matching = BipartiteMatching({})
+        self.assertEqual(0, len(matching))
+        self.assertEqual({}, matching.get_matching())
+
+    def test_rematch(self):
+        # Matched in order, 'a' takes share 0 and 'b' takes share 1, which
+        # leaves 'c' with nothing until 'b' has to move over to share 2.
+        matching = BipartiteMatching(OrderedDict([
+            ("a", [0, 1]),
+            ("b", [1, 2]),
+            ("c", [0, 1]),
+        ]))
+        self.assertEqual(3, len(matching))
+        self.assertEqual({"a": 0, "b": 2, "c": 1}, matching.get_matching())
+
+    def test_remove_left(self):
+        matching = BipartiteMatching(OrderedDict([
+            ("a", [0]),
+            ("b", [0, 1]),
+            ("c", [1]),
+        ]))
+        self.assertEqual({"a": 0, "b": 1}, matching.get_matching())
+        # without 'b', 'c' can have share 1
+        matching.remove_left("b")
+        self.assertEqual({"a": 0, "c": 1}, matching.get_matching())
+        matching.remove_left("c")
+        self.assertEqual({"a": 0}, matching.get_matching())
+
+    def test_remove_edge(self):
+        matching = BipartiteMatching(OrderedDict([
+            ("a", [0, 1]),
+            ("b", [0]),
+        ]))
+        self.assertEqual({"a": 1, "b": 0}, matching.get_matching())
+        # 'b' loses share 0, and there is no one else to give it to
+        matching.remove_edge("b", 0)
+        self.assertEqual({"a": 1}, matching.get_matching())
+        # 'a' loses share 1, but can hold share 0 instead
+        matching.remove_edge("a", 1)
+        self.assertEqual({"a": 0}, matching.get_matching())
+
+    @settings(deadline=None)
+    @given(servermaps)
+    def test_same_size_as_edmonds_karp(self, servermap):
+        """
+        A maximum matching is as big as the maximum flow through the
+        equivalent flow network.
+        """
+        matching = BipartiteMatching(servermap)
+        self.assertIsMatching(matching, servermap)
+        self.assertEqual(_edmonds_karp(_flow_graph(servermap)), len(matching))
+
+    @settings(deadline=None)
+    @given(servermaps, lists(integers(min_value=0), max_size=8))
+    def test_remove_left_stays_maximum(self, servermap, picks):
+        """
+        After each peer is removed, the matching is as big as the maximum
+        flow through the flow network without that peer.
+        """
+        matching = BipartiteMatching(servermap)
+        for pick in picks:
+            if not servermap:
+                break
+            peer = sorted(servermap)[pick % len(servermap)]
+            del servermap[peer]
+            matching.remove_left(peer)
+            self.assertIsMatching(matching, servermap)
+            self.assertEqual(_edmonds_karp(_flow_graph(servermap)), len(matching))
+
+    @settings(deadline=None)
+    @given(servermaps, lists(integers(min_value=0), max_size=8))
+    def test_remove_edge_stays_maximum(self, servermap, picks):
+        """
+        After each edge is removed, the matching is as big as the maximum
+        flow through the flow network without that edge.
+        """
+        servermap = dict((peer, set(shares)) for (peer, shares) in servermap.items())
+        matching = BipartiteMatching(servermap)
+        for pick in picks:
+            edges = sorted((peer, share) for peer in servermap
+                           for share in servermap[peer])
+            if not edges:
+                break
+            peer, share = edges[pick % len(edges)]
+            servermap[peer].remove(share)
+            matching.remove_edge(peer, share)
+            self.assertIsMatching(matching, servermap)
+            self.assertEqual(_edmonds_karp(_flow_graph(servermap)), len(matching))
+
+    @settings(deadline=None)
+    @given(servermaps)
+    def test_servers_of_happiness(self, servermap):
+        """
+        servers_of_happiness() agrees with Edmonds-Karp, as it did when it
+        used it.
+        """
+        sharemap = {}
+        for peer, shares in servermap.items():
+            for share in shares:
+                sharemap.setdefault(share, set()).add(peer)
+        self.assertEqual(
+            _edmonds_karp(_flow_graph(shares_by_server(sharemap))),
+            servers_of_happiness(sharemap),
+        )
+
+    @settings(deadline=None)
+    @given(servermaps)
+    def test_compute_maximum_graph(self, servermap):
+        """
+        _compute_maximum_graph() matches as many shares as Edmonds-Karp
+        finds flow through the same network, and only along its edges.
+        """
+        peers = sorted(servermap)
+        shares = sorted(set(share for peer in peers for share in servermap[peer]))
+        share_to_index, _ = happiness_upload._reindex(shares, len(peers) + 1)
+        shareIndices = [share_to_index[s] for s in shares]
+        for graph in [happiness_upload._servermap_flow_graph(peers, shares, servermap),
+                      happiness_upload._flow_network(list(range(1, len(peers) + 1)),
+                                                     shareIndices)]:
+            max_graph = happiness_upload._compute_maximum_graph(graph, shareIndices)
+            matched = dict((share, peer) for (share, peer) in max_graph.items()
+                           if peer is not None)
+            self.assertEqual(len(set(matched.values())), len(matched))
+            for share, peer in matched.items():
+                self.assertIn(share, graph[peer])
+            self.assertEqual(_edmonds_karp(graph) if graph else 0, len(matched))
+
+
 class FakeServerTracker(object):
     def __init__(self, serverid, buckets):
         self._serverid = serverid
@@ -14,7 +14,7 @@ if PY2:
 
 import gc
 
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.trial import unittest
 from twisted.python import log
 from twisted.python.failure import Failure
@@ -196,3 +196,54 @@ class Pipeline(unittest.TestCase):
 
         del d1,d2,d3,d4
         gc.collect()  # for PyPy
+
+
+class AdaptivePipeline(unittest.TestCase):
+    def pause(self, *args, **kwargs):
+        d = defer.Deferred()
+        self.calls.append(d)
+        return d
+
+    def test_window(self):
+        """The capacity follows the rate operations complete at times the
+        shortest round trip, within its bounds."""
+        self.calls = []
+        clock = task.Clock()
+        p = pipeline.AdaptivePipeline(100, 150, clock=clock)
+        finished = []
+        d = p.add(100, self.pause)
+        d.addCallbacks(finished.append, log.err)
+        self.failUnlessEqual(finished, [])
+
+        # 100 bytes taking two seconds makes a rate of 50 bytes per second,
+        # and a window of 200 bytes, which is more than we allow
+        clock.advance(2)
+        self.calls[0].callback(None)
+        self.failUnlessEqual(finished, [None])
+        self.failUnlessEqual(p.min_rtt, 2)
+        self.failUnlessEqual(p.rate, 50)
+        self.failUnlessEqual(p.capacity, 150)
+
+        # a quick round trip shrinks the window, but not below its minimum
+        p.add(10, self.pause)
+        clock.advance(0.25)
+        self.calls[1].callback(None)
+        self.failUnlessEqual(p.min_rtt, 0.25)
+        self.failUnlessEqual(p.capacity, 100)
+
+    def test_grows(self):
+        """A pipeline whose operations are slow to complete but complete in
+        quick succession lets more data into flight."""
+        self.calls = []
+        clock = task.Clock()
+        p = pipeline.AdaptivePipeline(100, 1000, clock=clock)
+        for i in range(4):
+            p.add(25, self.pause)
+        clock.advance(1)
+        for i in range(4):
+            self.calls[i].callback(None)
+            clock.advance(0.1)
+        # the first completion gives 25 bytes per second, the later ones
+        # 250, and the round trip is a second
+        self.failUnlessEqual(p.min_rtt, 1)
+        self.failUnless(p.capacity > 100, p.capacity)
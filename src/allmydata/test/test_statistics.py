@@ -156,3 +156,70 @@ class Statistics(unittest.TestCase):
         f = statistics.pr_backup_file_loss
         plist = [.5] * 10
         self.failUnlessEqual(f(plist, .5, 3), .02734375)
+
+
+class Histogram(unittest.TestCase):
+    def assertNear(self, actual, expected):
+        # percentiles are reported to within 1/SUB_BUCKETS
+        self.assertTrue(abs(actual - expected) <= expected / 32.0 + 1e-9,
+                        (actual, expected))
+
+    def test_empty(self):
+        h = statistics.Histogram()
+        self.assertEqual(h.count, 0)
+        self.assertEqual(h.get_mean(), None)
+        self.assertEqual(h.get_percentile(0.5), None)
+        self.assertEqual(h.summarize()["99_9_percentile"], None)
+
+    def test_percentiles(self):
+        h = statistics.Histogram()
+        for i in range(10000):
+            h.record(i / 1000.0)
+        self.assertEqual(h.count, 10000)
+        self.assertEqual(h.zeros, 1)
+        self.assertAlmostEqual(h.get_mean(), 4.9995)
+        self.assertEqual(h.min, 0)
+        self.assertEqual(h.max, 9.999)
+        for fraction in (0.01, 0.1, 0.5, 0.9, 0.99, 0.999):
+            self.assertNear(h.get_percentile(fraction), fraction * 10)
+        self.assertEqual(h.get_percentile(0), 0)
+        self.assertEqual(h.get_percentile(1.0), 9.999)
+
+    def test_single_value(self):
+        h = statistics.Histogram()
+        h.record(0.25)
+        # limited to the values actually seen
+        self.assertEqual(h.get_percentile(0.5), 0.25)
+        self.assertEqual(h.get_mean(), 0.25)
+
+    def test_merge(self):
+        a = statistics.Histogram()
+        b = statistics.Histogram()
+        both = statistics.Histogram()
+        for i in range(1, 1000):
+            (a if i % 3 else b).record(i)
+            both.record(i)
+        before = b.snapshot()
+        a.merge(b)
+        self.assertEqual(a.count, both.count)
+        self.assertEqual(a.total, both.total)
+        self.assertEqual((a.min, a.max), (both.min, both.max))
+        self.assertEqual(a.summarize(), both.summarize())
+        self.assertEqual(b.summarize(), before.summarize())
+
+    def test_stats_round_trip(self):
+        h = statistics.Histogram()
+        for value in (0, 0.001, 0.002, 0.5, 3, 700):
+            h.record(value)
+        stats = h.to_stats("x.latencies")
+        for key in stats:
+            self.assertTrue(key.startswith("x.latencies."), key)
+        stats["other.count"] = 17
+        h2 = statistics.Histogram.from_stats(stats, "x.latencies")
+        self.assertEqual(h2.count, 6)
+        self.assertEqual(h2.zeros, 1)
+        self.assertEqual(h2.summarize(), h.summarize())
+        empty = statistics.Histogram.from_stats(
+            statistics.Histogram().to_stats("y"), "y")
+        self.assertEqual(empty.count, 0)
+        self.assertEqual(empty.get_percentile(0.5), None)
@@ -1,7 +1,7 @@
 
 from twisted.trial import unittest
 from twisted.application import service
-from allmydata.stats import CPUUsageMonitor
+from allmydata.stats import CPUUsageMonitor, StatsProvider, merge_histograms
 from allmydata.util import pollmixin
 import allmydata.test.common_util as testutil
 
@@ -37,3 +37,36 @@ class CPUUsage(unittest.TestCase, pollmixin.PollMixin, testutil.StallMixin):
         d.addCallback(_check)
         return d
 
+
+
+class Histograms(unittest.TestCase):
+    def test_provider(self):
+        sp = StatsProvider(None, None)
+        sp.record("downloader.latencies.read", 1.5)
+        sp.get_histogram("downloader.latencies.read").record(2.5)
+        stats = sp.get_stats()
+        self.failUnlessEqual(stats["histograms"]["downloader.latencies.read.count"], 2)
+        self.failUnlessEqual(stats["histograms"]["downloader.latencies.read.sum"], 4.0)
+        remote = sp.remote_get_stats()
+        self.failUnlessIn(b"histograms", remote)
+        self.failUnlessIn(b"downloader.latencies.read.max",
+                          remote[b"histograms"])
+
+    def test_merge(self):
+        one = StatsProvider(None, None)
+        two = StatsProvider(None, None)
+        for i in range(100):
+            one.record("a", i)
+            two.record("a", 100 + i)
+        two.record("b", 1)
+        merged = merge_histograms([one.remote_get_stats(),
+                                   two.get_stats()])
+        self.failUnlessEqual(sorted(merged.keys()), ["a", "b"])
+        self.failUnlessEqual(merged["a"].count, 200)
+        self.failUnlessEqual(merged["a"].min, 0)
+        self.failUnlessEqual(merged["a"].max, 199)
+        self.failUnless(abs(merged["a"].get_percentile(0.5) - 100) < 4)
+        self.failUnlessEqual(merged["b"].count, 1)
+        # a node which predates histograms
+        self.failUnlessEqual(merge_histograms([{"counters": {}, "stats": {}}]),
+                             {})
@@ -8,7 +8,7 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
-from future.utils import native_str, PY2, bytes_to_native_str
+from future.utils import native_str, PY2, bytes_to_native_str, bchr
 if PY2:
     from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
 
@@ -20,21 +20,34 @@ import stat
 import struct
 import shutil
 import gc
+import threading
 
 from twisted.trial import unittest
 
-from twisted.internet import defer
+from twisted.internet import defer, task
 
 import itertools
-from allmydata import interfaces
-from allmydata.util import fileutil, hashutil, base32
+from allmydata import interfaces, uri
+from allmydata.hashtree import HashTree
+from allmydata.util import fileutil, hashutil, base32, pollmixin
+from allmydata.util.statistics import Histogram
 from allmydata.storage.server import StorageServer
 from allmydata.storage.shares import get_share_file
 from allmydata.storage.mutable import MutableShareFile
 from allmydata.storage.immutable import BucketWriter, BucketReader, ShareFile
-from allmydata.storage.common import DataTooLargeError, storage_index_to_dir, \
-     UnknownMutableContainerVersionError, UnknownImmutableContainerVersionError, \
-     si_b2a, si_a2b
+from allmydata.storage.fdcache import FileDescriptorCache
+from allmydata.storage.mmapcache import MappedFileCache
+from allmydata.storage.diskio import DiskIOPool
+from allmydata.storage.scheduler import RequestScheduler, ServerBusyError
+from allmydata.storage.leasedb import renew_secret_hash
+from allmydata.storage.corruption import CorruptionRegistry
+from allmydata.storage.sharecounter import ShareCounter
+from allmydata.storage.packed import PackedShareStore, RECORD_HEADER, \
+     RECORD_HEADER_SIZE, RECORD_MAGIC, KIND_SHARE
+from allmydata.storage import expirer
+from allmydata.storage.common import DataTooLargeError, \
+     storage_index_to_dir, UnknownMutableContainerVersionError, \
+     UnknownImmutableContainerVersionError, si_b2a, si_a2b
 from allmydata.storage.lease import LeaseInfo
 from allmydata.immutable.layout import WriteBucketProxy, WriteBucketProxy_v2, \
      ReadBucketProxy
@@ -95,6 +108,8 @@ class FakeStatsProvider(object):
         pass
     def register_producer(self, producer):
         pass
+    def get_histogram(self, name):
+        return Histogram()
 
 class Bucket(unittest.TestCase):
     def make_workdir(self, name):
@@ -145,6 +160,71 @@ class Bucket(unittest.TestCase):
         self.failUnlessEqual(br.remote_read(25, 25), b"b"*25)
         self.failUnlessEqual(br.remote_read(50, 7), b"c"*7)
 
+    def test_coalesced_writes(self):
+        incoming, final = self.make_workdir("test_coalesced_writes")
+        self.patch(BucketWriter, "WRITE_BUFFER_SIZE", 50)
+        opened = []
+        original_open = ShareFile._open
+        def _open(sharefile, mode):
+            opened.append(mode)
+            return original_open(sharefile, mode)
+        self.patch(ShareFile, "_open", _open)
+        written = []
+        original_write = ShareFile.write_share_data
+        def write_share_data(sharefile, offset, data):
+            written.append((offset, len(data)))
+            return original_write(sharefile, offset, data)
+        self.patch(ShareFile, "write_share_data", write_share_data)
+        bw = BucketWriter(self, incoming, final, 200, self.make_lease(),
+                          FakeCanary())
+        del opened[:]
+        bw.remote_write(0, b"a"*20)
+        bw.remote_write(20, b"b"*20)
+        self.failUnlessEqual(written, [])
+        bw.remote_write(40, b"c"*20) # fills the buffer
+        bw.remote_write(100, b"d"*10)
+        bw.remote_write(120, b"e"*60) # not adjacent, and too big to buffer
+        bw.remote_write(180, b"f"*10)
+        bw.remote_close()
+        self.failUnlessEqual(written, [(0, 60), (100, 10), (120, 60),
+                                       (180, 10)])
+        # the share stays open from creation to close
+        self.failUnlessEqual(opened, [])
+
+        br = BucketReader(self, bw.finalhome)
+        self.failUnlessEqual(br.remote_read(0, 60),
+                             b"a"*20 + b"b"*20 + b"c"*20)
+        self.failUnlessEqual(br.remote_read(100, 90),
+                             b"d"*10 + b"\x00"*10 + b"e"*60 + b"f"*10)
+
+    def test_write_too_large(self):
+        incoming, final = self.make_workdir("test_write_too_large")
+        bw = BucketWriter(self, incoming, final, 20, self.make_lease(),
+                          FakeCanary())
+        bw.remote_write(0, b"a"*10)
+        # refused at once, even though nothing is written to disk yet
+        self.failUnlessRaises(DataTooLargeError,
+                              bw.remote_write, 10, b"b"*11)
+        bw.remote_abort()
+        self.failIf(os.path.exists(incoming))
+
+    def test_readv(self):
+        incoming, final = self.make_workdir("test_readv")
+        bw = BucketWriter(self, incoming, final, 200, self.make_lease(),
+                          FakeCanary())
+        bw.remote_write(0, b"a"*25)
+        bw.remote_write(25, b"b"*25)
+        bw.remote_write(50, b"c"*7)
+        bw.remote_close()
+
+        br = BucketReader(self, bw.finalhome)
+        self.failUnlessEqual(br.remote_readv([(50, 7), (0, 25), (20, 10)]),
+                             [b"c"*7, b"a"*25, b"a"*5 + b"b"*5])
+        # reads past the end of the share data are truncated, just like read()
+        self.failUnlessEqual(br.remote_readv([(195, 10), (200, 10)]),
+                             [b"\x00"*5, b""])
+        self.failUnlessEqual(br.remote_readv([]), [])
+
     def test_read_past_end_of_share_data(self):
         # test vector for immutable files (hard-coded contents of an immutable share
         # file):
@@ -219,7 +299,7 @@ class RemoteBucket(object):
         return defer.maybeDeferred(_call)
 
 
-class BucketProxy(unittest.TestCase):
+class BucketProxy(unittest.TestCase, ShouldFailMixin):
     def make_bucket(self, name, size):
         basedir = os.path.join("storage", "BucketProxy", name)
         incoming = os.path.join(basedir, "tmp", "bucket")
@@ -326,6 +406,23 @@ class BucketProxy(unittest.TestCase):
             d1.addCallback(lambda res:
                            self.failUnlessEqual(res, uri_extension))
 
+            # the server hashes the same blocks that were written
+            root = HashTree([hashutil.block_hash(b"a"*25),
+                             hashutil.block_hash(b"b"*25),
+                             hashutil.block_hash(b"c"*25),
+                             hashutil.block_hash(b"d"*20)])[0]
+            d1.addCallback(lambda res: rb.callRemote("hash_blocks", 25, 95))
+            d1.addCallback(lambda res:
+                           self.failUnlessEqual(res, (root, share_hashes)))
+            # but refuses to hash more than the share holds, or more
+            # blocks than its block hash tree has room for
+            for (block_size, share_size) in [(25, 96), (1, 95), (23, 95)]:
+                d1.addCallback(lambda res, args=(block_size, share_size):
+                               self.shouldFail(ValueError, "hash_blocks%r"
+                                               % (args,), "cannot hash",
+                                               rb.callRemote, "hash_blocks",
+                                               *args))
+
             return d1
 
         d.addCallback(_start_reading)
@@ -340,7 +437,7 @@ class BucketProxy(unittest.TestCase):
         return self._do_test_readwrite("test_readwrite_v2",
                                        0x44, WriteBucketProxy_v2, ReadBucketProxy)
 
-class Server(unittest.TestCase):
+class Server(unittest.TestCase, pollmixin.PollMixin):
 
     def setUp(self):
         self.sparent = LoggingServiceParent()
@@ -369,6 +466,18 @@ class Server(unittest.TestCase):
         sv1 = ver[b'http://allmydata.org/tahoe/protocols/storage/v1']
         self.failUnless(sv1.get(b'prevents-read-past-end-of-share-data'), sv1)
 
+    def test_declares_immutable_readv(self):
+        ss = self.create("test_declares_immutable_readv")
+        ver = ss.remote_get_version()
+        sv1 = ver[b'http://allmydata.org/tahoe/protocols/storage/v1']
+        self.failUnless(sv1.get(b'supports-immutable-readv'), sv1)
+
+    def test_declares_bulk_add_lease(self):
+        ss = self.create("test_declares_bulk_add_lease")
+        ver = ss.remote_get_version()
+        sv1 = ver[b'http://allmydata.org/tahoe/protocols/storage/v1']
+        self.failUnless(sv1.get(b'supports-bulk-add-lease'), sv1)
+
     def test_declares_maximum_share_sizes(self):
         ss = self.create("test_declares_maximum_share_sizes")
         ver = ss.remote_get_version()
@@ -455,6 +564,28 @@ class Server(unittest.TestCase):
         self.failIf(os.path.exists(incoming_prefix_dir), incoming_prefix_dir)
         self.failUnless(os.path.exists(incoming_dir), incoming_dir)
 
+    @defer.inlineCallbacks
+    def test_incomplete_shares_removed_after_start(self):
+        """Shares left in ``incoming`` by an earlier run are moved aside when
+        the server is created, and removed once it has started."""
+        ss = self.create("test_incomplete_shares_removed_after_start")
+        already, writers = self.allocate(ss, b"vid", [0], 10)
+        writers[0].remote_write(0, b"%10d" % 0)
+        incoming_share = writers[0].incominghome
+        self.failUnless(os.path.exists(incoming_share))
+        yield ss.disownServiceParent()
+
+        workdir = self.workdir("test_incomplete_shares_removed_after_start")
+        ss2 = StorageServer(workdir, b"\x00" * 20)
+        discarddir = os.path.join(workdir, "incoming-discarded")
+        self.failIf(os.path.exists(incoming_share))
+        self.failUnlessEqual(os.listdir(ss2.incomingdir), [])
+        self.failUnless(os.path.exists(discarddir))
+        self.failUnlessIn("clean-incoming", ss2.startup_timings)
+
+        ss2.setServiceParent(self.sparent)
+        yield self.poll(lambda: not os.path.exists(discarddir))
+
     def test_abort(self):
         # remote_abort, when called on a writer, should make sure that
         # the allocated size of the bucket is not counted by the storage
@@ -626,6 +757,65 @@ class Server(unittest.TestCase):
         ss.disownServiceParent()
         del ss
 
+    def test_available_space_cached(self):
+        calls = []
+        used = [0]
+        def call_get_disk_stats(whichdir, reserved_space=0):
+            calls.append(whichdir)
+            return {
+              'total': 20000,
+              'used': 5000 + used[0],
+              'free_for_root': 15000 - used[0],
+              'free_for_nonroot': 15000 - used[0],
+              'avail': max(15000 - used[0] - reserved_space, 0),
+            }
+        self.patch(fileutil, 'get_disk_stats', call_get_disk_stats)
+
+        ss = self.create("test_available_space_cached", reserved_space=10000)
+        del calls[:]
+        canary = FakeCanary(True)
+        # a burst of uploads asks the filesystem once, and the space
+        # promised to them is kept as a running total
+        writers = []
+        for i in range(20):
+            already, w = self.allocate(ss, b"si%d" % i, [0], 100, canary)
+            writers.extend(w.values())
+        self.failUnlessEqual(len(calls), 1)
+        self.failUnlessEqual(len(writers), 20)
+        self.failUnlessEqual(ss.allocated_size(), 2000)
+        # 5000 - 2000 leaves room for 3000 more
+        already, w = self.allocate(ss, b"big", [0, 1, 2, 3], 1000, canary)
+        self.failUnlessEqual(len(w), 3)
+        self.failUnlessEqual(ss.allocated_size(), 5000)
+
+        # aborting gives the space back, closing turns it into the space
+        # taken by the finished share
+        for bw in w.values():
+            bw.remote_abort()
+        bw = writers.pop(0)
+        bw.remote_write(0, b"a" * 100)
+        bw.remote_close()
+        self.failUnlessEqual(ss.allocated_size(), 1900)
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.space.available"],
+                             5000 - 100 - 12 - 72)
+        self.failUnlessEqual(stats["storage_server.space.disk_stats_calls"], 1)
+        self.failUnlessEqual(stats["storage_server.space.cache_hits"], 20)
+
+        # writers dropped without being closed give their space back too
+        del bw, w
+        del writers[:]
+        gc.collect()
+        self.failUnlessEqual(ss.allocated_size(), 0)
+
+        # once the remembered answer is too old, the filesystem is asked
+        # again
+        used[0] = 4000
+        ss._space.invalidate()
+        already, w = self.allocate(ss, b"big2", [0, 1], 1000, canary)
+        self.failUnlessEqual(len(w), 1)
+        self.failUnlessEqual(ss._space.disk_stats_calls, 2)
+
     def test_seek(self):
         basedir = self.workdir("test_seek_behavior")
         fileutil.make_dirs(basedir)
@@ -646,6 +836,55 @@ class Server(unittest.TestCase):
         self.failUnlessEqual(f2.read(5), b"start")
 
 
+    def test_add_leases(self):
+        ss = self.create("test_add_leases")
+        canary = FakeCanary()
+        for si, sharenums in [(b"si0", [0, 1, 2]), (b"si1", [3])]:
+            already, writers = self.allocate(ss, si, sharenums, 100, canary)
+            for wb in writers.values():
+                wb.remote_close()
+
+        secrets = [(hashutil.tagged_hash(b"blah", b"%d" % next(self._lease_secret)),
+                    hashutil.tagged_hash(b"blah", b"%d" % next(self._lease_secret)))
+                   for i in range(3)]
+        # one result per item, in the caller's order: the number of shares
+        # that got the lease, zero for a storage index we don't hold
+        results = ss.remote_add_leases([(b"si1",) + secrets[0],
+                                        (b"si9",) + secrets[1],
+                                        (b"si0",) + secrets[2]])
+        self.failUnlessEqual(results, [1, 0, 3])
+        self.failUnlessEqual(len(list(ss.get_leases(b"si0"))), 2)
+        self.failUnlessEqual(len(list(ss.get_leases(b"si1"))), 2)
+        self.failUnlessIn(secrets[0][0],
+                          [l.renew_secret for l in ss.get_leases(b"si1")])
+        self.failUnlessIn(secrets[2][0],
+                          [l.renew_secret for l in ss.get_leases(b"si0")])
+
+        # adding the same leases again renews them instead
+        results = ss.remote_add_leases([(b"si0",) + secrets[2]])
+        self.failUnlessEqual(results, [3])
+        self.failUnlessEqual(len(list(ss.get_leases(b"si0"))), 2)
+        self.failUnlessEqual(ss.remote_add_leases([]), [])
+
+    def test_get_share_numbers(self):
+        ss = self.create("test_get_share_numbers")
+        v1 = ss.remote_get_version()[b"http://allmydata.org/tahoe/protocols/storage/v1"]
+        self.failUnless(v1[b"supports-bulk-share-query"])
+        canary = FakeCanary()
+        for si, sharenums in [(b"si0", [0, 1, 2]), (b"si1", [3])]:
+            already, writers = self.allocate(ss, si, sharenums, 100, canary)
+            for wb in writers.values():
+                wb.remote_close()
+        # shares still being uploaded are not counted, as by get_buckets()
+        already, writers = self.allocate(ss, b"si2", [4], 100, canary)
+
+        results = ss.remote_get_share_numbers([b"si1", b"si9", b"si0", b"si2"])
+        self.failUnlessEqual(results, [{3}, set(), {0, 1, 2}, set()])
+        self.failUnlessEqual(
+            results, [set(ss.remote_get_buckets(si))
+                      for si in [b"si1", b"si9", b"si0", b"si2"]])
+        self.failUnlessEqual(ss.remote_get_share_numbers([]), [])
+
     def test_leases(self):
         ss = self.create("test_leases")
         canary = FakeCanary()
@@ -746,6 +985,14 @@ class Server(unittest.TestCase):
         ss = StorageServer(workdir, b"\x00" * 20, readonly_storage=True)
         self.assertFalse(ss.have_shares())
 
+    def test_have_shares_after_write(self):
+        """Once a share has been stored the StorageServer has shares."""
+        ss = self.create("test_have_shares_after_write")
+        already, writers = self.allocate(ss, b"vid", [0], 10)
+        writers[0].remote_write(0, b"%10d" % 0)
+        writers[0].remote_close()
+        self.failUnless(ss.have_shares())
+
     def test_readonly(self):
         workdir = self.workdir("test_readonly")
         ss = StorageServer(workdir, b"\x00" * 20, readonly_storage=True)
@@ -992,6 +1239,85 @@ class MutableServer(unittest.TestCase):
         read_answer = read(b"si1", [0], [(0,10)])
         self.failUnlessEqual(read_answer, {})
 
+    def test_writev_opens_share_once(self):
+        """
+        A test-and-write request opens each existing share once to check its
+        magic and once more for everything else it does, however many test,
+        read and write vectors and leases it involves.
+        """
+        ss = self.create("test_writev_opens_share_once")
+        self.allocate(ss, b"si1", b"we1", next(self._lease_secret),
+                      set([0,1]), 100)
+        secrets = ( self.write_enabler(b"we1"),
+                    self.renew_secret(b"we1"),
+                    self.cancel_secret(b"we1") )
+        opened = []
+        original_open = MutableShareFile._open
+        def _open(share, mode):
+            opened.append(share.home)
+            return original_open(share, mode)
+        self.patch(MutableShareFile, "_open", _open)
+
+        data = b"".join([ (b"%d" % i) * 10 for i in range(10) ])
+        answer = ss.remote_slot_testv_and_readv_and_writev(
+            b"si1", secrets,
+            {0: ([(0, 1, b"eq", b"")], [(0, data), (100, data)], None),
+             1: ([], [(0, data)], None)},
+            [(0, 10), (10, 10)])
+        self.failUnlessEqual(answer, (True, {0: [b"", b""], 1: [b"", b""]}))
+        self.failUnlessEqual(len(opened), 4)
+        self.failUnlessEqual(len(set(opened)), 2)
+
+        # the shares were closed again, with the data and leases in place
+        self.failUnlessEqual(ss.remote_slot_readv(b"si1", [0], [(100, 10)]),
+                             {0: [data[:10]]})
+        bucketdir = os.path.join(ss.sharedir, storage_index_to_dir(b"si1"))
+        s0 = MutableShareFile(os.path.join(bucketdir, "0"))
+        self.failUnlessEqual(len(list(s0.get_leases())), 2)
+
+    def test_appends_grow_container(self):
+        """
+        A share written by a series of appends has its container enlarged
+        ahead of the data, so its extra leases are not moved for each one.
+        """
+        ss = self.create("test_appends_grow_container")
+        self.allocate(ss, b"si1", b"we1", next(self._lease_secret),
+                      set([0]), 100)
+        secrets = ( self.write_enabler(b"we1"),
+                    self.renew_secret(b"we1"),
+                    self.cancel_secret(b"we1") )
+        moves = []
+        original_change = MutableShareFile._change_container_size
+        def _change_container_size(share, f, new_container_size):
+            moves.append(new_container_size)
+            return original_change(share, f, new_container_size)
+        self.patch(MutableShareFile, "_change_container_size",
+                   _change_container_size)
+
+        # enough leases that some are extra leases, after the data
+        for i in range(6):
+            tag = b"extra%d" % (i,)
+            ss.remote_add_lease(b"si1", self.renew_secret(tag),
+                                self.cancel_secret(tag))
+        chunk = b"a" * 1000
+        for i in range(50):
+            answer = ss.remote_slot_testv_and_readv_and_writev(
+                b"si1", secrets,
+                {0: ([], [(i * len(chunk), chunk)], None)},
+                [])
+            self.failUnlessEqual(answer, (True, {0: []}))
+        self.failUnless(len(moves) < 15, moves)
+        self.failUnlessEqual(moves, sorted(moves))
+
+        read = ss.remote_slot_readv
+        self.failUnlessEqual(read(b"si1", [0], [(0, 50000)]),
+                             {0: [chunk * 50]})
+        self.failUnlessEqual(read(b"si1", [0], [(50000, 10)]), {0: [b""]})
+        bucketdir = os.path.join(ss.sharedir, storage_index_to_dir(b"si1"))
+        s0 = MutableShareFile(os.path.join(bucketdir, "0"))
+        self.failUnlessEqual(s0.get_data_length(), 50000)
+        self.failUnlessEqual(len(list(s0.get_leases())), 8)
+
     def test_allocate(self):
         ss = self.create("test_allocate")
         self.allocate(ss, b"si1", b"we1", next(self._lease_secret),
@@ -2929,6 +3255,1744 @@ class MDMFProxies(unittest.TestCase, ShouldFailMixin):
         return d
 
 
+class ShareIndex(unittest.TestCase, pollmixin.PollMixin):
+    """Tests for the optional in-memory share index."""
+
+    def setUp(self):
+        self.sparent = LoggingServiceParent()
+        self.sparent.startService()
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def workdir(self, name):
+        basedir = os.path.join("storage", "ShareIndex", name)
+        return basedir
+
+    def create(self, name, share_index_enabled=True):
+        workdir = self.workdir(name)
+        ss = StorageServer(workdir, b"\x00" * 20,
+                           share_index_enabled=share_index_enabled)
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def write_immutable(self, ss, storage_index, sharenums):
+        already, writers = ss.remote_allocate_buckets(
+            storage_index, b"r" * 32, b"c" * 32, sharenums, 10, FakeCanary())
+        for wb in writers.values():
+            wb.remote_write(0, b"0123456789")
+            wb.remote_close()
+
+    def write_mutable(self, ss, storage_index, sharenums, new_length=None):
+        secrets = (b"w" * 32, b"r" * 32, b"c" * 32)
+        tw_vectors = dict((shnum, ([], [(0, b"data")], new_length))
+                          for shnum in sharenums)
+        return ss.remote_slot_testv_and_readv_and_writev(
+            storage_index, secrets, tw_vectors, [])
+
+    def wait_for_scan(self, ss):
+        return self.poll(ss._share_index.is_complete)
+
+    def test_disabled(self):
+        ss = self.create("test_disabled", share_index_enabled=False)
+        self.write_immutable(ss, b"si1", [0])
+        self.failUnlessEqual(set(ss.remote_get_buckets(b"si1")), set([0]))
+        self.failIfIn("storage_server.share_index.hits", ss.get_stats())
+
+    def test_startup_scan(self):
+        # shares written before the server starts are found by the scan
+        writer = StorageServer(self.workdir("test_startup_scan"),
+                               b"\x00" * 20)
+        self.write_immutable(writer, b"si1", [0, 1])
+        self.write_mutable(writer, b"si2", [3])
+
+        ss = self.create("test_startup_scan")
+        # until the scan has reached them, lookups fall back to the disk
+        self.failUnlessEqual(set(ss.remote_get_buckets(b"si1")), set([0, 1]))
+        self.failUnlessEqual(ss.get_stats()["storage_server.share_index.misses"], 1)
+
+        d = self.wait_for_scan(ss)
+        def _scanned(ignored):
+            self.failUnlessEqual(ss._share_index.get_shares(b"si1"),
+                                 {0: ("immutable", 0x0c + 10 + 72),
+                                  1: ("immutable", 0x0c + 10 + 72)})
+            self.failUnlessEqual(list(ss._share_index.get_shares(b"si2")),
+                                 [3])
+            self.failUnlessEqual(ss._share_index.get_shares(b"si2")[3][0],
+                                 "mutable")
+            self.failUnlessEqual(set(ss.remote_get_buckets(b"si1")),
+                                 set([0, 1]))
+            self.failUnlessEqual(ss.remote_slot_readv(b"si2", [], [(0, 4)]),
+                                 {3: [b"data"]})
+            self.failUnlessEqual(ss.remote_get_buckets(b"si3"), {})
+            stats = ss.get_stats()
+            self.failUnlessEqual(stats["storage_server.share_index.buckets"], 2)
+            self.failUnlessEqual(stats["storage_server.share_index.complete"], 1)
+            self.failUnlessEqual(stats["storage_server.share_index.misses"], 1)
+            self.failUnless(stats["storage_server.share_index.hits"] >= 3,
+                            stats)
+            # the one-shot crawler removes itself once it is done
+            self.failIf(ss.share_index_crawler.running)
+        d.addCallback(_scanned)
+        return d
+
+    def test_updates(self):
+        ss = self.create("test_updates")
+        d = self.wait_for_scan(ss)
+        def _scanned(ignored):
+            # closing an immutable bucket adds it; aborting one does not
+            already, writers = ss.remote_allocate_buckets(
+                b"si1", b"r" * 32, b"c" * 32, [0, 1], 10, FakeCanary())
+            writers[0].remote_write(0, b"0123456789")
+            writers[0].remote_close()
+            writers[1].remote_abort()
+            self.failUnlessEqual(set(ss._share_index.get_shares(b"si1")),
+                                 set([0]))
+            self.failUnlessEqual(set(ss.remote_get_buckets(b"si1")), set([0]))
+
+            # creating mutable shares adds them, and truncating them to zero
+            # length removes them
+            self.write_mutable(ss, b"si2", [0, 1])
+            self.failUnlessEqual(set(ss._share_index.get_shares(b"si2")),
+                                 set([0, 1]))
+            self.write_mutable(ss, b"si2", [0], new_length=0)
+            self.failUnlessEqual(set(ss._share_index.get_shares(b"si2")),
+                                 set([1]))
+            self.failUnlessEqual(ss.remote_slot_readv(b"si2", [], [(0, 4)]),
+                                 {1: [b"data"]})
+
+            # lease expiration reports deleted shares too
+            ss.share_removed(b"si1", 0)
+            self.failUnlessEqual(ss._share_index.get_shares(b"si1"), {})
+            self.failUnlessEqual(ss.get_stats()["storage_server.share_index.misses"], 0)
+        d.addCallback(_scanned)
+        return d
+
+
+class ShareCounts(unittest.TestCase, pollmixin.PollMixin):
+    """Tests for the storage server's running share counts."""
+
+    def setUp(self):
+        self.sparent = LoggingServiceParent()
+        self.sparent.startService()
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def workdir(self, name):
+        return os.path.join("storage", "ShareCounts", name)
+
+    def create(self, name, **kwargs):
+        ss = StorageServer(self.workdir(name), b"\x00" * 20, **kwargs)
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def write_immutable(self, ss, storage_index, sharenums):
+        already, writers = ss.remote_allocate_buckets(
+            storage_index, b"r" * 32, b"c" * 32, sharenums, 10, FakeCanary())
+        for wb in writers.values():
+            wb.remote_write(0, b"0123456789")
+            wb.remote_close()
+
+    def write_mutable(self, ss, storage_index, datav, new_length=None,
+                      renew_leases=True):
+        secrets = (b"w" * 32, b"r" * 32, b"c" * 32)
+        tw_vectors = dict((shnum, ([], [(offset, data)], new_length))
+                          for (shnum, offset, data) in datav)
+        return ss.slot_testv_and_readv_and_writev(
+            storage_index, secrets, tw_vectors, [], renew_leases)
+
+    def counts(self, immutable, mutable):
+        return {"immutable": dict(zip(["buckets", "shares", "bytes"],
+                                      immutable)),
+                "mutable": dict(zip(["buckets", "shares", "bytes"], mutable))}
+
+    def wait_for_count(self, ss):
+        return self.poll(ss.share_counter.is_complete)
+
+    def test_updates(self):
+        ss = self.create("test_updates")
+        d = self.wait_for_count(ss)
+        def _counted(ignored):
+            self.failUnlessEqual(ss.share_counter.get_counts(),
+                                 self.counts((0, 0, 0), (0, 0, 0)))
+            # closing immutable buckets counts them, aborting one does not
+            self.write_immutable(ss, b"si1", [0, 1])
+            already, writers = ss.remote_allocate_buckets(
+                b"si1", b"r" * 32, b"c" * 32, [2], 10, FakeCanary())
+            writers[2].remote_abort()
+            self.write_immutable(ss, b"si3", [0])
+            self.failUnlessEqual(ss.share_counter.get_counts(),
+                                 self.counts((2, 3, 30), (0, 0, 0)))
+            # adding leases does not change the amount of share data
+            ss.remote_add_lease(b"si1", b"R" * 32, b"C" * 32)
+
+            # mutable shares are counted as they are created, resized, and
+            # truncated to nothing
+            self.write_mutable(ss, b"si2", [(0, 0, b"data"), (1, 0, b"data")])
+            self.write_mutable(ss, b"si2", [(0, 4, b"more")])
+            self.failUnlessEqual(ss.share_counter.get_counts(),
+                                 self.counts((2, 3, 30), (1, 2, 12)))
+            self.write_mutable(ss, b"si2", [(1, 0, b"")], new_length=0)
+            self.failUnlessEqual(ss.share_counter.get_counts(),
+                                 self.counts((2, 3, 30), (1, 1, 8)))
+            self.write_mutable(ss, b"si2", [(0, 0, b"")], new_length=0)
+            self.failUnlessEqual(ss.share_counter.get_counts(),
+                                 self.counts((2, 3, 30), (0, 0, 0)))
+
+            stats = ss.get_stats()
+            self.failUnlessEqual(stats["storage_server.total_bucket_count"], 2)
+            self.failUnlessEqual(
+                stats["storage_server.share_counts.immutable.bytes"], 30)
+        d.addCallback(_counted)
+        return d
+
+    def test_expiration(self):
+        now = time.time()
+        ss = StorageServer(self.workdir("test_expiration"), b"\x00" * 20,
+                           lease_db_enabled=True, expiration_enabled=True,
+                           expiration_mode="cutoff-date",
+                           expiration_cutoff_date=int(now - 10*24*60*60))
+        self.addCleanup(ss.lease_db.close)
+        # the share directory is empty, so there is nothing to count
+        ss.share_counter.count_finished()
+        self.write_mutable(ss, b"si1", [(0, 0, b"data")], renew_leases=False)
+        old_lease = LeaseInfo(1, b"r" * 32, b"c" * 32,
+                              now - 40*24*60*60, ss.my_nodeid)
+        [sf] = ss._iter_share_files(b"si1")
+        sf.add_or_renew_lease(old_lease)
+        ss.share_leases_changed(b"si1", 0, sf)
+        self.failUnlessEqual(ss.share_counter.get_counts(),
+                             self.counts((0, 0, 0), (1, 1, 4)))
+        ss.lease_checker.expire_leases_from_db()
+        self.failUnlessEqual(ss.share_counter.get_counts(),
+                             self.counts((0, 0, 0), (0, 0, 0)))
+
+    def test_saved_at_shutdown(self):
+        ss = self.create("test_saved_at_shutdown")
+        countsfile = os.path.join(ss.storedir, "share_counts.json")
+        d = self.wait_for_count(ss)
+        def _counted(ignored):
+            self.write_immutable(ss, b"si1", [0, 1])
+            self.write_mutable(ss, b"si2", [(0, 0, b"data")])
+            return ss.disownServiceParent()
+        d.addCallback(_counted)
+        def _stopped(ignored):
+            self.failUnless(os.path.exists(countsfile))
+            ss2 = self.create("test_saved_at_shutdown")
+            # the saved counts are used instead of counting again, and the
+            # file is removed in case we crash before saving them again
+            self.failUnlessIdentical(ss2.share_counter_crawler, None)
+            self.failIf(os.path.exists(countsfile))
+            self.failUnlessEqual(ss2.share_counter.get_counts(),
+                                 self.counts((1, 2, 20), (1, 1, 4)))
+        d.addCallback(_stopped)
+        return d
+
+    def test_recount(self):
+        # a server which never shut down cleanly leaves no saved counts
+        writer = StorageServer(self.workdir("test_recount"), b"\x00" * 20)
+        self.write_immutable(writer, b"si1", [0, 1])
+        self.write_mutable(writer, b"si2", [(0, 0, b"data")])
+
+        ss = self.create("test_recount")
+        self.failIf(ss.share_counter.is_complete())
+        self.failUnlessIdentical(ss.share_counter.get_counts(), None)
+        self.failIfIn("storage_server.total_bucket_count", ss.get_stats())
+        d = self.wait_for_count(ss)
+        def _counted(ignored):
+            self.failUnlessEqual(ss.share_counter.get_counts(),
+                                 self.counts((1, 2, 20), (1, 1, 4)))
+            self.failIf(ss.share_counter_crawler.running)
+        d.addCallback(_counted)
+        return d
+
+    def test_suspect_counts_not_saved(self):
+        ss = self.create("test_suspect_counts_not_saved")
+        countsfile = os.path.join(ss.storedir, "share_counts.json")
+        d = self.wait_for_count(ss)
+        def _counted(ignored):
+            self.write_immutable(ss, b"si1", [0])
+            # a share disappeared without our knowing what it held
+            ss.share_removed(b"si1", 0)
+            return ss.disownServiceParent()
+        d.addCallback(_counted)
+        d.addCallback(lambda ign:
+                      self.failIf(os.path.exists(countsfile)))
+        return d
+
+    def test_changes_during_count(self):
+        c = ShareCounter()
+        si_a = b"\x00" * 16 # prefix "aa"
+        si_b = b"\xff" * 16 # prefix "77"
+        c.prefix_listed("aa", [base32.b2a(si_a).decode("ascii")])
+        c.bucket_counted(base32.b2a(si_a).decode("ascii"),
+                         self.counts((1, 1, 10), (0, 0, 0)))
+        c.prefix_counted("aa")
+        # changes in prefixes not yet counted are left for the crawler
+        c.add_share(si_a, "immutable", 10, False)
+        c.add_share(si_b, "mutable", 5, True)
+        c.remove_share(si_b, "mutable", 5, True)
+        self.failUnlessIdentical(c.get_counts(), None)
+        c.prefix_listed("77", [base32.b2a(si_b).decode("ascii")])
+        c.bucket_counted(base32.b2a(si_b).decode("ascii"),
+                         self.counts((0, 0, 0), (1, 1, 7)))
+        c.prefix_counted("77")
+        c.count_finished()
+        c.add_share(si_b, "mutable", 3, False)
+        self.failUnlessEqual(c.get_counts(),
+                             self.counts((1, 2, 20), (1, 2, 10)))
+        self.failUnlessEqual(c.get_total_bucket_count(), 2)
+
+    def test_changes_during_prefix(self):
+        c = ShareCounter()
+        si_1 = b"\x00" * 15 + b"\x01"
+        si_2 = b"\x00" * 15 + b"\x02"
+        si_3 = b"\x00" * 15 + b"\x03"
+        b32 = lambda si: base32.b2a(si).decode("ascii")
+        c.prefix_listed("aa", [b32(si_1), b32(si_2)])
+        c.bucket_counted(b32(si_1), self.counts((1, 1, 10), (0, 0, 0)))
+        # partway through the prefix: a change to a counted bucket is
+        # counted, one to a listed bucket which is still to come is left
+        # for the crawler, and one to a bucket which appeared after the
+        # listing, and which the crawler will not visit, is counted
+        c.add_share(si_1, "immutable", 10, False)
+        c.add_share(si_2, "immutable", 10, True)
+        c.add_share(si_3, "mutable", 4, True)
+        c.bucket_counted(b32(si_2), self.counts((1, 2, 20), (0, 0, 0)))
+        c.prefix_counted("aa")
+        c.count_finished()
+        self.failUnlessEqual(c.get_counts(),
+                             self.counts((2, 4, 40), (1, 1, 4)))
+
+    def test_recount_yields_per_bucket(self):
+        writer = StorageServer(self.workdir("test_recount_yields_per_bucket"),
+                               b"\x00" * 20)
+        for i in range(3):
+            self.write_immutable(writer, b"\x00" * 15 + bchr(i), [0])
+        ss = StorageServer(self.workdir("test_recount_yields_per_bucket"),
+                           b"\x00" * 20)
+        crawler = ss.share_counter_crawler
+        slices = []
+        def _yielding(sleep_time):
+            slices.append(crawler.state["last-complete-bucket"])
+        crawler.yielding = _yielding
+        # yield after every bucket
+        crawler.cpu_slice = -1
+        ss.setServiceParent(self.sparent)
+        d = self.wait_for_count(ss)
+        def _counted(ignored):
+            self.failUnlessEqual(ss.share_counter.get_counts(),
+                                 self.counts((3, 3, 30), (0, 0, 0)))
+            # the three buckets all share the first prefix, and were
+            # counted in separate slices
+            self.failUnlessEqual(
+                len(set(b for b in slices if b is not None)), 3, slices)
+        d.addCallback(_counted)
+        return d
+
+    def test_recount_skips_shares_being_written(self):
+        writer = StorageServer(self.workdir("test_recount_skips"),
+                               b"\x00" * 20)
+        self.write_immutable(writer, b"si1", [0])
+        ss = StorageServer(self.workdir("test_recount_skips"), b"\x00" * 20)
+        # a share which is on disk, but whose writer has not been closed
+        # yet, is left for bucket_writer_closed() to count
+        already, writers = ss.remote_allocate_buckets(
+            b"si1", b"r" * 32, b"c" * 32, [1], 10, FakeCanary())
+        writers[1].remote_write(0, b"0123456789")
+        filelen = writers[1]._close_share()
+        ss.setServiceParent(self.sparent)
+        d = self.wait_for_count(ss)
+        def _counted(ignored):
+            self.failUnlessEqual(ss.share_counter.get_counts(),
+                                 self.counts((1, 1, 10), (0, 0, 0)))
+            writers[1]._closed(filelen, time.time())
+            self.failUnlessEqual(ss.share_counter.get_counts(),
+                                 self.counts((1, 2, 20), (0, 0, 0)))
+        d.addCallback(_counted)
+        return d
+
+
+class DiskIOTests(unittest.TestCase, pollmixin.PollMixin):
+    """Tests for doing the storage server's disk I/O in a thread pool."""
+
+    def setUp(self):
+        self.sparent = LoggingServiceParent()
+        self.sparent.startService()
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def create(self, name):
+        ss = StorageServer(os.path.join("storage", "DiskIO", name),
+                           b"\x00" * 20, disk_io_threads=2)
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def test_ordering(self):
+        pool = DiskIOPool(4)
+        pool.setServiceParent(self.sparent)
+        release = threading.Event()
+        events = []
+        def slow():
+            events.append("slow-start")
+            release.wait(10)
+            events.append("slow-end")
+        d1 = pool.run(b"k", slow)
+        d2 = pool.run(b"k", events.append, "same-key")
+        d3 = pool.run(b"other", events.append, "other-key")
+        def _other_done(ignored):
+            # an operation on another key does not wait for the slow one,
+            # but one on the same key does
+            self.failIfIn("same-key", events)
+            release.set()
+            return defer.gatherResults([d1, d2])
+        d3.addCallback(_other_done)
+        def _check(ignored):
+            self.failUnless(events.index("slow-end") <
+                            events.index("same-key"), events)
+            stats = pool.get_stats()
+            self.failUnlessEqual(stats["completed"], 3)
+            self.failUnlessEqual(stats["queue_depth"], 0)
+            self.failUnless(stats["max_queue_depth"] >= 2, stats)
+            self.failUnlessIn("wait_time.mean", stats)
+            self.failUnlessIn("wait_time.99_0_percentile", stats)
+            self.failUnlessEqual(pool.wait_times.count, 3)
+            self.failUnlessEqual(stats["wait_time.max"], pool.wait_times.max)
+        d3.addCallback(_check)
+        return d3
+
+    def test_immutable(self):
+        ss = self.create("test_immutable")
+        d = ss.remote_allocate_buckets(b"si1", b"r" * 32, b"c" * 32, [0, 1],
+                                       20, FakeCanary())
+        def _allocated(res):
+            (already, writers) = res
+            self.failUnlessEqual(set(writers), set([0, 1]))
+            # the client need not wait for one write before sending the
+            # next: they are carried out in order
+            ds = [writers[0].remote_write(0, b"a" * 10),
+                  writers[0].remote_write(10, b"b" * 10),
+                  writers[0].remote_close(),
+                  writers[1].remote_write(0, b"x" * 10)]
+            writers[1].remote_abort()
+            return defer.gatherResults(ds)
+        d.addCallback(_allocated)
+        d.addCallback(lambda ign: self.poll(
+            lambda: ss._disk_io.get_stats()["queue_depth"] == 0))
+        def _written(ignored):
+            self.failIf(os.path.exists(os.path.join(
+                ss.incomingdir, storage_index_to_dir(b"si1"))))
+            readers = ss.remote_get_buckets(b"si1")
+            self.failUnlessEqual(set(readers), set([0]))
+            return defer.gatherResults([
+                readers[0].remote_read(0, 20),
+                readers[0].remote_readv([(0, 1), (15, 5)])])
+        d.addCallback(_written)
+        def _read(res):
+            self.failUnlessEqual(res, [b"a" * 10 + b"b" * 10,
+                                       [b"a", b"bbbbb"]])
+            stats = ss.get_stats()
+            self.failUnlessEqual(stats["storage_server.disk_io.queue_depth"],
+                                 0)
+            self.failUnless(stats["storage_server.disk_io.completed"] >= 8,
+                            stats)
+            self.failUnlessEqual(ss.allocated_size(), 0)
+            return ss.remote_get_version()
+        d.addCallback(_read)
+        def _version(version):
+            v1 = version[b"http://allmydata.org/tahoe/protocols/storage/v1"]
+            self.failUnless(v1[b"available-space"] > 0)
+        d.addCallback(_version)
+        return d
+
+    def test_mutable(self):
+        ss = self.create("test_mutable")
+        secrets = (b"w" * 32, b"r" * 32, b"c" * 32)
+        writev = ss.remote_slot_testv_and_readv_and_writev
+        # each of these waits for the ones before it
+        ds = [writev(b"si1", secrets, {0: ([], [(0, b"data")], None)}, []),
+              ss.remote_slot_readv(b"si1", [], [(0, 4)]),
+              writev(b"si1", secrets,
+                     {0: ([(0, 4, b"eq", b"data")], [(0, b"DATA")], None)},
+                     [(0, 4)]),
+              ss.remote_add_lease(b"si1", b"R" * 32, b"C" * 32),
+              ss.remote_slot_readv(b"si1", [], [(0, 4)]),
+              writev(b"si1", secrets, {0: ([], [], 0)}, []),
+              ss.remote_slot_readv(b"si1", [], [(0, 4)]),
+              ]
+        d = defer.gatherResults(ds)
+        def _check(res):
+            self.failUnlessEqual(res, [(True, {}),
+                                       {0: [b"data"]},
+                                       (True, {0: [b"data"]}),
+                                       None,
+                                       {0: [b"DATA"]},
+                                       (True, {0: []}),
+                                       {},
+                                       ])
+        d.addCallback(_check)
+        return d
+
+
+class Corruption(unittest.TestCase):
+    """Tests for the registry of shares reported as corrupt, and for
+    quarantining them."""
+
+    def setUp(self):
+        self.sparent = LoggingServiceParent()
+        self.sparent.startService()
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def create(self, name, **kwargs):
+        ss = StorageServer(os.path.join("storage", "Corruption", name),
+                           b"\x00" * 20, **kwargs)
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def upload(self, ss, storage_index, shnum, blocks):
+        """Upload a share, with a valid layout and hashes, of a file
+        encoded 2-of-4 in segments of 50 bytes."""
+        block_hashes = list(HashTree([hashutil.block_hash(block)
+                                      for block in blocks]))
+        leaves = [hashutil.tagged_hash(b"share", b"%d" % i)
+                  for i in range(4)]
+        leaves[shnum] = block_hashes[0]
+        share_tree = HashTree(leaves)
+        share_hashes = [(i, share_tree[i]) for i in
+                        sorted(share_tree.needed_hashes(shnum,
+                                                        include_leaf=True))]
+        uri_extension = uri.pack_extension({"segment_size": 50,
+                                            "needed_shares": 2,
+                                            "total_shares": 4,
+                                            "size": 50 * len(blocks),
+                                            })
+        wbp = WriteBucketProxy(None, None,
+                               data_size=sum(len(b) for b in blocks),
+                               block_size=25, num_segments=len(blocks),
+                               num_share_hashes=len(share_hashes),
+                               uri_extension_size_max=len(uri_extension))
+        d = defer.maybeDeferred(ss.remote_allocate_buckets, storage_index,
+                                b"r" * 32, b"c" * 32, [shnum],
+                                wbp.get_allocated_size(), FakeCanary())
+        def _allocated(res):
+            (already, writers) = res
+            wbp._rref = RemoteBucket(writers[shnum])
+            return wbp.put_header()
+        d.addCallback(_allocated)
+        for (i, block) in enumerate(blocks):
+            d.addCallback(lambda ign, i=i, block=block: wbp.put_block(i, block))
+        d.addCallback(lambda ign: wbp.put_crypttext_hashes(block_hashes))
+        d.addCallback(lambda ign: wbp.put_block_hashes(block_hashes))
+        d.addCallback(lambda ign: wbp.put_share_hashes(share_hashes))
+        d.addCallback(lambda ign: wbp.put_uri_extension(uri_extension))
+        d.addCallback(lambda ign: wbp.close())
+        return d
+
+    def corrupt(self, ss, storage_index, shnum, offset):
+        # flip a bit of the share data
+        fn = os.path.join(ss.sharedir, storage_index_to_dir(storage_index),
+                          "%d" % shnum)
+        with open(fn, "rb+") as f:
+            f.seek(0x0c + offset)
+            b = f.read(1)
+            f.seek(0x0c + offset)
+            f.write(bchr(ord(b) ^ 1))
+
+    def test_registry(self):
+        basedir = os.path.join("storage", "Corruption", "test_registry")
+        fileutil.make_dirs(basedir)
+        dbfile = os.path.join(basedir, "corruption.sqlite")
+        registry = CorruptionRegistry(dbfile)
+        self.failUnlessEqual(registry.add_report(b"si1", 0, "mutable",
+                                                 "client", "bad", 10), 1)
+        self.failUnlessEqual(registry.add_report(b"si1", 0, "mutable",
+                                                 "client", "worse", 20), 2)
+        registry.add_report(b"si2", 1, "immutable", "server", "bad hash", 30)
+        registry.quarantine(b"si2", 1, "immutable", "bad hash", 30)
+        registry.close()
+
+        # everything is remembered
+        registry = CorruptionRegistry(dbfile)
+        self.failUnless(registry.is_registered(b"si1", 0))
+        self.failIf(registry.is_registered(b"si1", 1))
+        self.failUnlessEqual(registry.get_quarantined(b"si1"), frozenset())
+        self.failUnlessEqual(registry.get_quarantined(b"si2"), frozenset([1]))
+        shares = registry.get_shares()
+        self.failUnlessEqual([(share["shnum"], share["quarantined"])
+                              for share in shares], [(1, 30), (0, None)])
+        self.failUnlessEqual(shares[1]["reports"],
+                             {"client": {"count": 2, "reason": "worse",
+                                         "last_reported": 20}})
+        self.failUnlessEqual(registry.get_stats(),
+                             {"reported": 2, "quarantined": 1})
+
+        registry.release(b"si2", 1)
+        self.failUnlessEqual(registry.get_quarantined(b"si2"), frozenset())
+        self.failUnlessEqual(len(registry.get_shares()), 1)
+        registry.close()
+
+    def test_registry_created_lazily(self):
+        basedir = os.path.join("storage", "Corruption",
+                               "test_registry_created_lazily")
+        fileutil.make_dirs(basedir)
+        dbfile = os.path.join(basedir, "corruption.sqlite")
+        registry = CorruptionRegistry(dbfile)
+        self.failIf(registry.is_registered(b"si1", 0))
+        self.failUnlessEqual(registry.get_shares(), [])
+        self.failUnlessEqual(registry.get_stats(),
+                             {"reported": 0, "quarantined": 0})
+        registry.release(b"si1", 0)
+        registry.close()
+        self.failIf(os.path.exists(dbfile))
+
+        registry = CorruptionRegistry(dbfile)
+        registry.add_report(b"si1", 0, "mutable", "client", "bad", 10)
+        registry.close()
+        self.failUnless(os.path.exists(dbfile))
+
+    def test_intact_share(self):
+        ss = self.create("test_intact_share")
+        d = self.upload(ss, b"si1", 1, [b"a" * 25, b"b" * 25, b"c" * 10])
+        d.addCallback(lambda ign: ss.remote_advise_corrupt_share(
+            b"immutable", b"si1", 1, b"looks odd\n"))
+        def _check(ign):
+            # the report is recorded, but the server found nothing wrong
+            self.failUnlessEqual(set(ss.remote_get_buckets(b"si1")), set([1]))
+            [share] = ss.corruption_registry.get_shares()
+            self.failUnlessEqual(share["storage_index"],
+                                 si_b2a(b"si1").decode("ascii"))
+            self.failUnlessEqual(share["reports"]["client"]["reason"],
+                                 "looks odd\n")
+            self.failIfIn("server", share["reports"])
+            self.failUnlessEqual(share["quarantined"], None)
+        d.addCallback(_check)
+        return d
+
+    def test_corrupt_share(self):
+        ss = self.create("test_corrupt_share", disk_io_threads=1)
+        d = self.upload(ss, b"si1", 1, [b"a" * 25, b"b" * 25, b"c" * 10])
+        d.addCallback(lambda ign: self.upload(ss, b"si1", 2,
+                                              [b"a" * 25, b"b" * 25]))
+        def _corrupt(ign):
+            # the second block of share 1
+            self.corrupt(ss, b"si1", 1, 0x24 + 30)
+            readers = ss.remote_get_buckets(b"si1")
+            return readers[1].remote_advise_corrupt_share(b"bad block\n")
+        d.addCallback(_corrupt)
+        def _check(ign):
+            # the server confirmed it, and stopped serving the share
+            self.failUnlessEqual(set(ss.remote_get_buckets(b"si1")), set([2]))
+            [share] = ss.corruption_registry.get_shares()
+            self.failUnlessIn("block hash tree",
+                              share["reports"]["server"]["reason"])
+            self.failIfEqual(share["quarantined"], None)
+            self.failUnlessEqual(
+                ss.get_stats()["storage_server.corruption.quarantined"], 1)
+            # nor does it claim to have the share when asked to store it
+            return ss.remote_allocate_buckets(b"si1", b"R" * 32, b"C" * 32,
+                                              [1], 100, FakeCanary())
+        d.addCallback(_check)
+        def _allocated(res):
+            self.failUnlessEqual(res, (set([2]), {}))
+            # but it renews the quarantined share's leases all the same
+            fn = os.path.join(ss.sharedir, storage_index_to_dir(b"si1"), "1")
+            sf = ss._open_share(b"si1", 1, fn, "immutable")
+            self.failUnlessIn(b"R" * 32, [lease.renew_secret
+                                          for lease in sf.get_leases()])
+        d.addCallback(_allocated)
+        return d
+
+    def test_checks_limited(self):
+        ss = self.create("test_checks_limited")
+        d = defer.succeed(None)
+        for si in [b"si1", b"si2", b"si3"]:
+            for shnum in [1, 2]:
+                d.addCallback(lambda ign, si=si, shnum=shnum:
+                              self.upload(ss, si, shnum,
+                                          [b"a" * 25, b"b" * 25]))
+                d.addCallback(lambda ign, si=si, shnum=shnum:
+                              self.corrupt(ss, si, shnum, 0x24 + 30))
+        def _report(ign, si, shnum):
+            return ss.remote_advise_corrupt_share(b"immutable", si, shnum,
+                                                  b"bad block\n")
+        d.addCallback(_report, b"si1", 1)
+        # a second share in the same bucket is not checked
+        d.addCallback(_report, b"si1", 2)
+        # nor is a share reported too soon after the last check
+        d.addCallback(_report, b"si2", 1)
+        def _check(ign):
+            self.failUnlessEqual(set(ss.remote_get_buckets(b"si1")), set([2]))
+            self.failUnlessEqual(set(ss.remote_get_buckets(b"si2")),
+                                 set([1, 2]))
+            ss.REPORTED_SHARE_CHECK_INTERVAL = 0
+        d.addCallback(_check)
+        d.addCallback(_report, b"si3", 1)
+        d.addCallback(lambda ign: self.failUnlessEqual(
+            set(ss.remote_get_buckets(b"si3")), set([2])))
+        return d
+
+    def test_quarantine_threshold(self):
+        ss = self.create("test_quarantine_threshold",
+                         corruption_quarantine_threshold=2)
+        secrets = (b"w" * 32, b"r" * 32, b"c" * 32)
+        writev = ss.remote_slot_testv_and_readv_and_writev
+        writev(b"si1", secrets, {0: ([], [(0, b"data")], None),
+                                 1: ([], [(0, b"data")], None)}, [])
+        ss.remote_advise_corrupt_share(b"mutable", b"si1", 0, b"bad\n")
+        self.failUnlessEqual(ss.remote_slot_readv(b"si1", [], [(0, 4)]),
+                             {0: [b"data"], 1: [b"data"]})
+        ss.remote_advise_corrupt_share(b"mutable", b"si1", 0, b"bad\n")
+        self.failUnlessEqual(ss.remote_slot_readv(b"si1", [], [(0, 4)]),
+                             {1: [b"data"]})
+        self.failUnlessEqual(ss.remote_slot_readv(b"si1", [0], [(0, 4)]), {})
+
+        # rewriting the share replaces the corrupt contents
+        writev(b"si1", secrets, {0: ([], [(0, b"DATA")], None)}, [])
+        self.failUnlessEqual(ss.remote_slot_readv(b"si1", [], [(0, 4)]),
+                             {0: [b"DATA"], 1: [b"data"]})
+        self.failUnlessEqual(ss.corruption_registry.get_shares(), [])
+
+
+class DurabilityTests(unittest.TestCase):
+    """Tests for syncing finished immutable shares to disk."""
+
+    def setUp(self):
+        self.sparent = LoggingServiceParent()
+        self.sparent.startService()
+        self.synced = []
+        original_fsync = os.fsync
+        def fsync(fd):
+            self.synced.append(fd)
+            return original_fsync(fd)
+        self.patch(os, "fsync", fsync)
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def create(self, name, **kwargs):
+        ss = StorageServer(os.path.join("storage", "Durability", name),
+                           b"\x00" * 20, **kwargs)
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def upload(self, ss, storage_index, sharenums):
+        d = defer.maybeDeferred(ss.remote_allocate_buckets, storage_index,
+                                b"r" * 32, b"c" * 32, sharenums, 20,
+                                FakeCanary())
+        def _allocated(res):
+            (already, writers) = res
+            ds = []
+            for shnum in sorted(writers):
+                ds.append(defer.maybeDeferred(writers[shnum].remote_write,
+                                              0, b"a" * 20))
+                ds.append(defer.maybeDeferred(writers[shnum].remote_close))
+            return defer.gatherResults(ds)
+        d.addCallback(_allocated)
+        return d
+
+    def test_none(self):
+        ss = self.create("test_none")
+        d = self.upload(ss, b"si1", [0, 1])
+        d.addCallback(lambda ign: self.failUnlessEqual(self.synced, []))
+        return d
+
+    def test_fsync(self):
+        ss = self.create("test_fsync", durability="fsync")
+        d = self.upload(ss, b"si1", [0, 1])
+        def _check(ign):
+            # each share, and its directory each time
+            self.failUnlessEqual(len(self.synced), 4)
+            self.failUnlessEqual(set(ss.remote_get_buckets(b"si1")),
+                                 set([0, 1]))
+        d.addCallback(_check)
+        return d
+
+    def test_group(self):
+        ss = self.create("test_group", durability="group")
+        clock = task.Clock()
+        ss._group_committer._reactor = clock
+        closed = []
+        d = defer.gatherResults([self.upload(ss, b"si1", [0, 1]),
+                                 self.upload(ss, b"si2", [0])])
+        d.addCallback(closed.append)
+        # nothing is stored until the group is synced
+        self.failUnlessEqual(closed, [])
+        self.failUnlessEqual(ss.remote_get_buckets(b"si1"), {})
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.group_commit.pending"], 3)
+        clock.advance(ss._group_committer.interval)
+        self.failUnlessEqual(len(closed), 1)
+        # three shares, and the two directories they are in
+        self.failUnlessEqual(len(self.synced), 5)
+        self.failUnlessEqual(set(ss.remote_get_buckets(b"si1")), set([0, 1]))
+        self.failUnlessEqual(set(ss.remote_get_buckets(b"si2")), set([0]))
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.group_commit.batches"], 1)
+        self.failUnlessEqual(stats["storage_server.group_commit.committed"],
+                             3)
+        self.failUnlessEqual(ss.allocated_size(), 0)
+
+    def test_group_with_disk_io(self):
+        ss = self.create("test_group_with_disk_io", durability="group",
+                         durability_group_interval=0, disk_io_threads=2)
+        d = self.upload(ss, b"si1", [0, 1, 2])
+        def _check(ign):
+            self.failUnlessEqual(set(ss.remote_get_buckets(b"si1")),
+                                 set([0, 1, 2]))
+            self.failUnlessEqual(ss.allocated_size(), 0)
+        d.addCallback(_check)
+        return d
+
+    def test_group_failure(self):
+        ss = self.create("test_group_failure", durability="group")
+        clock = task.Clock()
+        ss._group_committer._reactor = clock
+        d = self.upload(ss, b"si1", [0])
+        (already, writers) = ss.remote_allocate_buckets(
+            b"si2", b"r" * 32, b"c" * 32, [0], 20, FakeCanary())
+        writers[0].remote_write(0, b"a" * 20)
+        d2 = writers[0].remote_close()
+        # the second share cannot be moved into place
+        fileutil.make_dirs(os.path.join(ss.sharedir,
+                                        storage_index_to_dir(b"si2"), "0"))
+        clock.advance(ss._group_committer.interval)
+        # but the first is stored regardless
+        self.failUnlessEqual(set(ss.remote_get_buckets(b"si1")), set([0]))
+        d2 = self.assertFailure(d2, EnvironmentError)
+        return defer.gatherResults([d, d2])
+
+
+class RemoteCanary(FakeCanary):
+    """A FakeCanary which, like a RemoteReference, knows its Tub."""
+    def __init__(self, tubid):
+        FakeCanary.__init__(self)
+        self.tubid = tubid
+    def getRemoteTubID(self):
+        return self.tubid
+
+
+class RequestSchedulerTests(unittest.TestCase):
+    """Tests for scheduling the storage server's requests by priority."""
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.sparent = LoggingServiceParent()
+        self.sparent.startService()
+        self.events = []
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def make_scheduler(self, max_active=1, **kwargs):
+        scheduler = RequestScheduler(max_active, reactor=self.clock, **kwargs)
+        scheduler.setServiceParent(self.sparent)
+        return scheduler
+
+    def block(self, scheduler, request_class="lease"):
+        """Occupy a request slot until the returned Deferred is fired."""
+        blocker = defer.Deferred()
+        scheduler.submit(request_class, "blocker", 0, lambda: blocker)
+        return blocker
+
+    def submit(self, scheduler, request_class, client, name, cost=0):
+        return scheduler.submit(request_class, client, cost,
+                                self.events.append, name)
+
+    def test_priority(self):
+        scheduler = self.make_scheduler()
+        blocker = self.block(scheduler)
+        self.submit(scheduler, "lease", "a", "lease")
+        self.submit(scheduler, "verify", "a", "verify")
+        self.submit(scheduler, "write", "a", "write")
+        self.submit(scheduler, "read", "a", "read")
+        self.failUnlessEqual(self.events, [])
+        stats = scheduler.get_stats()
+        self.failUnlessEqual(stats["active"], 1)
+        self.failUnlessEqual(stats["lease.queued"], 1)
+        blocker.callback(None)
+        self.failUnlessEqual(self.events, ["read", "write", "verify", "lease"])
+        stats = scheduler.get_stats()
+        self.failUnlessEqual(stats["active"], 0)
+        self.failUnlessEqual(stats["lease.queued"], 0)
+        self.failUnlessEqual(stats["lease.started"], 2)
+        self.failUnlessEqual(stats["read.started"], 1)
+        self.failUnlessIn("read.wait_time.mean", stats)
+
+    def test_clients_take_turns(self):
+        scheduler = self.make_scheduler()
+        blocker = self.block(scheduler)
+        for name in ["a1", "a2", "a3"]:
+            self.submit(scheduler, "read", "a", name)
+        self.submit(scheduler, "read", "b", "b1")
+        self.failUnlessEqual(scheduler.get_stats()["read.clients"], 2)
+        blocker.callback(None)
+        self.failUnlessEqual(self.events, ["a1", "b1", "a2", "a3"])
+
+    def test_no_starvation(self):
+        scheduler = self.make_scheduler()
+        blocker = self.block(scheduler, "read")
+        self.submit(scheduler, "lease", "a", "lease")
+        self.clock.advance(scheduler.MAX_WAIT + 1)
+        self.submit(scheduler, "read", "a", "read")
+        blocker.callback(None)
+        self.failUnlessEqual(self.events, ["lease", "read"])
+
+    def test_concurrency(self):
+        scheduler = self.make_scheduler(max_active=2)
+        blockers = [self.block(scheduler), self.block(scheduler)]
+        self.submit(scheduler, "read", "a", "read")
+        self.failUnlessEqual(self.events, [])
+        blockers[0].callback(None)
+        self.failUnlessEqual(self.events, ["read"])
+        self.failUnlessEqual(scheduler.get_stats()["active"], 1)
+
+    def test_bandwidth(self):
+        scheduler = self.make_scheduler(max_active=10,
+                                        bandwidth={"verify": 100})
+        self.submit(scheduler, "verify", "a", "v1", cost=150)
+        self.submit(scheduler, "verify", "a", "v2", cost=10)
+        # other classes are not held up
+        self.submit(scheduler, "lease", "a", "lease", cost=1000)
+        self.failUnlessEqual(self.events, ["v1", "lease"])
+        self.clock.advance(0.4)
+        self.failUnlessEqual(self.events, ["v1", "lease"])
+        self.clock.advance(0.2)
+        self.failUnlessEqual(self.events, ["v1", "lease", "v2"])
+
+    def test_too_many_queued(self):
+        scheduler = self.make_scheduler(max_queued_per_client=2)
+        blocker = self.block(scheduler)
+        self.submit(scheduler, "read", "a", "a1")
+        self.submit(scheduler, "read", "a", "a2")
+        d = self.submit(scheduler, "read", "a", "a3")
+        self.failureResultOf(d, ServerBusyError)
+        # other clients, and other classes, still have room
+        self.submit(scheduler, "read", "b", "b1")
+        self.submit(scheduler, "write", "a", "w1")
+        self.failUnlessEqual(scheduler.get_stats()["read.rejected"], 1)
+        blocker.callback(None)
+        self.failUnlessEqual(self.events, ["a1", "b1", "a2", "w1"])
+
+    def test_unidentified_clients_limited(self):
+        # requests from clients which did not identify themselves all share
+        # one queue, which has a limit of its own
+        scheduler = self.make_scheduler(max_queued_per_client=2,
+                                        max_queued_unidentified=4)
+        blocker = self.block(scheduler)
+        for i in range(4):
+            self.submit(scheduler, "read", None, "n%d" % i)
+        d = self.submit(scheduler, "read", None, "n4")
+        self.failureResultOf(d, ServerBusyError)
+        self.failUnlessEqual(scheduler.get_stats()["read.rejected"], 1)
+        blocker.callback(None)
+        self.failUnlessEqual(self.events, ["n%d" % i for i in range(4)])
+
+    def test_failures(self):
+        scheduler = self.make_scheduler()
+        def fail():
+            raise ValueError("oops")
+        d = scheduler.submit("read", "a", 0, fail)
+        self.failureResultOf(d, ValueError)
+        self.submit(scheduler, "read", "a", "read")
+        self.failUnlessEqual(self.events, ["read"])
+
+    def create(self, name, **kwargs):
+        ss = StorageServer(os.path.join("storage", "RequestScheduler", name),
+                           b"\x00" * 20, max_active_requests=1, **kwargs)
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def test_server(self):
+        ss = self.create("test_server")
+        self.failUnless(ss.remote_get_version()[
+            b"http://allmydata.org/tahoe/protocols/storage/v1"][
+                b"supports-priority-hints"])
+        d = ss.doRemoteCall("allocate_buckets",
+                            (b"si1", b"r" * 32, b"c" * 32, [0], 10,
+                             FakeCanary()), {})
+        (already, writers) = self.successResultOf(d)
+        self.successResultOf(writers[0].doRemoteCall("write",
+                                                      (0, b"a" * 10), {}))
+        self.successResultOf(writers[0].doRemoteCall("close", (), {}))
+
+        verifier = ss.remote_with_priority(b"verify", FakeCanary())
+        readers = self.successResultOf(
+            verifier.doRemoteCall("get_buckets", (b"si1",), {}))
+        data = self.successResultOf(readers[0].doRemoteCall("read", (0, 10),
+                                                            {}))
+        self.failUnlessEqual(data, b"a" * 10)
+        readers = self.successResultOf(
+            ss.doRemoteCall("get_buckets", (b"si1",), {}))
+        self.successResultOf(readers[0].doRemoteCall("readv", ([(0, 5)],),
+                                                     {}))
+
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.scheduler.write.started"], 3)
+        self.failUnlessEqual(stats["storage_server.scheduler.verify.started"], 2)
+        self.failUnlessEqual(stats["storage_server.scheduler.read.started"], 2)
+        # unscheduled methods are carried out directly
+        version = ss.doRemoteCall("get_version", (), {})
+        self.failUnlessIn(b"application-version", version)
+
+    def test_unknown_priority(self):
+        ss = self.create("test_unknown_priority")
+        prioritized = ss.remote_with_priority(b"urgent!", FakeCanary())
+        self.successResultOf(prioritized.doRemoteCall(
+            "get_buckets", (b"si1",), {}))
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.scheduler.read.started"], 1)
+
+    def test_clients_by_tub(self):
+        # a client's requests share one queue however many prioritized
+        # servers it asks for, since clients are told apart by their Tub
+        ss = self.create("test_clients_by_tub",
+                         max_queued_requests_per_client=1)
+        blocker = self.block(ss._scheduler)
+        first = ss.remote_with_priority(b"verify", RemoteCanary(b"tub1"))
+        second = ss.remote_with_priority(b"verify", RemoteCanary(b"tub1"))
+        other = ss.remote_with_priority(b"verify", RemoteCanary(b"tub2"))
+        d1 = first.doRemoteCall("get_buckets", (b"si1",), {})
+        d2 = second.doRemoteCall("get_buckets", (b"si1",), {})
+        d3 = other.doRemoteCall("get_buckets", (b"si1",), {})
+        self.failureResultOf(d2, ServerBusyError)
+        blocker.callback(None)
+        self.successResultOf(d1)
+        self.successResultOf(d3)
+
+    def test_disabled(self):
+        ss = StorageServer(os.path.join("storage", "RequestScheduler",
+                                        "test_disabled"), b"\x00" * 20)
+        ss.setServiceParent(self.sparent)
+        verifier = ss.remote_with_priority(b"verify", FakeCanary())
+        # requests are carried out at once
+        self.failUnlessEqual(verifier.doRemoteCall("get_buckets", (b"si1",),
+                                                   {}), {})
+        self.failIfIn("storage_server.scheduler.active", ss.get_stats())
+
+
+class PackedShareStoreTests(unittest.TestCase):
+    """Tests for the log-structured store of small shares."""
+
+    def workdir(self, name):
+        return os.path.join("storage", "PackedShareStoreTests", name)
+
+    def si(self, c):
+        return c * 16
+
+    def open_store(self, name, segment_size=None):
+        store = PackedShareStore(self.workdir(name), segment_size)
+        self.addCleanup(store.close)
+        return store
+
+    def test_put_read_remove(self):
+        store = self.open_store("test_put_read_remove")
+        self.failIf(store.has_shares())
+        store.put_share(self.si(b"a"), 0, b"first share")
+        store.put_share(self.si(b"a"), 3, b"second share")
+        store.put_share(self.si(b"b"), 1, b"third share")
+        store.put_share(self.si(b"a"), 0, b"replaced")
+        store.remove_share(self.si(b"b"), 1)
+        # removing a share which is not there appends nothing
+        store.remove_share(self.si(b"c"), 0)
+
+        self.failUnless(store.has_share(self.si(b"a"), 0))
+        self.failIf(store.has_share(self.si(b"b"), 1))
+        self.failUnlessEqual(store.get_shnums(self.si(b"a")), [0, 3])
+        self.failUnlessEqual(store.get_shnums(self.si(b"b")), [])
+        self.failUnlessEqual(store.get_share(self.si(b"a"), 0), b"replaced")
+        self.failUnlessEqual(store.read_share(self.si(b"a"), 3, 7, 100),
+                             b"share")
+        self.failUnlessEqual(store.read_share(self.si(b"a"), 3, 100, 5), b"")
+        self.failUnlessEqual(store.get_share_size(self.si(b"a"), 3), 12)
+        self.failUnlessRaises(KeyError, store.get_share, self.si(b"b"), 1)
+        prefix = si_b2a(self.si(b"a"))[:2].decode("ascii")
+        self.failUnlessEqual(store.get_bucket_names(prefix),
+                             [si_b2a(self.si(b"a")).decode("ascii")])
+        self.failUnlessEqual(store.get_bucket_names("zz"), [])
+
+        stats = store.get_stats()
+        self.failUnlessEqual(stats["segments"], 1)
+        self.failUnlessEqual(stats["shares"], 2)
+        self.failUnlessEqual(stats["live_bytes"],
+                             2 * RECORD_HEADER_SIZE + len(b"replaced") + 12)
+        self.failUnlessEqual(stats["total_bytes"],
+                             5 * RECORD_HEADER_SIZE + 11 + 12 + 11 + 8)
+
+        # the index is rebuilt from the segments
+        store.close()
+        store2 = self.open_store("test_put_read_remove")
+        self.failUnlessEqual(store2.get_stats(), stats)
+        self.failUnlessEqual(store2.get_share(self.si(b"a"), 0), b"replaced")
+        self.failIf(store2.has_share(self.si(b"b"), 1))
+
+    def test_torn_tail(self):
+        store = self.open_store("test_torn_tail")
+        store.put_share(self.si(b"a"), 0, b"share data")
+        store.close()
+        segment = os.path.join(self.workdir("test_torn_tail"),
+                               "segment-00000001")
+        size = os.path.getsize(segment)
+        # a crash in the middle of appending a record
+        header = struct.pack(RECORD_HEADER, RECORD_MAGIC, KIND_SHARE,
+                             self.si(b"b"), 0, 0, 100)
+        with open(segment, "ab") as f:
+            f.write(header + b"partial")
+
+        store2 = self.open_store("test_torn_tail")
+        self.failUnlessEqual(os.path.getsize(segment), size)
+        self.failIf(store2.has_share(self.si(b"b"), 0))
+        store2.put_share(self.si(b"b"), 0, b"more data")
+        store2.close()
+
+        # a record whose data did not all reach the disk
+        with open(segment, "rb+") as f:
+            f.seek(-4, os.SEEK_END)
+            f.write(b"XXXX")
+        store3 = self.open_store("test_torn_tail")
+        self.failUnlessEqual(os.path.getsize(segment), size)
+        self.failUnlessEqual(store3.get_share(self.si(b"a"), 0),
+                             b"share data")
+        self.failIf(store3.has_share(self.si(b"b"), 0))
+
+    def test_compaction(self):
+        store = self.open_store("test_compaction", segment_size=100)
+        data = b"x" * 40
+        store.put_share(self.si(b"a"), 0, data)
+        store.put_share(self.si(b"b"), 0, data) # fills segment 1
+        store.put_share(self.si(b"c"), 0, data)
+        store.put_share(self.si(b"a"), 0, b"new") # fills segment 2
+        store.remove_share(self.si(b"b"), 0)
+        store.put_share(self.si(b"d"), 0, data) # fills segment 3
+        self.failUnlessEqual(store.get_stats()["segments"], 3)
+
+        # segment 1 is all garbage, segment 2 is not garbage enough
+        reclaimed = store.compact()
+        self.failUnlessEqual(reclaimed, 2 * (RECORD_HEADER_SIZE + 40))
+        stats = store.get_stats()
+        self.failUnlessEqual(stats["segments"], 2)
+        self.failUnlessEqual(stats["compactions"], 1)
+        self.failUnlessEqual(stats["reclaimed_bytes"], reclaimed)
+        self.failIf(os.path.exists(os.path.join(
+            self.workdir("test_compaction"), "segment-00000001")))
+
+        # the live share in segment 2 is moved out of it
+        store.remove_share(self.si(b"c"), 0)
+        store.compact()
+        self.failUnlessEqual(sorted(store._segments), [3, 4])
+        self.failUnlessEqual(store.get_share(self.si(b"a"), 0), b"new")
+        self.failUnlessEqual(store.get_share(self.si(b"d"), 0), data)
+
+        store.close()
+        store2 = self.open_store("test_compaction", segment_size=100)
+        for c in (b"b", b"c"):
+            self.failIf(store2.has_share(self.si(c), 0))
+        self.failUnlessEqual(store2.get_share(self.si(b"a"), 0), b"new")
+        self.failUnlessEqual(store2.get_share(self.si(b"d"), 0), data)
+
+    def test_deletion_carried_forward(self):
+        store = self.open_store("test_deletion_carried_forward",
+                                segment_size=100)
+        data = b"x" * 40
+        store.put_share(self.si(b"a"), 0, data)
+        store.put_share(self.si(b"b"), 0, data) # fills segment 1
+        store.remove_share(self.si(b"a"), 0)
+        store.put_share(self.si(b"c"), 0, b"y" * 100) # fills segment 2
+        store.put_share(self.si(b"c"), 0, b"z") # segment 3
+        # segment 2 is now mostly garbage, but it holds the record which
+        # says that the share in segment 1 was deleted
+        store.compact(threshold=0.6)
+        self.failUnlessEqual(sorted(store._segments), [1, 3])
+        store.close()
+        store2 = self.open_store("test_deletion_carried_forward",
+                                 segment_size=100)
+        self.failIf(store2.has_share(self.si(b"a"), 0))
+        self.failUnlessEqual(store2.get_share(self.si(b"b"), 0), data)
+        self.failUnlessEqual(store2.get_share(self.si(b"c"), 0), b"z")
+
+
+class PackedShares(unittest.TestCase, pollmixin.PollMixin):
+    """Tests for a storage server which packs small shares."""
+
+    def setUp(self):
+        self.sparent = LoggingServiceParent()
+        self.sparent.startService()
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def workdir(self, name):
+        return os.path.join("storage", "PackedShares", name)
+
+    def create(self, name, **kwargs):
+        kwargs.setdefault("packed_shares_enabled", True)
+        kwargs.setdefault("packed_share_max_size", 1000)
+        ss = StorageServer(self.workdir(name), b"\x00" * 20, **kwargs)
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def write_immutable(self, ss, storage_index, sharenums, data):
+        already, writers = ss.remote_allocate_buckets(
+            storage_index, b"r" * 32, b"c" * 32, sharenums, len(data),
+            FakeCanary())
+        for wb in writers.values():
+            wb.remote_write(0, data)
+            wb.remote_close()
+
+    def write_mutable(self, ss, storage_index, datav, new_length=None):
+        secrets = (b"w" * 32, b"r" * 32, b"c" * 32)
+        tw_vectors = dict((shnum, ([], [(offset, data)], new_length))
+                          for (shnum, offset, data) in datav)
+        return ss.remote_slot_testv_and_readv_and_writev(
+            storage_index, secrets, tw_vectors, [])
+
+    def bucket_dir(self, ss, storage_index):
+        return os.path.join(ss.sharedir, storage_index_to_dir(storage_index))
+
+    def test_immutable(self):
+        ss = self.create("test_immutable")
+        small_si = b"s" * 16
+        large_si = b"l" * 16
+        self.write_immutable(ss, small_si, [0, 1], b"small share")
+        self.write_immutable(ss, large_si, [0], b"L" * 2000)
+
+        # the small shares are packed, the large one has a file of its own
+        self.failIf(os.path.exists(self.bucket_dir(ss, small_si)))
+        self.failUnlessEqual(ss.packed_store.get_shnums(small_si), [0, 1])
+        self.failUnless(os.path.exists(
+            os.path.join(self.bucket_dir(ss, large_si), "0")))
+        self.failUnlessEqual(ss.packed_store.get_shnums(large_si), [])
+        self.failUnless(ss.have_shares())
+
+        # nothing is left behind in incoming/
+        incoming = os.path.join(ss.sharedir, "incoming")
+        self.failUnlessEqual(os.listdir(incoming), [])
+
+        # allocating the same shares again finds them
+        already, writers = ss.remote_allocate_buckets(
+            small_si, b"r" * 32, b"c" * 32, [0, 1, 2], 11, FakeCanary())
+        self.failUnlessEqual(already, set([0, 1]))
+        self.failUnlessEqual(set(writers), set([2]))
+        writers[2].remote_abort()
+
+        buckets = ss.remote_get_buckets(small_si)
+        self.failUnlessEqual(set(buckets), set([0, 1]))
+        self.failUnlessEqual(buckets[0].remote_read(6, 5), b"share")
+        self.failUnlessEqual(buckets[1].remote_readv([(0, 5), (6, 100)]),
+                             [b"small", b"share"])
+        buckets = ss.remote_get_buckets(large_si)
+        self.failUnlessEqual(buckets[0].remote_read(0, 5), b"LLLLL")
+
+        # leases are kept in the packed containers
+        ss.remote_add_lease(small_si, b"R" * 32, b"C" * 32)
+        leases = list(ss.get_leases(small_si))
+        self.failUnlessEqual(len(leases), 2)
+        ss.remote_renew_lease(small_si, b"R" * 32)
+        self.failUnlessEqual(ss.remote_get_buckets(small_si)[0]
+                             .remote_read(0, 11), b"small share")
+
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.packed.shares"], 2)
+        self.failUnlessEqual(stats["storage_server.packed.segments"], 1)
+        self.failUnless(stats["storage_server.packed.live_bytes"] > 0)
+
+    def test_mutable(self):
+        ss = self.create("test_mutable")
+        si = b"m" * 16
+        res = self.write_mutable(ss, si, [(0, 0, b"data"), (1, 0, b"more")])
+        self.failUnlessEqual(res, (True, {}))
+        self.failIf(os.path.exists(self.bucket_dir(ss, si)))
+        self.failUnlessEqual(ss.packed_store.get_shnums(si), [0, 1])
+        self.failUnlessEqual(ss.remote_slot_readv(si, [], [(0, 4)]),
+                             {0: [b"data"], 1: [b"more"]})
+
+        # a test vector against a packed share
+        secrets = (b"w" * 32, b"r" * 32, b"c" * 32)
+        res = ss.remote_slot_testv_and_readv_and_writev(
+            si, secrets, {0: ([(0, 4, b"eq", b"data")], [(4, b"!")], None)},
+            [(0, 5)])
+        self.failUnlessEqual(res, (True, {0: [b"data"], 1: [b"more"]}))
+        self.failUnlessEqual(ss.remote_slot_readv(si, [0], [(0, 5)]),
+                             {0: [b"data!"]})
+        self.failUnlessEqual(len(list(ss.get_slot_leases(si))), 1)
+
+        # a share which outgrows the limit is moved into a file
+        self.write_mutable(ss, si, [(0, 0, b"D" * 2000)])
+        self.failUnlessEqual(ss.packed_store.get_shnums(si), [1])
+        self.failUnless(os.path.exists(
+            os.path.join(self.bucket_dir(ss, si), "0")))
+        self.failUnlessEqual(ss.remote_slot_readv(si, [], [(0, 4)]),
+                             {0: [b"DDDD"], 1: [b"more"]})
+        self.failUnlessEqual(len(list(ss.get_slot_leases(si))), 1)
+
+        # deleting a packed share
+        self.write_mutable(ss, si, [(1, 0, b"")], new_length=0)
+        self.failUnlessEqual(ss.packed_store.get_shnums(si), [])
+        self.failUnlessEqual(ss.remote_slot_readv(si, [], [(0, 4)]),
+                             {0: [b"DDDD"]})
+
+    def test_disabled_later(self):
+        ss = self.create("test_disabled_later")
+        si = b"s" * 16
+        self.write_immutable(ss, si, [0], b"small share")
+        self.write_mutable(ss, b"m" * 16, [(0, 0, b"data")])
+        d = ss.disownServiceParent()
+        def _restart(ignored):
+            ss2 = self.create("test_disabled_later",
+                              packed_shares_enabled=False)
+            # what was packed stays readable, but new shares get files
+            self.failUnlessEqual(
+                ss2.remote_get_buckets(si)[0].remote_read(0, 11),
+                b"small share")
+            self.failUnlessEqual(
+                ss2.remote_slot_readv(b"m" * 16, [], [(0, 4)]),
+                {0: [b"data"]})
+            self.write_immutable(ss2, si, [1], b"small share")
+            self.failUnless(os.path.exists(
+                os.path.join(self.bucket_dir(ss2, si), "1")))
+            self.failUnlessEqual(set(ss2.remote_get_buckets(si)),
+                                 set([0, 1]))
+        d.addCallback(_restart)
+        return d
+
+    def test_counted_and_expired(self):
+        # a server which never shut down cleanly leaves no saved counts
+        writer = StorageServer(self.workdir("test_counted_and_expired"),
+                               b"\x00" * 20, packed_shares_enabled=True)
+        self.write_immutable(writer, b"s" * 16, [0, 1], b"0123456789")
+        self.write_mutable(writer, b"m" * 16, [(0, 0, b"data")])
+        writer.packed_store.close()
+
+        ss = self.create("test_counted_and_expired")
+        d = self.poll(ss.share_counter.is_complete)
+        def _counted(ignored):
+            counts = ss.share_counter.get_counts()
+            self.failUnlessEqual(counts["immutable"]["shares"], 2)
+            self.failUnlessEqual(counts["mutable"]["shares"], 1)
+            return ss.disownServiceParent()
+        d.addCallback(_counted)
+        def _restart(ignored):
+            ss2 = StorageServer(self.workdir("test_counted_and_expired"),
+                                b"\x00" * 20, expiration_enabled=True,
+                                expiration_mode="cutoff-date",
+                                expiration_cutoff_date=int(time.time() + 1000))
+            lc = ss2.lease_checker
+            lc.slow_start = 0
+            ss2.setServiceParent(self.sparent)
+            d2 = self.poll(
+                lambda: lc.get_state()["last-cycle-finished"] is not None)
+            d2.addCallback(lambda ign: ss2)
+            return d2
+        d.addCallback(_restart)
+        def _expired(ss2):
+            # every lease was older than the cutoff date
+            self.failIf(ss2.packed_store.has_shares())
+            counts = ss2.share_counter.get_counts()
+            self.failUnlessEqual(counts["immutable"]["shares"], 0)
+            self.failUnlessEqual(counts["mutable"]["shares"], 0)
+            last = ss2.lease_checker.get_state()["history"][0]
+            self.failUnlessEqual(last["space-recovered"]["actual-shares"], 3)
+        d.addCallback(_expired)
+        return d
+
+
+class FileDescriptorCacheTests(unittest.TestCase):
+    """Tests for allmydata.storage.fdcache.FileDescriptorCache."""
+
+    def make_file(self, data):
+        fn = self.mktemp()
+        with open(fn, "wb") as f:
+            f.write(data)
+        return fn
+
+    def test_pread(self):
+        cache = FileDescriptorCache(2)
+        self.addCleanup(cache.close_all)
+        fn = self.make_file(b"0123456789")
+        self.assertEqual(cache.pread(fn, 3, 2), b"234")
+        self.assertEqual(cache.pread(fn, 5, 0), b"01234")
+        # short reads only happen at the end of the file
+        self.assertEqual(cache.pread(fn, 10, 8), b"89")
+        self.assertEqual(cache.pread(fn, 10, 20), b"")
+        self.assertEqual(cache.get_stats(),
+                         {"open": 1, "hits": 3, "misses": 1, "evictions": 0})
+
+    def test_lru_eviction(self):
+        cache = FileDescriptorCache(2)
+        self.addCleanup(cache.close_all)
+        a, b, c = [self.make_file(x * 4) for x in (b"a", b"b", b"c")]
+        cache.pread(a, 1, 0)
+        cache.pread(b, 1, 0)
+        cache.pread(a, 1, 0) # a is now the most recently used
+        cache.pread(c, 1, 0) # so b is evicted
+        self.assertEqual(cache.get_stats()["evictions"], 1)
+        self.assertEqual(cache.get_stats()["open"], 2)
+        misses = cache.misses
+        cache.pread(a, 1, 0)
+        self.assertEqual(cache.misses, misses)
+        cache.pread(b, 1, 0)
+        self.assertEqual(cache.misses, misses + 1)
+
+    def test_invalidate(self):
+        cache = FileDescriptorCache(2)
+        self.addCleanup(cache.close_all)
+        fn = self.make_file(b"old data")
+        self.assertEqual(cache.pread(fn, 3, 0), b"old")
+        os.unlink(fn)
+        with open(fn, "wb") as f:
+            f.write(b"new data")
+        # the cached descriptor still refers to the deleted file
+        self.assertEqual(cache.pread(fn, 3, 0), b"old")
+        cache.invalidate(fn)
+        self.assertEqual(cache.pread(fn, 3, 0), b"new")
+        cache.close_all()
+        self.assertEqual(cache.get_stats()["open"], 0)
+
+    def test_invalidate_during_read(self):
+        cache = FileDescriptorCache(2)
+        self.addCleanup(cache.close_all)
+        fn = self.make_file(b"data")
+        # another thread is in the middle of reading from this descriptor
+        fd = cache._checkout_fd(fn)
+        cache.invalidate(fn)
+        self.assertEqual(cache.get_stats()["open"], 0)
+        os.fstat(fd) # still open
+        cache._checkin_fd(fd)
+        self.assertRaises(OSError, os.fstat, fd)
+
+    def test_sharefile_reads(self):
+        cache = FileDescriptorCache(4)
+        self.addCleanup(cache.close_all)
+        sf = ShareFile(self.mktemp(), max_size=10, create=True)
+        sf.write_share_data(0, b"abcdefghij")
+        sf = ShareFile(sf.home, fd_cache=cache)
+        self.assertEqual(sf.read_share_data(2, 3), b"cde")
+        self.assertEqual(sf.read_share_data(8, 10), b"ij")
+        self.assertEqual(cache.get_stats()["open"], 1)
+        sf.unlink()
+        self.assertEqual(cache.get_stats()["open"], 0)
+
+    def test_server_invalidates_removed_shares(self):
+        basedir = os.path.join("storage", "FileDescriptorCache", "server")
+        ss = StorageServer(basedir, b"\x00" * 20, fd_cache_size=10)
+        self.addCleanup(ss.stopService)
+        def upload(data):
+            already, writers = ss.remote_allocate_buckets(
+                b"si1", b"r" * 32, b"c" * 32, [0], len(data), FakeCanary())
+            writers[0].remote_write(0, data)
+            writers[0].remote_close()
+        upload(b"first")
+        readers = ss.remote_get_buckets(b"si1")
+        self.assertEqual(readers[0].remote_read(0, 5), b"first")
+        self.assertEqual(ss.get_stats()["storage_server.fd_cache.open"], 1)
+
+        # the lease checker deletes the share and tells the server
+        os.unlink(readers[0]._share_file.home)
+        ss.share_removed(b"si1", 0)
+        self.assertEqual(ss.get_stats()["storage_server.fd_cache.open"], 0)
+
+        upload(b"again")
+        readers = ss.remote_get_buckets(b"si1")
+        self.assertEqual(readers[0].remote_read(0, 5), b"again")
+
+
+class MappedFileCacheTests(unittest.TestCase):
+    """Tests for allmydata.storage.mmapcache.MappedFileCache."""
+
+    def make_file(self, data):
+        fn = self.mktemp()
+        with open(fn, "wb") as f:
+            f.write(data)
+        return fn
+
+    def test_read(self):
+        cache = MappedFileCache(2)
+        self.addCleanup(cache.close_all)
+        fn = self.make_file(b"0123456789")
+        view = cache.view(fn, 8, 2, 3)
+        self.assertIsInstance(view, memoryview)
+        self.assertEqual(view.tobytes(), b"234")
+        # only the first 8 bytes are mapped
+        self.assertEqual(cache.read(fn, 8, 6, 10), b"67")
+        self.assertEqual(cache.read(fn, 8, 20, 10), b"")
+        self.assertEqual(cache.get_stats(),
+                         {"mapped": 1, "mapped_bytes": 8, "hits": 2,
+                          "misses": 1, "evictions": 0})
+        # the file is too short to map this much
+        self.assertRaises(ValueError, cache.read, fn, 20, 0, 1)
+
+    def test_lru_eviction(self):
+        cache = MappedFileCache(2)
+        self.addCleanup(cache.close_all)
+        a, b, c = [self.make_file(x * 4) for x in (b"a", b"b", b"c")]
+        cache.read(a, 4, 0, 1)
+        cache.read(b, 4, 0, 1)
+        cache.read(a, 4, 0, 1) # a is now the most recently used
+        cache.read(c, 4, 0, 1) # so b is unmapped
+        self.assertEqual(cache.get_stats()["evictions"], 1)
+        self.assertEqual(cache.get_stats()["mapped"], 2)
+        misses = cache.misses
+        self.assertEqual(cache.read(a, 4, 0, 1), b"a")
+        self.assertEqual(cache.misses, misses)
+        self.assertEqual(cache.read(b, 4, 0, 1), b"b")
+        self.assertEqual(cache.misses, misses + 1)
+
+    def test_invalidate(self):
+        cache = MappedFileCache(2)
+        self.addCleanup(cache.close_all)
+        fn = self.make_file(b"old data")
+        self.assertEqual(cache.read(fn, 8, 0, 3), b"old")
+        # a view which is still in use when its file is invalidated
+        view = cache.view(fn, 8, 4, 4)
+        os.unlink(fn)
+        with open(fn, "wb") as f:
+            f.write(b"new data")
+        # the mapping still refers to the deleted file
+        self.assertEqual(cache.read(fn, 8, 0, 3), b"old")
+        cache.invalidate(fn)
+        self.assertEqual(cache.read(fn, 8, 0, 3), b"new")
+        self.assertEqual(view.tobytes(), b"data")
+        cache.close_all()
+        self.assertEqual(cache.get_stats()["mapped"], 0)
+
+    def test_sharefile_reads(self):
+        cache = MappedFileCache(4, min_size=10)
+        self.addCleanup(cache.close_all)
+        sf = ShareFile(self.mktemp(), max_size=10, create=True)
+        sf.write_share_data(0, b"abcdefghij")
+        sf.add_lease(LeaseInfo(1, b"r" * 32, b"c" * 32, 0, b"\x00" * 20))
+        sf.add_lease(LeaseInfo(2, b"R" * 32, b"C" * 32, 0, b"\x00" * 20))
+        sf = ShareFile(sf.home, mmap_cache=cache)
+        self.assertEqual(sf.read_share_data(2, 3), b"cde")
+        self.assertEqual(sf.read_share_data_view(8, 10).tobytes(), b"ij")
+        # only the share data is mapped, so the lease records after it can
+        # be truncated while it is in use
+        self.assertEqual(cache.get_stats()["mapped_bytes"], 0x0c + 10)
+        sf.cancel_lease(b"C" * 32)
+        self.assertEqual(sf.read_share_data(0, 10), b"abcdefghij")
+        sf.unlink()
+        self.assertEqual(cache.get_stats()["mapped"], 0)
+
+        # shares with less data than min_size are read normally
+        sf = ShareFile(self.mktemp(), max_size=9, create=True)
+        sf.write_share_data(0, b"abcdefghi")
+        sf = ShareFile(sf.home, mmap_cache=cache)
+        self.assertEqual(sf.read_share_data_view(0, 3).tobytes(), b"abc")
+        self.assertEqual(cache.get_stats()["misses"], 1)
+
+    def test_server_reads(self):
+        basedir = os.path.join("storage", "MappedFileCache", "server")
+        ss = StorageServer(basedir, b"\x00" * 20, mmap_cache_size=10,
+                           mmap_min_share_size=100)
+        self.addCleanup(ss.stopService)
+        def upload(si, data):
+            already, writers = ss.remote_allocate_buckets(
+                si, b"r" * 32, b"c" * 32, [0], len(data), FakeCanary())
+            writers[0].remote_write(0, data)
+            writers[0].remote_close()
+        upload(b"si1", b"a" * 1000)
+        upload(b"si2", b"small")
+        readers = ss.remote_get_buckets(b"si1")
+        self.assertEqual(readers[0].remote_read(0, 5), b"aaaaa")
+        self.assertEqual(readers[0].remote_readv([(995, 10)]), [b"aaaaa"])
+        readers = ss.remote_get_buckets(b"si2")
+        self.assertEqual(readers[0].remote_read(0, 5), b"small")
+        self.assertEqual(ss.get_stats()["storage_server.mmap_cache.mapped"],
+                         1)
+
+        # the lease checker deletes the share and tells the server
+        os.unlink(os.path.join(ss.sharedir, storage_index_to_dir(b"si1"),
+                               "0"))
+        ss.share_removed(b"si1", 0)
+        self.assertEqual(ss.get_stats()["storage_server.mmap_cache.mapped"],
+                         0)
+
+        upload(b"si1", b"b" * 1000)
+        readers = ss.remote_get_buckets(b"si1")
+        self.assertEqual(readers[0].remote_read(0, 5), b"bbbbb")
+
+
+class LeaseDBTests(unittest.TestCase, pollmixin.PollMixin):
+    """Tests for the optional SQLite lease database."""
+
+    def setUp(self):
+        self.sparent = LoggingServiceParent()
+        self.sparent.startService()
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def create(self, name, **kwargs):
+        workdir = os.path.join("storage", "LeaseDB", name)
+        ss = StorageServer(workdir, b"\x00" * 20, lease_db_enabled=True,
+                           **kwargs)
+        self.addCleanup(ss.lease_db.close)
+        return ss
+
+    def secrets(self, tag):
+        return (hashutil.tagged_hash(b"renew", tag),
+                hashutil.tagged_hash(b"cancel", tag))
+
+    def write_immutable(self, ss, storage_index, sharenums, tag):
+        (renew_secret, cancel_secret) = self.secrets(tag)
+        already, writers = ss.remote_allocate_buckets(
+            storage_index, renew_secret, cancel_secret, sharenums, 10,
+            FakeCanary())
+        for wb in writers.values():
+            wb.remote_write(0, b"0123456789")
+            wb.remote_close()
+
+    def write_mutable(self, ss, storage_index, sharenums, tag,
+                      new_length=None, renew_leases=True):
+        secrets = (b"w" * 32,) + self.secrets(tag)
+        tw_vectors = dict((shnum, ([], [(0, b"data")], new_length))
+                          for shnum in sharenums)
+        return ss.slot_testv_and_readv_and_writev(
+            storage_index, secrets, tw_vectors, [], renew_leases)
+
+    def renew_hashes(self, ss, storage_index, shnum):
+        return [row[0] for row in
+                ss.lease_db.get_share_leases(storage_index, shnum)]
+
+    def test_tracks_leases(self):
+        ss = self.create("test_tracks_leases")
+        h = lambda tag: renew_secret_hash(self.secrets(tag)[0])
+
+        # closing a bucket records its lease
+        self.write_immutable(ss, b"si1", [0, 1], b"a")
+        self.failUnlessEqual(self.renew_hashes(ss, b"si1", 0), [h(b"a")])
+        self.failUnlessEqual(self.renew_hashes(ss, b"si1", 1), [h(b"a")])
+        [(ignored, owner_num, expiration_time)] = \
+            ss.lease_db.get_share_leases(b"si1", 0)
+        self.failUnlessEqual(expiration_time,
+                             int(list(ss.get_leases(b"si1"))[0].expiration_time))
+
+        # adding a lease, directly or by allocating again, adds a row for
+        # every share
+        ss.remote_add_lease(b"si1", *self.secrets(b"b"))
+        self.write_immutable(ss, b"si1", [0], b"c")
+        for shnum in (0, 1):
+            self.failUnlessEqual(sorted(self.renew_hashes(ss, b"si1", shnum)),
+                                 sorted([h(b"a"), h(b"b"), h(b"c")]))
+
+        # renewing rewrites the share's rows from its lease records
+        ss.lease_db.set_share_leases(b"si1", 1, "immutable", [])
+        ss.remote_renew_lease(b"si1", self.secrets(b"b")[0])
+        self.failUnlessEqual(sorted(self.renew_hashes(ss, b"si1", 1)),
+                             sorted([h(b"a"), h(b"b"), h(b"c")]))
+
+        # mutable writes add leases, and deleting a share drops its rows
+        self.write_mutable(ss, b"si2", [0, 1], b"a")
+        self.failUnlessEqual(self.renew_hashes(ss, b"si2", 1), [h(b"a")])
+        self.write_mutable(ss, b"si2", [1], b"a", new_length=0)
+        self.failUnlessEqual(ss.lease_db.get_share_leases(b"si2", 1), [])
+        self.failUnlessEqual(self.renew_hashes(ss, b"si2", 0), [h(b"a")])
+
+        self.failUnlessEqual(ss.get_stats()["storage_server.lease_db.leases"],
+                             3 + 3 + 1)
+
+    def test_expire_from_db(self):
+        now = time.time()
+        ss = self.create("test_expire_from_db", expiration_enabled=True,
+                         expiration_mode="cutoff-date",
+                         expiration_cutoff_date=int(now - 10*24*60*60))
+        self.failUnlessEqual(ss.lease_db_expirer.step,
+                             ss.LEASE_DB_EXPIRY_INTERVAL)
+        old_lease = LeaseInfo(1, self.secrets(b"old")[0],
+                              self.secrets(b"old")[1],
+                              now - 40*24*60*60, ss.my_nodeid)
+        # si1 has a current lease and an old one, si2 has only an old one,
+        # and si3 has only a current one
+        self.write_immutable(ss, b"si1", [0], b"a")
+        self.write_mutable(ss, b"si2", [0], b"a", renew_leases=False)
+        self.write_immutable(ss, b"si3", [0], b"a")
+        for si in (b"si1", b"si2"):
+            [sf] = ss._iter_share_files(si)
+            sf.add_or_renew_lease(old_lease)
+            ss.share_leases_changed(si, 0, sf)
+        # and the database mentions a share which is no longer there
+        ss.lease_db.set_share_leases(b"si4", 0, "immutable", [old_lease])
+
+        opened = []
+        real_get_share_file = expirer.get_share_file
+        self.patch(expirer, "get_share_file",
+                   lambda filename: opened.append(filename) or
+                   real_get_share_file(filename))
+        ss.lease_checker.expire_leases_from_db()
+
+        # only the shares holding expired leases were opened
+        self.failUnlessEqual(len(opened), 2)
+        self.failUnlessEqual(self.renew_hashes(ss, b"si1", 0),
+                             [renew_secret_hash(self.secrets(b"a")[0])])
+        self.failUnlessEqual(len(list(ss.get_leases(b"si1"))), 1)
+        self.failUnlessEqual(ss.remote_slot_readv(b"si2", [], [(0, 4)]), {})
+        self.failUnlessEqual(ss.lease_db.get_share_leases(b"si2", 0), [])
+        self.failUnlessEqual(ss.lease_db.get_share_leases(b"si4", 0), [])
+        self.failUnlessEqual(len(ss.lease_db.get_share_leases(b"si3", 0)), 1)
+        self.failUnlessEqual(
+            ss.lease_db.get_shares_with_leases_expiring_before(
+                now, ["mutable", "immutable"]), [])
+
+    @defer.inlineCallbacks
+    def test_expire_from_db_serialized(self):
+        """
+        With disk I/O in threads, expiring a share waits for the operations
+        already queued on its storage index.
+        """
+        now = time.time()
+        ss = self.create("test_expire_from_db_serialized",
+                         expiration_enabled=True,
+                         expiration_mode="cutoff-date",
+                         expiration_cutoff_date=int(now - 10*24*60*60),
+                         disk_io_threads=1)
+        ss.setServiceParent(self.sparent)
+        yield self.write_mutable(ss, b"si1", [0], b"a", renew_leases=False)
+        [sf] = ss._iter_share_files(b"si1")
+        sf.add_or_renew_lease(LeaseInfo(1, self.secrets(b"old")[0],
+                                        self.secrets(b"old")[1],
+                                        now - 40*24*60*60, ss.my_nodeid))
+        ss.share_leases_changed(b"si1", 0, sf)
+
+        release = threading.Event()
+        queued = ss._disk_io.run(b"si1", release.wait, 10)
+        d = ss.lease_checker.expire_leases_from_db()
+        # the lease is still there while the earlier operation runs
+        [sf] = ss._iter_share_files(b"si1")
+        self.failUnlessEqual(len(list(sf.get_leases())), 1)
+        release.set()
+        yield queued
+        yield d
+        self.failUnlessEqual(ss.lease_db.get_share_leases(b"si1", 0), [])
+        res = yield ss.remote_slot_readv(b"si1", [], [(0, 4)])
+        self.failUnlessEqual(res, {})
+
+    def test_expiration_disabled(self):
+        ss = self.create("test_expiration_disabled")
+        self.failIf(hasattr(ss, "lease_db_expirer"))
+        self.write_mutable(ss, b"si1", [0], b"a", renew_leases=False)
+        [sf] = ss._iter_share_files(b"si1")
+        sf.add_or_renew_lease(LeaseInfo(1, self.secrets(b"old")[0],
+                                        self.secrets(b"old")[1],
+                                        time.time() - 40*24*60*60,
+                                        ss.my_nodeid))
+        ss.share_leases_changed(b"si1", 0, sf)
+        ss.lease_checker.expire_leases_from_db()
+        self.failUnlessEqual(len(ss.lease_db.get_share_leases(b"si1", 0)), 1)
+
+    def test_crawler_reconciles(self):
+        ss = self.create("test_crawler_reconciles")
+        self.write_immutable(ss, b"si1", [0, 1], b"a")
+        self.write_mutable(ss, b"si2", [0], b"a")
+        # lose track of some shares, as if the database had been enabled
+        # after they were written
+        ss.lease_db.remove_share(b"si1", 1)
+        ss.lease_db.remove_share(b"si2", 0)
+        lc = ss.lease_checker
+        lc.slow_start = 0
+        ss.setServiceParent(self.sparent)
+        d = self.poll(lambda: lc.get_state()["last-cycle-finished"] is not None)
+        def _check(ignored):
+            h = renew_secret_hash(self.secrets(b"a")[0])
+            self.failUnlessEqual(self.renew_hashes(ss, b"si1", 1), [h])
+            self.failUnlessEqual(self.renew_hashes(ss, b"si2", 0), [h])
+        d.addCallback(_check)
+        return d
+
 class Stats(unittest.TestCase):
 
     def setUp(self):
@@ -2963,27 +5027,35 @@ class Stats(unittest.TestCase):
 
         self.failUnlessEqual(sorted(output.keys()),
                              sorted(["allocate", "renew", "cancel", "write", "get"]))
-        self.failUnlessEqual(len(ss.latencies["allocate"]), 1000)
-        self.failUnless(abs(output["allocate"]["mean"] - 9500) < 1, output)
-        self.failUnless(abs(output["allocate"]["01_0_percentile"] - 9010) < 1, output)
-        self.failUnless(abs(output["allocate"]["10_0_percentile"] - 9100) < 1, output)
-        self.failUnless(abs(output["allocate"]["50_0_percentile"] - 9500) < 1, output)
-        self.failUnless(abs(output["allocate"]["90_0_percentile"] - 9900) < 1, output)
-        self.failUnless(abs(output["allocate"]["95_0_percentile"] - 9950) < 1, output)
-        self.failUnless(abs(output["allocate"]["99_0_percentile"] - 9990) < 1, output)
-        self.failUnless(abs(output["allocate"]["99_9_percentile"] - 9999) < 1, output)
-
-        self.failUnlessEqual(len(ss.latencies["renew"]), 1000)
+
+        def near(category, name, expected):
+            # the histograms are accurate to within a couple of percent
+            actual = output[category][name]
+            self.failUnless(abs(actual - expected) <= 0.02 * expected + 1,
+                            (category, name, actual, expected))
+
+        self.failUnlessEqual(ss.latencies["allocate"].count, 10000)
+        self.failUnlessEqual(output["allocate"]["samplesize"], 10000)
+        self.failUnless(abs(output["allocate"]["mean"] - 4999.5) < 1, output)
+        near("allocate", "01_0_percentile", 100)
+        near("allocate", "10_0_percentile", 1000)
+        near("allocate", "50_0_percentile", 5000)
+        near("allocate", "90_0_percentile", 9000)
+        near("allocate", "95_0_percentile", 9500)
+        near("allocate", "99_0_percentile", 9900)
+        near("allocate", "99_9_percentile", 9990)
+
+        self.failUnlessEqual(ss.latencies["renew"].count, 1000)
         self.failUnless(abs(output["renew"]["mean"] - 500) < 1, output)
-        self.failUnless(abs(output["renew"]["01_0_percentile"] -  10) < 1, output)
-        self.failUnless(abs(output["renew"]["10_0_percentile"] - 100) < 1, output)
-        self.failUnless(abs(output["renew"]["50_0_percentile"] - 500) < 1, output)
-        self.failUnless(abs(output["renew"]["90_0_percentile"] - 900) < 1, output)
-        self.failUnless(abs(output["renew"]["95_0_percentile"] - 950) < 1, output)
-        self.failUnless(abs(output["renew"]["99_0_percentile"] - 990) < 1, output)
-        self.failUnless(abs(output["renew"]["99_9_percentile"] - 999) < 1, output)
-
-        self.failUnlessEqual(len(ss.latencies["write"]), 20)
+        near("renew", "01_0_percentile", 10)
+        near("renew", "10_0_percentile", 100)
+        near("renew", "50_0_percentile", 500)
+        near("renew", "90_0_percentile", 900)
+        near("renew", "95_0_percentile", 950)
+        near("renew", "99_0_percentile", 990)
+        near("renew", "99_9_percentile", 999)
+
+        self.failUnlessEqual(ss.latencies["write"].count, 20)
         self.failUnless(abs(output["write"]["mean"] - 9) < 1, output)
         self.failUnless(output["write"]["01_0_percentile"] is None, output)
         self.failUnless(abs(output["write"]["10_0_percentile"] -  2) < 1, output)
@@ -2993,7 +5065,7 @@ class Stats(unittest.TestCase):
         self.failUnless(output["write"]["99_0_percentile"] is None, output)
         self.failUnless(output["write"]["99_9_percentile"] is None, output)
 
-        self.failUnlessEqual(len(ss.latencies["cancel"]), 10)
+        self.failUnlessEqual(ss.latencies["cancel"].count, 10)
         self.failUnless(abs(output["cancel"]["mean"] - 9) < 1, output)
         self.failUnless(output["cancel"]["01_0_percentile"] is None, output)
         self.failUnless(abs(output["cancel"]["10_0_percentile"] -  2) < 1, output)
@@ -3003,7 +5075,7 @@ class Stats(unittest.TestCase):
         self.failUnless(output["cancel"]["99_0_percentile"] is None, output)
         self.failUnless(output["cancel"]["99_9_percentile"] is None, output)
 
-        self.failUnlessEqual(len(ss.latencies["get"]), 1)
+        self.failUnlessEqual(ss.latencies["get"].count, 1)
         self.failUnless(output["get"]["mean"] is None, output)
         self.failUnless(output["get"]["01_0_percentile"] is None, output)
         self.failUnless(output["get"]["10_0_percentile"] is None, output)
@@ -35,13 +35,14 @@ from twisted.application.service import (
 )
 
 from twisted.trial import unittest
-from twisted.internet.defer import succeed, inlineCallbacks
+from twisted.internet.defer import Deferred, succeed, inlineCallbacks
 from twisted.python.filepath import (
     FilePath,
 )
 
 from foolscap.api import (
     Tub,
+    Referenceable,
 )
 
 from .common import (
@@ -62,12 +63,15 @@ from allmydata.webish import (
     WebishServer,
 )
 from allmydata.util import base32, yamlutil
+from allmydata.util.hashutil import permute_server_hash
 from allmydata.storage_client import (
     IFoolscapStorageServer,
     NativeStorageServer,
+    StorageClientConfig,
     StorageFarmBroker,
     _FoolscapStorage,
     _NullStorage,
+    _StorageServer,
 )
 from allmydata.interfaces import (
     IConnectionStatus,
@@ -111,6 +115,102 @@ class TestNativeStorageServer(unittest.TestCase):
         self.assertEqual(nss.get_nickname(), "")
 
 
+class FakeStorageRRef(object):
+    def __init__(self, version):
+        self.version = version
+        self.calls = []
+        self.prioritized = {}
+    def callRemote(self, methname, *args):
+        self.calls.append((methname,) + args)
+        if methname == "with_priority":
+            (priority, canary) = args
+            assert isinstance(canary, Referenceable)
+            self.calls[-1] = (methname, priority)
+            self.prioritized[priority] = FakeStorageRRef(None)
+            return succeed(self.prioritized[priority])
+        return succeed(None)
+
+
+class PriorityHints(unittest.TestCase):
+    """
+    Tests for ``_StorageServer.with_priority``.
+    """
+    def test_hinted(self):
+        """
+        A server which supports priority hints is asked for a prioritized
+        reference once, and requests go through it.
+        """
+        rref = FakeStorageRRef(
+            {b"http://allmydata.org/tahoe/protocols/storage/v1":
+             {b"supports-priority-hints": True}})
+        storage_server = _StorageServer(get_rref=lambda: rref)
+        verifier = storage_server.with_priority("verify")
+        self.assertIs(storage_server.with_priority("verify"), verifier)
+        verifier.get_buckets(b"si1")
+        verifier.add_lease(b"si1", b"r" * 32, b"c" * 32)
+        storage_server.get_buckets(b"si2")
+        self.assertEqual(rref.calls, [("with_priority", b"verify"),
+                                      ("get_buckets", b"si2")])
+        self.assertEqual(rref.prioritized[b"verify"].calls,
+                         [("get_buckets", b"si1"),
+                          ("add_lease", b"si1", b"r" * 32, b"c" * 32)])
+
+    def test_reconnected(self):
+        """
+        A new prioritized reference is asked for after a reconnection.
+        """
+        version = {b"http://allmydata.org/tahoe/protocols/storage/v1":
+                   {b"supports-priority-hints": True}}
+        rrefs = [FakeStorageRRef(version)]
+        verifier = _StorageServer(get_rref=lambda: rrefs[-1]).with_priority(
+            "verify")
+        verifier.get_buckets(b"si1")
+        rrefs.append(FakeStorageRRef(version))
+        verifier.get_buckets(b"si1")
+        for rref in rrefs:
+            self.assertEqual(rref.calls[0], ("with_priority", b"verify"))
+            self.assertEqual(rref.prioritized[b"verify"].calls,
+                             [("get_buckets", b"si1")])
+
+    def test_concurrent(self):
+        """
+        Requests made while the prioritized reference is being asked for
+        wait for the same ``with_priority`` request, and are sent in order.
+        """
+        rref = FakeStorageRRef(
+            {b"http://allmydata.org/tahoe/protocols/storage/v1":
+             {b"supports-priority-hints": True}})
+        answer = Deferred()
+        rref.callRemote = lambda methname, *args: (
+            rref.calls.append((methname,) + args[:1]) or answer)
+        verifier = _StorageServer(get_rref=lambda: rref).with_priority(
+            "verify")
+        d1 = verifier.get_buckets(b"si1")
+        d2 = verifier.get_buckets(b"si2")
+        self.assertEqual(rref.calls, [("with_priority", b"verify")])
+        prioritized = FakeStorageRRef(None)
+        answer.callback(prioritized)
+        verifier.get_buckets(b"si3")
+        self.successResultOf(d1)
+        self.successResultOf(d2)
+        self.assertEqual(rref.calls, [("with_priority", b"verify")])
+        self.assertEqual(prioritized.calls, [("get_buckets", b"si1"),
+                                             ("get_buckets", b"si2"),
+                                             ("get_buckets", b"si3")])
+
+    def test_unsupported(self):
+        """
+        A server which does not support priority hints gets requests without
+        them.
+        """
+        rref = FakeStorageRRef(
+            {b"http://allmydata.org/tahoe/protocols/storage/v1": {}})
+        verifier = _StorageServer(get_rref=lambda: rref).with_priority(
+            "verify")
+        verifier.get_buckets(b"si1")
+        self.assertEqual(rref.calls, [("get_buckets", b"si1")])
+
+
 class GetConnectionStatus(unittest.TestCase):
     """
     Tests for ``NativeStorageServer.get_connection_status``.
@@ -569,6 +669,88 @@ storage:
         self.assertEqual(s.get_permutation_seed(),
                          hashlib.sha256(server_id).digest())
 
+    def _add_servers(self, broker, count):
+        for i in range(count):
+            ann = {"anonymous-storage-FURL": SOME_FURL,
+                   "permutation-seed-base32": base32.b2a(b"%d" % i)}
+            broker.test_add_rref(b"%d" % i, "rref", ann)
+
+    def _sorted(self, broker, psi):
+        # what get_servers_for_psi() used to do: sort them all
+        def _permuted(server):
+            return (server.get_longname() not in broker.preferred_peers,
+                    permute_server_hash(psi, server.get_permutation_seed()))
+        return sorted(broker.get_connected_servers(), key=_permuted)
+
+    def test_permuted_servers(self):
+        broker = StorageFarmBroker(
+            True, None, EMPTY_CLIENT_CONFIG,
+            StorageClientConfig(preferred_peers=[b"7", b"30"]),
+        )
+        self._add_servers(broker, 50)
+        broker.servers[b"3"]._is_connected = False
+        expected = self._sorted(broker, b"psi")
+        self.assertEqual(len(expected), 49)
+        self.assertEqual([s.get_longname() for s in expected[:2]],
+                         [b"30", b"7"])
+
+        servers = broker.get_servers_for_psi(b"psi")
+        self.assertEqual(len(servers), 49)
+        self.assertTrue(servers)
+        self.assertEqual(servers[:10], expected[:10])
+        self.assertEqual(servers[0], expected[0])
+        self.assertEqual(servers[5:15:2], expected[5:15:2])
+        self.assertEqual(servers[-1], expected[-1])
+        self.assertEqual(servers[-3:], expected[-3:])
+        self.assertEqual(servers[40:100], expected[40:100])
+        self.assertRaises(IndexError, lambda: servers[49])
+        self.assertEqual(list(servers), expected)
+        # each iteration starts from the beginning
+        self.assertEqual(next(iter(servers)), expected[0])
+        self.assertFalse(broker.get_servers_for_psi(b"psi") is servers)
+
+    def test_permuted_servers_follow_membership(self):
+        broker = make_broker()
+        self._add_servers(broker, 5)
+        self.assertEqual(list(broker.get_servers_for_psi(b"psi")),
+                         self._sorted(broker, b"psi"))
+        self.assertEqual(len(broker.get_servers_for_psi(b"psi")), 5)
+        del broker.servers[b"2"]
+        self.assertEqual(list(broker.get_servers_for_psi(b"psi")),
+                         self._sorted(broker, b"psi"))
+        self.assertEqual(len(broker.get_servers_for_psi(b"psi")), 4)
+        self._add_servers(broker, 10)
+        self.assertEqual(list(broker.get_servers_for_psi(b"psi")),
+                         self._sorted(broker, b"psi"))
+        broker.servers.clear()
+        self.assertEqual(list(broker.get_servers_for_psi(b"psi")), [])
+        self.assertFalse(broker.get_servers_for_psi(b"psi"))
+
+    def test_permuted_servers_follow_announcements(self):
+        broker = make_broker()
+        key_s = b"v0-1234-1"
+        ann = {
+            "service-name": "storage",
+            "anonymous-storage-FURL": SOME_FURL,
+            "permutation-seed-base32": "aaaaaaaaaaaaaaaaaaaaaaaa",
+        }
+        broker._got_announcement(key_s, ann)
+        # it isn't connected yet
+        self.assertEqual(list(broker.get_servers_for_psi(b"psi")), [])
+        broker.servers[key_s]._is_connected = True
+        [server] = broker.get_servers_for_psi(b"psi")
+        self.assertEqual(server.get_permutation_seed(),
+                         base32.a2b(b"aaaaaaaaaaaaaaaaaaaaaaaa"))
+
+        # a new announcement replaces the server, and its seed
+        broker._got_announcement(
+            key_s, dict(ann, **{"permutation-seed-base32":
+                                "bbbbbbbbbbbbbbbbbbbbbbbb"}))
+        broker.servers[key_s]._is_connected = True
+        [server] = broker.get_servers_for_psi(b"psi")
+        self.assertEqual(server.get_permutation_seed(),
+                         base32.a2b(b"bbbbbbbbbbbbbbbbbbbbbbbb"))
+
     @inlineCallbacks
     def test_threshold_reached(self):
         introducer = Mock()
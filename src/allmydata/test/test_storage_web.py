@@ -19,6 +19,7 @@ import time
 import os.path
 import re
 import json
+import threading
 
 from twisted.trial import unittest
 
@@ -40,10 +41,10 @@ from zope.interface import implementer
 
 from foolscap.api import fireEventually
 from allmydata.util import fileutil, hashutil, base32, pollmixin
-from allmydata.storage.common import storage_index_to_dir, \
+from allmydata.storage.common import storage_index_to_dir, si_b2a, \
      UnknownMutableContainerVersionError, UnknownImmutableContainerVersionError
 from allmydata.storage.server import StorageServer
-from allmydata.storage.crawler import BucketCountingCrawler
+from allmydata.storage.sharecounter import ShareCountingCrawler
 from allmydata.storage.expirer import LeaseCheckingCrawler
 from allmydata.web.storage import (
     StorageStatus,
@@ -90,21 +91,18 @@ def renderJSON(resource):
 
     return resource.render(JSONRequest())
 
-class MyBucketCountingCrawler(BucketCountingCrawler):
+class MyShareCountingCrawler(ShareCountingCrawler):
     def finished_prefix(self, cycle, prefix):
-        BucketCountingCrawler.finished_prefix(self, cycle, prefix)
+        ShareCountingCrawler.finished_prefix(self, cycle, prefix)
         if self.hook_ds:
             d = self.hook_ds.pop(0)
             d.callback(None)
 
 class MyStorageServer(StorageServer):
-    def add_bucket_counter(self):
-        statefile = os.path.join(self.storedir, "bucket_counter.state")
-        self.bucket_counter = MyBucketCountingCrawler(self, statefile)
-        self.bucket_counter.setServiceParent(self)
+    ShareCountingCrawlerClass = MyShareCountingCrawler
 
 
-class BucketCounter(unittest.TestCase, pollmixin.PollMixin):
+class ShareCounts(unittest.TestCase, pollmixin.PollMixin):
 
     def setUp(self):
         self.s = service.MultiService()
@@ -112,16 +110,25 @@ class BucketCounter(unittest.TestCase, pollmixin.PollMixin):
     def tearDown(self):
         return self.s.stopService()
 
-    def test_bucket_counter(self):
-        basedir = "storage/BucketCounter/bucket_counter"
+    def write_immutable(self, ss, storage_index, sharenums):
+        already, writers = ss.remote_allocate_buckets(
+            storage_index, b"r" * 32, b"c" * 32, sharenums, 10, FakeCanary())
+        for wb in writers.values():
+            wb.remote_write(0, b"0123456789")
+            wb.remote_close()
+
+    def test_share_counts(self):
+        basedir = "storage/ShareCounts/share_counts"
         fileutil.make_dirs(basedir)
+        # this server never shuts down, so it leaves no saved counts behind
+        writer = StorageServer(basedir, b"\x00" * 20)
+        self.write_immutable(writer, b"si1", [0, 1])
+
         ss = StorageServer(basedir, b"\x00" * 20)
-        # to make sure we capture the bucket-counting-crawler in the middle
-        # of a cycle, we reach in and reduce its maximum slice time to 0. We
-        # also make it start sooner than usual.
-        ss.bucket_counter.slow_start = 0
-        orig_cpu_slice = ss.bucket_counter.cpu_slice
-        ss.bucket_counter.cpu_slice = 0
+        # to make sure we capture the recount in the middle, we reach in and
+        # reduce its maximum slice time to 0.
+        crawler = ss.share_counter_crawler
+        crawler.cpu_slice = 0
         ss.setServiceParent(self.s)
 
         w = StorageStatus(ss)
@@ -133,91 +140,67 @@ class BucketCounter(unittest.TestCase, pollmixin.PollMixin):
         self.failUnlessIn(b"Accepting new shares: Yes", s)
         self.failUnlessIn(b"Reserved space: - 0 B (0)", s)
         self.failUnlessIn(b"Total buckets: Not computed yet", s)
-        self.failUnlessIn(b"Next crawl in", s)
-
-        # give the bucket-counting-crawler one tick to get started. The
-        # cpu_slice=0 will force it to yield right after it processes the
-        # first prefix
+        self.failUnlessIn(b"Share counts: not computed yet", s)
 
+        # give the crawler one tick to get started. The cpu_slice=0 will
+        # force it to yield right after it processes the first prefix
         d = fireEventually()
         def _check(ignored):
             # are we really right after the first prefix?
-            state = ss.bucket_counter.get_state()
+            state = crawler.get_state()
             if state["last-complete-prefix"] is None:
                 d2 = fireEventually()
                 d2.addCallback(_check)
                 return d2
             self.failUnlessEqual(state["last-complete-prefix"],
-                                 ss.bucket_counter.prefixes[0])
-            ss.bucket_counter.cpu_slice = 100.0 # finish as fast as possible
+                                 crawler.prefixes[0])
+            crawler.cpu_slice = 100.0 # finish as fast as possible
             html = renderSynchronously(w)
             s = remove_tags(html)
+            self.failUnlessIn(b"Total buckets: Not computed yet", s)
             self.failUnlessIn(b" Current crawl ", s)
             self.failUnlessIn(b" (next work in ", s)
         d.addCallback(_check)
 
-        # now give it enough time to complete a full cycle
-        def _watch():
-            return not ss.bucket_counter.get_progress()["cycle-in-progress"]
-        d.addCallback(lambda ignored: self.poll(_watch))
+        # now give it enough time to finish
+        d.addCallback(lambda ignored: self.poll(ss.share_counter.is_complete))
         def _check2(ignored):
-            ss.bucket_counter.cpu_slice = orig_cpu_slice
             html = renderSynchronously(w)
             s = remove_tags(html)
-            self.failUnlessIn(b"Total buckets: 0 (the number of", s)
-            self.failUnless(b"Next crawl in 59 minutes" in s or "Next crawl in 60 minutes" in s, s)
-        d.addCallback(_check2)
-        return d
-
-    def test_bucket_counter_cleanup(self):
-        basedir = "storage/BucketCounter/bucket_counter_cleanup"
-        fileutil.make_dirs(basedir)
-        ss = StorageServer(basedir, b"\x00" * 20)
-        # to make sure we capture the bucket-counting-crawler in the middle
-        # of a cycle, we reach in and reduce its maximum slice time to 0.
-        ss.bucket_counter.slow_start = 0
-        orig_cpu_slice = ss.bucket_counter.cpu_slice
-        ss.bucket_counter.cpu_slice = 0
-        ss.setServiceParent(self.s)
-
-        d = fireEventually()
-
-        def _after_first_prefix(ignored):
-            state = ss.bucket_counter.state
-            if state["last-complete-prefix"] is None:
-                d2 = fireEventually()
-                d2.addCallback(_after_first_prefix)
-                return d2
-            ss.bucket_counter.cpu_slice = 100.0 # finish as fast as possible
-            # now sneak in and mess with its state, to make sure it cleans up
-            # properly at the end of the cycle
-            self.failUnlessEqual(state["last-complete-prefix"],
-                                 ss.bucket_counter.prefixes[0])
-            state["bucket-counts"][-12] = {}
-            state["storage-index-samples"]["bogusprefix!"] = (-12, [])
-            ss.bucket_counter.save_state()
-        d.addCallback(_after_first_prefix)
-
-        # now give it enough time to complete a cycle
-        def _watch():
-            return not ss.bucket_counter.get_progress()["cycle-in-progress"]
-        d.addCallback(lambda ignored: self.poll(_watch))
-        def _check2(ignored):
-            ss.bucket_counter.cpu_slice = orig_cpu_slice
-            s = ss.bucket_counter.get_state()
-            self.failIf(-12 in s["bucket-counts"], list(s["bucket-counts"].keys()))
-            self.failIf("bogusprefix!" in s["storage-index-samples"],
-                        list(s["storage-index-samples"].keys()))
+            self.failUnlessIn(b"Total buckets: 1 (the number of", s)
+            self.failUnlessIn(b"Immutable: 1 buckets, 2 shares, 20 B of "
+                              b"share data; Mutable: 0 buckets, 0 shares, "
+                              b"0 B of share data", s)
+            self.failUnlessIn(b"Counts are updated as shares are added and "
+                              b"removed", s)
+
+            # from now on, the page shows the live counts
+            self.write_immutable(ss, b"si2", [0])
+            s = remove_tags(renderSynchronously(w))
+            self.failUnlessIn(b"Total buckets: 2 (the number of", s)
+            self.failUnlessIn(b"Immutable: 2 buckets, 3 shares, 30 B", s)
+            return renderJSON(w)
         d.addCallback(_check2)
+        def _check_json(raw):
+            data = json.loads(raw)
+            self.failUnlessEqual(data["share-counts"]["immutable"],
+                                 {"buckets": 2, "shares": 3, "bytes": 30})
+            self.failUnlessEqual(
+                data["stats"]["storage_server.total_bucket_count"], 2)
+            # the old bucket-counter state is still there for clients that
+            # read it
+            self.failUnlessEqual(
+                data["bucket-counter"]["last-complete-bucket-count"], 2)
+        d.addCallback(_check_json)
         return d
 
-    def test_bucket_counter_eta(self):
-        basedir = "storage/BucketCounter/bucket_counter_eta"
+    def test_share_counter_eta(self):
+        basedir = "storage/ShareCounts/share_counter_eta"
         fileutil.make_dirs(basedir)
         ss = MyStorageServer(basedir, b"\x00" * 20)
-        ss.bucket_counter.slow_start = 0
         # these will be fired inside finished_prefix()
-        hooks = ss.bucket_counter.hook_ds = [defer.Deferred() for i in range(3)]
+        hooks = ss.share_counter_crawler.hook_ds = [defer.Deferred()
+                                                    for i in range(3)]
         w = StorageStatus(ss)
 
         d = defer.Deferred()
@@ -249,6 +232,7 @@ class BucketCounter(unittest.TestCase, pollmixin.PollMixin):
         ss.setServiceParent(self.s)
         return d
 
+
 class InstrumentedLeaseCheckingCrawler(LeaseCheckingCrawler):
     stop_after_first_bucket = False
     def process_bucket(self, *args, **kwargs):
@@ -275,6 +259,23 @@ class No_ST_BLOCKS_LeaseCheckingCrawler(LeaseCheckingCrawler):
             setattr(bsr, attrname, getattr(s, attrname))
         return bsr
 
+class ThreadRecordingLeaseCheckingCrawler(LeaseCheckingCrawler):
+    def process_bucket(self, *args, **kwargs):
+        self.threads.add(threading.current_thread())
+        LeaseCheckingCrawler.process_bucket(self, *args, **kwargs)
+
+class FailingLeaseCheckingCrawler(LeaseCheckingCrawler):
+    failing_bucket = None
+    def process_bucket(self, cycle, prefix, prefixdir, bucket):
+        if bucket == self.failing_bucket:
+            raise ValueError("oops")
+        LeaseCheckingCrawler.process_bucket(self, cycle, prefix, prefixdir,
+                                            bucket)
+    def finished_cycle(self, cycle):
+        LeaseCheckingCrawler.finished_cycle(self, cycle)
+        # this test logs an error, which poll() would stop at
+        self.cycle_finished.callback(cycle)
+
 class InstrumentedStorageServer(StorageServer):
     LeaseCheckerClass = InstrumentedLeaseCheckingCrawler
 class No_ST_BLOCKS_StorageServer(StorageServer):
@@ -653,6 +654,147 @@ class LeaseCrawler(unittest.TestCase, pollmixin.PollMixin):
         d.addCallback(_check_html)
         return d
 
+    def test_expire_age_in_threads(self):
+        basedir = "storage/LeaseCrawler/expire_age_in_threads"
+        fileutil.make_dirs(basedir)
+        class ThreadedStorageServer(StorageServer):
+            LeaseCheckerClass = ThreadRecordingLeaseCheckingCrawler
+        ss = ThreadedStorageServer(basedir, b"\x00" * 20,
+                                   expiration_enabled=True,
+                                   expiration_mode="age",
+                                   expiration_override_lease_duration=2000,
+                                   lease_checker_threads=2)
+        lc = ss.lease_checker
+        lc.slow_start = 0
+        lc.threads = set()
+        self.make_shares(ss)
+        [immutable_si_0, immutable_si_1, mutable_si_2, mutable_si_3] = self.sis
+
+        def _get_sharefile(si):
+            return list(ss._iter_share_files(si))[0]
+        def count_shares(si):
+            return len(list(ss._iter_share_files(si)))
+        def count_leases(si):
+            return len(list(_get_sharefile(si).get_leases()))
+
+        # expire the first lease on each share, as in test_expire_age
+        now = time.time()
+        sf0 = _get_sharefile(immutable_si_0)
+        self.backdate_lease(sf0, self.renew_secrets[0], now - 1000)
+        sf1 = _get_sharefile(immutable_si_1)
+        self.backdate_lease(sf1, self.renew_secrets[1], now - 1000)
+        sf2 = _get_sharefile(mutable_si_2)
+        self.backdate_lease(sf2, self.renew_secrets[3], now - 1000)
+        sf3 = _get_sharefile(mutable_si_3)
+        self.backdate_lease(sf3, self.renew_secrets[4], now - 1000)
+        size = os.stat(sf0.home).st_size + os.stat(sf2.home).st_size
+
+        ss.setServiceParent(self.s)
+
+        def _wait():
+            return bool(lc.get_state()["last-cycle-finished"] is not None)
+        d = self.poll(_wait)
+        def _after_first_cycle(ignored):
+            self.failUnless(lc.threads)
+            self.failIf(threading.current_thread() in lc.threads)
+
+            self.failUnlessEqual(count_shares(immutable_si_0), 0)
+            self.failUnlessEqual(count_shares(immutable_si_1), 1)
+            self.failUnlessEqual(count_leases(immutable_si_1), 1)
+            self.failUnlessEqual(count_shares(mutable_si_2), 0)
+            self.failUnlessEqual(count_shares(mutable_si_3), 1)
+            self.failUnlessEqual(count_leases(mutable_si_3), 1)
+
+            last = lc.get_state()["history"][0]
+            self.failUnlessEqual(last["leases-per-share-histogram"],
+                                 {1: 2, 2: 2})
+            rec = last["space-recovered"]
+            self.failUnlessEqual(rec["examined-buckets"], 4)
+            self.failUnlessEqual(rec["examined-shares"], 4)
+            self.failUnlessEqual(rec["actual-buckets"], 2)
+            self.failUnlessEqual(rec["actual-shares"], 2)
+            self.failUnlessEqual(rec["actual-sharebytes"], size)
+        d.addCallback(_after_first_cycle)
+        return d
+
+    def test_renewed_before_cancel(self):
+        # A bucket processed in a worker thread has its expired leases
+        # cancelled later, in the reactor. A lease renewed in between is
+        # kept.
+        basedir = "storage/LeaseCrawler/renewed_before_cancel"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, b"\x00" * 20,
+                           expiration_enabled=True,
+                           expiration_mode="age",
+                           expiration_override_lease_duration=2000)
+        lc = ss.lease_checker
+        self.make_shares(ss)
+        [immutable_si_0, immutable_si_1, mutable_si_2, mutable_si_3] = self.sis
+        def count_leases(si):
+            return sum(len(list(sf.get_leases()))
+                       for sf in ss._iter_share_files(si))
+
+        now = time.time()
+        for (si, renew_secret) in [(immutable_si_0, self.renew_secrets[0]),
+                                   (immutable_si_1, self.renew_secrets[1])]:
+            [sf] = ss._iter_share_files(si)
+            self.backdate_lease(sf, renew_secret, now - 1000)
+
+        cycle = lc._start_cycle()
+        calls = []
+        for si in (immutable_si_0, immutable_si_1):
+            bucket = si_b2a(si).decode("ascii")
+            prefixdir = os.path.join(ss.sharedir, bucket[:2])
+            calls.append(lc._process_bucket_in_thread(cycle, bucket[:2],
+                                                      prefixdir, bucket))
+        # nothing has been cancelled yet
+        self.failUnlessEqual(count_leases(immutable_si_0), 1)
+        self.failUnlessEqual(count_leases(immutable_si_1), 2)
+
+        ss.remote_renew_lease(immutable_si_0, self.renew_secrets[0])
+        for bucket_calls in calls:
+            for (f, args, kwargs) in bucket_calls:
+                f(*args, **kwargs)
+        # the renewed lease was kept, and the other one cancelled
+        self.failUnlessEqual(count_leases(immutable_si_0), 1)
+        self.failUnlessEqual(count_leases(immutable_si_1), 1)
+
+    def test_bucket_error_in_threads(self):
+        # an error in one bucket does not stop the crawl, or the rest of
+        # its batch
+        basedir = "storage/LeaseCrawler/bucket_error_in_threads"
+        fileutil.make_dirs(basedir)
+        class FailingStorageServer(StorageServer):
+            LeaseCheckerClass = FailingLeaseCheckingCrawler
+        ss = FailingStorageServer(basedir, b"\x00" * 20,
+                                  expiration_enabled=True,
+                                  expiration_mode="age",
+                                  expiration_override_lease_duration=2000,
+                                  lease_checker_threads=4)
+        lc = ss.lease_checker
+        lc.slow_start = 0
+        self.make_shares(ss)
+        [immutable_si_0, immutable_si_1, mutable_si_2, mutable_si_3] = self.sis
+        lc.failing_bucket = si_b2a(immutable_si_1).decode("ascii")
+        now = time.time()
+        for (si, renew_secret) in [(immutable_si_0, self.renew_secrets[0]),
+                                   (immutable_si_1, self.renew_secrets[1])]:
+            [sf] = ss._iter_share_files(si)
+            self.backdate_lease(sf, renew_secret, now - 1000)
+
+        d = lc.cycle_finished = defer.Deferred()
+        ss.setServiceParent(self.s)
+        def _after_first_cycle(ignored):
+            self.failUnlessEqual(len(self.flushLoggedErrors(ValueError)), 1)
+            self.failUnlessEqual(len(list(ss._iter_share_files(
+                immutable_si_0))), 0)
+            [sf] = ss._iter_share_files(immutable_si_1)
+            self.failUnlessEqual(len(list(sf.get_leases())), 2)
+            rec = lc.get_state()["history"][0]["space-recovered"]
+            self.failUnlessEqual(rec["examined-buckets"], 3)
+        d.addCallback(_after_first_cycle)
+        return d
+
     def test_expire_cutoff_date(self):
         basedir = "storage/LeaseCrawler/expire_cutoff_date"
         fileutil.make_dirs(basedir)
@@ -1196,6 +1338,7 @@ class WebStatus(unittest.TestCase, pollmixin.PollMixin):
             self.failUnlessIn(b"Server Nodeid: %s"  % base32.b2a(nodeid), s)
             self.failUnlessIn(b"Accepting new shares: Yes", s)
             self.failUnlessIn(b"Reserved space: - 0 B (0)", s)
+            self.failUnlessIn(b"No shares have been reported as corrupt.", s)
         d.addCallback(_check_html)
         d.addCallback(lambda ign: renderJSON(w))
         def _check_json(raw):
@@ -1203,11 +1346,35 @@ class WebStatus(unittest.TestCase, pollmixin.PollMixin):
             s = data["stats"]
             self.failUnlessEqual(s["storage_server.accepting_immutable_shares"], 1)
             self.failUnlessEqual(s["storage_server.reserved_space"], 0)
+            self.failUnlessIn("share-counts", data)
             self.failUnlessIn("bucket-counter", data)
             self.failUnlessIn("lease-checker", data)
         d.addCallback(_check_json)
         return d
 
+    def test_corrupt_shares(self):
+        basedir = "storage/WebStatus/corrupt_shares"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, b"\x00" * 20,
+                           corruption_quarantine_threshold=1)
+        ss.setServiceParent(self.s)
+        ss.remote_advise_corrupt_share(b"mutable", b"si1", 3,
+                                       b"signature does not verify")
+        w = StorageStatus(ss)
+        html = renderSynchronously(w)
+        s = remove_tags(html)
+        self.failUnlessIn(b"Corrupt Shares", s)
+        self.failUnlessIn(base32.b2a(b"si1"), s)
+        self.failUnlessIn(b"client: 1", s)
+        self.failUnlessIn(b"signature does not verify", s)
+        self.failIfIn(b"No shares have been reported", s)
+        data = json.loads(renderJSON(w))
+        [share] = data["corrupt-shares"]
+        self.failUnlessEqual(share["shnum"], 3)
+        self.failUnlessEqual(share["sharetype"], "mutable")
+        self.failUnlessEqual(share["reports"]["client"]["count"], 1)
+        self.failIfEqual(share["quarantined"], None)
+
 
     def test_status_no_disk_stats(self):
         def call_get_disk_stats(whichdir, reserved_space=0):
@@ -1289,6 +1456,23 @@ class WebStatus(unittest.TestCase, pollmixin.PollMixin):
         self.failUnlessIn(b"Space Available to Tahoe: 2.00 GB", s)
         self.failUnlessEqual(ss.get_available_space(), 2*GB)
 
+    def test_status_space_accounting(self):
+        basedir = "storage/WebStatus/status_space_accounting"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, b"\x00" * 20)
+        ss.setServiceParent(self.s)
+        w = StorageStatus(ss)
+        s = remove_tags(renderSynchronously(w))
+        self.failUnlessIn(b"Space allocated to uploads in progress: 0 B", s)
+        self.failUnlessIn(b"Free space for new shares not yet checked", s)
+
+        already, writers = ss.remote_allocate_buckets(
+            b"si1", b"r" * 32, b"c" * 32, [0, 1], 1000, FakeCanary())
+        ss.remote_get_version()
+        s = remove_tags(renderSynchronously(w))
+        self.failUnlessIn(b"Space allocated to uploads in progress: 2.00 kB", s)
+        self.failUnlessIn(b"1 checks of the disk, 1 answered from memory", s)
+
     def test_readonly(self):
         basedir = "storage/WebStatus/readonly"
         fileutil.make_dirs(basedir)
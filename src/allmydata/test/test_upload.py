@@ -26,6 +26,8 @@ from allmydata.immutable import upload, encode
 from allmydata.interfaces import FileTooLargeError, UploadUnhappinessError
 from allmydata.util import log, base32
 from allmydata.util.assertutil import precondition
+from allmydata.util.hashutil import convergence_hash
+from allmydata.util.consumer import download_to_data
 from allmydata.util.deferredutil import DeferredListShouldSucceed
 from allmydata.test.no_network import GridTestMixin
 from allmydata.test.common_py3 import ShouldFailMixin
@@ -99,6 +101,61 @@ class Uploadable(unittest.TestCase):
         d.addCallback(lambda res: u.close())
         return d
 
+    @defer.inlineCallbacks
+    def _get_convergent_key(self, u):
+        # a multiple of k, so it is used as-is for large files
+        u.set_default_encoding_parameters({"k": 3, "happy": 7, "n": 10,
+                                           "max_segment_size": 126*1024})
+        key = yield u.get_encryption_key()
+        # the key is computed before anything is read, so must leave the
+        # file where it found it
+        data = yield u.read(10)
+        self.shouldEqual(data, b"a"*10)
+        defer.returnValue(key)
+
+    @defer.inlineCallbacks
+    def test_convergent_key(self):
+        convergence = b"some convergence string"
+        data = b"a"*(2*MiB + 41)
+        expected = convergence_hash(3, 10, 126*1024, data, convergence)
+
+        # read in-line, read in a thread, and mapped in a thread
+        u = upload.Data(data, convergence)
+        u.THREADED_HASH_SIZE = 4*MiB
+        key = yield self._get_convergent_key(u)
+        self.failUnlessEqual(key, expected)
+        u = upload.Data(data, convergence)
+        key = yield self._get_convergent_key(u)
+        self.failUnlessEqual(key, expected)
+        fn = self.mktemp()
+        with open(fn, "wb") as f:
+            f.write(data)
+        u = upload.FileName(fn, convergence)
+        key = yield self._get_convergent_key(u)
+        u.close()
+        self.failUnlessEqual(key, expected)
+        self.failUnlessEqual(u.get_known_keys(), {(3, 10, 126*1024): expected})
+
+    @defer.inlineCallbacks
+    def test_known_keys(self):
+        convergence = b"some convergence string"
+        u = upload.Data(b"a"*41, convergence)
+        key = yield self._get_convergent_key(u)
+        known_keys = u.get_known_keys()
+
+        # a caller that vouches for unchanged contents skips the hashing,
+        # so it gets the old key even though these contents differ
+        u = upload.FileHandle(BytesIO(b"a"*40 + b"b"), convergence,
+                              known_keys=known_keys)
+        key2 = yield self._get_convergent_key(u)
+        self.failUnlessEqual(key2, key)
+
+        # but not when the encoding parameters differ
+        u = upload.FileHandle(BytesIO(b"a"*40 + b"b"), convergence,
+                              known_keys={(3, 10, 63*1024): key})
+        key3 = yield self._get_convergent_key(u)
+        self.failIfEqual(key3, key)
+
 class ServerError(Exception):
     pass
 
@@ -2029,6 +2086,121 @@ class EncodingParameters(GridTestMixin, unittest.TestCase, SetDEPMixin,
         f.close()
         return None
 
+
+class BulkShareQueryServer(object):
+    """
+    I am a storage server which answers get_share_numbers() only when told
+    to, so a test can see which questions were asked together.
+    """
+    def __init__(self, bulk=True):
+        self.calls = []
+        v1 = {b"maximum-immutable-share-size": 2**32 - 1}
+        if bulk:
+            v1[b"supports-bulk-share-query"] = True
+        self.version = {b"http://allmydata.org/tahoe/protocols/storage/v1": v1}
+
+    def get_version(self):
+        return self.version
+    def get_storage_server(self):
+        return self
+
+    def get_share_numbers(self, storage_indexes):
+        d = defer.Deferred()
+        self.calls.append((storage_indexes, d))
+        return d
+
+    def get_buckets(self, storage_index):
+        self.calls.append(([storage_index], None))
+        return defer.succeed({0: None, 3: None})
+
+
+class ShareQueryBatcher(unittest.TestCase):
+    @defer.inlineCallbacks
+    def test_batches(self):
+        batcher = upload.ShareQueryBatcher()
+        server = BulkShareQueryServer()
+        d0 = batcher.ask(server, b"si0")
+        d1 = batcher.ask(server, b"si1")
+        # the questions asked in the same turn go together
+        yield fireEventually()
+        self.failUnlessEqual([sis for (sis, d) in server.calls],
+                             [[b"si0", b"si1"]])
+        # and those asked while that call is outstanding wait for it
+        d2 = batcher.ask(server, b"si2")
+        d3 = batcher.ask(server, b"si3")
+        yield fireEventually()
+        self.failUnlessEqual(len(server.calls), 1)
+        server.calls[0][1].callback([{1}, set()])
+        self.failUnlessEqual((yield d0), {1})
+        self.failUnlessEqual((yield d1), set())
+        self.failUnlessEqual([sis for (sis, d) in server.calls[1:]],
+                             [[b"si2", b"si3"]])
+        # a failed call fails every question in it
+        server.calls[1][1].errback(ServerError())
+        yield self.assertFailure(d2, ServerError)
+        yield self.assertFailure(d3, ServerError)
+        # after which the next question gets a call of its own
+        d4 = batcher.ask(server, b"si4")
+        yield fireEventually()
+        self.failUnlessEqual([sis for (sis, d) in server.calls[2:]],
+                             [[b"si4"]])
+        server.calls[2][1].callback([{2}])
+        self.failUnlessEqual((yield d4), {2})
+
+    @defer.inlineCallbacks
+    def test_old_server(self):
+        batcher = upload.ShareQueryBatcher()
+        server = BulkShareQueryServer(bulk=False)
+        shnums = yield batcher.ask(server, b"si0")
+        self.failUnlessEqual(shnums, {0, 3})
+        self.failUnlessEqual(server.calls, [([b"si0"], None)])
+
+
+class FailingUploadable(upload.Data):
+    def get_size(self):
+        return defer.fail(ServerError())
+
+
+class UploadMany(GridTestMixin, unittest.TestCase):
+    @defer.inlineCallbacks
+    def test_upload_many(self):
+        self.basedir = "upload/UploadMany/test_upload_many"
+        self.set_up_grid()
+        client = self.g.clients[0]
+        uploader = client.getServiceNamed("uploader")
+        uploader.BATCH_CONCURRENCY = 8
+        datas = [b"%d" % i * 1000 for i in range(20)] + [b"small"]
+        uploadables = [upload.Data(data, convergence=b"") for data in datas]
+        uploadables.insert(5, FailingUploadable(b"", convergence=b""))
+
+        results = yield uploader.upload_many(uploadables)
+
+        self.failUnlessEqual(len(results), 22)
+        (success, f) = results.pop(5)
+        self.failIf(success)
+        f.trap(ServerError)
+        wrappers = list(self.g.wrappers_by_id.values())
+        # every server was asked about every file, but in far fewer calls,
+        # and without any get_buckets()
+        calls = sum(w.counter_by_methname.get("get_share_numbers", 0)
+                    for w in wrappers)
+        self.failUnless(0 < calls < 10 * 20 // 2, calls)
+        self.failIf(any(w.counter_by_methname.get("get_buckets")
+                        for w in wrappers))
+        for (data, (success, results)) in zip(datas, results):
+            self.failUnless(success, results)
+            node = client.create_node_from_uri(results.get_uri())
+            downloaded = yield download_to_data(node)
+            self.failUnlessEqual(downloaded, data)
+
+        batches = set(s.get_batch() for s in
+                      client.get_history().list_all_upload_statuses())
+        self.failUnlessEqual(len(batches), 1)
+        batch = batches.pop()
+        self.failUnlessEqual(batch.get_count(), 22)
+        self.failUnlessEqual(batch.get_finished(), 22)
+        self.failUnless(batch.get_files_per_second() > 0)
+
 # TODO:
 #  upload with exactly 75 servers (shares_of_happiness)
 #  have a download fail
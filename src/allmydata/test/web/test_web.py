@@ -218,13 +218,16 @@ class FakeDisplayableServer(StubServer):
         return ConnectionStatus(self.connected, "summary", {},
                                 self.last_connect_time, self.last_rx_time)
 
-class FakeBucketCounter(object):
-    def get_state(self):
-        return {"last-complete-bucket-count": 0}
-    def get_progress(self):
-        return {"estimated-time-per-cycle": 0,
-                "cycle-in-progress": False,
-                "remaining-wait-time": 0}
+class FakeShareCounter(object):
+    def get_total_bucket_count(self):
+        return 0
+    def get_counts(self):
+        return {"immutable": {"buckets": 0, "shares": 0, "bytes": 0},
+                "mutable": {"buckets": 0, "shares": 0, "bytes": 0}}
+
+class FakeCorruptionRegistry(object):
+    def get_shares(self):
+        return []
 
 class FakeLeaseChecker(object):
     def __init__(self):
@@ -245,7 +248,9 @@ class FakeStorageServer(service.MultiService):
         service.MultiService.__init__(self)
         self.my_nodeid = nodeid
         self.nickname = nickname
-        self.bucket_counter = FakeBucketCounter()
+        self.share_counter = FakeShareCounter()
+        self.share_counter_crawler = None
+        self.corruption_registry = FakeCorruptionRegistry()
         self.lease_checker = FakeLeaseChecker()
     def get_stats(self):
         return {"storage_server.accepting_immutable_shares": False}
@@ -45,13 +45,24 @@ PORTED_MODULES = [
     "allmydata.introducer.interfaces",
     "allmydata.monitor",
     "allmydata.storage.common",
+    "allmydata.storage.corruption",
     "allmydata.storage.crawler",
+    "allmydata.storage.diskio",
+    "allmydata.storage.durability",
     "allmydata.storage.expirer",
+    "allmydata.storage.fdcache",
     "allmydata.storage.immutable",
     "allmydata.storage.lease",
+    "allmydata.storage.leasedb",
+    "allmydata.storage.mmapcache",
     "allmydata.storage.mutable",
+    "allmydata.storage.packed",
+    "allmydata.storage.scheduler",
     "allmydata.storage.server",
+    "allmydata.storage.sharecounter",
+    "allmydata.storage.shareindex",
     "allmydata.storage.shares",
+    "allmydata.storage.space",
     "allmydata.test.common_py3",
     "allmydata.test.no_network",
     "allmydata.uri",
@@ -60,6 +71,7 @@ PORTED_MODULES = [
     "allmydata.util.assertutil",
     "allmydata.util.base32",
     "allmydata.util.base62",
+    "allmydata.util.bipartite",
     "allmydata.util.configutil",
     "allmydata.util.connection_status",
     "allmydata.util.deferredutil",
@@ -0,0 +1,174 @@
+"""
+Maximum matchings in bipartite graphs.
+
+Servers-of-happiness is the size of a maximum matching between servers and
+shares, with an edge wherever a server holds (or is to hold) a share. Both
+allmydata.util.happinessutil and allmydata.immutable.happiness_upload use
+the BipartiteMatching here to find one.
+
+Ported to Python 3.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    # We omit dict, just in case newdict breaks things.
+    from builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, list, object, range, str, max, min  # noqa: F401
+
+from collections import deque
+
+
+class BipartiteMatching(object):
+    """
+    I am a maximum matching in a bipartite graph, found with the
+    Hopcroft-Karp algorithm in O(E * sqrt(V)) time. I stay maximum as
+    vertices and edges are removed from the graph, by searching for one
+    augmenting path from whatever they leave unmatched, rather than
+    starting again.
+
+    I am given 'adjacency', a dict mapping each vertex on the left to an
+    iterable of the vertices on the right that it has an edge to. Left
+    vertices are matched in the order the dict gives them, and each to the
+    first right vertex it can be, so the same input always gives the same
+    matching.
+    """
+
+    def __init__(self, adjacency):
+        self._order = [] # left vertices, in the order we were given them
+        self._rights = {} # left -> [right]
+        self._lefts = {} # right -> [left]
+        for left, rights in adjacency.items():
+            self._order.append(left)
+            self._rights[left] = []
+            for right in rights:
+                if right not in self._lefts:
+                    self._lefts[right] = []
+                self._rights[left].append(right)
+                self._lefts[right].append(left)
+        self._left_to_right = {}
+        self._right_to_left = {}
+        self._match_all()
+
+    def __len__(self):
+        return len(self._left_to_right)
+
+    def get_matching(self):
+        """
+        I return a dict mapping each matched left vertex to the right
+        vertex it is matched with.
+        """
+        return dict(self._left_to_right)
+
+    def remove_left(self, left):
+        """
+        Remove 'left' and all of its edges from the graph, and re-match
+        whatever it was matched with if that can be done without making
+        the matching smaller.
+        """
+        for right in self._rights.pop(left):
+            self._lefts[right].remove(left)
+        self._order.remove(left)
+        right = self._left_to_right.pop(left, None)
+        if right is not None:
+            del self._right_to_left[right]
+            self._augment_to(right, set())
+
+    def remove_edge(self, left, right):
+        """
+        Remove the edge between 'left' and 'right' from the graph. If it was
+        in the matching, look for another way to match one of them.
+        """
+        self._rights[left].remove(right)
+        self._lefts[right].remove(left)
+        if self._left_to_right.get(left) == right:
+            del self._left_to_right[left]
+            del self._right_to_left[right]
+            # The matching was maximum before, so any augmenting path now
+            # must end at one of the two vertices we just freed, and one
+            # path puts us back where we were.
+            if not self._augment_from(left, set()):
+                self._augment_to(right, set())
+
+    def _match_all(self):
+        # Each phase finds a maximal set of vertex-disjoint shortest
+        # augmenting paths. There are at most O(sqrt(V)) phases.
+        while True:
+            layers = self._layers()
+            if layers is None:
+                return
+            for left in self._order:
+                if left not in self._left_to_right:
+                    self._augment_along(left, layers)
+
+    def _layers(self):
+        """
+        Breadth-first search from every unmatched left vertex, alternating
+        between unmatched and matched edges. I return a dict mapping each
+        left vertex reached to its distance, counted in left vertices, or
+        None if no unmatched right vertex can be reached.
+        """
+        layers = {}
+        queue = deque()
+        for left in self._order:
+            if left not in self._left_to_right:
+                layers[left] = 0
+                queue.append(left)
+        shortest = None
+        while queue:
+            left = queue.popleft()
+            if shortest is not None and layers[left] >= shortest:
+                continue
+            for right in self._rights[left]:
+                mate = self._right_to_left.get(right)
+                if mate is None:
+                    if shortest is None:
+                        shortest = layers[left] + 1
+                elif mate not in layers:
+                    layers[mate] = layers[left] + 1
+                    queue.append(mate)
+        if shortest is None:
+            return None
+        return layers
+
+    def _augment_along(self, left, layers):
+        # depth-first search for a shortest augmenting path from 'left',
+        # following only edges into the next layer
+        for right in self._rights[left]:
+            mate = self._right_to_left.get(right)
+            if mate is None or (layers.get(mate) == layers[left] + 1 and
+                                self._augment_along(mate, layers)):
+                self._left_to_right[left] = right
+                self._right_to_left[right] = left
+                return True
+        # no path from here in this phase, so don't try again
+        layers[left] = None
+        return False
+
+    def _augment_from(self, left, seen):
+        # depth-first search for any augmenting path from unmatched 'left'
+        for right in self._rights[left]:
+            if right in seen:
+                continue
+            seen.add(right)
+            mate = self._right_to_left.get(right)
+            if mate is None or self._augment_from(mate, seen):
+                self._left_to_right[left] = right
+                self._right_to_left[right] = left
+                return True
+        return False
+
+    def _augment_to(self, right, seen):
+        # depth-first search for any augmenting path to unmatched 'right'
+        for left in self._lefts[right]:
+            if left in seen:
+                continue
+            seen.add(left)
+            mate = self._left_to_right.get(left)
+            if mate is None or self._augment_to(mate, seen):
+                self._left_to_right[left] = right
+                self._right_to_left[right] = left
+                return True
+        return False
@@ -13,6 +13,8 @@ from future.utils import PY2
 if PY2:
     from builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
 
+import time
+
 from twisted.internet import defer
 from twisted.python.failure import Failure
 from twisted.python import log
@@ -147,3 +149,60 @@ class Pipeline(object):
     def _eat_pipeline_errors(self, f):
         f.trap(PipelineError)
         return None
+
+
+class AdaptivePipeline(Pipeline):
+    """I am a Pipeline whose capacity follows the bandwidth-delay product of
+    the connection my operations travel over: the rate at which they are
+    completed, times the shortest time any of them took, doubled to leave
+    room for the rate to grow. My capacity stays between min_capacity and
+    max_capacity."""
+
+    # how much each new sample of the completion rate counts for
+    RATE_WEIGHT = 0.25
+
+    def __init__(self, min_capacity, max_capacity, clock=None):
+        precondition(min_capacity <= max_capacity, min_capacity, max_capacity)
+        Pipeline.__init__(self, min_capacity)
+        self.min_capacity = min_capacity
+        self.max_capacity = max_capacity
+        if clock is None:
+            self._now = time.time
+        else:
+            self._now = clock.seconds
+        self.min_rtt = None
+        self.rate = None # bytes per second
+        self._last_completed = None
+
+    def add(self, _size, _func, *args, **kwargs):
+        sent = self._now()
+        if not self.gauge:
+            # nothing was outstanding, so the time since the last operation
+            # completed says nothing about the rate
+            self._last_completed = sent
+        def _call():
+            d = defer.maybeDeferred(_func, *args, **kwargs)
+            d.addCallback(self._completed, _size, sent)
+            return d
+        return Pipeline.add(self, _size, _call)
+
+    def _completed(self, res, size, sent):
+        now = self._now()
+        rtt = now - sent
+        if self.min_rtt is None or rtt < self.min_rtt:
+            self.min_rtt = rtt
+        interval = now - self._last_completed
+        self._last_completed = now
+        if size and interval > 0:
+            sample = size / interval
+            if self.rate is None:
+                self.rate = sample
+            else:
+                self.rate += self.RATE_WEIGHT * (sample - self.rate)
+        if self.rate is not None:
+            # Pipeline._call_finished wakes waiting callers if this has made
+            # room for them
+            self.capacity = int(min(self.max_capacity,
+                                    max(self.min_capacity,
+                                        2 * self.rate * self.min_rtt)))
+        return res
@@ -291,3 +291,144 @@ def binomial_coeff(n, k):
         accum = accum * (n - k + i) // i;
 
     return int(accum + 0.5)
+
+
+class Histogram(object):
+    """
+    A log-bucketed histogram of non-negative values (HDR-style), for
+    latencies and other quantities whose percentiles matter over long
+    periods.
+
+    Each power of two is divided into ``SUB_BUCKETS`` equal buckets, so any
+    percentile is reported to within ``1/SUB_BUCKETS`` of the true value,
+    however many values were recorded. Recording a value is O(1), and the
+    space used grows only with the range of the values, not their number.
+    Histograms of the same quantity from different places (or different
+    nodes) can be combined with ``merge``, which is how a stats gatherer
+    computes percentiles over a whole grid.
+
+    The count, sum, minimum and maximum are exact.
+    """
+
+    SUB_BUCKETS = 32
+
+    def __init__(self):
+        self._buckets = {} # bucket index -> count
+        self.zeros = 0 # values of zero (or less), which have no bucket
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _bucket(self, value):
+        (mantissa, exponent) = math.frexp(value)
+        # 0.5 <= mantissa < 1
+        return (exponent * self.SUB_BUCKETS
+                + int((mantissa - 0.5) * 2 * self.SUB_BUCKETS))
+
+    def _bucket_bounds(self, index):
+        (exponent, sub) = divmod(index, self.SUB_BUCKETS)
+        low = math.ldexp(0.5 + sub / (2 * self.SUB_BUCKETS), exponent)
+        high = math.ldexp(0.5 + (sub + 1) / (2 * self.SUB_BUCKETS), exponent)
+        return (low, high)
+
+    def record(self, value):
+        if value <= 0:
+            value = 0
+            self.zeros += 1
+        else:
+            index = self._bucket(value)
+            self._buckets[index] = self._buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Add the values recorded in another Histogram to mine."""
+        for (index, n) in other._buckets.items():
+            self._buckets[index] = self._buckets.get(index, 0) + n
+        self.zeros += other.zeros
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                if self.min is None or value < self.min:
+                    self.min = value
+                if self.max is None or value > self.max:
+                    self.max = value
+
+    def snapshot(self):
+        """Return a copy of me, which later records will not change."""
+        h = Histogram()
+        h.merge(self)
+        return h
+
+    def get_mean(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def get_percentile(self, fraction):
+        """Return the value below which ``fraction`` of the recorded values
+        fall, or None if nothing has been recorded. Like the ``int(fraction
+        * count)``-th smallest value, this is the middle of the bucket that
+        value fell in, limited to the smallest and largest values seen."""
+        if not self.count:
+            return None
+        rank = int(fraction * self.count)
+        seen = self.zeros
+        if seen > rank:
+            return 0
+        for index in sorted(self._buckets):
+            seen += self._buckets[index]
+            if seen > rank:
+                (low, high) = self._bucket_bounds(index)
+                return min(max((low + high) / 2, self.min), self.max)
+        return self.max
+
+    # the percentiles reported by summarize()
+    PERCENTILES = [(0.01, "01_0_percentile"), (0.10, "10_0_percentile"),
+                   (0.50, "50_0_percentile"), (0.90, "90_0_percentile"),
+                   (0.95, "95_0_percentile"), (0.99, "99_0_percentile"),
+                   (0.999, "99_9_percentile")]
+
+    def summarize(self):
+        """Return a dict with the count, mean, and the usual percentiles."""
+        summary = {"count": self.count, "mean": self.get_mean()}
+        for (fraction, name) in self.PERCENTILES:
+            summary[name] = self.get_percentile(fraction)
+        return summary
+
+    def to_stats(self, prefix):
+        """Return my contents as a flat dict of numbers, with keys starting
+        with ``prefix``, as reported through the stats provider. The result
+        can be turned back into a Histogram with ``from_stats``."""
+        stats = {prefix + ".count": self.count,
+                 prefix + ".sum": self.total,
+                 prefix + ".zeros": self.zeros,
+                 }
+        if self.count:
+            stats[prefix + ".min"] = self.min
+            stats[prefix + ".max"] = self.max
+        for (index, n) in self._buckets.items():
+            stats["%s.bucket.%d" % (prefix, index)] = n
+        return stats
+
+    @classmethod
+    def from_stats(cls, stats, prefix):
+        """Rebuild a Histogram from the output of ``to_stats``. Keys not
+        starting with ``prefix`` are ignored."""
+        h = cls()
+        bucket_prefix = prefix + ".bucket."
+        for (key, value) in stats.items():
+            if key.startswith(bucket_prefix):
+                h._buckets[int(key[len(bucket_prefix):])] = value
+        h.count = stats.get(prefix + ".count", 0)
+        h.total = stats.get(prefix + ".sum", 0)
+        h.zeros = stats.get(prefix + ".zeros", 0)
+        h.min = stats.get(prefix + ".min")
+        h.max = stats.get(prefix + ".max")
+        return h
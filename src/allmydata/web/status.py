@@ -134,6 +134,21 @@ class UploadResultsRendererMixin(Element):
     def time_hashes_and_close(self, req, tag):
         return tag(self._get_time("hashes_and_close"))
 
+    @renderer
+    def server_stalls(self, req, tag):
+        d = self.upload_results()
+        d.addCallback(lambda res: res.get_timings().get("stalls_per_server"))
+        def _render(per_server):
+            if not per_server:
+                return ""
+            ul = tags.ul()
+            for server in sorted(per_server.keys(), key=lambda s: s.get_name()):
+                ul(tags.li("[%s]: %s" % (server.get_name(),
+                                         abbreviate_time(per_server[server]))))
+            return tags.li("Per-Server Pipeline Stalls: ", ul)
+        d.addCallback(_render)
+        return d
+
     def _get_rate(self, name):
         d = self.upload_results()
         def _convert(r):
@@ -267,6 +282,15 @@ class UploadStatusElement(UploadResultsRendererMixin):
     def status(self, req, tag):
         return tag(self._upload_status.get_status())
 
+    @renderer
+    def batch(self, req, tag):
+        batch = self._upload_status.get_batch()
+        if batch is None:
+            return ""
+        return tags.li("Batch: %d of %d files uploaded (%.1f files/s)"
+                       % (batch.get_finished(), batch.get_count(),
+                          batch.get_files_per_second()))
+
 
 def _find_overlap(events, start_key, end_key):
     """
@@ -112,17 +112,72 @@ class StorageStatusElement(Element):
         accepting = self._get_storage_stat("storage_server.accepting_immutable_shares")
         return tag({True: "Yes", False: "No"}[bool(accepting)])
 
+    @renderer
+    def allocated_space(self, req, tag):
+        allocated = self._get_storage_stat("storage_server.allocated")
+        return tag(self.render_abbrev_space(allocated))
+
+    @renderer
+    def space_checks(self, req, tag):
+        calls = self._get_storage_stat("storage_server.space.disk_stats_calls")
+        hits = self._get_storage_stat("storage_server.space.cache_hits")
+        age = self._get_storage_stat("storage_server.space.age")
+        if age is None:
+            checked = "not yet checked"
+        else:
+            checked = "last checked %s ago" % abbreviate_time(age)
+        return tag("%s; %d checks of the disk, %d answered from memory" %
+                   (checked, calls or 0, hits or 0))
+
     @renderer
     def last_complete_bucket_count(self, req, tag):
-        s = self._storage.bucket_counter.get_state()
-        count = s.get("last-complete-bucket-count")
+        count = self._storage.share_counter.get_total_bucket_count()
         if count is None:
             return tag("Not computed yet")
         return tag(str(count))
 
+    @renderer
+    def share_counts(self, req, tag):
+        counts = self._storage.share_counter.get_counts()
+        if counts is None:
+            return tag("Share counts: not computed yet")
+        return tag("; ".join("%s: %d buckets, %d shares, %s of share data" %
+                             (sharetype.capitalize(), c["buckets"],
+                              c["shares"], abbreviate_space(c["bytes"]))
+                             for (sharetype, c) in sorted(counts.items())))
+
+    @renderer
+    def corrupt_shares(self, req, tag):
+        shares = self._storage.corruption_registry.get_shares()
+        if not shares:
+            return tag("No shares have been reported as corrupt.")
+        rows = [T.tr(T.th("Storage Index"), T.th("Share"), T.th("Type"),
+                     T.th("Reports"), T.th("Latest Reason"),
+                     T.th("Quarantined"))]
+        for share in shares:
+            reports = share["reports"]
+            reasons = [r["reason"] for r in sorted(
+                reports.values(), key=lambda r: r["last_reported"])]
+            quarantined = "No"
+            if share["quarantined"] is not None:
+                quarantined = time_format.iso_utc(share["quarantined"],
+                                                  sep=" ")
+            rows.append(T.tr(T.td(share["storage_index"]),
+                             T.td("%d" % share["shnum"]),
+                             T.td(share["sharetype"]),
+                             T.td(", ".join("%s: %d" % (reporter, r["count"])
+                                            for (reporter, r)
+                                            in sorted(reports.items()))),
+                             T.td(reasons[-1] if reasons else ""),
+                             T.td(quarantined)))
+        return tag(T.table(rows, class_="corrupt-shares"))
+
     @renderer
     def count_crawler_status(self, req, tag):
-        p = self._storage.bucket_counter.get_progress()
+        crawler = self._storage.share_counter_crawler
+        if crawler is None or crawler.parent is None:
+            return tag("Counts are updated as shares are added and removed")
+        p = crawler.get_progress()
         return tag(self.format_crawler_progress(p))
 
     def format_crawler_progress(self, p):
@@ -310,10 +365,33 @@ class StorageStatus(MultiFormatResource):
     def render_HTML(self, req):
         return renderElement(req, StorageStatusElement(self._storage, self._nickname))
 
+    def _get_bucket_counter_state(self):
+        # "bucket-counter" was the state of the crawler which counted
+        # buckets before the server kept running counts. Keep its shape for
+        # the consumers which read it, with the count filled in from
+        # "share-counts".
+        crawler = self._storage.share_counter_crawler
+        if crawler is not None:
+            state = crawler.get_state()
+        else:
+            state = {"version": 1,
+                     "last-cycle-finished": None,
+                     "current-cycle": None,
+                     "last-complete-prefix": None,
+                     "last-complete-bucket": None,
+                     }
+        state["last-complete-bucket-count"] = \
+            self._storage.share_counter.get_total_bucket_count()
+        state["bucket-counts"] = {}
+        state["storage-index-samples"] = {}
+        return state
+
     def render_JSON(self, req):
         req.setHeader("content-type", "text/plain")
         d = {"stats": self._storage.get_stats(),
-             "bucket-counter": self._storage.bucket_counter.get_state(),
+             "bucket-counter": self._get_bucket_counter_state(),
+             "share-counts": self._storage.share_counter.get_counts(),
+             "corrupt-shares": self._storage.corruption_registry.get_shares(),
              "lease-checker": self._storage.lease_checker.get_state(),
              "lease-checker-progress": self._storage.lease_checker.get_progress(),
              }